@@ -9,10 +9,14 @@ from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
 from pydantic import BaseModel
+from collections import OrderedDict
 import os
+import time
 import logging
 
 from models import get_db, User
+from config import Config
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +25,9 @@ SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'jwt-secret-key-change-in-producti
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_HOURS = 24
 
+# Decoded tokens, so repeat requests skip JWT parsing and signature checks
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', '10000'))
+
 # SSO Cookie Configuration
 COOKIE_NAME = "eusuite_token"
 COOKIE_MAX_AGE = 86400  # 24 hours in seconds
@@ -33,6 +40,31 @@ class TokenData(BaseModel):
     user_id: Optional[int] = None
 
 
+_token_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+def decode_token(token: str) -> Optional[int]:
+    """
+    user_id of a valid token, None if it has none. Raises JWTError for
+    invalid or expired tokens. Results are kept in a small LRU until the
+    token expires; tokens are stateless, so this changes no outcome.
+    """
+    cached = _token_cache.get(token)
+    if cached is not None and cached[1] > time.time():
+        _token_cache.move_to_end(token)
+        metrics.AUTH_CACHE.inc(1, 'hit')
+        return cached[0]
+    metrics.AUTH_CACHE.inc(1, 'miss')
+    
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    user_id = payload.get("user_id")
+    if user_id is not None and payload.get("exp"):
+        _token_cache[token] = (user_id, payload["exp"])
+        while len(_token_cache) > AUTH_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return user_id
+
+
 def create_access_token(user_id: int) -> str:
     """
     Create a JWT access token
@@ -47,6 +79,14 @@ def create_access_token(user_id: int) -> str:
     return encoded_jwt
 
 
+def request_token(request: Request) -> Optional[str]:
+    """The token get_current_user would use: Bearer header first, then the SSO cookie"""
+    scheme, _, credentials = request.headers.get('authorization', '').partition(' ')
+    if scheme.lower() == 'bearer' and credentials:
+        return credentials
+    return request.cookies.get(COOKIE_NAME)
+
+
 async def get_current_user(
     request: Request,
     credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
@@ -88,8 +128,7 @@ async def get_current_user(
     
     # Validate JWT token
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: int = payload.get("user_id")
+        user_id: int = decode_token(token)
         
         if user_id is None:
             logger.warning("Token payload missing user_id")
@@ -110,6 +149,14 @@ async def get_current_user(
     return user
 
 
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    """Operators listed in ADMIN_EMAILS; everyone else gets 403"""
+    admins = {email.strip().lower() for email in Config.ADMIN_EMAILS.split(',') if email.strip()}
+    if (current_user.email or '').lower() not in admins:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
+
 def authenticate_user(db, email: str, password: str) -> Optional[User]:
     """Authenticate a user by email and password"""
     user = db.query(User).filter(User.email == email).first()
@@ -0,0 +1 @@
+# Benchmarks (run explicitly, not collected by the default pytest run)
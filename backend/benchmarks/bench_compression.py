@@ -0,0 +1,177 @@
+"""
+At-rest compression benchmark
+
+Writes a corpus through the local storage driver with and without zstd and
+reports, per document kind, the compression ratio and write/read throughput
+in MB/s of logical data. The synthetic corpus mimics what users actually store:
+EuType documents (JSON blocks of prose), EuSheets workbooks (JSON cell
+grids), application logs, CSV exports and Markdown notes. Point --corpus at
+a directory to measure real files instead (grouped by extension).
+
+Usage:
+    python benchmarks/bench_compression.py --docs 200 --levels 1 3 6
+    python benchmarks/bench_compression.py --corpus ~/Documents
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression
+from blobstore import BlobWriter, reset_blob_writer
+from config import Config
+from storage import LocalDriver
+
+WORDS = (
+    "the a of and to in is that for it as was with be by on not this are or at from but "
+    "report budget meeting project quarter revenue customer design review release plan "
+    "team decision deadline storage cloud document sheet invoice contract proposal draft "
+    "amsterdam rotterdam utrecht growth forecast risk action item follow owner status"
+).split()
+LEVELS = ('INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR')
+
+
+def sentence(rng):
+    words = rng.choices(WORDS, k=rng.randint(6, 20))
+    return ' '.join(words).capitalize() + '.'
+
+
+def eutype_document(rng):
+    blocks = []
+    for i in range(rng.randint(20, 200)):
+        kind = rng.choice(['paragraph', 'paragraph', 'paragraph', 'heading', 'list'])
+        if kind == 'list':
+            content = [sentence(rng) for _ in range(rng.randint(2, 6))]
+        else:
+            content = ' '.join(sentence(rng) for _ in range(rng.randint(1, 6)))
+        blocks.append({'id': f'b{i}', 'type': kind, 'content': content, 'marks': []})
+    return json.dumps({'title': sentence(rng), 'blocks': blocks}).encode()
+
+
+def eusheets_document(rng):
+    rows = []
+    for r in range(rng.randint(50, 800)):
+        rows.append([f'Item {r}', rng.choice(WORDS), round(rng.uniform(0, 10000), 2),
+                     rng.randint(0, 500), f'=C{r + 1}*D{r + 1}'])
+    return json.dumps({'sheets': [{'name': 'Sheet1', 'cells': rows}]}).encode()
+
+
+def log_file(rng):
+    now = datetime(2024, 1, 1)
+    lines = []
+    for _ in range(rng.randint(2000, 20000)):
+        now += timedelta(milliseconds=rng.randint(1, 5000))
+        lines.append(f"{now.isoformat()} {rng.choice(LEVELS):<7} [worker-{rng.randint(1, 8)}] "
+                     f"{rng.choice(['request', 'upload', 'sync', 'auth'])}: {sentence(rng)} "
+                     f"id={rng.getrandbits(32):08x} ms={rng.randint(1, 900)}")
+    return '\n'.join(lines).encode()
+
+
+def csv_file(rng):
+    lines = ['date,customer,product,quantity,unit_price,total']
+    day = datetime(2023, 1, 1)
+    for _ in range(rng.randint(1000, 20000)):
+        day += timedelta(minutes=rng.randint(1, 300))
+        quantity, price = rng.randint(1, 50), round(rng.uniform(1, 500), 2)
+        lines.append(f"{day:%Y-%m-%d},{rng.choice(WORDS)}-{rng.randint(1, 400)},"
+                     f"SKU{rng.randint(1000, 9999)},{quantity},{price},{quantity * price:.2f}")
+    return '\n'.join(lines).encode()
+
+
+def markdown_note(rng):
+    parts = []
+    for _ in range(rng.randint(5, 40)):
+        parts.append('## ' + sentence(rng))
+        parts.extend('- ' + sentence(rng) for _ in range(rng.randint(0, 5)))
+        parts.append(' '.join(sentence(rng) for _ in range(rng.randint(2, 8))))
+    return '\n\n'.join(parts).encode()
+
+
+GENERATORS = {
+    'eutype (.ty)': eutype_document,
+    'eusheets (.es)': eusheets_document,
+    'logs (.log)': log_file,
+    'csv (.csv)': csv_file,
+    'markdown (.md)': markdown_note,
+}
+
+
+def synthetic_corpus(n_docs, rng):
+    corpus = {}
+    for kind, generate in GENERATORS.items():
+        corpus[kind] = [generate(rng) for _ in range(n_docs)]
+    return corpus
+
+
+def directory_corpus(root):
+    corpus = {}
+    for directory, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(directory, name)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            extension = name.rsplit('.', 1)[-1].lower() if '.' in name else '(none)'
+            corpus.setdefault(f'.{extension}', []).append(data)
+    return corpus
+
+
+def measure(driver, documents, encoding):
+    keys = [f'bench/{i}.blob' for i in range(len(documents))]
+
+    started = time.perf_counter()
+    blobs = [driver.write_bytes(key, data, encoding) for key, data in zip(keys, documents)]
+    write_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for key, blob in zip(keys, blobs):
+        for _ in driver.iter_content(key, blob.encoding):
+            pass
+    read_seconds = time.perf_counter() - started
+
+    for key in keys:
+        driver.delete(key)
+    return sum(b.size for b in blobs), sum(b.stored_size for b in blobs), write_seconds, read_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=100, help='synthetic documents per kind')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 3, 6])
+    parser.add_argument('--corpus', help='benchmark the files under this directory instead')
+    args = parser.parse_args()
+
+    if compression.zstandard is None:
+        sys.exit("zstandard is not installed")
+
+    corpus = directory_corpus(args.corpus) if args.corpus else synthetic_corpus(args.docs, random.Random(42))
+    workdir = tempfile.mkdtemp(prefix='eucloud-bench-')
+    reset_blob_writer(BlobWriter(policy='none'))
+    driver = LocalDriver(workdir)
+    mb = 1024 * 1024
+
+    print(f"{'kind':<18}{'level':>6}{'logical MB':>12}{'stored MB':>11}{'ratio':>8}{'write MB/s':>12}{'read MB/s':>11}")
+    try:
+        for kind, documents in sorted(corpus.items()):
+            runs = [('raw', compression.IDENTITY)] + [(str(level), compression.ZSTD) for level in args.levels]
+            for label, encoding in runs:
+                if encoding == compression.ZSTD:
+                    Config.COMPRESSION_LEVEL = int(label)
+                logical, stored, write_s, read_s = measure(driver, documents, encoding)
+                print(f"{kind:<18}{label:>6}{logical / mb:>12.2f}{stored / mb:>11.2f}{logical / stored:>8.2f}"
+                      f"{logical / mb / write_s:>12.0f}{logical / mb / read_s:>11.0f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Server-side copy benchmark
+
+Copies blobs of several sizes through every mechanism the copy strategies
+use and reports milliseconds per copy, effective throughput and how much
+free disk space the copies consumed:
+
+- python:          the generic driver copy (read and write through Python)
+- read_write, sendfile, copy_file_range: the physical copies of LocalDriver.copy
+- hardlink:        LocalDriver.link
+- reflink:         LocalDriver.clone (skipped where the filesystem can't)
+
+Copy-on-write references copy nothing at all; their cost is one conditional
+UPDATE and one INSERT, so they are not measured here. Run with --dir on a
+btrfs or XFS (reflink=1) mount to see reflinks.
+
+Usage:
+    python benchmarks/bench_copy.py --sizes 1 16 256 --copies 10
+    python benchmarks/bench_copy.py --dir /mnt/btrfs/bench
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blobstore import BlobWriter, reset_blob_writer
+from storage import LocalDriver, StorageDriver
+from storage import copying
+
+
+def physical(method):
+    def run(driver, source_key, target_key):
+        with open(driver.path(source_key), 'rb') as source:
+            with driver.open_write(target_key) as blob:
+                size = os.fstat(source.fileno()).st_size
+                blob.file.flush()
+                method(source.fileno(), blob.file.fileno(), size)
+                blob.size = blob.stored_size = size
+        return True
+    return run
+
+
+def generic_copy(driver, source_key, target_key):
+    StorageDriver.copy(driver, source_key, target_key)
+    return True
+
+
+METHODS = {
+    'python': generic_copy,
+    'read_write': physical(copying.read_write),
+    'sendfile': physical(copying.sendfile),
+    'copy_file_range': physical(copying.copy_file_range),
+    'hardlink': LocalDriver.link,
+    'reflink': LocalDriver.clone,
+}
+
+
+def free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def measure(driver, method, source_key, copies):
+    """(seconds per copy, bytes of free space used per copy), or None if unsupported"""
+    keys = [f'bench/copies/{i}.bin' for i in range(copies)]
+    os.sync()
+    free_before = free_bytes(driver.root)
+    started = time.perf_counter()
+    for key in keys:
+        if not method(driver, source_key, key):
+            return None
+    elapsed = time.perf_counter() - started
+    os.sync()
+    used = free_before - free_bytes(driver.root)
+    for key in keys:
+        driver.delete(key)
+    return elapsed / copies, max(used, 0) / copies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 16, 128], help='blob sizes in MB')
+    parser.add_argument('--copies', type=int, default=5, help='copies per size and method')
+    parser.add_argument('--dir', help='directory on the filesystem to test (default: a temp dir)')
+    parser.add_argument('--methods', nargs='+', choices=list(METHODS), default=list(METHODS))
+    parser.add_argument('--fsync', choices=['always', 'batch', 'none'], default='none', help='blob writer fsync policy')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='eucloud-bench-', dir=args.dir)
+    reset_blob_writer(BlobWriter(policy=args.fsync))
+    driver = LocalDriver(workdir)
+    mb = 1024 * 1024
+
+    print(f"{'size MB':>8}  {'method':<16}{'ms/copy':>10}{'GB/s':>9}{'disk MB/copy':>14}")
+    try:
+        for size in args.sizes:
+            source_key = f'bench/source-{size}.bin'
+            with driver.open_write(source_key) as blob:
+                for _ in range(size):
+                    blob.write(os.urandom(mb))
+
+            for name in args.methods:
+                if name in copying.PHYSICAL_METHODS and name != 'read_write' and not hasattr(os, name):
+                    print(f"{size:>8}  {name:<16}{'n/a (not in this Python/OS)':>33}")
+                    continue
+                result = measure(driver, METHODS[name], source_key, args.copies)
+                if result is None:
+                    print(f"{size:>8}  {name:<16}{'n/a (filesystem)':>33}")
+                    continue
+                seconds, used = result
+                print(f"{size:>8}  {name:<16}{seconds * 1000:>10.2f}{size / 1024 / seconds:>9.2f}{used / mb:>14.2f}")
+            driver.delete(source_key)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Metrics overhead benchmark
+
+Drives a minimal FastAPI app directly over ASGI (no sockets, so the
+middleware is not lost in network noise) with and without
+MetricsMiddleware, and times SQLite queries on an engine with and without
+the query-timing listeners. Reports the added cost per request and per
+query; fails if the per-request overhead exceeds the budget.
+
+Usage:
+    python benchmarks/bench_metrics.py --requests 20000 --budget-us 50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import FastAPI
+from sqlalchemy import create_engine, event, text
+
+import metrics
+
+
+def make_app(instrumented: bool) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/api/items/{item_id}")
+    async def get_item(item_id: int):
+        return {"item_id": item_id, "name": "benchmark"}
+
+    if instrumented:
+        app.add_middleware(metrics.MetricsMiddleware)
+    return app
+
+
+async def drive(app, n: int) -> float:
+    """Seconds for n sequential GETs through the full ASGI stack"""
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        pass
+
+    def scope(i):
+        return {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': f'/api/items/{i}', 'raw_path': f'/api/items/{i}'.encode(),
+            'query_string': b'', 'headers': [(b'host', b'bench')], 'server': ('bench', 80),
+            'client': ('127.0.0.1', 1), 'root_path': '', 'app': app,
+        }
+
+    for i in range(200):  # warm up routing and the route-template cache
+        await app(scope(i), receive, send)
+    started = time.perf_counter()
+    for i in range(n):
+        await app(scope(i), receive, send)
+    return time.perf_counter() - started
+
+
+def time_queries(engine, n: int) -> float:
+    with engine.connect() as conn:
+        statement = text("SELECT 1")
+        for _ in range(200):
+            conn.execute(statement)
+        started = time.perf_counter()
+        for _ in range(n):
+            conn.execute(statement)
+        return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20_000)
+    parser.add_argument('--queries', type=int, default=50_000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--budget-us', type=float, default=50.0, help='fail if the per-request overhead exceeds this')
+    args = parser.parse_args()
+
+    plain, instrumented = make_app(False), make_app(True)
+    base_runs, metric_runs = [], []
+    for _ in range(args.rounds):  # interleaved, so drift hits both alike
+        base_runs.append(asyncio.run(drive(plain, args.requests)) / args.requests * 1e6)
+        metric_runs.append(asyncio.run(drive(instrumented, args.requests)) / args.requests * 1e6)
+    base, measured = statistics.median(base_runs), statistics.median(metric_runs)
+    overhead = measured - base
+
+    bare_engine = create_engine("sqlite://")
+    timed_engine = create_engine("sqlite://")
+    event.listen(timed_engine, 'before_cursor_execute', metrics._before_cursor_execute)
+    event.listen(timed_engine, 'after_cursor_execute', metrics._after_cursor_execute)
+    query_base = statistics.median(time_queries(bare_engine, args.queries) for _ in range(args.rounds)) / args.queries * 1e6
+    query_timed = statistics.median(time_queries(timed_engine, args.queries) for _ in range(args.rounds)) / args.queries * 1e6
+
+    metrics.REGISTRY.collectors.clear()  # they read the app database, not part of the overhead
+    started = time.perf_counter()
+    size = len(metrics.REGISTRY.render())
+    render_ms = (time.perf_counter() - started) * 1000
+
+    print(f"{'':<24}{'plain us':>10}{'metrics us':>12}{'overhead us':>13}")
+    print(f"{'request':<24}{base:>10.1f}{measured:>12.1f}{overhead:>13.1f}  ({overhead / base:.0%})")
+    print(f"{'query (SELECT 1)':<24}{query_base:>10.1f}{query_timed:>12.1f}{query_timed - query_base:>13.1f}")
+    print(f"\nScrape: {size:,} bytes rendered in {render_ms:.1f} ms")
+    print(f"Per-request overhead {overhead:.1f} us (budget {args.budget_us:.0f} us)")
+    sys.exit(0 if overhead <= args.budget_us else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+Microbenchmarks for CPU hot paths
+
+Times the functions that dominate CPU under load in isolation, with the
+same statistics pytest-benchmark reports (min/max/mean/stddev/median/IQR
+and ops per second over calibrated rounds):
+
+    to_dict      File.to_dict over listing-sized lists, and JSON-encoded
+    auth         jwt.decode, the decoded-token cache and get_current_user
+                 with its user lookup
+    redirect     normalize_redirect in routes/auth.py
+    thumbnail    generate_thumbnail per image size and format
+    upload       storage write throughput per chunk size (as the upload handler writes)
+    mimetypes    mimetypes.guess_type
+
+Each run is saved as a JSON artifact in pytest-benchmark's format (machine
+and commit info, one entry per benchmark), by default under
+benchmarks/results/<machine>/, so results can be tracked across commits
+and compared with `pytest-benchmark compare` or with --compare.
+
+Usage:
+    python benchmarks/bench_micro.py
+    python benchmarks/bench_micro.py --filter thumbnail --max-time 2
+    python benchmarks/bench_micro.py --compare benchmarks/results/<machine>/<earlier>.json --fail-over 0.2
+"""
+import argparse
+import datetime
+import gc
+import io
+import json
+import logging
+import mimetypes
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FORMAT_VERSION = '4.0.0'  # the pytest-benchmark JSON layout this mirrors
+
+
+class Runner:
+    """Calibrates iterations per round, then runs rounds until the time budget is spent"""
+
+    def __init__(self, min_round: float, max_time: float, min_rounds: int, selected: Optional[str]):
+        self.min_round = min_round
+        self.max_time = max_time
+        self.min_rounds = min_rounds
+        self.selected = selected
+        self.results: List[dict] = []
+
+    def wanted(self, group: str, name: str) -> bool:
+        return not self.selected or self.selected in f"{group}/{name}"
+
+    def bench(self, group: str, name: str, fn: Callable[[], object], params: Optional[dict] = None,
+              extra_info: Optional[Callable[[dict], dict]] = None):
+        if not self.wanted(group, name):
+            return
+        timer = time.perf_counter
+        fn()  # warm up caches and lazy imports
+
+        iterations = 1
+        while True:
+            started = timer()
+            for _ in range(iterations):
+                fn()
+            elapsed = timer() - started
+            if elapsed >= self.min_round or iterations >= 1 << 20:
+                break
+            iterations *= max(2, min(10, int(self.min_round / max(elapsed, 1e-9))))
+
+        timings = []
+        deadline = timer() + self.max_time
+        gc.collect()
+        while len(timings) < self.min_rounds or timer() < deadline:
+            started = timer()
+            for _ in range(iterations):
+                fn()
+            timings.append((timer() - started) / iterations)
+
+        stats = summarize(timings, iterations)
+        self.results.append({
+            'group': group, 'name': name, 'fullname': f"bench_micro.py::{group}::{name}",
+            'params': params, 'param': ','.join(f"{k}={v}" for k, v in (params or {}).items()) or None,
+            'stats': stats, 'options': {'timer': 'perf_counter', 'min_time': self.min_round,
+                                        'max_time': self.max_time, 'min_rounds': self.min_rounds},
+            'extra_info': extra_info(stats) if extra_info else {},
+        })
+        print(f"  {group:<10} {name:<34} median {fmt_time(stats['median']):>10}   "
+              f"iqr {fmt_time(stats['iqr']):>10}   {stats['ops']:>12,.1f} ops/s   {stats['rounds']} rounds")
+
+
+def summarize(timings: List[float], iterations: int) -> dict:
+    ordered = sorted(timings)
+    quartiles = statistics.quantiles(ordered, n=4) if len(ordered) > 1 else [ordered[0]] * 3
+    mean = statistics.fmean(ordered)
+    return {
+        'min': ordered[0], 'max': ordered[-1], 'mean': mean,
+        'stddev': statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+        'rounds': len(ordered), 'median': statistics.median(ordered),
+        'q1': quartiles[0], 'q3': quartiles[2], 'iqr': quartiles[2] - quartiles[0],
+        'iterations': iterations, 'ops': 1 / mean if mean else 0.0, 'total': sum(ordered) * iterations,
+    }
+
+
+def fmt_time(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+# --- Benchmarks ----------------------------------------------------------
+
+def bench_to_dict(runner: Runner, rng: random.Random):
+    from models import File
+
+    now = datetime.datetime.utcnow()
+    files = [
+        File(file_id=i, filename=f"file {i}.pdf", file_path=f"1/ab/cd/{uuid.uuid4().hex}.pdf",
+             file_size=rng.randint(1, 10 ** 8), mime_type='application/pdf', folder_id=rng.choice([None, 7]),
+             owner_id=1, thumbnail_path=None, is_deleted=False, is_favorite=rng.random() < 0.1,
+             content_version=rng.randint(1, 9), physical_size=None, created_at=now, modified_at=now)
+        for i in range(10_000)
+    ]
+    for count in (100, 1_000, 10_000):
+        subset = files[:count]
+        runner.bench('to_dict', f"File.to_dict[{count}]", lambda s=subset: [f.to_dict() for f in s],
+                     {'files': count}, lambda stats, c=count: {'per_file_us': stats['median'] / c * 1e6})
+    subset = files[:1_000]
+    runner.bench('to_dict', "File.to_dict+json.dumps[1000]",
+                 lambda: json.dumps({'files': [f.to_dict() for f in subset]}), {'files': 1_000})
+
+
+def bench_auth(runner: Runner, rng: random.Random):
+    from fastapi.security import HTTPAuthorizationCredentials
+    from jose import jwt
+    from starlette.requests import Request
+
+    import auth
+    from models import Base, SessionLocal, User, engine
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    user = User(email=f"bench-{uuid.uuid4().hex[:8]}@bench.local", password_hash='x')
+    db.add(user)
+    db.commit()
+    user_id = user.user_id
+    db.close()
+
+    token = auth.create_access_token(user_id)
+    runner.bench('auth', "jwt.decode", lambda: jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM]))
+
+    auth._token_cache.clear()
+    auth.decode_token(token)
+    runner.bench('auth', "decode_token[cached]", lambda: auth.decode_token(token))
+
+    request = Request({'type': 'http', 'headers': [], 'method': 'GET', 'path': '/'})
+    credentials = HTTPAuthorizationCredentials(scheme='Bearer', credentials=token)
+
+    def current_user(cache: bool):
+        if not cache:
+            auth._token_cache.clear()
+        session = SessionLocal()  # one per request, like get_db
+        try:
+            return run_coroutine(auth.get_current_user(request, credentials, session))
+        finally:
+            session.close()
+
+    runner.bench('auth', "get_current_user[cached token]", lambda: current_user(True))
+    runner.bench('auth', "get_current_user[cold token]", lambda: current_user(False))
+
+
+def run_coroutine(coroutine):
+    """Result of a coroutine that never suspends, without an event loop"""
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    raise RuntimeError("coroutine suspended")
+
+
+def bench_redirect(runner: Runner, rng: random.Random):
+    from routes.auth import normalize_redirect
+
+    cases = {
+        'default': None,
+        'relative': '/eutype/documents/42?tab=recent',
+        'absolute': 'https://evil.example.com/phish',
+        'traversal': '/cloud/../../etc/passwd',
+    }
+    for name, redirect in cases.items():
+        runner.bench('redirect', f"normalize_redirect[{name}]", lambda r=redirect: normalize_redirect(r))
+
+
+def bench_thumbnail(runner: Runner, rng: random.Random):
+    from storage import get_storage, get_thumbnail_storage, thumbnail_key
+    from tasks import generate_thumbnail
+
+    storage = get_storage()
+    for width, height in ((640, 480), (1920, 1080), (4032, 3024)):
+        image = synthetic_photo(width, height)
+        for image_format in ('JPEG', 'PNG', 'WEBP', 'GIF'):
+            buffer = io.BytesIO()
+            (image.convert('P') if image_format == 'GIF' else image).save(buffer, format=image_format)
+            key = f"bench/{width}x{height}.{image_format.lower()}"
+            storage.write_bytes(key, buffer.getvalue())
+            thumb = thumbnail_key(key)
+            runner.bench('thumbnail', f"generate_thumbnail[{width}x{height}-{image_format}]",
+                         lambda k=key, t=thumb: generate_thumbnail(k, t),
+                         {'size': f"{width}x{height}", 'format': image_format},
+                         lambda stats, n=len(buffer.getvalue()): {'source_bytes': n})
+            get_thumbnail_storage().delete(thumb)
+
+
+def synthetic_photo(width: int, height: int):
+    """Smooth gradients with sensor-like noise: compresses like a photo, unlike pure noise"""
+    from PIL import Image
+
+    gradient = Image.linear_gradient('L').resize((width, height))
+    radial = Image.radial_gradient('L').resize((width, height))
+    base = Image.merge('RGB', (gradient, radial, gradient.transpose(Image.Transpose.ROTATE_180)))
+    noise = Image.effect_noise((width, height), 32).convert('RGB')
+    return Image.blend(base, noise, 0.15)
+
+
+def bench_upload(runner: Runner, rng: random.Random):
+    from storage import get_storage
+
+    storage = get_storage()
+    total = 16 * 1024 * 1024
+    payload = memoryview(rng.randbytes(total))
+
+    def write(chunk_size: int):
+        key = f"bench/upload-{uuid.uuid4().hex}.bin"
+        blob = storage.open_write(key)
+        for offset in range(0, total, chunk_size):
+            blob.write(payload[offset:offset + chunk_size])
+        blob.commit()
+        storage.delete(key)  # keeps the disk footprint flat; an unlink is noise next to 16 MB
+
+    for chunk_size in (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+        runner.bench('upload', f"write[{chunk_size // 1024}K chunks]", lambda c=chunk_size: write(c),
+                     {'chunk_size': chunk_size, 'bytes': total},
+                     lambda stats: {'mb_per_s': total / stats['median'] / 1e6})
+
+
+def bench_mimetypes(runner: Runner, rng: random.Random):
+    mimetypes.init()
+    names = [f"{rng.choice(['Report', 'IMG_2041', 'notes', 'archive.tar', 'budget 2024'])}"
+             f"{rng.choice(['.pdf', '.jpg', '.JPG', '.docx', '.gz', '.ty', '.csv', '', '.unknownext'])}"
+             for _ in range(1_000)]
+    runner.bench('mimetypes', "guess_type[1000 names]", lambda: [mimetypes.guess_type(n) for n in names],
+                 {'names': len(names)}, lambda stats: {'per_name_us': stats['median'] / len(names) * 1e6})
+
+
+BENCHMARKS = [bench_to_dict, bench_auth, bench_redirect, bench_thumbnail, bench_upload, bench_mimetypes]
+
+
+# --- Artifacts -----------------------------------------------------------
+
+def git(*args) -> str:
+    try:
+        return subprocess.run(['git', *args], cwd=BENCH_DIR, capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def machine_info() -> dict:
+    return {
+        'node': platform.node(), 'processor': platform.processor(), 'machine': platform.machine(),
+        'python_implementation': platform.python_implementation(), 'python_version': platform.python_version(),
+        'system': platform.system(), 'release': platform.release(), 'cpu': {'count': os.cpu_count()},
+    }
+
+
+def commit_info() -> dict:
+    return {
+        'id': git('rev-parse', 'HEAD'), 'branch': git('rev-parse', '--abbrev-ref', 'HEAD'),
+        'time': git('log', '-1', '--format=%cI'), 'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+    }
+
+
+def default_artifact_path(info: dict) -> str:
+    machine = f"{info['system']}-{info['python_implementation']}-{info['python_version']}-{info['machine']}"
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    sha = (git('rev-parse', '--short', 'HEAD') or 'nogit')
+    return os.path.join(BENCH_DIR, 'results', machine, f"{stamp}_{sha}.json")
+
+
+def compare(results: List[dict], previous_path: str, fail_over: Optional[float]) -> int:
+    with open(previous_path) as f:
+        previous: Dict[str, dict] = {b['fullname']: b['stats'] for b in json.load(f)['benchmarks']}
+    print(f"\nMedian vs {os.path.basename(previous_path)}:")
+    regressions = 0
+    for result in results:
+        before = previous.get(result['fullname'])
+        if before is None:
+            continue
+        change = result['stats']['median'] / before['median'] - 1
+        flag = ''
+        if fail_over is not None and change > fail_over:
+            flag, regressions = '  REGRESSION', regressions + 1
+        print(f"  {result['group']:<10} {result['name']:<34} {fmt_time(before['median']):>10} -> "
+              f"{fmt_time(result['stats']['median']):>10}  {change:+.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', help='only benchmarks whose group/name contains this')
+    parser.add_argument('--min-round', type=float, default=0.005, help='seconds; iterations are batched up to this')
+    parser.add_argument('--max-time', type=float, default=1.0, help='seconds of rounds per benchmark')
+    parser.add_argument('--min-rounds', type=int, default=5)
+    parser.add_argument('--json', help='artifact path (default: benchmarks/results/<machine>/<time>_<commit>.json)')
+    parser.add_argument('--compare', help='earlier artifact to compare medians with')
+    parser.add_argument('--fail-over', type=float, help='with --compare: exit 1 if a median grew by more than this')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # The app's log format and level, written nowhere: formatting stays in the
+    # measurement without flooding the terminal (main.py's basicConfig is then a no-op)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        handlers=[logging.StreamHandler(open(os.devnull, 'w'))])
+
+    # Throwaway database and storage, set up before the app modules are imported
+    workdir = tempfile.mkdtemp(prefix='eucloud-micro-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    from config import Config
+    from storage import reset_storage
+    Config.UPLOAD_FOLDER = os.path.join(workdir, 'uploads')
+    Config.THUMBNAIL_FOLDER = os.path.join(workdir, 'thumbnails')
+    Config.init_app(None)
+    reset_storage()
+
+    runner = Runner(args.min_round, args.max_time, args.min_rounds, args.filter)
+    started = time.perf_counter()
+    try:
+        for benchmark in BENCHMARKS:
+            benchmark(runner, random.Random(args.seed))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if not runner.results:
+        raise SystemExit(f"No benchmark matches {args.filter!r}")
+
+    info = machine_info()
+    artifact = {
+        'machine_info': info, 'commit_info': commit_info(), 'benchmarks': runner.results,
+        'datetime': datetime.datetime.utcnow().isoformat(), 'version': FORMAT_VERSION,
+    }
+    path = args.json or default_artifact_path(info)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(artifact, f, indent=2)
+        f.write('\n')
+    print(f"\n{len(runner.results)} benchmarks in {time.perf_counter() - started:.0f}s; saved {path}")
+
+    if args.compare and compare(runner.results, args.compare, args.fail_over):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
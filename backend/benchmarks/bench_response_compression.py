@@ -0,0 +1,122 @@
+"""
+Response compression benchmark
+
+What compressing a response costs in CPU against the bytes it saves, per
+encoding and level, on the bodies the API sends most: /api/files/list
+listings of typical folder sizes (built with File.to_dict and serialized
+the way FastAPI does) and /content responses of EuType documents. For each
+it reports the body size, the compressed size and ratio, the compression
+time per response, throughput, and CPU microseconds spent per KB saved,
+plus what a repeated body costs when its compressed variant is cached
+(a sha256 hash). Encodings whose package isn't installed are skipped.
+
+Usage:
+    python benchmarks/bench_response_compression.py
+    python benchmarks/bench_response_compression.py --files 10 100 1000 --levels gzip:1,6 zstd:1,3 br:4,11
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpcompression
+from benchmarks.bench_compression import eutype_document
+from config import Config
+from models import File, Folder
+
+MIME_TYPES = ('application/pdf', 'image/jpeg', 'image/png', 'text/plain', 'application/json',
+              'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+NAMES = ('report', 'invoice', 'photo', 'notes', 'budget', 'contract', 'scan', 'draft', 'export')
+DEFAULT_LEVELS = ['gzip:1,6,9', 'zstd:1,3,6', 'br:1,4,11']
+
+
+def serialize(content) -> bytes:
+    # As fastapi.responses.JSONResponse renders it
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode()
+
+
+def listing(n_files: int, rng: random.Random) -> bytes:
+    now = datetime.datetime(2024, 5, 1)
+    files = []
+    for i in range(n_files):
+        modified = now - datetime.timedelta(seconds=rng.randint(0, 10 ** 7))
+        mime_type = rng.choice(MIME_TYPES)
+        files.append(File(
+            file_id=10_000 + i, filename=f"{rng.choice(NAMES)} {rng.randint(1, 999)}.{mime_type.rsplit('/', 1)[-1][:4]}",
+            file_path=f"1/ab/cd/{uuid.UUID(int=rng.getrandbits(128)).hex}", file_size=rng.randint(1, 10 ** 8),
+            mime_type=mime_type, folder_id=None, owner_id=1, thumbnail_path=None, is_deleted=False,
+            is_favorite=rng.random() < 0.1, content_version=rng.randint(1, 9), physical_size=None,
+            created_at=modified, modified_at=modified))
+    folders = [Folder(folder_id=500 + i, folder_name=f"{rng.choice(NAMES).title()} {i}", owner_id=1,
+                      parent_folder_id=None, created_at=now) for i in range(max(1, n_files // 10))]
+    return serialize({'files': [f.to_dict(include_tags=True) for f in files],
+                      'folders': [f.to_dict() for f in folders]})
+
+
+def document(rng: random.Random) -> bytes:
+    return serialize({'file_id': 1, 'filename': 'Plan.ty', 'content': eutype_document(rng).decode(),
+                      'app_type': 'eutype', 'version': 3, 'modified_at': '2024-05-01T12:00:00'})
+
+
+def timed(fn, body: bytes, min_time: float) -> float:
+    """Seconds per call, over enough calls to take at least min_time"""
+    fn(body)
+    calls, started = 0, time.perf_counter()
+    while True:
+        fn(body)
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return elapsed / calls
+
+
+def parse_levels(specs):
+    levels = []
+    for spec in specs:
+        encoding, _, values = spec.partition(':')
+        levels.extend((encoding, int(level)) for level in values.split(','))
+    return levels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, nargs='+', default=[10, 50, 200, 1000], help='files per listing')
+    parser.add_argument('--documents', type=int, default=3, help='EuType documents to measure')
+    parser.add_argument('--levels', nargs='+', default=DEFAULT_LEVELS, help='encoding:level,level...')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds spent timing each measurement')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    bodies = [(f"listing[{n}]", listing(n, rng)) for n in args.files]
+    bodies += [(f"eutype doc {i + 1}", document(rng)) for i in range(args.documents)]
+
+    Config.RESPONSE_COMPRESSION_ENCODINGS = 'br,zstd,gzip'
+    installed = set(httpcompression.available_encodings())
+    levels = [(encoding, level) for encoding, level in parse_levels(args.levels) if encoding in installed]
+    skipped = sorted({encoding for encoding, _ in parse_levels(args.levels)} - installed)
+    if skipped:
+        print(f"(not installed, skipped: {', '.join(skipped)})")
+
+    print(f"{'body':<18}{'enc':>6}{'level':>6}{'KB':>9}{'out KB':>9}{'ratio':>7}{'us/resp':>10}{'MB/s':>8}{'us/KB saved':>13}")
+    for name, body in bodies:
+        cached = timed(lambda b: hashlib.sha256(b).digest(), body, args.min_time)
+        for encoding, level in levels:
+            Config.RESPONSE_COMPRESSION_LEVELS = {**Config.RESPONSE_COMPRESSION_LEVELS, encoding: level}
+            out = httpcompression.compress(body, encoding)
+            seconds = timed(lambda b: httpcompression.compress(b, encoding), body, args.min_time)
+            saved_kb = (len(body) - len(out)) / 1024
+            print(f"{name:<18}{encoding:>6}{level:>6}{len(body) / 1024:>9.1f}{len(out) / 1024:>9.1f}"
+                  f"{len(body) / len(out):>7.1f}{seconds * 1e6:>10.0f}{len(body) / seconds / 1e6:>8.0f}"
+                  f"{seconds * 1e6 / saved_kb if saved_kb > 0 else float('inf'):>13.2f}")
+        print(f"{name:<18}{'cached variant (hash only)':>29}{'':>16}{cached * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
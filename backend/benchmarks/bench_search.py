@@ -0,0 +1,143 @@
+"""
+Search latency benchmark
+
+Seeds a throwaway SQLite database with a synthetic corpus (filenames drawn
+from a word list, random tags/sizes/mime types, a long-tailed distribution
+of files per user), builds the search index and reports query latency
+percentiles for typical searches of a heavy user.
+
+Usage:
+    python benchmarks/bench_search.py --files 1000000 --users 2000
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, insert
+
+from models import Base, User, Folder, File
+from search import SearchFilters, get_search_index
+
+WORDS = (
+    "report invoice budget holiday photo scan contract draft final notes meeting agenda "
+    "summary project alpha beta gamma roadmap design spec review backup archive export "
+    "presentation slides budget2024 taxes receipt travel amsterdam rotterdam utrecht paris "
+    "berlin family wedding birthday video music podcast thesis chapter manuscript resume "
+    "letter offer quote planning sprint retro kpi forecast sales marketing hr payroll"
+).split()
+MIME_TYPES = ['application/pdf', 'image/jpeg', 'image/png', 'text/plain', 'video/mp4',
+              'application/json', 'application/zip', 'text/csv']
+
+
+def seed(engine, n_files, n_users, rng):
+    Base.metadata.create_all(bind=engine)
+    index = get_search_index(engine)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {'user_id': u, 'email': f'user{u}@bench.local', 'password_hash': 'x'}
+            for u in range(1, n_users + 1)
+        ])
+        conn.execute(insert(Folder), [
+            {'folder_id': u, 'folder_name': 'root', 'owner_id': u}
+            for u in range(1, n_users + 1)
+        ])
+
+    # Zipf-ish ownership: user 1 is the heavy user every query is run against
+    weights = [1.0 / (u ** 0.8) for u in range(1, n_users + 1)]
+    batch = 20_000
+    for start in range(0, n_files, batch):
+        owners = rng.choices(range(1, n_users + 1), weights=weights, k=min(batch, n_files - start))
+        rows, docs = [], []
+        for offset, owner in enumerate(owners):
+            file_id = start + offset + 1
+            name = ' '.join(rng.sample(WORDS, 3)) + rng.choice(['.pdf', '.jpg', '.txt', '.ty', '.csv'])
+            rows.append({
+                'file_id': file_id, 'filename': name, 'file_path': f'{owner}/{file_id}',
+                'file_size': rng.randint(100, 50_000_000), 'mime_type': rng.choice(MIME_TYPES),
+                'folder_id': owner if rng.random() < 0.5 else None, 'owner_id': owner,
+                'app_type': 'generic', 'is_deleted': False, 'is_favorite': rng.random() < 0.05,
+                'created_at': now, 'modified_at': now - timedelta(days=rng.randint(0, 1000)),
+            })
+            docs.append({'file_id': file_id, 'owner_id': owner, 'filename': name,
+                         'tags': ' '.join(rng.sample(WORDS, rng.randint(0, 2))), 'comments': '', 'content': ''})
+        with engine.begin() as conn:
+            conn.execute(insert(File), rows)
+            index.write_documents(conn, docs)
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            conn.exec_driver_sql("INSERT INTO search_index(search_index) VALUES('optimize')")
+            conn.exec_driver_sql("ANALYZE")
+
+
+def run_queries(engine, rounds, rng):
+    index = get_search_index(engine)
+    cases = {
+        'single word': lambda: ([rng.choice(WORDS)], SearchFilters()),
+        'prefix (3 chars)': lambda: ([rng.choice(WORDS)[:3]], SearchFilters()),
+        'two words': lambda: (rng.sample(WORDS, 2), SearchFilters()),
+        'word + mime filter': lambda: ([rng.choice(WORDS)], SearchFilters(mime_type='image/')),
+        'word + folder subtree': lambda: ([rng.choice(WORDS)], SearchFilters(folder_id=1)),
+        'word + size/date/favorite': lambda: ([rng.choice(WORDS)], SearchFilters(
+            min_size=1_000_000, modified_after=datetime.utcnow() - timedelta(days=365), favorite=False)),
+    }
+    results = {}
+    with engine.connect() as conn:
+        for label, make in cases.items():
+            timings = []
+            for _ in range(rounds):
+                terms, filters = make()
+                started = time.perf_counter()
+                index.match(conn, 1, terms, filters, 50, 0)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            results[label] = {
+                'p50': statistics.median(timings),
+                'p95': timings[int(len(timings) * 0.95) - 1],
+                'p99': timings[int(len(timings) * 0.99) - 1],
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=200_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--budget-ms', type=float, default=50.0, help='fail if any p95 exceeds this')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    workdir = tempfile.mkdtemp(prefix='eucloud-bench-')
+    engine = create_engine(f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+
+    started = time.perf_counter()
+    seed(engine, args.files, args.users, rng)
+    with engine.connect() as conn:
+        heavy = conn.exec_driver_sql("SELECT count(*) FROM files WHERE owner_id = 1").scalar()
+    print(f"Seeded {args.files:,} files for {args.users:,} users in {time.perf_counter() - started:.1f}s "
+          f"(heavy user owns {heavy:,})")
+
+    results = run_queries(engine, args.rounds, rng)
+    print(f"\n{'query':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for label, r in results.items():
+        print(f"{label:<28}{r['p50']:>10.2f}{r['p95']:>10.2f}{r['p99']:>10.2f}")
+
+    engine.dispose()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    worst = max(r['p95'] for r in results.values())
+    print(f"\nWorst p95: {worst:.2f} ms (budget {args.budget_ms:.0f} ms)")
+    sys.exit(0 if worst <= args.budget_ms else 1)
+
+
+if __name__ == '__main__':
+    main()
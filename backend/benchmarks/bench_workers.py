@@ -0,0 +1,196 @@
+"""
+Worker scaling benchmark
+
+Starts the API as a real server with 1, 2, 4 and 8 worker processes
+(gunicorn with gunicorn.conf.py; uvicorn --workers where gunicorn is not
+installed) on a seeded throwaway dataset, drives the same mixed workload
+at each size with the load test's virtual users (see loadtest.py) and
+reports throughput, latency and scaling efficiency against one worker.
+
+Load comes from --generators separate processes so the client side is not
+what saturates first; still, on a machine with few cores the generators
+compete with the workers they measure. Run it on a box with more cores
+than the largest worker count, or point real load at a real deployment.
+The SQLite database is switched to WAL so concurrent workers don't lock
+each other out on reads.
+
+Usage:
+    python benchmarks/bench_workers.py --workers 1 2 4 8 --duration 20 --concurrency 64
+    python benchmarks/bench_workers.py --server uvicorn --report /tmp/scaling.json
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import shutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import httpx
+
+import loadtest
+
+DEFAULT_MIX = 'list=40,download=20,share=20,autosave=10,upload=5,login=5,trash_purge=0'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(server: str, workers: int, port: int, env: dict) -> subprocess.Popen:
+    env = {**env, 'WEB_CONCURRENCY': str(workers), 'BIND': f'127.0.0.1:{port}'}
+    if workers > 1:
+        # What gunicorn.conf.py defaults to; uvicorn needs telling
+        env.setdefault('SHARED_STATE', 'shm')
+        env.setdefault('CHANGE_BROKER', 'shared')
+        env.setdefault('SHARED_STATE_PATH', os.path.join(env['BENCH_WORKDIR'], f'state-{port}.db'))
+    if server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'main:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port),
+                   '--workers', str(workers), '--log-level', 'warning', '--no-access-log']
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            start_new_session=True)
+
+
+def wait_until_up(process: subprocess.Popen, url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited: {process.stderr.read().decode(errors='replace')[-2000:]}")
+        try:
+            if httpx.get(f'{url}/health', timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not come up")
+
+
+def stop_server(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def generate(url: str, manifest: dict, mix: dict, duration: float, concurrency: int, seed: int) -> dict:
+    """One load generator process; returns raw latencies so percentiles merge exactly"""
+    async def run():
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=url, timeout=60, limits=limits) as client:
+            return await loadtest.drive(client, manifest, mix, duration, concurrency, seed)
+
+    recorder, elapsed = asyncio.run(run())
+    return {'latencies': dict(recorder.latencies), 'errors': dict(recorder.errors), 'elapsed': elapsed}
+
+
+def measure(url: str, manifest: dict, mix: dict, args) -> dict:
+    per_generator = max(1, args.concurrency // args.generators)
+    with multiprocessing.get_context('spawn').Pool(args.generators) as pool:
+        parts = pool.starmap(generate, [(url, manifest, mix, args.duration, per_generator, args.seed + 1000 * g)
+                                        for g in range(args.generators)])
+    recorder = loadtest.Recorder()
+    for part in parts:
+        for workload, timings in part['latencies'].items():
+            recorder.latencies[workload].extend(timings)
+        for workload, count in part['errors'].items():
+            recorder.errors[workload] += count
+    elapsed = max(part['elapsed'] for part in parts)
+    timings = sorted(t for values in recorder.latencies.values() for t in values)
+    return {
+        'requests': len(timings),
+        'errors': sum(recorder.errors.values()),
+        'throughput': round(len(timings) / elapsed, 1),
+        'p50_ms': round(loadtest.percentile(timings, 50), 1),
+        'p95_ms': round(loadtest.percentile(timings, 95), 1),
+        'p99_ms': round(loadtest.percentile(timings, 99), 1),
+        'workloads': recorder.summary(elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--server', choices=('auto', 'gunicorn', 'uvicorn'), default='auto')
+    parser.add_argument('--scale', choices=('tiny', 'small', 'medium', 'large'), default='small')
+    parser.add_argument('--duration', type=float, default=15.0, help='seconds per worker count')
+    parser.add_argument('--concurrency', type=int, default=64, help='virtual users in total')
+    parser.add_argument('--generators', type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                        help='load generator processes')
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--report', help='write the results as JSON')
+    args = parser.parse_args()
+
+    server = args.server
+    if server == 'auto':
+        server = 'gunicorn' if importlib.util.find_spec('gunicorn') else 'uvicorn'
+    mix = dict(loadtest.DEFAULT_MIX)
+    for item in args.mix.split(','):
+        name, _, weight = item.partition('=')
+        mix[name] = int(weight)
+    mix = {name: weight for name, weight in mix.items() if weight > 0}
+
+    workdir = tempfile.mkdtemp(prefix='eucloud-workers-')
+    database = os.path.join(workdir, 'bench.db')
+    manifest_path = os.path.join(workdir, 'manifest.json')
+    env = {
+        **os.environ, 'BENCH_WORKDIR': workdir, 'DATABASE_URL': f'sqlite:///{database}',
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'), 'THUMBNAIL_FOLDER': os.path.join(workdir, 'thumbnails'),
+    }
+    results = []
+    try:
+        subprocess.run([sys.executable, os.path.join(BENCH_DIR, 'loadtest_seed.py'), '--scale', args.scale,
+                        '--upload-folder', env['UPLOAD_FOLDER'], '--manifest', manifest_path],
+                       cwd=BACKEND_DIR, env=env, check=True)
+        with sqlite3.connect(database) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        print(f"\n{server}, {args.concurrency} virtual users from {args.generators} generator(s), "
+              f"{args.duration:.0f}s per size, {os.cpu_count()} CPUs")
+        print(f"{'workers':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'speedup':>9}{'efficiency':>12}")
+        for workers in args.workers:
+            port = free_port()
+            process = start_server(server, workers, port, env)
+            try:
+                url = f'http://127.0.0.1:{port}'
+                wait_until_up(process, url)
+                result = {'workers': workers, **measure(url, manifest, mix, args)}
+            finally:
+                stop_server(process)
+            results.append(result)
+            speedup = result['throughput'] / results[0]['throughput'] if results[0]['throughput'] else 0.0
+            result['speedup'] = round(speedup, 2)
+            result['efficiency'] = round(speedup * results[0]['workers'] / workers, 2)
+            print(f"{workers:>8}{result['throughput']:>10.1f}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+                  f"{result['p99_ms']:>10.1f}{result['errors']:>8}{speedup:>8.2f}x{result['efficiency']:>11.0%}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'server': server, 'cpus': os.cpu_count(), 'scale': args.scale, 'mix': mix,
+                       'concurrency': args.concurrency, 'duration': args.duration, 'results': results}, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""
+End-to-end load test
+
+Drives a weighted mix of realistic workloads with N concurrent virtual
+users (closed loop: each user sends its next request when the previous
+one finishes) and reports throughput and p50/p95/p99 latency per
+workload. Each virtual user logs in as a seeded user and then works on
+that user's data:
+
+    login       POST /api/auth/login (Argon2 verify)
+    list        GET  /api/files/list in a random folder of a deep tree
+    download    GET  /api/files/{id}/download of a 16 KB - 1 MB blob
+    upload      POST /api/files/upload of 64 KB
+    autosave    PATCH /api/files/{id}/content with a small text edit (If-Match chained)
+    trash_purge DELETE a file uploaded earlier, then purge it from the trash
+    share       GET  /api/shares/{id} without credentials
+
+Two targets:
+  in-process (default): seeds a throwaway SQLite database and upload folder
+    (see loadtest_seed.py) and calls the ASGI app directly, lifespan included.
+  --url: a running server over HTTP. Seed its database first with
+    loadtest_seed.py and pass the manifest.
+
+Results can be saved as a baseline and compared on later runs; a workload
+whose p95 grows or whose throughput drops by more than --tolerance fails
+the run. Baselines are only comparable on the same machine and settings.
+
+One worker process runs out of database connections (pool of 5 + 10
+overflow) with more than about 15 requests in flight: a blocked checkout
+holds the event loop that the requests holding connections need. Keep
+--concurrency below that for in-process runs.
+
+Usage:
+    python benchmarks/loadtest.py --scale small --duration 30 --concurrency 12
+    python benchmarks/loadtest.py --save-baseline benchmarks/baselines/loadtest-small.json
+    python benchmarks/loadtest.py --baseline benchmarks/baselines/loadtest-small.json
+    python benchmarks/loadtest.py --url http://localhost:5000 --manifest /tmp/eucloud-load.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+DEFAULT_MIX = {'list': 30, 'download': 20, 'autosave': 20, 'upload': 8, 'share': 10, 'trash_purge': 5, 'login': 7}
+UPLOAD_SIZE = 64 * 1024
+MIN_SAMPLES = 50  # fewer requests than this make a p95 too noisy to compare
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+
+    def add(self, workload: str, seconds: float, status: int, ok: bool):
+        self.latencies[workload].append(seconds * 1000)
+        self.statuses[workload][status] += 1
+        if not ok:
+            self.errors[workload] += 1
+
+    def summary(self, elapsed: float) -> Dict[str, dict]:
+        results = {}
+        for workload, timings in sorted(self.latencies.items()):
+            timings = sorted(timings)
+            results[workload] = {
+                'requests': len(timings),
+                'errors': self.errors[workload],
+                'throughput': round(len(timings) / elapsed, 2),
+                'p50_ms': round(statistics.median(timings), 2),
+                'p95_ms': round(percentile(timings, 95), 2),
+                'p99_ms': round(percentile(timings, 99), 2),
+                'statuses': {str(code): n for code, n in sorted(self.statuses[workload].items())},
+            }
+        return results
+
+
+def percentile(ordered: List[float], pct: float) -> float:
+    if not ordered:
+        return 0.0
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def token_from(response: httpx.Response) -> Optional[str]:
+    """The SSO cookie's value, read from Set-Cookie (its domain would not match a test host)"""
+    for header in response.headers.get_list('set-cookie'):
+        name, _, rest = header.partition('=')
+        if name.strip() == 'eusuite_token':
+            return rest.split(';', 1)[0]
+    return None
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, account: dict, password: str, shares: List[str],
+                 recorder: Recorder, rng: random.Random):
+        self.client = client
+        self.account = account
+        self.password = password
+        self.shares = shares
+        self.recorder = recorder
+        self.rng = rng
+        self.headers: Dict[str, str] = {}
+        self.etag: Optional[str] = None
+        self.uploaded: List[int] = []
+
+    async def timed(self, workload: str, method: str, url: str, expect=(200,), **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.recorder.add(workload, time.perf_counter() - started, 0, False)
+            raise
+        self.recorder.add(workload, time.perf_counter() - started, response.status_code, response.status_code in expect)
+        return response
+
+    async def login(self):
+        response = await self.timed('login', 'POST', '/api/auth/login',
+                                    json={'email': self.account['email'], 'password': self.password})
+        token = token_from(response)
+        if token:
+            self.headers = {'Authorization': f'Bearer {token}'}
+
+    async def list(self):
+        folder = self.rng.choice(self.account['folders'] + [None])
+        params = {'folder_id': folder} if folder else {}
+        await self.timed('list', 'GET', '/api/files/list', params=params, headers=self.headers)
+
+    async def download(self):
+        file_id = self.rng.choice(self.account['hot_files'])
+        await self.timed('download', 'GET', f'/api/files/{file_id}/download', headers=self.headers,
+                         expect=(200, 302, 307))
+
+    async def upload(self):
+        response = await self.timed(
+            'upload', 'POST', '/api/files/upload', expect=(201,), headers=self.headers,
+            files={'file': (f'load-{self.rng.getrandbits(32):08x}.bin', self.rng.randbytes(UPLOAD_SIZE))},
+            data={'folder_id': str(self.account['upload_folder_id'])})
+        if response.status_code == 201:
+            self.uploaded.append(response.json()['file']['file_id'])
+
+    async def autosave(self):
+        document = self.account['document_id']
+        if self.etag is None:
+            self.etag = f'"{document}-1"'
+        response = await self.timed(
+            'autosave', 'PATCH', f'/api/files/{document}/content', expect=(200, 412),
+            headers={**self.headers, 'If-Match': self.etag},
+            json={'format': 'text', 'patch': [{'offset': self.rng.randint(0, 10_000), 'delete': 5, 'insert': 'edit!'}]})
+        if response.status_code == 200:
+            self.etag = response.headers.get('ETag')
+        else:  # another virtual user on the same account saved first
+            current = await self.client.get(f'/api/files/{document}/content', headers=self.headers)
+            self.etag = current.headers.get('ETag')
+
+    async def trash_purge(self):
+        if not self.uploaded:
+            return await self.upload()
+        file_id = self.uploaded.pop()
+        await self.timed('trash_purge', 'DELETE', f'/api/files/{file_id}', headers=self.headers)
+        await self.timed('trash_purge', 'DELETE', f'/api/trash/permanent/{file_id}', headers=self.headers)
+
+    async def share(self):
+        await self.timed('share', 'GET', f'/api/shares/{self.rng.choice(self.shares)}')
+
+    async def run(self, mix: Dict[str, int], deadline: float):
+        await self.login()
+        workloads, weights = list(mix), list(mix.values())
+        while time.perf_counter() < deadline:
+            workload = self.rng.choices(workloads, weights=weights)[0]
+            try:
+                await getattr(self, workload)()
+            except httpx.HTTPError:
+                await asyncio.sleep(0.05)
+
+
+async def drive(client: httpx.AsyncClient, manifest: dict, mix: Dict[str, int], duration: float,
+                concurrency: int, seed: int) -> tuple:
+    recorder = Recorder()
+    accounts = manifest['users']
+    deadline = time.perf_counter() + duration
+    started = time.perf_counter()
+    users = [VirtualUser(client, accounts[i % len(accounts)], manifest['password'], manifest['shares'],
+                         recorder, random.Random(seed + i))
+             for i in range(concurrency)]
+    await asyncio.gather(*(user.run(mix, deadline) for user in users))
+    return recorder, time.perf_counter() - started
+
+
+@contextlib.asynccontextmanager
+async def in_process_client(scale: str, seed: int):
+    """Throwaway database and upload folder, seeded, with the app's lifespan running"""
+    workdir = tempfile.mkdtemp(prefix='eucloud-load-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    from config import Config
+    from storage import reset_storage
+    Config.UPLOAD_FOLDER = os.path.join(workdir, 'uploads')
+    Config.THUMBNAIL_FOLDER = os.path.join(workdir, 'thumbnails')
+    Config.init_app(None)
+    reset_storage()
+
+    import loadtest_seed
+    import main as app_module
+    logging.getLogger().setLevel(logging.WARNING)  # the app logs every login at INFO
+    logging.getLogger('profiler').setLevel(logging.ERROR)  # stalls are counted in the report instead
+
+    started = time.perf_counter()
+    manifest = loadtest_seed.seed(scale, random.Random(seed))
+    print(f"Seeded {', '.join(f'{n:,} {kind}' for kind, n in manifest['counts'].items())} "
+          f"in {time.perf_counter() - started:.1f}s")
+    try:
+        async with app_module.lifespan(app_module.app):
+            # Unhandled exceptions become 500s and count as errors, as they would behind a server
+            transport = httpx.ASGITransport(app=app_module.app, raise_app_exceptions=False)
+            async with httpx.AsyncClient(transport=transport, base_url='http://loadtest', timeout=60) as client:
+                yield client, manifest
+    finally:
+        app_module.engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Regressions beyond tolerance, one message each"""
+    regressions = []
+    for workload, base in baseline.items():
+        current = results.get(workload)
+        if current is None or min(current['requests'], base['requests']) < MIN_SAMPLES:
+            continue
+        if current['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{workload}: p95 {current['p95_ms']:.1f} ms vs baseline {base['p95_ms']:.1f} ms")
+        if current['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{workload}: {current['throughput']:.1f} req/s vs baseline {base['throughput']:.1f} req/s")
+    return regressions
+
+
+def print_report(results: Dict[str, dict], elapsed: float, baseline: Optional[Dict[str, dict]]):
+    header = f"{'workload':<13}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    print(('\n' + header + ('   p95 vs baseline' if baseline else '')))
+    for workload, r in results.items():
+        line = (f"{workload:<13}{r['requests']:>10}{r['errors']:>8}{r['throughput']:>9.1f}"
+                f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}")
+        if baseline and workload in baseline:
+            line += f"   {r['p95_ms'] / baseline[workload]['p95_ms'] - 1:+.0%}"
+            if min(r['requests'], baseline[workload]['requests']) < MIN_SAMPLES:
+                line += " (too few requests to compare)"
+        print(line)
+    total = sum(r['requests'] for r in results.values())
+    print(f"\n{total:,} requests in {elapsed:.1f}s: {total / elapsed:.1f} req/s overall")
+
+
+async def main_async(args) -> int:
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, (args.mix or '').split(',')):
+        name, _, weight = item.partition('=')
+        if name not in DEFAULT_MIX:
+            raise SystemExit(f"Unknown workload {name!r}; choose from {', '.join(DEFAULT_MIX)}")
+        mix[name] = int(weight)
+    mix = {name: weight for name, weight in mix.items() if weight > 0}
+
+    if args.url:
+        if not args.manifest:
+            raise SystemExit("--url needs --manifest from loadtest_seed.py")
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+        async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+            recorder, elapsed = await drive(client, manifest, mix, args.duration, args.concurrency, args.seed)
+    else:
+        async with in_process_client(args.scale, args.seed) as (client, manifest):
+            recorder, elapsed = await drive(client, manifest, mix, args.duration, args.concurrency, args.seed)
+
+    results = recorder.summary(elapsed)
+    if not args.url:
+        import profiler
+        from config import Config
+        if Config.LOOP_MONITOR_ENABLED:
+            print(f"\nEvent loop blocked over {Config.LOOP_BLOCK_THRESHOLD_MS} ms "
+                  f"{profiler.LOOP_STALLS.value():.0f} times during the run")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    print_report(results, elapsed, baseline)
+
+    report = {'target': args.url or 'in-process', 'scale': manifest['scale'], 'duration': args.duration,
+              'concurrency': args.concurrency, 'mix': mix, 'results': results}
+    for path in filter(None, (args.report, args.save_baseline)):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+    if any(r['errors'] > r['requests'] * args.max_error_rate for r in results.values()):
+        print("\nFAIL: error rate above --max-error-rate")
+        return 1
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nFAIL: regressions beyond tolerance:\n  " + "\n  ".join(regressions))
+            return 1
+        print(f"\nNo regression beyond {args.tolerance:.0%} of the baseline")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='server under test; default is in-process')
+    parser.add_argument('--manifest', help='seed manifest (with --url)')
+    parser.add_argument('--scale', choices=('tiny', 'small', 'medium', 'large'), default='small',
+                        help='dataset for in-process runs')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds')
+    parser.add_argument('--concurrency', type=int, default=12, help='virtual users')
+    parser.add_argument('--mix', help='override weights, e.g. login=0,upload=20')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--report', help='write the results as JSON')
+    parser.add_argument('--baseline', help='compare with a saved report')
+    parser.add_argument('--save-baseline', help='write the results as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95/throughput regression')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Synthetic dataset for the load test (see loadtest.py)
+
+Bulk-inserts users, a folder tree per user, files with a long-tailed
+distribution over users and folders, activities, comment threads and
+shares. Only the files the workloads actually read or write get real
+blobs ("hot" files and one autosave document per user); the rest are
+metadata rows, which is what listing, search and trash scale with.
+
+Writes a manifest (JSON) with the ids and credentials the workloads need.
+
+Usage (against the database and upload folder a server will use):
+    DATABASE_URL=sqlite:////tmp/eucloud-load.db \\
+        python benchmarks/loadtest_seed.py --scale medium --upload-folder /tmp/eucloud-load-uploads \\
+        --manifest /tmp/eucloud-load.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCALES = {
+    # users, files, folder tree depth and fanout per user, activities, comments
+    'tiny': dict(users=8, files=2_000, depth=3, fanout=2, activities=2_000, comments=500, hot_files=4),
+    'small': dict(users=50, files=50_000, depth=4, fanout=3, activities=50_000, comments=10_000, hot_files=6),
+    'medium': dict(users=500, files=1_000_000, depth=5, fanout=3, activities=500_000, comments=100_000, hot_files=8),
+    'large': dict(users=2_000, files=5_000_000, depth=6, fanout=3, activities=2_000_000, comments=500_000, hot_files=8),
+}
+PASSWORD = 'loadtest-password'
+WORDS = (
+    "report invoice budget holiday photo scan contract draft final notes meeting agenda summary "
+    "project roadmap design spec review backup archive export slides taxes receipt travel family"
+).split()
+EXTENSIONS = [('.pdf', 'application/pdf'), ('.jpg', 'image/jpeg'), ('.txt', 'text/plain'),
+              ('.csv', 'text/csv'), ('.zip', 'application/zip'), ('.mp4', 'video/mp4')]
+BATCH = 20_000
+
+
+def document_text(rng: random.Random, size: int) -> str:
+    return ''.join(rng.choice('abcdefghij klmnop\n') for _ in range(size))
+
+
+def seed(scale: str, rng: random.Random) -> dict:
+    """Fill the configured database and upload storage; returns the manifest"""
+    from sqlalchemy import insert
+
+    from models import Base, engine, ph, User, Folder, File, Activity, Comment, Share
+    from storage import get_storage, new_blob_key
+
+    spec = SCALES[scale]
+    Base.metadata.create_all(bind=engine)
+    storage = get_storage()
+    now = datetime.utcnow()
+    password_hash = ph.hash(PASSWORD)  # one Argon2 hash for everyone; logins still verify it
+    n_users = spec['users']
+
+    with engine.begin() as conn:
+        first_user = (conn.exec_driver_sql("SELECT COALESCE(MAX(user_id), 0) FROM users").scalar() or 0) + 1
+        first_folder = (conn.exec_driver_sql("SELECT COALESCE(MAX(folder_id), 0) FROM folders").scalar() or 0) + 1
+        first_file = (conn.exec_driver_sql("SELECT COALESCE(MAX(file_id), 0) FROM files").scalar() or 0) + 1
+    run_tag = f"{int(time.time())}"
+    user_ids = list(range(first_user, first_user + n_users))
+
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {'user_id': u, 'email': f'load{u}-{run_tag}@bench.local', 'password_hash': password_hash,
+             'storage_quota': 0, 'storage_used': 0}
+            for u in user_ids
+        ])
+
+    # A complete tree of depth x fanout per user, breadth first
+    folders, folders_by_user, deepest_by_user = [], {}, {}
+    next_folder = first_folder
+    for u in user_ids:
+        level, owned = [None], []
+        for depth in range(spec['depth']):
+            next_level = []
+            for parent in level:
+                for branch in range(spec['fanout'] if parent is not None else spec['fanout'] + 1):
+                    folders.append({'folder_id': next_folder, 'folder_name': f"{rng.choice(WORDS)} {depth}.{branch}",
+                                    'parent_folder_id': parent, 'owner_id': u, 'created_at': now})
+                    next_level.append(next_folder)
+                    owned.append(next_folder)
+                    next_folder += 1
+            level = next_level
+        folders_by_user[u] = owned
+        deepest_by_user[u] = level
+    with engine.begin() as conn:
+        for start in range(0, len(folders), BATCH):
+            conn.execute(insert(Folder), folders[start:start + BATCH])
+
+    # Zipf-ish ownership: a few heavy users, a long tail of light ones
+    weights = [1.0 / (rank ** 0.8) for rank in range(1, n_users + 1)]
+    next_file = first_file
+    for start in range(0, spec['files'], BATCH):
+        owners = rng.choices(user_ids, weights=weights, k=min(BATCH, spec['files'] - start))
+        rows = []
+        for owner in owners:
+            extension, mime_type = rng.choice(EXTENSIONS)
+            deleted = rng.random() < 0.03
+            rows.append({
+                'file_id': next_file, 'filename': ' '.join(rng.sample(WORDS, 2)) + extension,
+                'file_path': f"{owner}/seed/{next_file}{extension}", 'file_size': rng.randint(1_000, 20_000_000),
+                'mime_type': mime_type, 'owner_id': owner,
+                'folder_id': rng.choice(folders_by_user[owner]) if rng.random() < 0.9 else None,
+                'app_type': 'generic', 'is_deleted': deleted, 'deleted_at': now if deleted else None,
+                'is_favorite': rng.random() < 0.05, 'content_version': 1, 'stored_encoding': 'identity',
+                'created_at': now, 'modified_at': now - timedelta(days=rng.randint(0, 1000)),
+            })
+            next_file += 1
+        with engine.begin() as conn:
+            conn.execute(insert(File), rows)
+
+    # Real blobs for what the workloads read and write
+    manifest_users = []
+    hot_rows = []
+    for u in user_ids:
+        hot = []
+        for i in range(spec['hot_files']):
+            size = rng.choice((16 * 1024, 256 * 1024, 1024 * 1024))
+            key = new_blob_key(u, f"hot{i}.bin")
+            storage.write_bytes(key, rng.randbytes(size))
+            hot_rows.append({'file_id': next_file, 'filename': f"hot{i}.bin", 'file_path': key, 'file_size': size,
+                             'mime_type': 'application/octet-stream', 'owner_id': u, 'folder_id': None,
+                             'app_type': 'generic', 'content_version': 1, 'stored_encoding': 'identity',
+                             'physical_size': size, 'created_at': now, 'modified_at': now})
+            hot.append(next_file)
+            next_file += 1
+        text = document_text(rng, 20_000).encode()
+        key = new_blob_key(u, "notes.ty")
+        storage.write_bytes(key, text)
+        hot_rows.append({'file_id': next_file, 'filename': "notes.ty", 'file_path': key, 'file_size': len(text),
+                         'mime_type': None, 'owner_id': u, 'folder_id': None, 'app_type': 'eutype',
+                         'content_version': 1, 'stored_encoding': 'identity', 'physical_size': len(text),
+                         'created_at': now, 'modified_at': now})
+        manifest_users.append({
+            'user_id': u, 'email': f'load{u}-{run_tag}@bench.local', 'hot_files': hot, 'document_id': next_file,
+            'folders': rng.sample(folders_by_user[u], min(20, len(folders_by_user[u]))) + deepest_by_user[u][:5],
+            'upload_folder_id': deepest_by_user[u][0],
+        })
+        next_file += 1
+
+    shares = []
+    with engine.begin() as conn:
+        conn.execute(insert(File), hot_rows)
+        conn.exec_driver_sql(
+            f"UPDATE users SET storage_used = (SELECT COALESCE(SUM(file_size), 0) FROM files "
+            f"WHERE files.owner_id = users.user_id) WHERE user_id >= {first_user}")
+        # Heavy users would be over any fixed quota; leave everyone room for the upload workload
+        conn.exec_driver_sql(
+            f"UPDATE users SET storage_quota = storage_used + {10 * 1024 ** 3} WHERE user_id >= {first_user}")
+        for entry in manifest_users:
+            for file_id in entry['hot_files'][:2]:
+                share_id = f"ld{rng.getrandbits(40):010x}"
+                shares.append({'share_id': share_id, 'file_id': file_id, 'created_by': entry['user_id'],
+                               'access_type': 'view', 'created_at': now})
+        conn.execute(insert(Share), shares)
+
+        activity_types = ('upload', 'download', 'rename', 'move', 'update_content', 'delete')
+        for start in range(0, spec['activities'], BATCH):
+            conn.execute(insert(Activity), [
+                {'user_id': rng.choices(user_ids, weights=weights)[0], 'activity_type': rng.choice(activity_types),
+                 'activity_details': 'seeded', 'created_at': now - timedelta(minutes=rng.randint(0, 500_000))}
+                for _ in range(min(BATCH, spec['activities'] - start))
+            ])
+
+    # Comment threads on hot files: roots plus replies, with thread bookkeeping
+    first_comment = None
+    with engine.begin() as conn:
+        first_comment = (conn.exec_driver_sql("SELECT COALESCE(MAX(comment_id), 0) FROM comments").scalar() or 0) + 1
+        hot_ids = [(f, e['user_id']) for e in manifest_users for f in e['hot_files']]
+        rows, roots = [], []
+        for offset in range(spec['comments']):
+            comment_id = first_comment + offset
+            file_id, author = rng.choice(hot_ids)
+            segment = str(comment_id).zfill(Comment.PATH_SEGMENT_WIDTH) + '/'
+            if roots and rng.random() < 0.6:
+                root_id, root_file, root_path = rng.choice(roots)
+                rows.append({'comment_id': comment_id, 'file_id': root_file, 'user_id': author,
+                             'comment_text': 'seeded reply', 'parent_comment_id': root_id, 'root_comment_id': root_id,
+                             'path': root_path + segment, 'depth': 1, 'created_at': now})
+            else:
+                roots.append((comment_id, file_id, segment))
+                rows.append({'comment_id': comment_id, 'file_id': file_id, 'user_id': author,
+                             'comment_text': 'seeded comment', 'parent_comment_id': None, 'root_comment_id': comment_id,
+                             'path': segment, 'depth': 0, 'created_at': now})
+        for start in range(0, len(rows), BATCH):
+            conn.execute(insert(Comment), rows[start:start + BATCH])
+        if engine.dialect.name == 'sqlite':
+            conn.exec_driver_sql("ANALYZE")
+
+    return {
+        'scale': scale,
+        'password': PASSWORD,
+        'users': manifest_users,
+        'shares': [s['share_id'] for s in shares],
+        'counts': {'users': n_users, 'folders': len(folders), 'files': spec['files'] + len(hot_rows),
+                   'activities': spec['activities'], 'comments': spec['comments'], 'shares': len(shares)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--upload-folder', help='blob root of the server under test (local storage)')
+    parser.add_argument('--manifest', required=True, help='where to write the manifest JSON')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    from config import Config
+    from storage import reset_storage
+    if args.upload_folder:
+        Config.UPLOAD_FOLDER = args.upload_folder
+    Config.init_app(None)
+    reset_storage()
+
+    started = time.perf_counter()
+    manifest = seed(args.scale, random.Random(args.seed))
+    with open(args.manifest, 'w') as f:
+        json.dump(manifest, f)
+    counts = ', '.join(f"{n:,} {kind}" for kind, n in manifest['counts'].items())
+    print(f"Seeded {counts} in {time.perf_counter() - started:.1f}s; manifest in {args.manifest}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""
+Crash-safe blob writes shared by every route that puts bytes on disk.
+
+A write always goes to a temp file in the target directory and is renamed
+over the final path, so readers and crashes only ever observe the complete
+old or the complete new blob. Callers commit their database changes only
+after the write has returned, never before.
+
+How much durability a write buys is set by Config.FSYNC_POLICY:
+- always: fsync the data and the directory on every write
+- batch:  group commit. Writes queue up for a committer thread that syncs
+          every pending temp file, renames them and syncs each touched
+          directory once per window of Config.FSYNC_BATCH_WINDOW_MS, so a
+          burst of small autosaves shares the directory syncs and journal
+          commits instead of paying them one by one. Writers still block
+          until their blob is durable.
+- none:   rename only (development and tests)
+
+A blob can also be opened with encoding='zstd' (see compression.py): it is
+then compressed as it streams in, once it has grown past
+Config.COMPRESSION_MIN_SIZE; smaller blobs are stored as-is. The committed
+blob reports the encoding it actually got, its logical size and the bytes
+it occupies on disk (stored_size).
+"""
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Iterable, Optional
+
+from config import Config
+import compression
+
+logger = logging.getLogger(__name__)
+
+TEMP_PREFIX = '.tmp-'
+POLICIES = ('always', 'batch', 'none')
+
+
+def fsync_directory(path: str):
+    """Persist a rename by syncing the containing directory (no-op on Windows)"""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _datasync(fd: int):
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+class BlobUpload(ABC):
+    """
+    Write half of a blob, shared by every storage driver: tracks logical and
+    stored size and applies the requested encoding. Subclasses decide where
+    the stored bytes go (_store) and how they become visible (_publish).
+    """
+
+    def __init__(self, encoding: str = compression.IDENTITY):
+        self.size = 0
+        self.stored_size = 0
+        self.encoding = compression.IDENTITY
+        self.done = False
+        # Compression starts only once the blob outgrows the threshold
+        self._compress = encoding == compression.ZSTD
+        self._compressor = None
+        self._held = []
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self._compressor is not None:
+            self._write_stored(self._compressor.compress(chunk))
+        elif self._compress:
+            self._held.append(chunk)
+            if self.size >= Config.COMPRESSION_MIN_SIZE:
+                self._compressor = compression.compressor()
+                self.encoding = compression.ZSTD
+                held, self._held = b''.join(self._held), []
+                self._write_stored(self._compressor.compress(held))
+        else:
+            self._write_stored(chunk)
+
+    def _write_stored(self, data: bytes):
+        if data:
+            self._store(data)
+            self.stored_size += len(data)
+
+    def _finish(self):
+        if self._compressor is not None:
+            self._write_stored(self._compressor.flush())
+        elif self._held:
+            self._write_stored(b''.join(self._held))
+        self._held = []
+
+    def commit(self) -> int:
+        """Make the blob durable and atomically visible"""
+        try:
+            self._finish()
+            self._publish()
+            self.done = True
+        except BaseException:
+            self.abort()
+            raise
+        return self.size
+
+    def abort(self):
+        if self.done:
+            return
+        self.done = True
+        self._discard()
+
+    @abstractmethod
+    def _store(self, data: bytes):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _publish(self):
+        raise NotImplementedError
+
+    def _discard(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class PendingBlob(BlobUpload):
+    """A local blob being written; becomes visible at final_path on commit()"""
+
+    def __init__(self, writer: 'BlobWriter', final_path: str, encoding: str = compression.IDENTITY):
+        super().__init__(encoding)
+        self.writer = writer
+        self.final_path = final_path
+        self.directory = os.path.dirname(final_path)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=self.directory, prefix=TEMP_PREFIX)
+        self.file = os.fdopen(fd, 'wb')
+
+    def _store(self, data: bytes):
+        self.file.write(data)
+
+    def _publish(self):
+        self.file.flush()
+        self.writer._commit(self)
+
+    def _discard(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+
+class _GroupCommitter(threading.Thread):
+    """Background thread that makes queued blobs durable in batches"""
+
+    def __init__(self, window_ms: int):
+        super().__init__(name='blob-group-commit', daemon=True)
+        self.window = window_ms / 1000.0
+        self.requests = queue.Queue()
+        self.batches = 0
+
+    def submit(self, blob: PendingBlob):
+        done = threading.Event()
+        result = {}
+        self.requests.put((blob, done, result))
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+
+    def run(self):
+        while True:
+            first = self.requests.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.requests.put(None)
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        directories = set()
+        renamed = []
+        for blob, done, result in batch:
+            try:
+                _datasync(blob.file.fileno())
+                blob.file.close()
+                os.replace(blob.temp_path, blob.final_path)
+                directories.add(blob.directory)
+                renamed.append((blob, done, result))
+            except BaseException as e:
+                result['error'] = e
+                done.set()
+        for directory in directories:
+            try:
+                fsync_directory(directory)
+            except OSError as e:
+                for blob, done, result in renamed:
+                    if blob.directory == directory:
+                        result['error'] = e
+        self.batches += 1
+        for _, done, _ in renamed:
+            done.set()
+
+    def stop(self):
+        self.requests.put(None)
+        self.join(timeout=5)
+
+
+class BlobWriter:
+    """Writes blobs atomically with the configured fsync policy"""
+
+    def __init__(self, policy: Optional[str] = None, batch_window_ms: Optional[int] = None):
+        self.policy = policy or Config.FSYNC_POLICY
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown fsync policy {self.policy!r}, expected one of {POLICIES}")
+        self.batch_window_ms = Config.FSYNC_BATCH_WINDOW_MS if batch_window_ms is None else batch_window_ms
+        self._committer = None
+        self._lock = threading.Lock()
+
+    def open(self, final_path: str, encoding: str = compression.IDENTITY) -> PendingBlob:
+        return PendingBlob(self, final_path, encoding)
+
+    def write_bytes(self, final_path: str, data: bytes, encoding: str = compression.IDENTITY) -> PendingBlob:
+        """Write a whole blob; returns it committed (size, stored_size, encoding)"""
+        with self.open(final_path, encoding) as blob:
+            blob.write(data)
+        return blob
+
+    def write_chunks(self, final_path: str, chunks: Iterable[bytes], encoding: str = compression.IDENTITY) -> PendingBlob:
+        with self.open(final_path, encoding) as blob:
+            for chunk in chunks:
+                blob.write(chunk)
+        return blob
+
+    def _commit(self, blob: PendingBlob):
+        if self.policy == 'batch':
+            self._group_committer().submit(blob)
+            return
+        if self.policy == 'always':
+            _datasync(blob.file.fileno())
+        blob.file.close()
+        os.replace(blob.temp_path, blob.final_path)
+        if self.policy == 'always':
+            fsync_directory(blob.directory)
+
+    def _group_committer(self) -> _GroupCommitter:
+        with self._lock:
+            if self._committer is None:
+                self._committer = _GroupCommitter(self.batch_window_ms)
+                self._committer.start()
+            return self._committer
+
+    def close(self):
+        """Drain and stop the group committer (called on shutdown)"""
+        with self._lock:
+            committer, self._committer = self._committer, None
+        if committer:
+            committer.stop()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_blob_writer() -> BlobWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BlobWriter()
+        return _writer
+
+
+def reset_blob_writer(writer: Optional[BlobWriter] = None):
+    """Swap the process-wide writer (shutdown, tests, policy changes)"""
+    global _writer
+    with _writer_lock:
+        previous, _writer = _writer, writer
+    if previous:
+        previous.close()
+
+
+def remove_stale_temp_files(root: str, older_than_seconds: int = 3600) -> int:
+    """Delete temp files left behind by a crash mid-write; returns how many"""
+    removed = 0
+    cutoff = time.time() - older_than_seconds
+    for directory, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.startswith(TEMP_PREFIX):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
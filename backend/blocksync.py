@@ -0,0 +1,176 @@
+"""
+Client-driven block-level sync for large files (rsync with the roles of
+rsync's sender and receiver swapped).
+
+1. The client fetches the file's block signature: an Adler-32 rolling hash
+   and a BLAKE2b strong hash per block (see deltas.py).
+2. It scans its new version of the file against them and uploads a delta
+   in deltas.py's format: COPY records for blocks the server already has,
+   literal DATA for everything else.
+3. The server streams the new content together from the current blob and
+   the delta into a fresh blob. The old blob becomes the newest version as
+   it is (versioning.keep_as_version), so a small edit to a large file costs
+   about as many bytes as were edited, on the wire and on disk.
+
+Signatures take a full read of the file to compute, so they are cached in
+one sidecar blob per file, keyed by content version and block size. A
+delta upload computes the new content's signature while it streams.
+"""
+import struct
+import tempfile
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import compression
+from deltas import (MAX_BLOCK_SIZE, MIN_BLOCK_SIZE, SignatureBuilder, apply_delta_stream,
+                    choose_block_size, signature_index)
+from models import File
+from storage import delete_after_commit, discard_on_rollback, get_storage, new_blob_key
+from versioning import keep_as_version
+
+SIGNATURE_MAGIC = b'EUS1'
+_HEADER = struct.Struct('>4sIIQ32s')  # magic, content version, block size, size, sha256
+_BLOCK = struct.Struct('>I16s')
+
+
+class DeltaRejected(Exception):
+    """The uploaded delta is malformed or does not produce the promised content"""
+
+
+@dataclass
+class Signature:
+    content_version: int
+    block_size: int
+    size: int
+    sha256: bytes
+    blocks: List[Tuple[int, bytes]]
+
+    def serialize(self) -> bytes:
+        header = _HEADER.pack(SIGNATURE_MAGIC, self.content_version, self.block_size, self.size, self.sha256)
+        return header + b''.join(_BLOCK.pack(weak, strong) for weak, strong in self.blocks)
+
+    @classmethod
+    def parse(cls, data: bytes) -> Optional['Signature']:
+        if len(data) < _HEADER.size:
+            return None
+        magic, content_version, block_size, size, sha256 = _HEADER.unpack_from(data)
+        if magic != SIGNATURE_MAGIC:
+            return None
+        blocks = list(_BLOCK.iter_unpack(data[_HEADER.size:]))
+        return cls(content_version, block_size, size, sha256, blocks)
+
+    def to_dict(self) -> dict:
+        return {
+            'version': self.content_version,
+            'size': self.size,
+            'sha256': self.sha256.hex(),
+            'block_size': self.block_size,
+            'blocks': [[weak, strong.hex()] for weak, strong in self.blocks]
+        }
+
+
+def signature_key(file: File) -> str:
+    return f"{file.owner_id}/.signatures/{file.file_id}.sig"
+
+
+def valid_block_size(block_size: Optional[int], size: int) -> int:
+    """The requested block size if it is a power of two in range, else the default for the size"""
+    if block_size and MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE and block_size & (block_size - 1) == 0:
+        return block_size
+    return choose_block_size(size)
+
+
+def index_from_signature(signature: dict) -> Tuple[Dict[int, Dict[bytes, int]], int]:
+    """Client side: (index, block_size) for deltas.compute_delta from a signature response"""
+    blocks = [(weak, bytes.fromhex(strong)) for weak, strong in signature['blocks']]
+    return signature_index(blocks, signature['block_size']), signature['block_size']
+
+
+def file_signature(file: File, block_size: Optional[int] = None) -> Signature:
+    """The signature of the file's current content, from the cache when it is fresh"""
+    storage = get_storage()
+    block_size = valid_block_size(block_size, file.file_size)
+    key = signature_key(file)
+    try:
+        cached = Signature.parse(storage.read_content(key))
+    except FileNotFoundError:
+        cached = None
+    if cached and cached.content_version == file.content_version and cached.block_size == block_size:
+        return cached
+
+    builder = SignatureBuilder(block_size)
+    for chunk in storage.iter_content(file.file_path, file.stored_encoding):
+        builder.feed(chunk)
+    signature = Signature(file.content_version, block_size, builder.size, builder.digest.digest(), builder.signatures)
+    # A racing write may have moved the file on; the version in the cache says which content it describes
+    store_signature(file, signature)
+    return signature
+
+
+def _open_base(file: File) -> BinaryIO:
+    """Seekable logical content of the file"""
+    storage = get_storage()
+    if file.stored_encoding == compression.IDENTITY:
+        return storage.open_seekable(file.file_path)
+    spooled = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    for chunk in storage.iter_content(file.file_path, file.stored_encoding):
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+def apply_file_delta(db: Session, file: File, delta: BinaryIO, max_size: int,
+                     expected_sha256: Optional[str] = None) -> Tuple[int, Signature]:
+    """
+    Rebuild the file's content from its current blob and a client delta,
+    into a fresh blob; the old one is kept as a version. Call after
+    claiming the next content version (so file.content_version is the new
+    one); the caller updates quota, commits and then store_signature()s.
+    Returns the size change and the new content's signature.
+    """
+    storage = get_storage()
+    new_key = new_blob_key(file.owner_id, file.filename)
+    encoding = compression.choose_encoding(file.mime_type, file.app_type, file.filename)
+    builder = SignatureBuilder(choose_block_size(file.file_size))
+
+    blob = storage.open_write(new_key, encoding)
+    try:
+        with _open_base(file) as base:
+            for chunk in apply_delta_stream(base, file.file_size, delta):
+                builder.feed(chunk)
+                if builder.size > max_size:
+                    raise DeltaRejected("File too large")
+                blob.write(chunk)
+        sha256 = builder.digest.hexdigest()
+        if expected_sha256 and expected_sha256.lower() != sha256:
+            raise DeltaRejected("Reconstructed content does not match its SHA-256")
+        blob.commit()
+    except ValueError as e:
+        blob.abort()
+        raise DeltaRejected(str(e))
+    except BaseException:
+        blob.abort()
+        raise
+    discard_on_rollback(db, [new_key])
+
+    size_diff = builder.size - file.file_size
+    keep_as_version(db, file)
+    file.file_path = new_key
+    file.file_size = builder.size
+    file.stored_encoding = blob.encoding
+    file.physical_size = blob.stored_size
+
+    return size_diff, Signature(file.content_version, builder.block_size, builder.size,
+                                builder.digest.digest(), builder.signatures)
+
+
+def store_signature(file: File, signature: Signature):
+    """Cache a signature computed during a write; call once the write has committed"""
+    get_storage().write_bytes(signature_key(file), signature.serialize())
+
+
+def forget_signature(db: Session, file: File):
+    """Drop the cached signature once the file's delete commits"""
+    delete_after_commit(db, [signature_key(file)])
@@ -0,0 +1,588 @@
+"""
+Per-user change feed and change journal: file, folder and share changes
+pushed to clients as they are committed, and kept for sync clients that
+ask what changed since their cursor (GET /api/changes).
+
+Session hooks collect what each flush created, updated or deleted. Just
+before the transaction commits they are numbered with the user's
+change_seq and written to the journal, in the same transaction; right
+after it commits they go to the broker (rolled back changes are never
+journaled or published). Bulk writes the hooks can't see call
+record_change().
+
+The journal keeps only the latest change per object, so it stays as large
+as the account, however often things change; a client's cursor still
+misses nothing, since an object changed again reappears later. Tombstones
+of deleted objects expire after Config.CHANGE_TOMBSTONE_DAYS
+(python changefeed.py compact); cursors older than that get a reset.
+
+The broker gives every event a per-user id and keeps the last
+Config.CHANGE_REPLAY_EVENTS of them, so a client reconnecting with the id
+of the last event it saw (SSE's Last-Event-ID) gets what it missed. When
+that id is no longer known (too old, or the broker restarted) the client
+gets a single 'resync' event and catches up through GET /api/changes from
+the journal cursor of the last event it saw (every event carries one).
+- LocalBroker: in-process fan-out; enough for a single API process
+- SharedBroker: an event log in the shared-memory SQLite file of
+  shared_state.py, tailed by every worker process on the host
+- RedisBroker: a capped Redis stream per user, shared by every process and
+  pod (needs the optional redis package)
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, event, func, insert, inspect, select, update
+
+from config import Config
+from models import SessionLocal, Change, File, Folder, Share, User
+from shared_state import SQLiteState
+
+try:
+    import redis
+    import redis.asyncio as redis_async
+except ImportError:
+    redis = None
+    redis_async = None
+
+logger = logging.getLogger(__name__)
+
+RESYNC = {'type': 'resync'}
+
+# Columns worth sending along; clients refetch anything else they show
+FIELDS = {
+    'file': ('filename', 'folder_id', 'file_size', 'mime_type', 'is_deleted', 'is_favorite', 'content_version'),
+    'folder': ('folder_name', 'parent_folder_id'),
+    'share': ('file_id', 'access_type', 'expires_at'),
+}
+
+
+def describe(obj):
+    """(kind, id, owner) of a tracked object, or None"""
+    if isinstance(obj, File):
+        return 'file', obj.file_id, obj.owner_id
+    if isinstance(obj, Folder):
+        return 'folder', obj.folder_id, obj.owner_id
+    if isinstance(obj, Share):
+        return 'share', obj.share_id, obj.created_by
+    return None
+
+
+def change_action(kind: str, obj, created: bool = False, deleted: bool = False) -> Optional[str]:
+    """created, deleted, trashed, restored, moved or updated; None if nothing changed"""
+    if created:
+        return 'created'
+    if deleted:
+        return 'deleted'
+    state = inspect(obj)
+    changed = {attr.key for attr in state.attrs if attr.history.has_changes()}
+    if not changed:
+        return None
+    if kind == 'file' and 'is_deleted' in changed:
+        return 'trashed' if obj.is_deleted else 'restored'
+    if 'folder_id' in changed or 'parent_folder_id' in changed:
+        return 'moved'
+    return 'updated'
+
+
+def make_event(kind: str, action: str, object_id, data: Optional[dict] = None) -> dict:
+    return {
+        'type': f'{kind}.{action}',
+        'id': object_id,
+        'data': data or {},
+        'at': datetime.utcnow().isoformat()
+    }
+
+
+def snapshot(kind: str, obj) -> dict:
+    """The object's loaded FIELDS, without triggering loads"""
+    loaded = inspect(obj).dict
+    data = {}
+    for field in FIELDS[kind]:
+        if field in loaded:
+            value = loaded[field]
+            data[field] = value.isoformat() if isinstance(value, datetime) else value
+    return data
+
+
+def record_change(session, user_id: int, kind: str, action: str, object_id, data: Optional[dict] = None):
+    """Publish a change on commit (for bulk writes the hooks can't see)"""
+    session.info.setdefault('changes', []).append((user_id, make_event(kind, action, object_id, data)))
+
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _collect_changes(session, flush_context):
+    changes = session.info.setdefault('changes', [])
+    for objects, flags in ((session.new, {'created': True}), (session.dirty, {}), (session.deleted, {'deleted': True})):
+        for obj in objects:
+            described = describe(obj)
+            if described is None:
+                continue
+            kind, object_id, owner_id = described
+            action = change_action(kind, obj, **flags)
+            if action:
+                data = {} if action == 'deleted' else snapshot(kind, obj)
+                changes.append((owner_id, make_event(kind, action, object_id, data)))
+
+
+def merge_action(first: str, then: str) -> Optional[str]:
+    """One action for two changes of an object in the same transaction; None if they cancel out"""
+    if first == 'created':
+        return None if then == 'deleted' else 'created'
+    if then == 'updated' and first != 'updated':
+        return first
+    return then
+
+
+def coalesce(changes) -> Dict[int, List[dict]]:
+    """Per user, one event per object (a transaction may flush an object several times)"""
+    merged: Dict[tuple, Optional[dict]] = {}
+    for user_id, change in changes:
+        key = (user_id, change['type'].split('.')[0], change['id'])
+        previous = merged.get(key)
+        if previous is not None:
+            kind, first = previous['type'].split('.')
+            action = merge_action(first, change['type'].split('.')[1])
+            if action is None:
+                merged[key] = None
+                continue
+            data = {} if action == 'deleted' else {**previous['data'], **change['data']}
+            change = {**change, 'type': f'{kind}.{action}', 'data': data}
+        merged[key] = change
+
+    by_user: Dict[int, List[dict]] = {}
+    for (user_id, _, _), change in merged.items():
+        if change is not None:
+            by_user.setdefault(user_id, []).append(change)
+    return by_user
+
+
+# --- Journal --------------------------------------------------------------
+
+def journal_changes(session, user_id: int, events: List[dict]):
+    """Number the user's events (adds 'cursor' to each) and replace their objects' previous entries"""
+    session.execute(update(User).where(User.user_id == user_id).values(change_seq=User.change_seq + len(events)))
+    last = session.execute(select(User.change_seq).where(User.user_id == user_id)).scalar()
+    if last is None:
+        return
+    ids_by_kind: Dict[str, List[str]] = {}
+    rows = []
+    now = datetime.utcnow()
+    for seq, item in enumerate(events, start=last - len(events) + 1):
+        kind, action = item['type'].split('.')
+        ids_by_kind.setdefault(kind, []).append(str(item['id']))
+        item['cursor'] = seq
+        rows.append({
+            'user_id': user_id, 'seq': seq, 'kind': kind, 'object_id': str(item['id']),
+            'action': action, 'data': json.dumps(item['data']) if item['data'] else None, 'created_at': now
+        })
+    for kind, ids in ids_by_kind.items():
+        session.execute(delete(Change).where(Change.user_id == user_id, Change.kind == kind, Change.object_id.in_(ids)))
+    session.execute(insert(Change), rows)
+
+
+def changes_since(db, user: User, cursor: int, limit: int):
+    """(entries after cursor, whether more follow); None if the cursor can't be served"""
+    if cursor < (user.change_floor or 0) or cursor > (user.change_seq or 0):
+        return None
+    rows = db.query(Change).filter(Change.user_id == user.user_id, Change.seq > cursor).order_by(Change.seq).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def compact_journal(tombstone_days: Optional[int] = None) -> int:
+    """Drop expired tombstones, moving each user's floor past them; returns how many went"""
+    days = Config.CHANGE_TOMBSTONE_DAYS if tombstone_days is None else tombstone_days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    db = SessionLocal()
+    removed = 0
+    try:
+        floors = db.query(Change.user_id, func.max(Change.seq)).filter(
+            Change.action == 'deleted', Change.created_at < cutoff
+        ).group_by(Change.user_id).all()
+        for user_id, floor in floors:
+            removed += db.query(Change).filter(
+                Change.user_id == user_id, Change.seq <= floor, Change.action == 'deleted'
+            ).delete(synchronize_session=False)
+            db.query(User).filter(User.user_id == user_id, User.change_floor < floor).update(
+                {User.change_floor: floor}, synchronize_session=False
+            )
+            db.commit()  # one user per transaction
+        return removed
+    finally:
+        db.close()
+
+
+@event.listens_for(SessionLocal, 'before_commit')
+def _write_journal(session):
+    session.flush()  # the commit's own flush only comes after this hook
+    changes = session.info.get('changes')
+    if not changes:
+        return
+    journaled = []
+    for user_id, events in coalesce(changes).items():
+        journal_changes(session, user_id, events)
+        journaled.extend((user_id, item) for item in events)
+    session.info['changes'] = journaled
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _publish_changes(session):
+    changes = session.info.pop('changes', None)
+    if not changes:
+        return
+    by_user = coalesce(changes)
+    try:
+        broker = get_broker()
+        for user_id, events in by_user.items():
+            broker.publish(user_id, events)
+    except Exception as e:
+        # The feed is a notification channel; never fail the write behind it
+        logger.warning(f"Publishing {len(changes)} changes failed: {e}")
+
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('changes', None)
+
+
+# --- Brokers --------------------------------------------------------------
+
+class Subscription(ABC):
+    """One client's stream of events; get() waits for the next one"""
+
+    @abstractmethod
+    async def get(self, timeout: float) -> Optional[dict]:
+        """Next event, RESYNC, or None after timeout seconds without one"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class Broker(ABC):
+    @abstractmethod
+    def publish(self, user_id: int, events: List[dict]):
+        """Assign ids and deliver; called from any thread, right after a commit"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def subscribe(self, user_id: int, after: Optional[str] = None) -> Subscription:
+        """Events after the given id (replayed first), or from now on"""
+        raise NotImplementedError
+
+
+class LocalSubscription(Subscription):
+    def __init__(self, broker: 'LocalBroker', user_id: int):
+        self.broker = broker
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.overflowed = False
+
+    def deliver(self, events: List[dict]):
+        """Called on the subscriber's loop"""
+        if self.overflowed:
+            return
+        if self.queue.qsize() + len(events) > Config.CHANGE_REPLAY_EVENTS:
+            # A client this far behind reloads instead of holding unbounded memory
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            return
+        for item in events:
+            self.queue.put_nowait(item)
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        try:
+            item = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if item is RESYNC:
+            self.overflowed = False
+        return item
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(Broker):
+    """In-process fan-out with a per-user replay buffer"""
+
+    def __init__(self, replay_size: Optional[int] = None):
+        self.replay_size = replay_size or Config.CHANGE_REPLAY_EVENTS
+        self.epoch = uuid.uuid4().hex[:8]  # ids from before a restart are recognizably stale
+        self._lock = threading.Lock()
+        self._seq: Dict[int, int] = {}
+        self._recent: Dict[int, deque] = {}
+        self._subscribers: Dict[int, set] = {}
+
+    def publish(self, user_id: int, events: List[dict]):
+        with self._lock:
+            seq = self._seq.get(user_id, 0)
+            recent = self._recent.setdefault(user_id, deque(maxlen=self.replay_size))
+            published = []
+            for item in events:
+                seq += 1
+                published.append({**item, 'seq': f'{self.epoch}-{seq}'})
+            recent.extend(published)
+            self._seq[user_id] = seq
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for sub in subscribers:
+            sub.loop.call_soon_threadsafe(sub.deliver, published)
+
+    def subscribe(self, user_id: int, after: Optional[str] = None) -> LocalSubscription:
+        sub = LocalSubscription(self, user_id)
+        with self._lock:
+            # Registered and replayed under the lock: nothing is missed or sent twice
+            self._subscribers.setdefault(user_id, set()).add(sub)
+            if after is not None:
+                missed = self._replay(user_id, after)
+                sub.deliver([RESYNC] if missed is None else missed)
+        return sub
+
+    def _replay(self, user_id: int, after: str) -> Optional[List[dict]]:
+        epoch, _, seq = after.partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        recent = self._recent.get(user_id, ())
+        oldest = int(recent[0]['seq'].split('-')[1]) if recent else self._seq.get(user_id, 0) + 1
+        if seq < oldest - 1 or seq > self._seq.get(user_id, 0):
+            return None
+        return [item for item in recent if int(item['seq'].split('-')[1]) > seq]
+
+    def unsubscribe(self, sub: LocalSubscription):
+        with self._lock:
+            subscribers = self._subscribers.get(sub.user_id)
+            if subscribers:
+                subscribers.discard(sub)
+                if not subscribers:
+                    del self._subscribers[sub.user_id]
+
+
+class SharedSubscription(LocalSubscription):
+    def __init__(self, broker: 'SharedBroker', user_id: int):
+        super().__init__(broker, user_id)
+        self.cursor = 0  # log id of the last event handed to this subscriber
+
+
+class SharedBroker(LocalBroker):
+    """
+    Fan-out across the worker processes of one host. Events go to a log
+    table in the shared SQLite file; each process tails it with one
+    thread (while it has subscribers) and delivers to its own clients.
+    Log ids are the event ids, so a client reconnecting to another worker
+    still resumes where it was. The log keeps the latest
+    CHANGE_REPLAY_EVENTS x 100 events of all users.
+    """
+
+    POLL_SECONDS = 0.05
+
+    def __init__(self, state: Optional[SQLiteState] = None, replay_size: Optional[int] = None):
+        super().__init__(replay_size)
+        self.state = state or SQLiteState(Config.SHARED_STATE_PATH)
+        self.retention = self.replay_size * 100
+        conn = self.state.connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS change_log ("
+                     "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, event TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS change_log_meta (name TEXT PRIMARY KEY, value TEXT)")
+        # One epoch per log: ids stay valid across workers and worker restarts, not a new log
+        conn.execute("INSERT OR IGNORE INTO change_log_meta VALUES ('epoch', ?)", (uuid.uuid4().hex[:8],))
+        self.epoch = conn.execute("SELECT value FROM change_log_meta WHERE name = 'epoch'").fetchone()[0]
+        self._published = 0
+        self._cursor: Optional[int] = None
+        self._wake = threading.Event()
+        self._tail: Optional[threading.Thread] = None
+
+    def _last_id(self, conn) -> int:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM change_log").fetchone()[0]
+
+    def publish(self, user_id: int, events: List[dict]):
+        conn = self.state.connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO change_log (user_id, event) VALUES (?, ?)",
+                             [(user_id, json.dumps(item)) for item in events])
+            self._published += 1
+            if self._published % 100 == 0:
+                conn.execute("DELETE FROM change_log WHERE id <= ?", (self._last_id(conn) - self.retention,))
+        self._wake.set()  # this process's subscribers need not wait for the next poll
+
+    def subscribe(self, user_id: int, after: Optional[str] = None) -> SharedSubscription:
+        sub = SharedSubscription(self, user_id)
+        conn = self.state.connect()
+        with self._lock:
+            sub.cursor = self._last_id(conn)
+            if after is not None:
+                missed = self._replay_log(conn, user_id, after, sub.cursor)
+                sub.deliver([RESYNC] if missed is None else missed)
+            self._subscribers.setdefault(user_id, set()).add(sub)
+            if self._cursor is None or self._cursor > sub.cursor:
+                self._cursor = sub.cursor
+            if self._tail is None:
+                self._tail = threading.Thread(target=self._follow, name='change-log-tail', daemon=True)
+                self._tail.start()
+        return sub
+
+    def _replay_log(self, conn, user_id: int, after: str, upto: int) -> Optional[List[dict]]:
+        epoch, _, seq = after.partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        oldest = conn.execute("SELECT MIN(id) FROM change_log").fetchone()[0] or upto + 1
+        if int(seq) < oldest - 1 or int(seq) > upto:
+            return None
+        rows = conn.execute("SELECT id, event FROM change_log WHERE user_id = ? AND id > ? AND id <= ? ORDER BY id",
+                            (user_id, int(seq), upto)).fetchall()
+        return [{**json.loads(event), 'seq': f'{self.epoch}-{log_id}'} for log_id, event in rows]
+
+    def _follow(self):
+        conn = self.state.connect()
+        while True:
+            self._wake.wait(self.POLL_SECONDS)
+            self._wake.clear()
+            with self._lock:
+                if not self._subscribers:
+                    self._cursor = None
+                    continue
+                cursor = self._cursor
+            try:
+                rows = conn.execute("SELECT id, user_id, event FROM change_log WHERE id > ? ORDER BY id LIMIT 1000",
+                                    (cursor,)).fetchall()
+            except sqlite3.Error:
+                logger.exception("Reading the shared change log failed")
+                time.sleep(1)
+                continue
+            if not rows:
+                continue
+            batches: Dict[SharedSubscription, List[dict]] = {}
+            with self._lock:
+                for log_id, user_id, payload in rows:
+                    for sub in self._subscribers.get(user_id, ()):
+                        if log_id > sub.cursor:
+                            batches.setdefault(sub, []).append({**json.loads(payload), 'seq': f'{self.epoch}-{log_id}'})
+                            sub.cursor = log_id
+                self._cursor = max(self._cursor or 0, rows[-1][0])
+            for sub, published in batches.items():
+                sub.loop.call_soon_threadsafe(sub.deliver, published)
+
+
+class RedisSubscription(Subscription):
+    def __init__(self, broker: 'RedisBroker', user_id: int, after: Optional[str]):
+        self.client = redis_async.Redis.from_url(broker.url)
+        self.key = broker.key(user_id)
+        self.after = after
+        self.last_id = None
+        self.pending: deque = deque()
+
+    async def _start(self):
+        after = _parse_id(self.after) if self.after is not None else None
+        if self.after is not None:
+            first = await self.client.xrange(self.key, count=1)
+            # A foreign id, or the stream was trimmed past the client's position
+            if after is None or (first and _parse_id(first[0][0].decode()) > after):
+                self.pending.append(RESYNC)
+            else:
+                self.last_id = self.after
+        if self.last_id is None:
+            newest = await self.client.xrevrange(self.key, count=1)
+            self.last_id = newest[0][0].decode() if newest else '0-0'
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        if self.last_id is None:
+            await self._start()
+        if not self.pending:
+            result = await self.client.xread({self.key: self.last_id}, block=int(timeout * 1000), count=100)
+            for _, entries in result or ():
+                for entry_id, fields in entries:
+                    self.last_id = entry_id.decode()
+                    self.pending.append({**json.loads(fields[b'event']), 'seq': self.last_id})
+        return self.pending.popleft() if self.pending else None
+
+    def close(self):
+        try:
+            asyncio.get_running_loop().create_task(self.client.close())
+        except RuntimeError:
+            pass
+
+
+def _parse_id(value: str):
+    """Redis stream id as a comparable tuple; None if it isn't one"""
+    major, _, minor = value.partition('-')
+    if not major.isdigit() or not (minor or '0').isdigit():
+        return None
+    return int(major), int(minor or 0)
+
+
+class RedisBroker(Broker):
+    """A capped Redis stream per user; stream entry ids are the event ids"""
+
+    def __init__(self, url: str, replay_size: Optional[int] = None, prefix: str = 'eucloud:changes:'):
+        if redis is None:
+            raise RuntimeError("redis is required for the Redis change broker")
+        self.url = url
+        self.replay_size = replay_size or Config.CHANGE_REPLAY_EVENTS
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+
+    def key(self, user_id: int) -> str:
+        return f'{self.prefix}{user_id}'
+
+    def publish(self, user_id: int, events: List[dict]):
+        pipe = self.client.pipeline(transaction=False)
+        for item in events:
+            pipe.xadd(self.key(user_id), {'event': json.dumps(item)}, maxlen=self.replay_size, approximate=True)
+        pipe.execute()
+
+    def subscribe(self, user_id: int, after: Optional[str] = None) -> RedisSubscription:
+        return RedisSubscription(self, user_id, after)
+
+
+_broker: Optional[Broker] = None
+_broker_lock = threading.Lock()
+
+
+def create_broker() -> Broker:
+    if Config.CHANGE_BROKER == 'redis':
+        return RedisBroker(Config.REDIS_URL)
+    if Config.CHANGE_BROKER == 'shared':
+        return SharedBroker()
+    return LocalBroker()
+
+
+def get_broker() -> Broker:
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = create_broker()
+        return _broker
+
+
+def set_broker(broker: Optional[Broker]):
+    """Swap the process-wide broker (config changes, tests)"""
+    global _broker
+    with _broker_lock:
+        _broker = broker
+
+
+def format_sse(item: dict) -> str:
+    """One Server-Sent Events message"""
+    if item is RESYNC:
+        return 'event: resync\ndata: {}\n\n'
+    return f"id: {item['seq']}\nevent: change\ndata: {json.dumps(item)}\n\n"
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'compact':
+        print(f"✅ Removed {compact_journal()} expired tombstones")
+    else:
+        print("Usage: python changefeed.py compact")
@@ -0,0 +1,79 @@
+"""
+Transparent at-rest compression for blobs.
+
+Documents (EuType/EuSheets), logs, CSVs and other text compress well, so
+the blob writer stores them as zstd frames when Config.COMPRESSION_ENABLED
+is set and the optional `zstandard` package is installed. File.file_size
+always stays the logical size; File.physical_size is what the blob takes on
+disk and File.stored_encoding says how to read it back.
+
+Everything that reads an uploaded blob goes through the storage driver's
+open_content/iter_content/read_content (see storage/), which decode with
+decoded(), so callers never have to care how the bytes are stored.
+"""
+from typing import BinaryIO, Optional
+
+from config import Config
+
+try:
+    import zstandard
+except ImportError:  # compression is optional; blobs are then stored as-is
+    zstandard = None
+
+IDENTITY = 'identity'
+ZSTD = 'zstd'
+
+
+def choose_encoding(mime_type: Optional[str], app_type: Optional[str] = None,
+                    filename: Optional[str] = None) -> str:
+    """Encoding new content should be stored with, from the per-type policy"""
+    if not Config.COMPRESSION_ENABLED or zstandard is None:
+        return IDENTITY
+    if app_type in Config.COMPRESSIBLE_APP_TYPES:
+        return ZSTD
+    if mime_type:
+        return ZSTD if compressible_type(mime_type) else IDENTITY
+    extension = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+    return ZSTD if extension in Config.COMPRESSIBLE_EXTENSIONS else IDENTITY
+
+
+def compressible_type(mime_type: str) -> bool:
+    """Whether content of this type shrinks (text, JSON, XML...); media and archives don't"""
+    mime_type = mime_type.split(';', 1)[0].strip().lower()
+    return mime_type.startswith('text/') or mime_type in Config.COMPRESSIBLE_MIME_TYPES
+
+
+def compressor():
+    """Streaming zstd compressor: .compress(chunk) and .flush()"""
+    return zstandard.ZstdCompressor(level=Config.COMPRESSION_LEVEL).compressobj()
+
+
+def decoded(raw: BinaryIO, encoding: Optional[str] = IDENTITY) -> BinaryIO:
+    """Wrap a stream of stored bytes so reading it yields the logical content"""
+    if encoding in (None, IDENTITY):
+        return raw
+    if encoding != ZSTD:
+        raw.close()
+        raise ValueError(f"Unknown blob encoding {encoding!r}")
+    if zstandard is None:
+        raw.close()
+        raise RuntimeError("zstandard is required to read compressed blobs")
+    return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows sending `encoding` as-is"""
+    if not accept_encoding:
+        return False
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        if name.strip().lower() != encoding:
+            continue
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
@@ -10,12 +10,103 @@ class Config:
     # Database
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///eucloud.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SCHEMA_AUTO_CREATE = os.environ.get('SCHEMA_AUTO_CREATE', 'true').lower() in ('1', 'true', 'yes')  # false: run `python schema.py` once per deploy instead (see schema.py)
+    
+    # Schema migrations (see migrations/): backfills commit every batch and pause THROTTLE x the batch's time after it
+    MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', '1000'))
+    MIGRATION_THROTTLE = float(os.environ.get('MIGRATION_THROTTLE', '1.0'))
+    MIGRATION_LOCK_TIMEOUT_MS = int(os.environ.get('MIGRATION_LOCK_TIMEOUT_MS', '5000'))  # PostgreSQL DDL gives up waiting for its lock after this, then retries
     
     # File Upload
-    UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-    THUMBNAIL_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnails')
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+    THUMBNAIL_FOLDER = os.environ.get('THUMBNAIL_FOLDER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnails')
     MAX_CONTENT_LENGTH = 500 * 1024 * 1024  # 500MB per file (increased for larger files)
     ALLOWED_EXTENSIONS = None  # Allow ALL file types (like Nextcloud)
+    UPLOAD_CHUNK_SIZE = 1024 * 1024  # Uploads are streamed to disk in chunks of this size
+    
+    # Blob storage driver: 'local' (UPLOAD_FOLDER), 'sharded' (several volumes) or 's3'
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+    STORAGE_VOLUMES = os.environ.get('STORAGE_VOLUMES', '')  # comma-separated volume roots for 'sharded'
+    S3_BUCKET = os.environ.get('S3_BUCKET', 'eucloud')
+    S3_PREFIX = os.environ.get('S3_PREFIX', '')
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. http://minio:9000 for MinIO
+    S3_REGION = os.environ.get('S3_REGION')
+    S3_ACCESS_KEY_ID = os.environ.get('S3_ACCESS_KEY_ID')
+    S3_SECRET_ACCESS_KEY = os.environ.get('S3_SECRET_ACCESS_KEY')
+    PRESIGNED_DOWNLOADS = os.environ.get('PRESIGNED_DOWNLOADS', 'true').lower() in ('1', 'true', 'yes')  # redirect downloads when the driver can presign
+    PRESIGN_EXPIRES_SECONDS = 300
+    
+    # Server-side copies try these in order: reflink, hardlink, reference (copy-on-write rows), copy (physical)
+    COPY_STRATEGIES = os.environ.get('COPY_STRATEGIES', 'reflink,hardlink,reference,copy')
+    
+    # Blob durability: 'always' (fsync every write), 'batch' (group commit), 'none'
+    FSYNC_POLICY = os.environ.get('FSYNC_POLICY', 'always')
+    FSYNC_BATCH_WINDOW_MS = int(os.environ.get('FSYNC_BATCH_WINDOW_MS', '10'))
+    
+    # File versioning: history is kept as deltas against periodic full snapshots
+    VERSION_KEEP_LAST = int(os.environ.get('VERSION_KEEP_LAST', '50'))  # newest N are always kept
+    VERSION_MAX_AGE_DAYS = int(os.environ.get('VERSION_MAX_AGE_DAYS', '90'))  # older ones thin to one per day until this age
+    VERSION_SNAPSHOT_INTERVAL = 20  # deltas per full snapshot; reconstruction is at most one delta
+    VERSION_MIN_INTERVAL_SECONDS = int(os.environ.get('VERSION_MIN_INTERVAL_SECONDS', '60'))  # autosaves closer than this share a version
+    VERSION_MAX_DELTA_SIZE = 64 * 1024 * 1024  # larger files are always stored as full snapshots
+    
+    # At-rest compression (needs the optional zstandard package); quotas stay on logical size
+    COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', '3'))
+    COMPRESSION_MIN_SIZE = 4 * 1024  # smaller blobs are not worth a zstd frame
+    COMPRESSIBLE_APP_TYPES = ('eutype', 'eusheets')
+    COMPRESSIBLE_MIME_TYPES = (  # plus every text/* type
+        'application/json', 'application/xml', 'application/javascript', 'application/x-ndjson',
+        'application/sql', 'application/x-sh', 'application/rtf', 'image/svg+xml',
+    )
+    COMPRESSIBLE_EXTENSIONS = ('log', 'txt', 'csv', 'tsv', 'md', 'json', 'jsonl', 'xml', 'sql', 'yaml', 'yml')  # when the mime type is unknown
+    
+    # Background jobs (see jobs.py): work is committed in batches of this many items
+    JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', '500'))
+    JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '2'))
+    JOB_QUEUES = os.environ.get('JOB_QUEUES', 'default:2,folders:2,media:2')  # queue:max concurrent batches, across all workers
+    JOB_RUNNER_IN_PROCESS = os.environ.get('JOB_RUNNER_IN_PROCESS', 'true').lower() in ('1', 'true', 'yes')  # false when worker.py runs separately
+    JOB_LEASE_SECONDS = 300  # a batch not finished by then is assumed dead and rerun elsewhere
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_BASE_SECONDS = 5  # doubled per failed attempt, with jitter
+    JOB_RETRY_MAX_SECONDS = 15 * 60
+    
+    # Change feed (see changefeed.py): 'local' fans out in-process, 'redis' across processes and pods
+    CHANGE_BROKER = os.environ.get('CHANGE_BROKER', 'local')  # 'local' (one process), 'shared' (workers on this host) or 'redis'
+    REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+    CHANGE_REPLAY_EVENTS = int(os.environ.get('CHANGE_REPLAY_EVENTS', '1000'))  # per user, for reconnecting clients
+    CHANGE_KEEPALIVE_SECONDS = 20  # comment line sent on idle streams so proxies keep them open
+    CHANGE_TOMBSTONE_DAYS = int(os.environ.get('CHANGE_TOMBSTONE_DAYS', '90'))  # sync clients offline longer do a full resync
+    
+    # State shared by worker processes (see shared_state.py): 'local' (one process), 'shm' (this host) or 'redis'
+    SHARED_STATE = os.environ.get('SHARED_STATE', 'local')
+    SHARED_STATE_PATH = os.environ.get('SHARED_STATE_PATH')  # SQLite file for 'shm' and the 'shared' broker; default /dev/shm/eucloud-state.db
+    
+    # Per-user cache of listing responses (see responsecache.py), in each process's memory; stays off with SHARED_STATE=local
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+    
+    # On-the-wire compression of responses (see httpcompression.py); br needs the optional brotli package
+    RESPONSE_COMPRESSION_ENABLED = os.environ.get('RESPONSE_COMPRESSION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    RESPONSE_COMPRESSION_ENCODINGS = os.environ.get('RESPONSE_COMPRESSION_ENCODINGS', 'br,zstd,gzip')  # preferred first, among those the client accepts
+    RESPONSE_COMPRESSION_MIN_SIZE = int(os.environ.get('RESPONSE_COMPRESSION_MIN_SIZE', '1024'))  # smaller bodies barely shrink and still cost a compressor
+    RESPONSE_COMPRESSION_LEVELS = {'gzip': 4, 'br': 4, 'zstd': 3}  # see benchmarks/bench_response_compression.py: higher levels cost far more CPU per KB saved
+    RESPONSE_COMPRESSION_CACHE_BYTES = int(os.environ.get('RESPONSE_COMPRESSION_CACHE_BYTES', str(16 * 1024 * 1024)))  # compressed variants of repeated bodies
+    
+    # Prometheus metrics on /metrics (see metrics.py); with a token set, scrapers send it as a Bearer token
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    
+    # SQL profiling (see sqlprofile.py): per-route query aggregates and the slow query log
+    SQL_PROFILING = os.environ.get('SQL_PROFILING', 'false').lower() in ('1', 'true', 'yes')
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+    DEBUG = os.environ.get('DEBUG', 'false').lower() in ('1', 'true', 'yes')  # adds X-Query-Count / Server-Timing headers
+    ADMIN_EMAILS = os.environ.get('ADMIN_EMAILS', '')  # comma-separated; these users may use /api/admin
+    
+    # Live profiling (see profiler.py): sampling profiles on demand, event loop stall detection always
+    PROFILE_MAX_SECONDS = 60
+    LOOP_MONITOR_ENABLED = os.environ.get('LOOP_MONITOR_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    LOOP_BLOCK_THRESHOLD_MS = float(os.environ.get('LOOP_BLOCK_THRESHOLD_MS', '100'))  # log the loop's stack when blocked this long
     
     # Storage Quotas (in bytes)
     DEFAULT_STORAGE_QUOTA = 5 * 1024 * 1024 * 1024  # 5GB
@@ -0,0 +1,92 @@
+"""
+Shared pytest fixtures for in-process API tests.
+
+Points the app at a throwaway SQLite database and upload folder *before*
+models.py is imported, so tests never touch instance/eucloud.db.
+"""
+import os
+import shutil
+import tempfile
+import uuid
+
+import pytest
+
+_TEST_ROOT = tempfile.mkdtemp(prefix='eucloud-test-')
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(_TEST_ROOT, 'test.db')}")
+
+from config import Config  # noqa: E402
+from models import Base, engine, SessionLocal, User  # noqa: E402
+import main  # noqa: E402,F401  (registers every router and schema hook before create_all)
+
+Config.UPLOAD_FOLDER = os.path.join(_TEST_ROOT, 'uploads')
+Config.THUMBNAIL_FOLDER = os.path.join(_TEST_ROOT, 'thumbnails')
+Config.init_app(None)
+Base.metadata.create_all(bind=engine)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_TEST_ROOT, ignore_errors=True)
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def user(db):
+    """A fresh user with a default quota (password hashing skipped for speed)"""
+    new_user = User(email=f"{uuid.uuid4().hex[:12]}@test.local", password_hash='x')
+    db.add(new_user)
+    db.commit()
+    db.refresh(new_user)
+    return new_user
+
+
+@pytest.fixture
+def client(user):
+    """TestClient authenticated as `user`"""
+    from fastapi import Depends
+    from fastapi.testclient import TestClient
+    from main import app
+    from auth import get_current_user
+    from models import get_db
+
+    # Same request-scoped session as the route, exactly like the real dependency
+    def _current_user(db=Depends(get_db)):
+        return db.query(User).get(user.user_id)
+
+    app.dependency_overrides[get_current_user] = _current_user
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.pop(get_current_user, None)
+
+
+@pytest.fixture
+def upload(client):
+    """upload(name, content, app_type=..., folder_id=...) through the API; returns the file's dict"""
+    def _upload(name, content, app_type='generic', folder_id=None):
+        data = {"app_type": app_type}
+        if folder_id:
+            data["folder_id"] = str(folder_id)
+        response = client.post("/api/files/upload", files={"file": (name, content)}, data=data)
+        assert response.status_code == 201, response.text
+        return response.json()["file"]
+    return _upload
+
+
+@pytest.fixture
+def every_save_versions(monkeypatch):
+    """Every content save records a version, however soon after the last"""
+    monkeypatch.setattr(Config, 'VERSION_MIN_INTERVAL_SECONDS', 0)
+
+
+@pytest.fixture
+def admin(monkeypatch, user):
+    """Makes `user` an admin, matched case-insensitively within a list"""
+    monkeypatch.setattr(Config, 'ADMIN_EMAILS', f"someone@else.test, {user.email.upper()}")
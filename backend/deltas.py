@@ -0,0 +1,244 @@
+"""
+rsync-style binary deltas.
+
+A base blob is described by per-block signatures: an Adler-32 weak hash
+(cheap to roll one byte at a time) plus a BLAKE2b strong hash. Scanning a
+target against those signatures yields a delta made of COPY(offset, length)
+references into the base and literal DATA runs.
+
+Serialized form: MAGIC, then records
+    b'C' + offset (u64) + length (u32)
+    b'D' + length (u32) + bytes
+"""
+import hashlib
+import math
+import struct
+import zlib
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+MAGIC = b'EUD1'
+MOD_ADLER = 65521
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 64 * 1024
+READ_CHUNK = 1024 * 1024
+
+_COPY = struct.Struct('>QI')
+_DATA = struct.Struct('>I')
+
+
+def strong_hash(block: bytes) -> bytes:
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def choose_block_size(size: int) -> int:
+    """~sqrt(size) rounded to a power of two, the classic rsync trade-off"""
+    if size <= 0:
+        return MIN_BLOCK_SIZE
+    block = 2 ** round(math.log2(math.sqrt(size)))
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block))
+
+
+def block_signatures(stream: BinaryIO, block_size: int) -> List[Tuple[int, bytes]]:
+    """(weak, strong) for every full block of the stream, in order"""
+    signatures = []
+    while True:
+        block = stream.read(block_size)
+        if len(block) < block_size:
+            break
+        signatures.append((zlib.adler32(block), strong_hash(block)))
+    return signatures
+
+
+def signature_index(signatures: List[Tuple[int, bytes]], block_size: int) -> Dict[int, Dict[bytes, int]]:
+    """weak -> strong -> base offset of the first block with that content"""
+    index = {}
+    for number, (weak, strong) in enumerate(signatures):
+        index.setdefault(weak, {}).setdefault(strong, number * block_size)
+    return index
+
+
+class DeltaBuilder:
+    """Accumulates ops, merging adjacent copies and literal runs"""
+
+    def __init__(self):
+        self.ops = []
+        self.literal_bytes = 0
+
+    def copy(self, offset: int, length: int):
+        if self.ops and self.ops[-1][0] == 'C' and self.ops[-1][1] + self.ops[-1][2] == offset:
+            self.ops[-1] = ('C', self.ops[-1][1], self.ops[-1][2] + length)
+        else:
+            self.ops.append(('C', offset, length))
+
+    def data(self, payload: bytes):
+        if not payload:
+            return
+        self.literal_bytes += len(payload)
+        if self.ops and self.ops[-1][0] == 'D':
+            self.ops[-1] = ('D', self.ops[-1][1] + payload)
+        else:
+            self.ops.append(('D', payload))
+
+    def serialize(self) -> bytes:
+        parts = [MAGIC]
+        for op in self.ops:
+            if op[0] == 'C':
+                parts.append(b'C' + _COPY.pack(op[1], op[2]))
+            else:
+                parts.append(b'D' + _DATA.pack(len(op[1])) + op[1])
+        return b''.join(parts)
+
+
+def compute_delta(index: Dict[int, Dict[bytes, int]], block_size: int, target: bytes,
+                  max_literal_bytes: Optional[int] = None) -> Optional[bytes]:
+    """
+    Delta turning the indexed base into `target`, or None once more than
+    max_literal_bytes would have to be sent literally (a full copy is then
+    the better deal, and it also bounds the per-byte rolling loop).
+    """
+    builder = DeltaBuilder()
+    n = len(target)
+    limit = n if max_literal_bytes is None else max_literal_bytes
+    i = 0
+    literal_start = 0
+
+    if index and n >= block_size:
+        weak = zlib.adler32(target[:block_size])
+        a, b = weak & 0xffff, weak >> 16
+        while True:
+            candidates = index.get((b << 16) | a)
+            if candidates:
+                offset = candidates.get(strong_hash(target[i:i + block_size]))
+                if offset is not None:
+                    builder.data(target[literal_start:i])
+                    builder.copy(offset, block_size)
+                    i += block_size
+                    literal_start = i
+                    if i + block_size > n:
+                        break
+                    weak = zlib.adler32(target[i:i + block_size])
+                    a, b = weak & 0xffff, weak >> 16
+                    continue
+            if i + block_size >= n:
+                break
+            outgoing, incoming = target[i], target[i + block_size]
+            a = (a - outgoing + incoming) % MOD_ADLER
+            b = (b - block_size * outgoing + a - 1) % MOD_ADLER
+            i += 1
+            if builder.literal_bytes + (i - literal_start) > limit:
+                return None
+
+    builder.data(target[literal_start:])
+    if builder.literal_bytes > limit:
+        return None
+    return builder.serialize()
+
+
+def parse_delta(delta: bytes) -> Iterator[Tuple]:
+    """Yield ('C', offset, length) and ('D', bytes) records"""
+    if not delta.startswith(MAGIC):
+        raise ValueError("Not a delta")
+    position = len(MAGIC)
+    while position < len(delta):
+        kind = delta[position:position + 1]
+        position += 1
+        if kind == b'C':
+            offset, length = _COPY.unpack_from(delta, position)
+            position += _COPY.size
+            yield ('C', offset, length)
+        elif kind == b'D':
+            (length,) = _DATA.unpack_from(delta, position)
+            position += _DATA.size
+            yield ('D', delta[position:position + length])
+            position += length
+        else:
+            raise ValueError(f"Corrupt delta record at byte {position - 1}")
+
+
+def apply_delta(base: BinaryIO, delta: bytes, chunk_size: int = READ_CHUNK) -> Iterator[bytes]:
+    """Stream the reconstructed target; base must be seekable"""
+    for record in parse_delta(delta):
+        if record[0] == 'D':
+            yield record[1]
+            continue
+        _, offset, length = record
+        base.seek(offset)
+        while length > 0:
+            chunk = base.read(min(chunk_size, length))
+            if not chunk:
+                raise ValueError("Delta references bytes beyond the end of its base")
+            length -= len(chunk)
+            yield chunk
+
+
+def iter_delta_records(stream: BinaryIO, chunk_size: int = READ_CHUNK) -> Iterator[Tuple]:
+    """parse_delta over a stream: literal runs come in chunks of at most chunk_size"""
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a delta")
+    position = len(MAGIC)
+    while True:
+        kind = stream.read(1)
+        if not kind:
+            return
+        if kind == b'C':
+            header = stream.read(_COPY.size)
+            if len(header) < _COPY.size:
+                raise ValueError(f"Truncated delta record at byte {position}")
+            offset, length = _COPY.unpack(header)
+            yield ('C', offset, length)
+            position += 1 + _COPY.size
+        elif kind == b'D':
+            header = stream.read(_DATA.size)
+            if len(header) < _DATA.size:
+                raise ValueError(f"Truncated delta record at byte {position}")
+            (remaining,) = _DATA.unpack(header)
+            position += 1 + _DATA.size + remaining
+            while remaining > 0:
+                chunk = stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise ValueError("Truncated literal data in delta")
+                remaining -= len(chunk)
+                yield ('D', chunk)
+        else:
+            raise ValueError(f"Corrupt delta record at byte {position}")
+
+
+def apply_delta_stream(base: BinaryIO, base_size: int, delta: BinaryIO,
+                       chunk_size: int = READ_CHUNK) -> Iterator[bytes]:
+    """apply_delta for deltas too large to hold in memory; copies are checked against base_size"""
+    for record in iter_delta_records(delta, chunk_size):
+        if record[0] == 'D':
+            yield record[1]
+            continue
+        _, offset, length = record
+        if offset + length > base_size:
+            raise ValueError("Delta references bytes beyond the end of its base")
+        base.seek(offset)
+        while length > 0:
+            chunk = base.read(min(chunk_size, length))
+            if not chunk:
+                raise ValueError("Delta references bytes beyond the end of its base")
+            length -= len(chunk)
+            yield chunk
+
+
+class SignatureBuilder:
+    """block_signatures() and a SHA-256 of a stream fed chunk by chunk (e.g. while writing it)"""
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.signatures: List[Tuple[int, bytes]] = []
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self._pending = bytearray()
+
+    def feed(self, chunk: bytes):
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        self._pending += chunk
+        block_size = self.block_size
+        full = len(self._pending) - len(self._pending) % block_size
+        for start in range(0, full, block_size):
+            block = bytes(self._pending[start:start + block_size])
+            self.signatures.append((zlib.adler32(block), strong_hash(block)))
+        del self._pending[:full]
@@ -0,0 +1,114 @@
+"""
+Server-side copies of files, avoiding byte copies.
+
+Config.COPY_STRATEGIES lists what to try, in order:
+- reflink:   the filesystem clones the blob (btrfs, XFS); an independent blob
+             that takes no space until either side is rewritten
+- hardlink:  a second name for the same inode; safe to share because blobs
+             are never modified in place, every write replaces the inode
+- reference: the copy's row points at the same key (copy-on-write). A shared
+             blob is deleted with its last reference, and content writes to a
+             shared key go to a fresh key instead (writable_key)
+- copy:      a physical copy, in the kernel on local disks (copy_file_range/
+             sendfile) and server-side on S3
+
+Blob operations block; call these from a worker thread.
+"""
+from typing import List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from config import Config
+from models import File
+from storage import delete_after_commit, discard_on_rollback, get_storage, new_blob_key
+
+STRATEGIES = ('reflink', 'hardlink', 'reference', 'copy')
+
+
+class CopyConflict(Exception):
+    """The source file changed or disappeared while it was being copied"""
+
+
+def copy_strategies() -> List[str]:
+    strategies = [s.strip() for s in Config.COPY_STRATEGIES.split(',') if s.strip()]
+    unknown = set(strategies) - set(STRATEGIES)
+    if unknown:
+        raise ValueError(f"Unknown copy strategies {sorted(unknown)}, expected some of {STRATEGIES}")
+    return strategies or ['copy']
+
+
+def is_shared(db: Session, key: str, file_id: int) -> bool:
+    """Whether a file other than file_id references the blob"""
+    return db.query(File.file_id).filter(File.file_path == key, File.file_id != file_id).first() is not None
+
+
+def _pin(db: Session, source: File):
+    """
+    Touch the source row so a concurrent content write or delete of it
+    serializes with this transaction: either it sees our new reference, or
+    we see its change and give up.
+    """
+    pinned = db.query(File).filter(
+        File.file_id == source.file_id,
+        File.file_path == source.file_path,
+        File.content_version == source.content_version
+    ).update({File.content_version: File.content_version}, synchronize_session=False)
+    if not pinned:
+        raise CopyConflict(f"File {source.file_id} changed while it was being copied")
+
+
+def copy_blob(db: Session, source: File, owner_id: int) -> Tuple[str, str]:
+    """Give a copy of source its content; returns (key, strategy used)"""
+    storage = get_storage()
+    target_key = new_blob_key(owner_id, source.filename)
+    for strategy in copy_strategies():
+        if strategy == 'reference':
+            _pin(db, source)
+            return source.file_path, strategy
+        if strategy == 'reflink':
+            done = storage.clone(source.file_path, target_key)
+        elif strategy == 'hardlink':
+            done = storage.link(source.file_path, target_key)
+        else:
+            storage.copy(source.file_path, target_key)
+            done = True
+        if done:
+            discard_on_rollback(db, [target_key])
+            return target_key, strategy
+    raise ValueError("No copy strategy succeeded; add 'copy' to COPY_STRATEGIES")
+
+
+def duplicate_file(db: Session, source: File, filename: str, folder_id: Optional[int]) -> Tuple[File, str]:
+    """New File row with the source's content, added to the session; the caller commits"""
+    key, strategy = copy_blob(db, source, source.owner_id)
+    copy = File(
+        filename=filename,
+        file_path=key,
+        file_size=source.file_size,
+        stored_encoding=source.stored_encoding,
+        physical_size=source.physical_size,
+        mime_type=source.mime_type,
+        app_type=source.app_type,
+        folder_id=folder_id,
+        owner_id=source.owner_id
+    )
+    db.add(copy)
+    return copy, strategy
+
+
+def writable_key(db: Session, file: File) -> str:
+    """
+    Key to write the file's new content to. Usually its own; if the blob is
+    shared with copies, the file moves to a fresh key so they keep theirs.
+    """
+    if not is_shared(db, file.file_path, file.file_id):
+        return file.file_path
+    file.file_path = new_blob_key(file.owner_id, file.filename)
+    discard_on_rollback(db, [file.file_path])
+    return file.file_path
+
+
+def release_blob(db: Session, file: File):
+    """Delete the file's blob once the transaction commits, unless copies still use it"""
+    if not is_shared(db, file.file_path, file.file_id):
+        delete_after_commit(db, [file.file_path])
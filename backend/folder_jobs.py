@@ -0,0 +1,301 @@
+"""
+Recursive folder copy, move and delete as background jobs (see jobs.py).
+
+Copy and delete start by planning the subtree: a breadth-first walk that
+records every folder in job_folders (seq = BFS position) one batch at a
+time, counting files and bytes on the way. Then:
+- folder_copy reserves the tree's size against the quota once, recreates
+  the folders parents-first and copies the files through filecopy
+  (reflinks, hard links or copy-on-write references). The reservation is
+  settled against what was actually copied when the job ends, however it
+  ends.
+- folder_delete moves the files to the trash (to the root, since their
+  folders go away) and deletes the folders children-first. Folders that
+  gained subfolders while the job ran are kept.
+folder_move only re-parents the root, a single step.
+
+Files and folders changed while a job runs are handled as they are found;
+anything that disappeared is skipped.
+"""
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from changefeed import record_change
+from filecopy import CopyConflict, duplicate_file
+from jobs import JobError, JobHandler, JobRetry, register
+from models import Activity, File, Folder, Job, JobFolder, User
+from responsecache import invalidate_user
+
+
+def is_within(db: Session, folder_id: Optional[int], ancestor_id: int) -> bool:
+    """Whether folder_id is ancestor_id or one of its descendants"""
+    seen = set()
+    while folder_id is not None and folder_id not in seen:
+        if folder_id == ancestor_id:
+            return True
+        seen.add(folder_id)
+        folder_id = db.query(Folder.parent_folder_id).filter(Folder.folder_id == folder_id).scalar()
+    return False
+
+
+def check_target(db: Session, job: Job):
+    """The target folder must exist, belong to the owner and lie outside the tree"""
+    if job.target_folder_id is None:
+        return
+    target = db.query(Folder).get(job.target_folder_id)
+    if target is None or target.owner_id != job.owner_id:
+        raise JobError("Target folder not found")
+    if is_within(db, target.folder_id, job.folder_id):
+        raise JobError("Cannot copy or move a folder into itself")
+
+
+def log_activity(db: Session, job: Job, activity_type: str, folder_id: Optional[int], details: str):
+    db.add(Activity(user_id=job.owner_id, folder_id=folder_id, activity_type=activity_type, activity_details=details))
+
+
+class TreeJob(JobHandler):
+    """Shared planning and iteration over a job's subtree"""
+    queue = 'folders'
+
+    def start(self, db, job):
+        db.add(JobFolder(job_id=job.job_id, seq=0, folder_id=job.folder_id))
+        job.save_state({'phase': 'plan', 'cursor': 0, 'next_seq': 1, 'folders': 0, 'files': 0, 'bytes': 0})
+
+    def plan(self, db, job, state, batch_size) -> bool:
+        """Record the next batch of folders' children; True once the tree is complete"""
+        rows = db.query(JobFolder).filter(
+            JobFolder.job_id == job.job_id, JobFolder.seq >= state['cursor']
+        ).order_by(JobFolder.seq).limit(batch_size).all()
+        if not rows:
+            job.total_items = state['folders'] + state['files']
+            return True
+
+        ids = [row.folder_id for row in rows]
+        planned = db.query(JobFolder.folder_id).filter(JobFolder.job_id == job.job_id)
+        children = db.query(Folder.folder_id).filter(
+            Folder.parent_folder_id.in_(ids),
+            Folder.owner_id == job.owner_id,
+            ~Folder.folder_id.in_(planned)  # never loop on corrupt parent links
+        ).order_by(Folder.folder_id).all()
+        for (child_id,) in children:
+            db.add(JobFolder(job_id=job.job_id, seq=state['next_seq'], folder_id=child_id))
+            state['next_seq'] += 1
+
+        count, size = db.query(func.count(File.file_id), func.coalesce(func.sum(File.file_size), 0)).filter(
+            File.folder_id.in_(ids), File.is_deleted == False
+        ).one()
+        state['folders'] += len(rows)
+        state['files'] += count
+        state['bytes'] += int(size)
+        state['cursor'] = rows[-1].seq + 1
+        return False
+
+    def next_files(self, db, job, state, limit, include_deleted=False) -> Tuple[List[Tuple[JobFolder, File]], bool]:
+        """
+        Up to `limit` files of the tree, folder by folder in plan order,
+        advancing the (seq, after) cursor; the flag is True once every
+        folder is exhausted.
+        """
+        batch = []
+        for _ in range(limit):  # bounds the empty folders visited per batch too
+            row = db.query(JobFolder).filter(
+                JobFolder.job_id == job.job_id, JobFolder.seq >= state['seq']
+            ).order_by(JobFolder.seq).first()
+            if row is None:
+                return batch, True
+
+            wanted = limit - len(batch)
+            query = db.query(File).filter(File.folder_id == row.folder_id, File.file_id > state['after'])
+            if not include_deleted:
+                query = query.filter(File.is_deleted == False)
+            files = query.order_by(File.file_id).limit(wanted).all()
+            batch.extend((row, file) for file in files)
+            if len(files) < wanted:
+                state['seq'], state['after'] = row.seq + 1, 0
+            else:
+                state['after'] = files[-1].file_id
+            if len(batch) >= limit:
+                break
+        return batch, False
+
+    def finish(self, db, job, state, status):
+        db.query(JobFolder).filter(JobFolder.job_id == job.job_id).delete(synchronize_session=False)
+
+
+@register
+class FolderCopy(TreeJob):
+    kind = 'folder_copy'
+
+    def step(self, db, job, state, batch_size):
+        phase = state['phase']
+        if phase == 'plan':
+            if self.plan(db, job, state, batch_size):
+                self.reserve_quota(db, job, state)
+                state.update(phase='folders', cursor=0)
+            return False
+        if phase == 'folders':
+            if self.copy_folders(db, job, state, batch_size):
+                state.update(phase='files', seq=0, after=0)
+            return False
+        return self.copy_files(db, job, state, batch_size)
+
+    def reserve_quota(self, db, job, state):
+        """Charge the whole tree up front, so the per-file copies need no quota checks"""
+        check_target(db, job)
+        user = db.query(User).get(job.owner_id)
+        if user.storage_used + state['bytes'] > user.storage_quota:
+            raise JobError("Storage quota exceeded")
+        db.query(User).filter(User.user_id == job.owner_id).update(
+            {User.storage_used: User.storage_used + state['bytes']}, synchronize_session=False
+        )
+        invalidate_user(db, job.owner_id)
+        state['reserved'] = state['bytes']
+        state['copied_bytes'] = 0
+
+    def copy_folders(self, db, job, state, batch_size) -> bool:
+        rows = db.query(JobFolder).filter(
+            JobFolder.job_id == job.job_id, JobFolder.seq >= state['cursor']
+        ).order_by(JobFolder.seq).limit(batch_size).all()
+        if not rows:
+            return True
+
+        for row in rows:
+            source = db.query(Folder).get(row.folder_id)
+            if source is None or source.owner_id != job.owner_id:
+                continue
+            if row.seq == 0:
+                parent_id = job.target_folder_id
+                name = job.load_params().get('folder_name') or f"Copy of {source.folder_name}"
+            else:
+                # Parents come first in BFS order; a parent that was skipped or moved out takes its subtree along
+                parent_id = db.query(JobFolder.new_folder_id).filter(
+                    JobFolder.job_id == job.job_id, JobFolder.folder_id == source.parent_folder_id
+                ).scalar()
+                if parent_id is None:
+                    continue
+                name = source.folder_name
+            copy = Folder(folder_name=name, parent_folder_id=parent_id, owner_id=job.owner_id)
+            db.add(copy)
+            db.flush()
+            row.new_folder_id = copy.folder_id
+            if row.seq == 0:
+                job.result_folder_id = copy.folder_id
+        job.processed_items += len(rows)
+        state['cursor'] = rows[-1].seq + 1
+        return False
+
+    def copy_files(self, db, job, state, batch_size) -> bool:
+        batch, exhausted = self.next_files(db, job, state, batch_size)
+        try:
+            for row, file in batch:
+                if row.new_folder_id is None:
+                    continue
+                duplicate_file(db, file, file.filename, row.new_folder_id)
+                state['copied_bytes'] += file.file_size
+        except CopyConflict as e:
+            raise JobRetry(str(e))
+        job.processed_items += len(batch)
+        return exhausted
+
+    def finish(self, db, job, state, status):
+        # Whatever happened, the owner ends up charged for exactly what was copied
+        settle = state.get('copied_bytes', 0) - state.get('reserved', 0)
+        if settle:
+            db.query(User).filter(User.user_id == job.owner_id).update(
+                {User.storage_used: User.storage_used + settle}, synchronize_session=False
+            )
+            invalidate_user(db, job.owner_id)
+        if status == 'completed':
+            log_activity(db, job, 'copy', job.result_folder_id, f"Copied folder tree ({job.processed_items} items)")
+        super().finish(db, job, state, status)
+
+
+@register
+class FolderDelete(TreeJob):
+    kind = 'folder_delete'
+
+    def step(self, db, job, state, batch_size):
+        phase = state['phase']
+        if phase == 'plan':
+            if self.plan(db, job, state, batch_size):
+                state.update(phase='files', seq=0, after=0)
+            return False
+        if phase == 'files':
+            if self.trash_files(db, job, state, batch_size):
+                state.update(phase='folders', cursor=state['next_seq'], kept=0)
+            return False
+        return self.delete_folders(db, job, state, batch_size)
+
+    def trash_files(self, db, job, state, batch_size) -> bool:
+        batch, exhausted = self.next_files(db, job, state, batch_size, include_deleted=True)
+        now = datetime.utcnow()
+        for _, file in batch:
+            if not file.is_deleted:
+                file.is_deleted = True
+                file.deleted_at = now
+                job.processed_items += 1
+            file.folder_id = None  # restores land in the root
+        return exhausted
+
+    def delete_folders(self, db, job, state, batch_size) -> bool:
+        """Children before parents: walk the plan backwards"""
+        rows = db.query(JobFolder).filter(
+            JobFolder.job_id == job.job_id, JobFolder.seq < state['cursor']
+        ).order_by(JobFolder.seq.desc()).limit(batch_size).all()
+        if not rows:
+            return True
+
+        ids = [row.folder_id for row in rows]
+        # Files that arrived after the files phase
+        for (file_id,) in db.query(File.file_id).filter(File.folder_id.in_(ids)):
+            record_change(db, job.owner_id, 'file', 'trashed', file_id, {'folder_id': None, 'is_deleted': True})
+        db.query(File).filter(File.folder_id.in_(ids)).update({
+            File.is_deleted: True,
+            File.deleted_at: func.coalesce(File.deleted_at, datetime.utcnow()),
+            File.folder_id: None
+        }, synchronize_session=False)
+        # Keep folders with subfolders outside this batch, and (children first) their ancestors in it
+        kept = {parent for (parent,) in db.query(Folder.parent_folder_id).filter(
+            Folder.parent_folder_id.in_(ids), ~Folder.folder_id.in_(ids)
+        ).distinct()}
+        parents = dict(db.query(Folder.folder_id, Folder.parent_folder_id).filter(Folder.folder_id.in_(ids)))
+        for folder_id in ids:
+            if folder_id in kept and parents.get(folder_id) is not None:
+                kept.add(parents[folder_id])
+        deletable = [folder_id for folder_id in ids if folder_id not in kept]
+        if deletable:
+            db.query(Folder).filter(Folder.folder_id.in_(deletable), Folder.owner_id == job.owner_id).delete(synchronize_session=False)
+            for folder_id in deletable:
+                record_change(db, job.owner_id, 'folder', 'deleted', folder_id)
+        state['kept'] += len(ids) - len(deletable)
+        job.processed_items += len(rows)
+        state['cursor'] = rows[-1].seq
+        return False
+
+    def finish(self, db, job, state, status):
+        if status == 'completed':
+            details = f"Deleted folder tree ({state.get('files', 0)} files moved to trash)"
+            if state.get('kept'):
+                details += f", kept {state['kept']} folders that gained subfolders"
+            log_activity(db, job, 'delete', None, details)
+        super().finish(db, job, state, status)
+
+
+@register
+class FolderMove(JobHandler):
+    kind = 'folder_move'
+    queue = 'folders'
+    priority = 10  # a single quick step; don't make it wait behind tree walks
+
+    def step(self, db, job, state, batch_size):
+        folder = db.query(Folder).get(job.folder_id)
+        if folder is None or folder.owner_id != job.owner_id:
+            raise JobError("Folder not found")
+        check_target(db, job)
+        folder.parent_folder_id = job.target_folder_id
+        job.total_items = job.processed_items = 1
+        log_activity(db, job, 'move', folder.folder_id, f"Moved folder {folder.folder_name}")
+        return True
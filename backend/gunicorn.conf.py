@@ -0,0 +1,116 @@
+"""
+Production serving: gunicorn supervising uvicorn workers
+
+    gunicorn -c gunicorn.conf.py main:app
+
+- Workers: WEB_CONCURRENCY if set, else one per CPU this container may
+  use (the cgroup CPU quota, else CPU affinity). Workers are async, so
+  more than one per core only adds contention.
+- Preloading (PRELOAD_APP, on by default): the app is imported once in
+  the master and forked, so workers start fast and share its memory
+  pages.
+- Schema: with SCHEMA_AUTO_CREATE on, the master creates the tables
+  before forking (in a `python schema.py` subprocess without preloading)
+  and turns it off for the workers, so they don't all run it at the same
+  moment. With it off the schema is left to `python schema.py`, run
+  before the deploy.
+- Shared state: with more than one worker, caches/counters and the change
+  feed default to the shared-memory backends (SHARED_STATE=shm,
+  CHANGE_BROKER=shared; see shared_state.py), in a file private to this
+  master. Set them to 'redis' to share across pods as well.
+- Graceful reload: `kill -HUP <master pid>` starts new workers and lets
+  the old ones finish in-flight requests (up to GRACEFUL_TIMEOUT seconds)
+  before they exit. With preloading, HUP reuses the code the master
+  imported; deploy new code by restarting the pod, or by USR2 (a new
+  master next to the old one) followed by QUIT to the old master.
+- MAX_REQUESTS recycles each worker after that many requests (with jitter)
+  if memory creeps up; 0 (default) never does.
+
+Process-local by design: the decoded-token cache (tokens are stateless),
+the SQL profile, the event loop monitor and /metrics, which reports the
+worker that answers the scrape.
+"""
+import math
+import os
+import subprocess
+import sys
+
+
+def cpu_limit() -> int:
+    """CPUs this process may use: cgroup quota (v2, then v1), else affinity"""
+    available = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            limit, period = f.read().split()[:2]
+        if limit != 'max':
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                limit = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        available = min(available, math.ceil(quota))
+    return max(1, available)
+
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY') or cpu_limit())
+worker_class = 'uvicorn.workers.UvicornWorker'
+preload_app = os.environ.get('PRELOAD_APP', 'true').lower() in ('1', 'true', 'yes')
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', '30'))
+timeout = int(os.environ.get('WORKER_TIMEOUT', '60'))  # a worker whose loop is stuck this long is restarted
+keepalive = 5
+max_requests = int(os.environ.get('MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+forwarded_allow_ips = os.environ.get('FORWARDED_ALLOW_IPS', '127.0.0.1')
+accesslog = None  # requests are logged and measured by the app
+errorlog = '-'
+
+# Before the app (and so config.py) is imported; explicit settings win
+# (this file is read again on HUP, in the same master)
+_state_file = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else '/tmp', f'eucloud-state-{os.getpid()}.db')
+if workers > 1:
+    os.environ.setdefault('SHARED_STATE', 'shm')
+    os.environ.setdefault('CHANGE_BROKER', 'shared')
+    os.environ.setdefault('SHARED_STATE_PATH', _state_file)
+
+
+def on_starting(server):
+    if preload_app:
+        from config import Config
+        from models import engine
+        from schema import create_schema
+        if Config.SCHEMA_AUTO_CREATE:
+            create_schema()
+            Config.SCHEMA_AUTO_CREATE = False  # the forked workers' copy
+        engine.dispose()
+    elif os.environ.get('SCHEMA_AUTO_CREATE', 'true').lower() in ('1', 'true', 'yes'):
+        # Without preloading the master stays free of the app's modules
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.py')], check=True)
+    # Workers importing config.py afterwards (the ones HUP starts too)
+    os.environ['SCHEMA_AUTO_CREATE'] = 'false'
+    server.log.info(f"Starting {workers} worker(s); shared state: {os.environ.get('SHARED_STATE', 'local')}, "
+                    f"change broker: {os.environ.get('CHANGE_BROKER', 'local')}")
+
+
+def post_fork(server, worker):
+    if preload_app:
+        # Pooled connections must not cross a fork; leave the parent's to the parent
+        from models import engine
+        engine.dispose(close=False)
+
+
+def on_exit(server):
+    if os.environ.get('SHARED_STATE_PATH') == _state_file:
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(_state_file + suffix)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,248 @@
+"""
+On-the-wire compression of responses.
+
+Listings and EuType/EuSheets content are JSON that shrinks four- to
+tenfold, so CompressionMiddleware compresses responses with the best
+encoding the client accepts, in Config.RESPONSE_COMPRESSION_ENCODINGS
+order: br (with the optional `brotli` package), zstd (with the optional
+`zstandard` package, also used for blobs at rest) and gzip. It leaves
+alone:
+
+  - bodies under Config.RESPONSE_COMPRESSION_MIN_SIZE, which barely shrink;
+  - types that don't compress (images, video, archives: see
+    compression.compressible_type) and Server-Sent Events, whose events
+    must not sit in a compressor's buffer;
+  - responses that already have a Content-Encoding, such as zstd blobs
+    sent as-is, and partial (206) responses, whose byte ranges refer to
+    the uncompressed blob.
+
+Bodies sent in one piece (every JSON response) are compressed at once; a
+body of several hundred KB is compressed in a worker thread so the event
+loop keeps serving. Streamed bodies (downloads) are compressed chunk by
+chunk as they go out, never held in memory.
+
+The same body is often sent many times over: a listing served from the
+response cache, a document several tabs keep reopening. Bodies are
+identified by a hash, and once one has been seen twice its compressed
+variant is kept in a per-process LRU of at most
+Config.RESPONSE_COMPRESSION_CACHE_BYTES, so later sends cost a hash
+instead of a compression. Bytes in and out per encoding and variant cache
+hits are exported on /metrics; benchmarks/bench_response_compression.py
+measures the CPU cost against the bytes saved.
+"""
+import hashlib
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+import anyio
+from starlette.datastructures import Headers, MutableHeaders
+
+import compression
+from config import Config
+import metrics
+from responsecache import Entry, ResponseCache
+
+try:
+    import brotli
+except ImportError:  # br is optional; clients get zstd or gzip instead
+    brotli = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+ZSTD = 'zstd'
+
+OFFLOAD_SIZE = 256 * 1024  # bodies this large are compressed off the event loop
+SEEN_BODIES = 4096  # hashes remembered to tell repeated bodies from one-offs
+UNCOMPRESSED_STATUSES = (204, 206, 304)
+
+
+def available_encodings() -> list:
+    installed = {GZIP: True, BROTLI: brotli is not None, ZSTD: compression.zstandard is not None}
+    names = [name.strip() for name in Config.RESPONSE_COMPRESSION_ENCODINGS.split(',')]
+    return [name for name in names if installed.get(name)]
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """The preferred encoding the client accepts, or None to send the body as-is"""
+    for encoding in available_encodings():
+        if compression.accepts_encoding(accept_encoding, encoding):
+            return encoding
+    return None
+
+
+class _Brotli:
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+def compressor(encoding: str):
+    """Streaming compressor for `encoding`: .compress(chunk) and .flush()"""
+    level = Config.RESPONSE_COMPRESSION_LEVELS[encoding]
+    if encoding == GZIP:
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == BROTLI:
+        return _Brotli(level)
+    return compression.zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    c = compressor(encoding)
+    return c.compress(body) + c.flush()
+
+
+def should_compress(status: int, headers: Headers) -> bool:
+    """Whether a response may be compressed at all, from its status and headers"""
+    if status in UNCOMPRESSED_STATUSES or status < 200:
+        return False
+    if 'content-encoding' in headers or 'content-range' in headers:
+        return False
+    if 'no-transform' in headers.get('cache-control', ''):
+        return False
+    content_type = headers.get('content-type', '')
+    if not content_type or content_type.startswith('text/event-stream'):
+        return False
+    return compression.compressible_type(content_type)
+
+
+# --- Compressed variants of repeated bodies ------------------------------
+
+class VariantCache:
+    """Compressed bodies by (encoding, body hash), for bodies seen more than once"""
+
+    def __init__(self, max_bytes: int):
+        self.entries = ResponseCache(max_bytes, evictions=metrics.COMPRESSION_VARIANT_EVICTIONS)
+        self._seen: "OrderedDict[tuple, None]" = OrderedDict()
+
+    def get(self, encoding: str, digest: bytes) -> Optional[bytes]:
+        entry = self.entries.get((encoding, digest))
+        return entry.body if entry is not None else None
+
+    def put(self, encoding: str, digest: bytes, compressed: bytes, content_type: bytes):
+        if (encoding, digest) not in self._seen:
+            # First sighting: most bodies are never sent again, don't spend the memory yet
+            self._seen[(encoding, digest)] = None
+            if len(self._seen) > SEEN_BODIES:
+                self._seen.popitem(last=False)
+            return
+        self.entries.put((encoding, digest), Entry(digest, compressed, content_type))
+
+    def clear(self):
+        self.entries.clear()
+        self._seen.clear()
+
+
+_variants: Optional[VariantCache] = None
+
+
+def get_variant_cache() -> VariantCache:
+    global _variants
+    if _variants is None:
+        _variants = VariantCache(Config.RESPONSE_COMPRESSION_CACHE_BYTES)
+    return _variants
+
+
+async def compress_body(body: bytes, encoding: str, content_type: bytes) -> bytes:
+    """Compressed `body`, from the variant cache when it was compressed before"""
+    variants = get_variant_cache()
+    digest = hashlib.sha256(body).digest()
+    compressed = variants.get(encoding, digest)
+    if compressed is not None:
+        metrics.COMPRESSION_VARIANT_CACHE.inc(1, 'hit')
+        return compressed
+    metrics.COMPRESSION_VARIANT_CACHE.inc(1, 'miss')
+    if len(body) >= OFFLOAD_SIZE:
+        compressed = await anyio.to_thread.run_sync(compress, body, encoding)
+    else:
+        compressed = compress(body, encoding)
+    variants.put(encoding, digest, compressed, content_type)
+    return compressed
+
+
+# --- Middleware -----------------------------------------------------------
+
+def _set_encoding(headers: MutableHeaders, encoding: str):
+    headers['content-encoding'] = encoding
+    if 'accept-encoding' not in headers.get('vary', '').lower():
+        headers.add_vary_header('Accept-Encoding')
+    # Ranges would refer to the uncompressed body
+    if 'accept-ranges' in headers:
+        del headers['accept-ranges']
+
+
+class CompressionMiddleware:
+    """Compresses compressible responses with the encoding the client prefers"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not Config.RESPONSE_COMPRESSION_ENABLED:
+            return await self.app(scope, receive, send)
+        encoding = negotiate(Headers(scope=scope).get('accept-encoding'))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        stream = None  # the compressor, once a streamed body is being compressed
+        passthrough = False
+
+        async def compressing_send(message):
+            nonlocal start, stream, passthrough
+            if message['type'] == 'http.response.start':
+                start = message
+                return  # held back until the first body chunk shows whether to compress
+            if message['type'] != 'http.response.body' or passthrough:
+                await send(message)
+                return
+
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if stream is not None:
+                metrics.COMPRESSION_INPUT_BYTES.inc(len(body), encoding)
+                out = stream.compress(body)
+                if not more_body:
+                    out += stream.flush()
+                if out or not more_body:
+                    metrics.COMPRESSION_OUTPUT_BYTES.inc(len(out), encoding)
+                    await send({'type': 'http.response.body', 'body': out, 'more_body': more_body})
+                return
+
+            headers = MutableHeaders(raw=list(start.get('headers', [])))
+            # A streamed body without a Content-Length is assumed large enough
+            length = int(headers.get('content-length', Config.RESPONSE_COMPRESSION_MIN_SIZE)) if more_body else len(body)
+            if not should_compress(start['status'], headers) or length < Config.RESPONSE_COMPRESSION_MIN_SIZE:
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+
+            if not more_body:
+                compressed = await compress_body(body, encoding, headers.get('content-type', '').encode())
+                metrics.COMPRESSION_INPUT_BYTES.inc(len(body), encoding)
+                metrics.COMPRESSION_OUTPUT_BYTES.inc(len(compressed), encoding)
+                _set_encoding(headers, encoding)
+                headers['content-length'] = str(len(compressed))
+                await send({**start, 'headers': headers.raw})
+                await send({'type': 'http.response.body', 'body': compressed})
+                return
+
+            # Streamed: compress each chunk as it goes; the length isn't known up front
+            _set_encoding(headers, encoding)
+            if 'content-length' in headers:
+                del headers['content-length']
+            await send({**start, 'headers': headers.raw})
+            stream = compressor(encoding)
+            metrics.COMPRESSION_INPUT_BYTES.inc(len(body), encoding)
+            out = stream.compress(body)
+            if out:
+                metrics.COMPRESSION_OUTPUT_BYTES.inc(len(out), encoding)
+                await send({'type': 'http.response.body', 'body': out, 'more_body': True})
+
+        await self.app(scope, receive, compressing_send)
@@ -0,0 +1,399 @@
+"""
+Background jobs: a persistent, database-backed queue processed in bounded
+batches.
+
+A job is a row in `jobs` plus a handler registered for its kind. A runner
+leases a job, runs one step of its handler and commits the step's work
+together with the job's cursor (Job.state) and the released lease. No
+transaction stays open for long, a job resumes exactly where it stopped
+after a restart, and a worker that dies mid-batch leaves only a lease that
+expires after Config.JOB_LEASE_SECONDS.
+
+Runners live in the API process (started from the lifespan) and/or in
+separate workers (worker.py); leases make any number of them safe. Each
+queue has a limit on concurrent batches (Config.JOB_QUEUES), counted over
+all runners. Within a queue, higher priority goes first, then the least
+recently run job, so long jobs take turns.
+
+Handlers implement:
+- start(db, job): seed the job's state when it is enqueued
+- step(db, job, state, batch_size) -> True once the job is done
+- finish(db, job, state, status): cleanup when the job completes, fails or
+  is cancelled (runs in the transaction that records the outcome)
+One-shot jobs can be plain functions decorated with @task.
+
+Raise JobError from step() to fail the job with a message for the user.
+Any other exception rolls the batch back and retries it with exponential
+backoff, up to max_attempts; JobRetry marks an expected, transient
+conflict, which is logged without a traceback.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import uuid
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import aliased
+from starlette.concurrency import run_in_threadpool
+
+from config import Config
+from models import SessionLocal, Job
+
+logger = logging.getLogger(__name__)
+
+HANDLERS: Dict[str, 'JobHandler'] = {}
+
+
+class JobRetry(Exception):
+    """Transient conflict: the batch is rolled back and rerun after a backoff"""
+
+
+class JobError(Exception):
+    """Expected failure (quota, invalid target); the message is shown to the user"""
+
+
+class JobHandler(ABC):
+    kind = 'abstract'
+    queue = 'default'
+    priority = 0  # higher runs first within the queue
+    max_attempts = None  # Config.JOB_MAX_ATTEMPTS
+
+    def start(self, db, job: Job):
+        pass
+
+    @abstractmethod
+    def step(self, db, job: Job, state: dict, batch_size: int) -> bool:
+        raise NotImplementedError
+
+    def finish(self, db, job: Job, state: dict, status: str):
+        pass
+
+
+def register(cls):
+    """Class decorator: handle jobs of cls.kind with an instance of cls"""
+    HANDLERS[cls.kind] = cls()
+    return cls
+
+
+def task(kind: str, queue: str = 'default', priority: int = 0, max_attempts: Optional[int] = None):
+    """Decorator for one-shot jobs: fn(db, job, **params) runs as a single batch"""
+    def decorate(fn: Callable):
+        class FunctionTask(JobHandler):
+            def step(self, db, job, state, batch_size):
+                fn(db, job, **job.load_params())
+                return True
+        FunctionTask.__name__ = fn.__name__
+        FunctionTask.kind, FunctionTask.queue = kind, queue
+        FunctionTask.priority, FunctionTask.max_attempts = priority, max_attempts
+        register(FunctionTask)
+        return fn
+    return decorate
+
+
+def enqueue(db, owner_id: int, kind: str, folder_id: Optional[int] = None,
+            target_folder_id: Optional[int] = None, params: Optional[dict] = None, state: Optional[dict] = None,
+            queue: Optional[str] = None, priority: Optional[int] = None) -> Job:
+    """Add a job to the session; the caller commits, then calls notify()"""
+    handler = HANDLERS.get(kind)
+    if handler is None:
+        raise ValueError(f"Unknown job kind {kind!r}")
+    job = Job(
+        owner_id=owner_id, kind=kind, folder_id=folder_id, target_folder_id=target_folder_id,
+        queue=queue or handler.queue,
+        priority=handler.priority if priority is None else priority,
+        max_attempts=handler.max_attempts or Config.JOB_MAX_ATTEMPTS
+    )
+    if params:
+        job.params = json.dumps(params)
+    job.save_state(state or {})
+    db.add(job)
+    db.flush()
+    handler.start(db, job)
+    return job
+
+
+def queue_limits(spec: Optional[str] = None) -> Dict[str, int]:
+    """Parse "name:limit,name:limit" (Config.JOB_QUEUES)"""
+    limits = {}
+    for part in (Config.JOB_QUEUES if spec is None else spec).split(','):
+        if part.strip():
+            name, _, limit = part.strip().partition(':')
+            limits[name] = max(1, int(limit or 1))
+    return limits
+
+
+def retry_delay(attempts: int) -> float:
+    """Seconds before attempt attempts + 1: exponential backoff with jitter"""
+    delay = min(Config.JOB_RETRY_MAX_SECONDS, Config.JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _release(job: Job):
+    job.lease_owner = None
+    job.lease_expires_at = None
+
+
+def _close(db, job: Job, handler: JobHandler, state: dict, status: str, error: Optional[str] = None):
+    handler.finish(db, job, state, status)
+    job.save_state(state)
+    job.status = status
+    job.error = error
+    job.finished_at = datetime.utcnow()
+    _release(job)
+
+
+def _renew_lease(db, job_id: int, worker_id: Optional[str]) -> bool:
+    """Check, inside the committing transaction, that the lease is still ours"""
+    if worker_id is None:
+        return True
+    return bool(db.query(Job).filter(Job.job_id == job_id, Job.lease_owner == worker_id).update(
+        {Job.lease_expires_at: datetime.utcnow() + timedelta(seconds=Config.JOB_LEASE_SECONDS)},
+        synchronize_session=False
+    ))
+
+
+def _retry_later(db, job_id: int, handler: JobHandler, error: Exception) -> bool:
+    """Count a failed attempt: back off, or fail the job once attempts run out"""
+    job = db.query(Job).get(job_id)
+    job.attempts = (job.attempts or 0) + 1
+    if isinstance(error, JobError) or job.attempts >= job.max_attempts:
+        if isinstance(error, JobError):
+            logger.info(f"Job {job_id} failed: {error}")
+        else:
+            logger.error(f"Job {job_id} failed after {job.attempts} attempts", exc_info=error)
+        _close(db, job, handler, job.load_state(), 'failed', str(error))
+        db.commit()
+        return False
+    delay = retry_delay(job.attempts)
+    logger.warning(f"Job {job_id} attempt {job.attempts} failed; retrying in {delay:.0f}s",
+                   exc_info=None if isinstance(error, JobRetry) else error)
+    job.error = str(error)
+    job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+    _release(job)
+    db.commit()
+    return True
+
+
+def run_batch(job_id: int, batch_size: Optional[int] = None, worker_id: Optional[str] = None) -> bool:
+    """
+    Run one batch of a job; returns True while it has more work. Runners
+    pass the worker_id holding the job's lease; without one the batch runs
+    unconditionally (CLI, tests).
+    """
+    db = SessionLocal()
+    try:
+        job = db.query(Job).get(job_id)
+        if job is None or job.status in Job.FINISHED:
+            return False
+        if worker_id is not None and job.lease_owner != worker_id:
+            return False
+        handler = HANDLERS[job.kind]
+        state = job.load_state()
+
+        if job.cancel_requested:
+            _close(db, job, handler, state, 'cancelled')
+            db.commit()
+            return False
+
+        if job.status == 'pending':
+            job.status = 'running'
+            job.started_at = datetime.utcnow()
+
+        try:
+            done = handler.step(db, job, state, batch_size or Config.JOB_BATCH_SIZE)
+        except Exception as e:
+            db.rollback()
+            if not _renew_lease(db, job_id, worker_id):
+                # Another worker took the job over; its attempts are its own
+                db.rollback()
+                logger.warning(f"Job {job_id}: lease lost, discarding failed batch")
+                return False
+            return _retry_later(db, job_id, handler, e)
+
+        if not _renew_lease(db, job_id, worker_id):
+            # Our lease expired and another worker took the job over; its run wins
+            db.rollback()
+            logger.warning(f"Job {job_id}: lease lost, discarding batch")
+            return False
+        if done:
+            _close(db, job, handler, state, 'completed')
+        else:
+            job.save_state(state)
+            _release(job)
+        job.run_after = None
+        db.commit()
+        return not done
+    finally:
+        db.close()
+
+
+def run_to_completion(job_id: int, batch_size: Optional[int] = None, max_batches: Optional[int] = None) -> int:
+    """Run a job's batches back to back in this thread, ignoring backoff (CLI, tests); returns how many ran"""
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        batches += 1
+        if not run_batch(job_id, batch_size):
+            break
+    return batches
+
+
+def claim(worker_id: str, queue: str, limit: int) -> Optional[int]:
+    """Lease the queue's next runnable job, unless the queue is already at its limit"""
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        active = db.query(func.count(Job.job_id)).filter(Job.queue == queue, Job.lease_expires_at > now).scalar()
+        if active >= limit:
+            return None
+
+        free = or_(Job.lease_expires_at == None, Job.lease_expires_at <= now)
+        candidates = db.query(Job.job_id).filter(
+            Job.queue == queue,
+            Job.status.in_(('pending', 'running')),
+            or_(Job.run_after == None, Job.run_after <= now),
+            free
+        ).order_by(Job.priority.desc(), Job.updated_at, Job.job_id).limit(5).all()
+
+        # Counted again in the UPDATE: runners claiming at the same moment can't overshoot the limit
+        leased = aliased(Job)
+        below_limit = select(func.count(leased.job_id)).where(
+            leased.queue == queue, leased.lease_expires_at > now
+        ).scalar_subquery() < limit
+        for (job_id,) in candidates:
+            # Conditional on the lease still being free: one runner wins each job
+            claimed = db.query(Job).filter(Job.job_id == job_id, free, below_limit).update({
+                Job.lease_owner: worker_id,
+                Job.lease_expires_at: now + timedelta(seconds=Config.JOB_LEASE_SECONDS)
+            }, synchronize_session=False)
+            db.commit()
+            if claimed:
+                return job_id
+        return None
+    finally:
+        db.close()
+
+
+def queue_metrics(db) -> Dict[str, dict]:
+    """Per queue: job counts by status, leases held, jobs backing off and the oldest wait"""
+    now = datetime.utcnow()
+    limits = queue_limits()
+    queues = {name: {'limit': limit} for name, limit in limits.items()}
+
+    def put(rows, key=None):
+        for row in rows:
+            queues.setdefault(row[0], {'limit': limits.get(row[0])})[key or row[1]] = row[-1]
+
+    put(db.query(Job.queue, Job.status, func.count(Job.job_id)).group_by(Job.queue, Job.status))
+    unfinished = Job.status.in_(('pending', 'running'))
+    put(db.query(Job.queue, func.count(Job.job_id)).filter(Job.lease_expires_at > now).group_by(Job.queue), 'leased')
+    put(db.query(Job.queue, func.count(Job.job_id)).filter(unfinished, Job.run_after > now).group_by(Job.queue), 'backing_off')
+    for queue, oldest in db.query(Job.queue, func.min(Job.created_at)).filter(Job.status == 'pending').group_by(Job.queue):
+        queues[queue]['oldest_pending_seconds'] = round((now - oldest).total_seconds(), 1)
+    return dict(sorted(queues.items()))
+
+
+class JobRunner:
+    """Claims and runs batches from a set of queues, up to each queue's limit"""
+
+    def __init__(self, queues: Optional[Dict[str, int]] = None, worker_id: Optional[str] = None,
+                 poll_seconds: Optional[float] = None):
+        self.queues = queues or queue_limits()
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.poll_seconds = Config.JOB_POLL_SECONDS if poll_seconds is None else poll_seconds
+        self.running = {queue: 0 for queue in self.queues}
+        self.stats = Counter()
+        self._wake = asyncio.Event()
+        self._batches = set()
+        self._task = None
+        self._loop = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Job runner {self.worker_id} serving {self.queues}")
+
+    async def stop(self, timeout: float = 30.0):
+        """Stop claiming, then give running batches time to commit"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._batches:
+            await asyncio.wait(self._batches, timeout=timeout)
+
+    def wake(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def status(self) -> dict:
+        return {
+            'worker_id': self.worker_id,
+            'queues': self.queues,
+            'running': dict(self.running),
+            'batches': dict(self.stats)
+        }
+
+    async def _run(self):
+        while True:
+            self._wake.clear()  # before looking, so a notify() during the lookup is not lost
+            for queue, limit in self.queues.items():
+                while self.running[queue] < limit:
+                    job_id = await run_in_threadpool(claim, self.worker_id, queue, limit)
+                    if job_id is None:
+                        break
+                    self.running[queue] += 1
+                    batch = asyncio.create_task(self._run_batch(queue, job_id))
+                    self._batches.add(batch)
+                    batch.add_done_callback(self._batches.discard)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_batch(self, queue: str, job_id: int):
+        try:
+            await run_in_threadpool(run_batch, job_id, None, self.worker_id)
+            self.stats['run'] += 1
+        except Exception:
+            self.stats['errors'] += 1
+            logger.exception(f"Job runner error on job {job_id}")
+        finally:
+            self.running[queue] -= 1
+            self._wake.set()  # a slot is free; the job itself may have more batches
+
+
+_runner: Optional[JobRunner] = None
+
+
+def get_runner() -> Optional[JobRunner]:
+    return _runner
+
+
+async def start_runner(queues: Optional[Dict[str, int]] = None) -> JobRunner:
+    global _runner
+    _runner = JobRunner(queues)
+    _runner.start()
+    return _runner
+
+
+async def stop_runner():
+    global _runner
+    if _runner:
+        await _runner.stop()
+        _runner = None
+
+
+def notify():
+    """Wake the local runner after committing a new job; other runners find it on their next poll"""
+    if _runner:
+        _runner.wake()
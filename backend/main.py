@@ -2,17 +2,29 @@
 FastAPI main application for EUCLOUD
 Migrated from Flask to FastAPI for better performance and modern features
 """
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Header, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+from typing import Optional
+import hmac
 from contextlib import asynccontextmanager
+import asyncio
 import os
 import logging
 import sys
 
 from config import Config
-from models import Base, engine
+from schema import create_schema
 from auth import get_current_user
+from blobstore import reset_blob_writer
+from storage import get_storage, get_thumbnail_storage
+from jobs import start_runner, stop_runner
+import metrics
+import sqlprofile
+import profiler
+from responsecache import ResponseCacheMiddleware
+from httpcompression import CompressionMiddleware
 
 # Import routers
 from routes.auth import router as auth_router
@@ -22,6 +34,14 @@ from routes.shares import router as shares_router
 from routes.storage import router as storage_router
 from routes.trash import router as trash_router
 from routes.extras import router as extras_router
+from routes.search import router as search_router
+from routes.versions import router as versions_router
+from routes.jobs import router as jobs_router
+from routes.events import router as events_router
+from routes.changes import router as changes_router
+from routes.blocksync import router as blocksync_router
+from routes.admin import router as admin_router
+import tasks  # noqa: F401  (registers the thumbnail and trash job handlers)
 
 
 # Configure logging
@@ -35,16 +55,38 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def sweep_incomplete_writes():
+    """Temp blobs older than an hour can only be leftovers of a crash mid-write"""
+    try:
+        removed = get_storage().sweep() + get_thumbnail_storage().sweep()
+    except Exception:
+        logger.exception("Could not sweep incomplete blob writes")
+        return
+    if removed:
+        logger.info(f"🧹 Removed {removed} incomplete blob writes")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan events"""
-    # Startup: Create database tables
-    Config.init_app(None)  # Initialize config (create directories)
-    Base.metadata.create_all(bind=engine)
-    logger.info("✅ Database tables created")
+    # Startup: Create database tables, unless `python schema.py` is run per deploy instead
+    if Config.SCHEMA_AUTO_CREATE:
+        create_schema()
+        logger.info("✅ Database tables created")
+    # Walks every upload folder, so it runs next to serving rather than before it
+    asyncio.get_running_loop().run_in_executor(None, sweep_incomplete_writes)
+    # Unfinished background jobs resume from their last committed batch;
+    # with JOB_RUNNER_IN_PROCESS off only worker.py processes run them
+    if Config.JOB_RUNNER_IN_PROCESS:
+        await start_runner()
+    if Config.LOOP_MONITOR_ENABLED:
+        profiler.start_loop_monitor()
     logger.info("🚀 EUCLOUD API started successfully")
     yield
-    # Shutdown: Cleanup if needed
+    # Shutdown: stop the job runner, flush pending group commits
+    await profiler.stop_loop_monitor()
+    await stop_runner()
+    reset_blob_writer()
     logger.info("👋 Shutting down EUCLOUD API")
 
 
@@ -56,6 +98,12 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Innermost: cached answers still get the CORS headers and the metrics
+app.add_middleware(ResponseCacheMiddleware)
+
+# Outside the response cache, which keeps (and hashes ETags over) uncompressed bodies
+app.add_middleware(CompressionMiddleware)
+
 # CORS Middleware - SSO Cookie Support for All EUsuite Apps
 app.add_middleware(
     CORSMiddleware,
@@ -74,11 +122,20 @@ app.add_middleware(
         "http://localhost:30090"
     ],
     allow_credentials=True,              # ⭐ CRITICAL for SSO cookies
-    allow_methods=["GET", "POST", "OPTIONS"],  # Explicit methods for security
-    allow_headers=["Content-Type", "Authorization"],  # Explicit headers
-    expose_headers=["Set-Cookie"],       # ⭐ Expose Set-Cookie header for credentials
+    allow_methods=["GET", "POST", "PATCH", "OPTIONS"],  # Explicit methods for security
+    allow_headers=["Content-Type", "Authorization", "If-Match", "If-None-Match"],  # Explicit headers
+    expose_headers=["Set-Cookie", "ETag"],  # ⭐ Expose Set-Cookie header for credentials
 )
 
+# Passes requests straight through unless SQL_PROFILING is on
+app.add_middleware(sqlprofile.SQLProfileMiddleware)
+if Config.SQL_PROFILING:
+    sqlprofile.install()
+
+# Outermost, so latency covers every other middleware too
+if Config.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
 
 # Root endpoints
 @app.get("/")
@@ -97,14 +154,33 @@ async def health():
     return {"status": "healthy"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint"""
+    if not Config.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if Config.METRICS_TOKEN and not hmac.compare_digest(authorization or '', f"Bearer {Config.METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    # Collectors query the database
+    body = await run_in_threadpool(metrics.render)
+    return Response(content=body, media_type=metrics.CONTENT_TYPE)
+
+
 # Include routers with /api prefix
 app.include_router(auth_router, prefix="/api/auth", tags=["Authentication"])
 app.include_router(files_router, prefix="/api/files", tags=["Files"])
+app.include_router(versions_router, prefix="/api/files", tags=["Versions"])
+app.include_router(blocksync_router, prefix="/api/files", tags=["Sync"])
 app.include_router(folders_router, prefix="/api/folders", tags=["Folders"])
 app.include_router(shares_router, prefix="/api/shares", tags=["Shares"])
 app.include_router(storage_router, prefix="/api/storage", tags=["Storage"])
 app.include_router(trash_router, prefix="/api/trash", tags=["Trash"])
 app.include_router(extras_router, prefix="/api/extras", tags=["Extras"])
+app.include_router(search_router, prefix="/api/search", tags=["Search"])
+app.include_router(jobs_router, prefix="/api/jobs", tags=["Jobs"])
+app.include_router(events_router, prefix="/api/events", tags=["Events"])
+app.include_router(changes_router, prefix="/api/changes", tags=["Changes"])
+app.include_router(admin_router, prefix="/api/admin", tags=["Admin"])
 
 
 # Global exception handler
@@ -0,0 +1,350 @@
+"""
+Prometheus metrics, exported in the text exposition format on /metrics.
+
+A small in-process registry rather than prometheus_client: the hot path of
+every request is a couple of dict lookups and list increments under an
+uncontended lock (see benchmarks/bench_metrics.py for the overhead).
+
+- MetricsMiddleware times every request and records, per route template
+  (never the raw path, which would explode the label set): latency, response
+  size, bytes received and sent, and the database queries it ran.
+- Database query counts and time come from engine cursor events and are
+  attributed to the request running them through a context variable, which
+  run_in_threadpool carries into sync endpoints and dependencies.
+- Values read from the database (job queue depths) are collected at scrape
+  time by register_collector() callbacks.
+
+Each process keeps its own registry; with several workers, scrape each one
+(or its pod) rather than the load balancer.
+"""
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+
+import jobs
+from models import SessionLocal, Job, engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (128, 1024, 8 * 1024, 64 * 1024, 512 * 1024, 4 * 1024 ** 2, 32 * 1024 ** 2, 256 * 1024 ** 2, 1024 ** 3)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda item: tuple(map(str, item[0])))
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items) -> List[str]:
+        return [f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}'
+                for labels, value in items]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, *labels):
+        self.inc(-amount, *labels)
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Per-bucket (not cumulative) counts, then sum and count
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[position] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, *labels) -> int:
+        series = self._values.get(labels)
+        return series[-1] if series else 0
+
+    def sum(self, *labels) -> float:
+        series = self._values.get(labels)
+        return series[-2] if series else 0.0
+
+    def _render_samples(self, items) -> List[str]:
+        lines = []
+        bounds = self.buckets + (float('inf'),)
+        for labels, series in items:
+            cumulative = 0
+            for bound, hits in zip(bounds, series):
+                cumulative += hits
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}')
+            suffix = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{suffix} {_format_value(series[-2])}')
+            lines.append(f'{self.name}_count{suffix} {series[-1]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception:
+                logger.exception("Metrics collector failed")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def register_collector(collect: Callable[[], None]) -> Callable[[], None]:
+    """Run `collect` before every scrape (e.g. to set gauges from the database)"""
+    REGISTRY.collectors.append(collect)
+    return collect
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+_ROUTE = ('method', 'route')
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'eucloud_http_request_duration_seconds', 'Time from request start to the last response byte', _ROUTE + ('status',)))
+REQUESTS_IN_PROGRESS = REGISTRY.register(Gauge(
+    'eucloud_http_requests_in_progress', 'Requests being handled, including open event streams', ('method',)))
+RESPONSE_SIZE = REGISTRY.register(Histogram(
+    'eucloud_http_response_size_bytes', 'Response body size', _ROUTE, buckets=SIZE_BUCKETS))
+RECEIVED_BYTES = REGISTRY.register(Counter(
+    'eucloud_http_received_bytes_total', 'Request body bytes received (uploads)', _ROUTE))
+SENT_BYTES = REGISTRY.register(Counter(
+    'eucloud_http_sent_bytes_total', 'Response body bytes sent (downloads)', _ROUTE))
+REQUEST_QUERIES = REGISTRY.register(Histogram(
+    'eucloud_http_request_db_queries', 'Database queries run per request', _ROUTE, buckets=QUERY_COUNT_BUCKETS))
+REQUEST_QUERY_TIME = REGISTRY.register(Histogram(
+    'eucloud_http_request_db_seconds', 'Database time per request', _ROUTE))
+DB_QUERIES = REGISTRY.register(Counter(
+    'eucloud_db_queries_total', 'Database queries, inside and outside requests'))
+DB_QUERY_TIME = REGISTRY.register(Counter(
+    'eucloud_db_query_seconds_total', 'Database time, inside and outside requests'))
+AUTH_CACHE = REGISTRY.register(Counter(
+    'eucloud_auth_cache_requests_total', 'Token lookups by whether the decoded token was cached', ('result',)))
+RESPONSE_CACHE = REGISTRY.register(Counter(
+    'eucloud_response_cache_requests_total', 'Cacheable listing requests by whether the response was cached',
+    ('route', 'result')))
+RESPONSE_CACHE_EVICTIONS = REGISTRY.register(Counter(
+    'eucloud_response_cache_evictions_total', 'Cached responses dropped to stay within the memory budget'))
+RESPONSE_CACHE_BYTES = REGISTRY.register(Gauge(
+    'eucloud_response_cache_bytes', 'Memory held by cached responses'))
+RESPONSE_CACHE_ENTRIES = REGISTRY.register(Gauge(
+    'eucloud_response_cache_entries', 'Cached responses'))
+COMPRESSION_INPUT_BYTES = REGISTRY.register(Counter(
+    'eucloud_response_compression_input_bytes_total', 'Response bytes before on-the-wire compression', ('encoding',)))
+COMPRESSION_OUTPUT_BYTES = REGISTRY.register(Counter(
+    'eucloud_response_compression_output_bytes_total', 'Response bytes after on-the-wire compression', ('encoding',)))
+COMPRESSION_VARIANT_CACHE = REGISTRY.register(Counter(
+    'eucloud_response_compression_cache_requests_total', 'Compressed bodies by whether a cached variant was reused', ('result',)))
+COMPRESSION_VARIANT_EVICTIONS = REGISTRY.register(Counter(
+    'eucloud_response_compression_cache_evictions_total', 'Compressed variants dropped to stay within the memory budget'))
+JOB_QUEUE = REGISTRY.register(Gauge(
+    'eucloud_job_queue_jobs', 'Unfinished background jobs by queue and state', ('queue', 'state')))
+THUMBNAIL_QUEUE = REGISTRY.register(Gauge(
+    'eucloud_thumbnail_queue_depth', 'Thumbnail jobs waiting or running'))
+
+
+# --- Database time per request ------------------------------------------
+
+class QueryStats:
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+_request_queries: contextvars.ContextVar[Optional[QueryStats]] = contextvars.ContextVar('request_queries', default=None)
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:  # None only for the dialect's own setup statements
+        context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    elapsed = time.perf_counter() - context._metrics_started
+    DB_QUERIES.inc()
+    DB_QUERY_TIME.inc(elapsed)
+    stats = _request_queries.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+
+
+def current_query_stats() -> Optional[QueryStats]:
+    """Queries run so far by the current request (None outside one)"""
+    return _request_queries.get()
+
+
+# --- Requests -----------------------------------------------------------
+
+_route_templates: Dict[object, str] = {}
+
+
+def route_template(scope) -> str:
+    """Path template of the route that handled the request ('/api/files/{file_id}'), after routing"""
+    endpoint = scope.get('endpoint')
+    if endpoint is None:
+        return '<unmatched>'
+    template = _route_templates.get(endpoint)
+    if template is None:
+        template = '<unknown>'
+        for route in scope['app'].router.routes:
+            if getattr(route, 'endpoint', None) is endpoint:
+                template = getattr(route, 'path_format', route.path)
+                break
+        _route_templates[endpoint] = template
+    return template
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware (no per-request task or body buffering, unlike BaseHTTPMiddleware)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        method = scope['method']
+        started = time.perf_counter()
+        stats = QueryStats()
+        token = _request_queries.set(stats)
+        received = 0
+        sent = 0
+        status_code = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get('body', b''))
+            return message
+
+        async def counting_send(message):
+            nonlocal sent, status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            elif message['type'] == 'http.response.body':
+                sent += len(message.get('body', b''))
+            await send(message)
+
+        REQUESTS_IN_PROGRESS.inc(1, method)
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            REQUESTS_IN_PROGRESS.dec(1, method)
+            _request_queries.reset(token)
+            route = route_template(scope)
+            REQUEST_LATENCY.observe(time.perf_counter() - started, method, route, str(status_code))
+            RESPONSE_SIZE.observe(sent, method, route)
+            if received:
+                RECEIVED_BYTES.inc(received, method, route)
+            SENT_BYTES.inc(sent, method, route)
+            REQUEST_QUERIES.observe(stats.count, method, route)
+            REQUEST_QUERY_TIME.observe(stats.seconds, method, route)
+
+
+# --- Scrape-time collectors ---------------------------------------------
+
+@register_collector
+def _collect_job_queues():
+    db = SessionLocal()
+    try:
+        JOB_QUEUE.clear()
+        for queue, counts in jobs.queue_metrics(db).items():
+            for state in ('pending', 'running', 'leased', 'backing_off'):
+                JOB_QUEUE.set(counts.get(state, 0), queue, state)
+        THUMBNAIL_QUEUE.set(db.query(Job).filter(Job.kind == 'thumbnail', Job.status.in_(('pending', 'running'))).count())
+    finally:
+        db.close()
@@ -0,0 +1,184 @@
+"""
+Online migration of existing blobs to the directory-sharded key layout
+({owner_id}/{ab}/{cd}/{uuid}.ext, see storage/layout.py).
+
+Safe to run while the service is up, and resumable: files are moved in
+batches ordered by file_id and the last finished id is checkpointed to a
+state file, so an interrupted run picks up where it stopped. Every move is:
+
+1. link (local disks) or copy the blob and its thumbnail to the new key;
+   the old key stays readable throughout
+2. repoint the row with a conditional UPDATE that only succeeds if the file
+   still has the old key and content version; a save that raced the copy
+   wins, the copy is dropped and the file is retried
+3. delete the old keys after a grace period, once requests that read the
+   row before the switch have had time to open them
+
+Usage:
+    python migrate_storage_layout.py [--batch-size 500] [--pause 0.2] [--dry-run]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+# Add backend directory to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import SessionLocal, File
+from responsecache import invalidate_user
+from storage import get_storage, get_thumbnail_storage, is_sharded_key, new_blob_key, thumbnail_key
+
+DEFAULT_STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'storage_layout_migration.json')
+MAX_ATTEMPTS = 3
+
+
+def load_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'last_file_id': 0}
+
+
+def save_state(state_path, state):
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    temp_path = state_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path)
+
+
+def place(driver, old_key, new_key):
+    """Make the blob available under new_key too, without removing old_key"""
+    if not driver.link(old_key, new_key):
+        driver.copy(old_key, new_key)
+
+
+def migrate_file(db, file_id, retired):
+    """Move one file to the sharded layout; returns 'migrated', 'skipped', 'missing' or 'conflict'"""
+    storage = get_storage()
+    thumbnails = get_thumbnail_storage()
+
+    for _ in range(MAX_ATTEMPTS):
+        row = db.query(
+            File.owner_id, File.filename, File.file_path, File.thumbnail_path, File.content_version
+        ).filter(File.file_id == file_id).first()
+        db.rollback()  # end the read transaction; don't hold it across blob I/O
+        if row is None:
+            return 'skipped'
+        if is_sharded_key(row.file_path):
+            return 'skipped'
+        if not storage.exists(row.file_path):
+            return 'missing'
+
+        new_key = new_blob_key(row.owner_id, row.filename)
+        place(storage, row.file_path, new_key)
+        new_thumbnail = row.thumbnail_path
+        if row.thumbnail_path and thumbnails.exists(row.thumbnail_path):
+            new_thumbnail = thumbnail_key(new_key)
+            place(thumbnails, row.thumbnail_path, new_thumbnail)
+
+        updated = db.query(File).filter(
+            File.file_id == file_id,
+            File.file_path == row.file_path,
+            File.content_version == row.content_version
+        ).update({File.file_path: new_key, File.thumbnail_path: new_thumbnail}, synchronize_session=False)
+        if updated and new_thumbnail != row.thumbnail_path:
+            invalidate_user(db, row.owner_id)  # listings show the thumbnail key
+        db.commit()
+
+        if updated:
+            # Copies made by reference keep the old key until they are migrated themselves
+            still_shared = db.query(File.file_id).filter(File.file_path == row.file_path).first() is not None
+            db.rollback()
+            if not still_shared:
+                retired.append((storage, row.file_path))
+            if new_thumbnail != row.thumbnail_path:
+                retired.append((thumbnails, row.thumbnail_path))
+            return 'migrated'
+
+        # The file was saved (or moved) while we copied it: drop our copy and retry
+        storage.delete(new_key)
+        if new_thumbnail != row.thumbnail_path:
+            thumbnails.delete(new_thumbnail)
+    return 'conflict'
+
+
+def migrate_storage_layout(batch_size=500, pause=0.0, grace_seconds=5.0, state_path=DEFAULT_STATE_PATH,
+                           restart=False, dry_run=False, max_batches=None):
+    """Run (or resume) the migration; returns the summary counters"""
+    state = {'last_file_id': 0} if restart else load_state(state_path)
+    summary = {'migrated': 0, 'skipped': 0, 'missing': 0, 'conflict': 0}
+    print(f"\nMigrating blobs to the sharded layout, starting after file {state['last_file_id']}...")
+
+    db = SessionLocal()
+    batches = 0
+    try:
+        while max_batches is None or batches < max_batches:
+            ids = [file_id for (file_id,) in db.query(File.file_id).filter(
+                File.file_id > state['last_file_id']
+            ).order_by(File.file_id).limit(batch_size)]
+            db.rollback()
+            if not ids:
+                break
+
+            retired = []
+            for file_id in ids:
+                if dry_run:
+                    file_path = db.query(File.file_path).filter(File.file_id == file_id).scalar()
+                    outcome = 'skipped' if is_sharded_key(file_path) else 'migrated'
+                else:
+                    try:
+                        outcome = migrate_file(db, file_id, retired)
+                    except Exception as e:
+                        db.rollback()
+                        print(f"❌ Error migrating file {file_id}: {str(e)}")
+                        outcome = 'conflict'
+                summary[outcome] += 1
+                if outcome in ('missing', 'conflict'):
+                    print(f"⚠️  File {file_id}: {outcome}, left in place")
+
+            if retired:
+                time.sleep(grace_seconds)
+                for driver, key in retired:
+                    driver.delete(key)
+
+            state['last_file_id'] = ids[-1]
+            if not dry_run:
+                save_state(state_path, state)
+            batches += 1
+            print(f"✅ Batch {batches}: up to file {ids[-1]} "
+                  f"({summary['migrated']} migrated, {summary['skipped']} already sharded)")
+            if pause:
+                time.sleep(pause)
+    finally:
+        db.close()
+
+    print("\n📊 Migration Summary:")
+    for outcome, count in summary.items():
+        print(f"   {outcome.capitalize()}: {count}")
+    if summary['conflict'] or summary['missing']:
+        print("   Re-run with --restart to retry files left in place")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move existing blobs to the sharded key layout")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.2, help='seconds to sleep between batches')
+    parser.add_argument('--grace-seconds', type=float, default=5.0, help='delay before old keys are deleted')
+    parser.add_argument('--state', default=DEFAULT_STATE_PATH, help='checkpoint file')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and scan all files')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("EUCLOUD Storage Layout Migration")
+    print("=" * 60)
+    migrate_storage_layout(args.batch_size, args.pause, args.grace_seconds, args.state, args.restart, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
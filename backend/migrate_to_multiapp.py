@@ -12,25 +12,15 @@ from pathlib import Path
 # Add backend directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from sqlalchemy import text, inspect
-from models import engine, get_db, File
+import migrations
+from models import get_db, File
 from config import Config
 
 def add_app_type_column():
-    """Add app_type column to files table if it doesn't exist"""
-    print("Checking for app_type column...")
-    
-    inspector = inspect(engine)
-    columns = [col['name'] for col in inspector.get_columns('files')]
-    
-    if 'app_type' not in columns:
-        print("Adding app_type column to files table...")
-        with engine.connect() as conn:
-            conn.execute(text("ALTER TABLE files ADD COLUMN app_type VARCHAR(50) DEFAULT 'generic'"))
-            conn.commit()
-        print("✅ app_type column added successfully")
-    else:
-        print("✅ app_type column already exists")
+    """Add app_type column to files table if it doesn't exist (now part of the schema migrations)"""
+    print("Applying schema migrations...")
+    applied = migrations.upgrade()
+    print(f"✅ Applied {len(applied)} schema migration(s)" if applied else "✅ Schema is up to date")
 
 def migrate_file_storage():
     """
@@ -0,0 +1,182 @@
+"""
+Versioned schema migrations.
+
+Each change to the schema of an existing deployment is a module in
+migrations/versions/, named <4-digit version>_<name>.py, with an
+upgrade(op) function; `op` is an operations.Operations, whose operations
+are safe to run while the API serves traffic (concurrent index builds,
+batched and throttled backfills, DDL that won't queue behind long
+queries). Applied versions are recorded in the schema_migrations table.
+
+    python -m migrations            # apply pending migrations (also: upgrade)
+    python -m migrations status     # applied and pending versions
+
+`python schema.py`, and the API and worker.py on startup when
+SCHEMA_AUTO_CREATE is on, run the same upgrade. One runner at a time:
+others wait for its lock (a PostgreSQL advisory lock, a lock file next to
+a SQLite database).
+
+Migrations run before the code that needs them is deployed, so they only
+add: new tables, nullable or constant-default columns, indexes. Removing
+what old code still uses waits for a later release (expand, then
+contract). Operations are idempotent, so a migration cut short is simply
+run again.
+"""
+import importlib
+import logging
+import pkgutil
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, select, text
+from sqlalchemy.engine import Engine
+
+from migrations.operations import Operations
+
+try:
+    import fcntl
+except ImportError:  # Windows: msvcrt byte-range locks instead
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger('migrations')
+
+VERSION_MODULE = re.compile(r'^(\d{4})_(\w+)$')
+ADVISORY_LOCK_ID = 0x6575636c6f7564  # 'eucloud'
+
+tracking = MetaData()
+schema_migrations = Table(
+    'schema_migrations', tracking,
+    Column('version', String(32), primary_key=True),
+    Column('name', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+    Column('duration_ms', Integer, nullable=False),
+)
+
+
+class Migration(NamedTuple):
+    version: str
+    name: str
+    module: object
+
+    @property
+    def description(self) -> str:
+        return (self.module.__doc__ or '').strip().split('\n')[0]
+
+
+def load_migrations() -> List[Migration]:
+    """Every migration in migrations/versions/, oldest first"""
+    from migrations import versions
+    found = []
+    for info in pkgutil.iter_modules(versions.__path__):
+        match = VERSION_MODULE.match(info.name)
+        if not match:
+            continue
+        module = importlib.import_module(f'{versions.__name__}.{info.name}')
+        found.append(Migration(match.group(1), match.group(2), module))
+    found.sort(key=lambda migration: migration.version)
+    versions_seen = [migration.version for migration in found]
+    if len(set(versions_seen)) != len(versions_seen):
+        raise RuntimeError(f"Duplicate migration versions in {versions.__path__[0]}")
+    return found
+
+
+def _engine(engine: Optional[Engine]) -> Engine:
+    if engine is None:
+        from models import engine
+    return engine
+
+
+@contextmanager
+def migration_lock(engine: Engine):
+    """Held for a whole upgrade, so concurrent runners apply each migration once"""
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:id)"), {'id': ADVISORY_LOCK_ID})
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {'id': ADVISORY_LOCK_ID})
+        return
+    database = engine.url.database if engine.dialect.name == 'sqlite' else None
+    if not database or database == ':memory:':
+        yield
+        return
+    with open(f'{database}.migrate.lock', 'w') as lock_file:
+        _lock_file(lock_file)
+        try:
+            yield
+        finally:
+            _unlock_file(lock_file)
+
+
+def _lock_file(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            # LK_LOCK itself gives up after ten one-second retries
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock_file(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def applied_versions(engine: Optional[Engine] = None) -> dict:
+    """version -> applied_at"""
+    engine = _engine(engine)
+    tracking.create_all(bind=engine)
+    with engine.connect() as conn:
+        return {row.version: row.applied_at for row in conn.execute(select(schema_migrations))}
+
+
+def pending(engine: Optional[Engine] = None) -> List[Migration]:
+    applied = applied_versions(engine)
+    return [migration for migration in load_migrations() if migration.version not in applied]
+
+
+def upgrade(engine: Optional[Engine] = None, target: Optional[str] = None) -> List[str]:
+    """Apply pending migrations (up to and including target); returns the versions applied"""
+    engine = _engine(engine)
+    done = []
+    with migration_lock(engine):
+        op = Operations(engine)
+        for migration in pending(engine):  # read under the lock: another runner may just have finished
+            if target is not None and migration.version > target:
+                break
+            logger.info(f"Applying {migration.version}_{migration.name}: {migration.description}")
+            started = time.monotonic()
+            migration.module.upgrade(op)
+            elapsed_ms = int((time.monotonic() - started) * 1000)
+            with engine.begin() as conn:
+                conn.execute(schema_migrations.insert().values(
+                    version=migration.version, name=migration.name,
+                    applied_at=datetime.utcnow(), duration_ms=elapsed_ms,
+                ))
+            logger.info(f"Applied {migration.version}_{migration.name} in {elapsed_ms} ms")
+            done.append(migration.version)
+    return done
+
+
+def status(engine: Optional[Engine] = None) -> List[dict]:
+    applied = applied_versions(engine)
+    return [
+        {'version': migration.version, 'name': migration.name, 'description': migration.description,
+         'applied_at': applied.get(migration.version)}
+        for migration in load_migrations()
+    ]
+
+
+__all__ = ['Migration', 'Operations', 'load_migrations', 'applied_versions', 'pending', 'upgrade', 'status']
@@ -0,0 +1,29 @@
+"""
+    python -m migrations [upgrade [--target VERSION] | status]
+"""
+import argparse
+import logging
+import sys
+
+import migrations
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m migrations', description="Apply or list schema migrations")
+    parser.add_argument('command', nargs='?', choices=('upgrade', 'status'), default='upgrade')
+    parser.add_argument('--target', help='stop after this version')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+    if args.command == 'status':
+        for row in migrations.status():
+            state = row['applied_at'].strftime('%Y-%m-%d %H:%M') if row['applied_at'] else 'pending'
+            print(f"{row['version']}  {row['name']:<30} {state:<17} {row['description']}")
+        return
+    applied = migrations.upgrade(target=args.target)
+    print(f"Applied {len(applied)} migration(s)" if applied else "Database is up to date")
+
+
+if __name__ == '__main__':
+    main()
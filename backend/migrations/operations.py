@@ -0,0 +1,201 @@
+"""
+Schema operations for migrations, safe to run next to live traffic.
+
+Every operation checks before it acts (a column that exists is not added
+again, an index that exists is not rebuilt), so a migration interrupted
+halfway is simply run again. Writes are kept short so the API keeps
+serving while a migration runs:
+
+- DDL runs in its own short transaction. On PostgreSQL it gives up after
+  MIGRATION_LOCK_TIMEOUT_MS instead of queueing for its lock behind a long
+  query (and everything else behind it), then retries.
+- Indexes are built with CREATE INDEX CONCURRENTLY on PostgreSQL, which
+  doesn't block writes to the table; a build that failed halfway leaves
+  an INVALID index, which is dropped and rebuilt. SQLite has no online
+  index builds: the table is locked for writes while the index is built.
+- Backfills update rows in primary key batches of MIGRATION_BATCH_SIZE,
+  each its own transaction, and sleep MIGRATION_THROTTLE times as long as
+  each batch took before the next one.
+"""
+import logging
+import time
+from typing import Callable, Iterator, List, Optional, Sequence
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+from config import Config
+
+logger = logging.getLogger('migrations')
+
+DDL_RETRIES = 5
+LOCK_NOT_AVAILABLE = '55P03'  # PostgreSQL: lock_timeout expired
+
+
+def index_ddl(dialect: str, name: str, table: str, columns: Sequence[str], unique: bool = False,
+              where: Optional[str] = None) -> str:
+    """CREATE INDEX for this dialect: concurrent on PostgreSQL"""
+    concurrently = ' CONCURRENTLY' if dialect == 'postgresql' else ''
+    sql = (f"CREATE {'UNIQUE ' if unique else ''}INDEX{concurrently} IF NOT EXISTS {name} "
+           f"ON {table} ({', '.join(columns)})")
+    if where:
+        sql += f" WHERE {where}"
+    return sql
+
+
+def drop_index_ddl(dialect: str, name: str) -> str:
+    concurrently = ' CONCURRENTLY' if dialect == 'postgresql' else ''
+    return f"DROP INDEX{concurrently} IF EXISTS {name}"
+
+
+class Operations:
+    """What a migration's upgrade(op) gets to change the schema with"""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+
+    # --- Looking before acting -----------------------------------------
+
+    def has_table(self, table: str) -> bool:
+        with self.engine.connect() as conn:
+            return inspect(conn).has_table(table)
+
+    def columns(self, table: str) -> List[str]:
+        with self.engine.connect() as conn:
+            if not inspect(conn).has_table(table):
+                return []
+            return [column['name'] for column in inspect(conn).get_columns(table)]
+
+    def has_index(self, table: str, name: str) -> bool:
+        """An index or unique constraint of that name (SQLite keeps the two apart)"""
+        with self.engine.connect() as conn:
+            inspector = inspect(conn)
+            if not inspector.has_table(table):
+                return False
+            names = {index['name'] for index in inspector.get_indexes(table)}
+            names |= {constraint['name'] for constraint in inspector.get_unique_constraints(table)}
+            return name in names
+
+    # --- Changing the schema -------------------------------------------
+
+    def execute(self, sql: str, params: Optional[dict] = None):
+        """One statement in its own transaction, retried while its locks are held elsewhere"""
+        for attempt in range(DDL_RETRIES):
+            try:
+                with self.engine.begin() as conn:
+                    if self.dialect == 'postgresql':
+                        conn.execute(text(f"SET LOCAL lock_timeout = {int(Config.MIGRATION_LOCK_TIMEOUT_MS)}"))
+                    return conn.execute(text(sql), params or {}).rowcount
+            except OperationalError as error:
+                if getattr(error.orig, 'pgcode', None) != LOCK_NOT_AVAILABLE or attempt == DDL_RETRIES - 1:
+                    raise
+                logger.warning(f"Lock not available, retrying: {sql}")
+                time.sleep(2 ** attempt)
+
+    def add_column(self, table: str, column: str, ddl: str) -> bool:
+        """ALTER TABLE ... ADD COLUMN unless the table is missing or has it; True if added
+
+        Keep defaults constant: PostgreSQL then adds the column without
+        rewriting the table."""
+        columns = self.columns(table)
+        if not columns or column in columns:
+            return False
+        self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+        logger.info(f"Added {table}.{column}")
+        return True
+
+    def create_index(self, name: str, table: str, columns: Sequence[str], unique: bool = False,
+                     where: Optional[str] = None) -> bool:
+        """Build an index unless the table is missing or has it; True if built"""
+        if not self.has_table(table):
+            return False
+        if self.dialect == 'postgresql':
+            return self._create_index_concurrently(name, table, columns, unique, where)
+        if self.has_index(table, name):
+            return False
+        self.execute(index_ddl(self.dialect, name, table, columns, unique, where))
+        logger.info(f"Built index {name}")
+        return True
+
+    def _create_index_concurrently(self, name, table, columns, unique, where) -> bool:
+        # Neither CONCURRENTLY statement may run inside a transaction block
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            valid = conn.execute(text(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+            ), {'name': name}).scalar()
+            if valid:
+                return False
+            if valid is False:
+                logger.warning(f"Rebuilding index {name}, left invalid by an interrupted build")
+                conn.execute(text(drop_index_ddl(self.dialect, name)))
+            conn.execute(text(index_ddl(self.dialect, name, table, columns, unique, where)))
+        logger.info(f"Built index {name}")
+        return True
+
+    def drop_index(self, name: str):
+        if self.dialect == 'postgresql':
+            with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text(drop_index_ddl(self.dialect, name)))
+        else:
+            self.execute(drop_index_ddl(self.dialect, name))
+
+    def create_tables(self, metadata):
+        """Create the tables of metadata that don't exist yet, with their indexes"""
+        with self.engine.begin() as conn:
+            metadata.create_all(bind=conn, checkfirst=True)
+
+    def create_declared_indexes(self, metadata):
+        """Build every index the models declare that an existing table is missing"""
+        for table in metadata.sorted_tables:
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                self.create_index(index.name, table.name, [column.name for column in index.columns],
+                                  unique=index.unique)
+
+    # --- Changing data -------------------------------------------------
+
+    def batches(self, table: str, key: str, where: str = '1=1', params: Optional[dict] = None,
+                batch_size: Optional[int] = None) -> Iterator[List[int]]:
+        """Primary keys of matching rows, ascending, a batch at a time, with
+        a throttling pause after each batch the caller processed"""
+        batch_size = batch_size or Config.MIGRATION_BATCH_SIZE
+        last = None
+        while True:
+            with self.engine.connect() as conn:
+                keys = [row[0] for row in conn.execute(text(
+                    f"SELECT {key} FROM {table} WHERE ({where})"
+                    f"{f' AND {key} > :_last' if last is not None else ''} ORDER BY {key} LIMIT :_limit"
+                ), {**(params or {}), '_last': last, '_limit': batch_size})]
+            if not keys:
+                return
+            started = time.monotonic()
+            yield keys
+            time.sleep((time.monotonic() - started) * Config.MIGRATION_THROTTLE)
+            last = keys[-1]
+
+    def backfill(self, table: str, key: str, assignments: str, where: str = '1=1', params: Optional[dict] = None,
+                 batch_size: Optional[int] = None) -> int:
+        """UPDATE table SET assignments WHERE where, in batches; returns the rows updated
+
+        Resumable when where excludes rows already done (e.g. "col IS NULL")."""
+        total = 0
+        for keys in self.batches(table, key, where, params, batch_size):
+            total += self.execute(
+                f"UPDATE {table} SET {assignments} WHERE {key} BETWEEN :_first AND :_last AND ({where})",
+                {**(params or {}), '_first': keys[0], '_last': keys[-1]},
+            )
+        if total:
+            logger.info(f"Backfilled {total} rows of {table}")
+        return total
+
+    def each_batch(self, table: str, key: str, process: Callable, where: str = '1=1', params: Optional[dict] = None,
+                   batch_size: Optional[int] = None) -> int:
+        """Call process(conn, keys) per batch, each in its own transaction; for
+        backfills computed in Python"""
+        total = 0
+        for keys in self.batches(table, key, where, params, batch_size):
+            with self.engine.begin() as conn:
+                process(conn, keys)
+            total += len(keys)
+        return total
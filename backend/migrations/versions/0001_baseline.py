@@ -0,0 +1,102 @@
+"""Current schema, and the upgrades migrate_db.py and migrate_to_multiapp.py applied
+
+A new database gets every table at once. One created by an older release
+(create_all on startup, then the migrate scripts, perhaps not all of them)
+gets the tables, columns and indexes it lacks, with the backfills those
+scripts ran.
+"""
+from sqlalchemy import text
+
+from models import Base, Comment
+import search  # noqa: F401  (its tables are created with the rest)
+
+ADDED_COLUMNS = [
+    ('files', 'app_type', "VARCHAR(50) DEFAULT 'generic'"),
+    ('files', 'is_deleted', "BOOLEAN DEFAULT FALSE"),
+    ('files', 'deleted_at', "TIMESTAMP"),
+    ('files', 'is_favorite', "BOOLEAN DEFAULT FALSE"),
+    ('files', 'content_version', "INTEGER NOT NULL DEFAULT 1"),
+    ('files', 'stored_encoding', "VARCHAR(16) NOT NULL DEFAULT 'identity'"),
+    ('files', 'physical_size', "BIGINT"),
+    ('comments', 'root_comment_id', "INTEGER"),
+    ('comments', 'path', "VARCHAR(255)"),
+    ('comments', 'depth', "INTEGER DEFAULT 0"),
+    ('tags', 'file_count', "INTEGER NOT NULL DEFAULT 0"),
+    ('file_versions', 'storage_kind', "VARCHAR(10) NOT NULL DEFAULT 'full'"),
+    ('file_versions', 'base_version_id', "INTEGER REFERENCES file_versions (version_id)"),
+    ('file_versions', 'stored_size', "BIGINT"),
+    ('file_versions', 'content_hash', "VARCHAR(64)"),
+    ('jobs', 'queue', "VARCHAR(30) NOT NULL DEFAULT 'default'"),
+    ('jobs', 'priority', "INTEGER NOT NULL DEFAULT 0"),
+    ('jobs', 'attempts', "INTEGER NOT NULL DEFAULT 0"),
+    ('jobs', 'max_attempts', "INTEGER NOT NULL DEFAULT 5"),
+    ('jobs', 'run_after', "TIMESTAMP"),
+    ('jobs', 'lease_owner', "VARCHAR(100)"),
+    ('jobs', 'lease_expires_at', "TIMESTAMP"),
+    ('users', 'change_seq', "BIGINT NOT NULL DEFAULT 0"),
+    ('users', 'change_floor', "BIGINT NOT NULL DEFAULT 0"),
+]
+
+# Unique constraints of the models that older databases got as unique indexes
+UNIQUE_INDEXES = [
+    ('uq_file_versions_file_number', 'file_versions', ('file_id', 'version_number')),
+    ('uq_tags_user_name', 'tags', ('user_id', 'tag_name')),
+    ('uq_file_tags_file_tag', 'file_tags', ('file_id', 'tag_id')),
+]
+
+
+def upgrade(op):
+    op.create_tables(Base.metadata)
+    added = {(table, column) for table, column, ddl in ADDED_COLUMNS if op.add_column(table, column, ddl)}
+
+    # Jobs from before queues existed were all folder jobs
+    if ('jobs', 'queue') in added:
+        op.backfill('jobs', 'job_id', "queue = 'folders'", "kind LIKE 'folder_%'")
+    op.drop_index('ix_jobs_status')  # superseded by ix_jobs_claim
+
+    if not op.has_index('file_tags', 'uq_file_tags_file_tag'):
+        op.execute("DELETE FROM file_tags WHERE file_tag_id NOT IN "
+                   "(SELECT MIN(file_tag_id) FROM file_tags GROUP BY file_id, tag_id)")
+    for name, table, columns in UNIQUE_INDEXES:
+        if not op.has_index(table, name):
+            op.create_index(name, table, columns, unique=True)
+    op.create_declared_indexes(Base.metadata)
+
+    op.backfill('files', 'file_id', "physical_size = file_size", "physical_size IS NULL")
+    op.backfill('file_versions', 'version_id', "stored_size = file_size", "stored_size IS NULL")
+    if ('tags', 'file_count') in added:
+        op.backfill('tags', 'tag_id',
+                    "file_count = (SELECT COUNT(*) FROM file_tags WHERE file_tags.tag_id = tags.tag_id)")
+    if op.has_table('comments'):
+        op.each_batch('comments', 'comment_id', place_comments, "path IS NULL")
+
+
+def place_comments(conn, ids):
+    """Thread positions for comments from before threads; parents have
+    smaller ids than their replies, so theirs are always set already"""
+    rows = conn.execute(text(
+        f"SELECT comment_id, parent_comment_id FROM comments WHERE comment_id IN ({', '.join(map(str, ids))}) "
+        "ORDER BY comment_id"
+    )).fetchall()
+    parent_ids = {parent_id for _, parent_id in rows if parent_id}
+    positions = {}
+    if parent_ids:
+        positions = {row[0]: tuple(row[1:]) for row in conn.execute(text(
+            "SELECT comment_id, root_comment_id, path, depth FROM comments "
+            f"WHERE path IS NOT NULL AND comment_id IN ({', '.join(map(str, parent_ids))})"
+        ))}
+    for comment_id, parent_id in rows:
+        segment = str(comment_id).zfill(Comment.PATH_SEGMENT_WIDTH) + '/'
+        if parent_id in positions:
+            root_id, parent_path, parent_depth = positions[parent_id]
+            position = (root_id, parent_path + segment, parent_depth + 1)
+        else:
+            # A root, or an orphan whose parent is gone: it starts its own thread, where
+            # the threads query (roots have no parent) can list it
+            position = (comment_id, segment, 0)
+            parent_id = None
+        positions[comment_id] = position
+        conn.execute(text("UPDATE comments SET root_comment_id = :root, path = :path, depth = :depth, "
+                          "parent_comment_id = :parent WHERE comment_id = :id"),
+                     {'root': position[0], 'path': position[1], 'depth': position[2], 'parent': parent_id,
+                      'id': comment_id})
@@ -0,0 +1 @@
+"""Migration modules, <4-digit version>_<name>.py; see migrations/__init__.py"""
@@ -3,7 +3,8 @@ SQLAlchemy models for FastAPI
 Pure SQLAlchemy implementation (no Flask-SQLAlchemy)
 """
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, Boolean, DateTime, Text, ForeignKey
+import json
+from sqlalchemy import create_engine, Column, Integer, String, BigInteger, Boolean, DateTime, Text, ForeignKey, Index, UniqueConstraint, update, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, Session
 from argon2 import PasswordHasher
@@ -11,10 +12,12 @@ from argon2.exceptions import VerifyMismatchError
 import os
 
 # Database setup
-DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///./instance/eucloud.db')
+DEFAULT_DATABASE_URL = 'sqlite:///./instance/eucloud.db'
+DATABASE_URL = os.environ.get('DATABASE_URL', DEFAULT_DATABASE_URL)
 
-# Create instance directory if it doesn't exist
-os.makedirs('./instance', exist_ok=True)
+# Create instance directory if it doesn't exist (only the default database lives there)
+if DATABASE_URL == DEFAULT_DATABASE_URL:
+    os.makedirs('./instance', exist_ok=True)
 
 engine = create_engine(
     DATABASE_URL, 
@@ -47,6 +50,8 @@ class User(Base):
     password_hash = Column(String(255), nullable=False)
     storage_quota = Column(BigInteger, default=5368709120)  # 5GB
     storage_used = Column(BigInteger, default=0)
+    change_seq = Column(BigInteger, default=0, nullable=False)  # last change journal entry (see changefeed.py)
+    change_floor = Column(BigInteger, default=0, nullable=False)  # older cursors lost tombstones to compaction
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -128,6 +133,9 @@ class File(Base):
     is_deleted = Column(Boolean, default=False)
     deleted_at = Column(DateTime, nullable=True)
     is_favorite = Column(Boolean, default=False)
+    content_version = Column(Integer, default=1, nullable=False)  # bumped on every content write
+    stored_encoding = Column(String(16), default='identity', nullable=False)  # 'identity' or 'zstd' (see compression.py)
+    physical_size = Column(BigInteger, nullable=True)  # bytes on disk; file_size stays the logical size
     created_at = Column(DateTime, default=datetime.utcnow)
     modified_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -136,8 +144,20 @@ class File(Base):
     folder = relationship('Folder', back_populates='files')
     shares = relationship('Share', back_populates='file', cascade='all, delete-orphan')
     versions = relationship('FileVersion', back_populates='file', cascade='all, delete-orphan')
+    # Read-only view of the file's tags; load with selectinload(File.tags) for listings
+    tags = relationship('Tag', secondary='file_tags', viewonly=True, order_by='Tag.tag_name')
     
-    def to_dict(self):
+    __table_args__ = (
+        # Copies may share a blob (see filecopy.py); deletes and writes look up its other users
+        Index('ix_files_file_path', 'file_path'),
+        Index('ix_files_folder_file', 'folder_id', 'file_id'),  # folder listings and tree walks
+    )
+    
+    def content_etag(self):
+        """Strong ETag identifying the current content version"""
+        return f'"{self.file_id}-{self.content_version or 1}"'
+    
+    def to_dict(self, include_tags=False):
         """Convert to dictionary"""
         data = {
             'id': self.file_id,
@@ -152,6 +172,8 @@ class File(Base):
             'created_at': self.created_at.isoformat(),
             'updated_at': self.modified_at.isoformat(),
             'modified_at': self.modified_at.isoformat(),
+            'version': self.content_version or 1,
+            'physical_size': self.physical_size if self.physical_size is not None else self.file_size,
             'type': 'file'
         }
         
@@ -161,6 +183,8 @@ class File(Base):
             data['deleted_at'] = self.deleted_at.isoformat()
         if self.is_favorite is not None:
             data['is_favorite'] = self.is_favorite
+        if include_tags:
+            data['tags'] = [{'tag_id': t.tag_id, 'tag_name': t.tag_name, 'color': t.color} for t in self.tags]
             
         return data
 
@@ -223,9 +247,18 @@ class FileVersion(Base):
     file_id = Column(Integer, ForeignKey('files.file_id'), nullable=False)
     version_number = Column(Integer, nullable=False)
     file_path = Column(Text, nullable=False)
-    file_size = Column(BigInteger, nullable=False)
+    file_size = Column(BigInteger, nullable=False)  # logical size of this version's content
+    storage_kind = Column(String(10), default='full', nullable=False)  # 'full' snapshot or 'delta'
+    base_version_id = Column(Integer, ForeignKey('file_versions.version_id'), nullable=True)  # snapshot a delta applies to
+    stored_size = Column(BigInteger, nullable=True)  # bytes actually used on disk
+    content_hash = Column(String(64), nullable=True)  # sha256 of the logical content
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        UniqueConstraint('file_id', 'version_number', name='uq_file_versions_file_number'),
+        Index('ix_file_versions_base', 'base_version_id'),
+    )
+    
     # Relationships
     file = relationship('File', back_populates='versions')
     
@@ -236,6 +269,8 @@ class FileVersion(Base):
             'file_id': self.file_id,
             'version_number': self.version_number,
             'file_size': self.file_size,
+            'storage_kind': self.storage_kind,
+            'stored_size': self.stored_size,
             'created_at': self.created_at.isoformat()
         }
 
@@ -274,13 +309,45 @@ class Tag(Base):
     tag_name = Column(String(50), nullable=False)
     color = Column(String(7), default='#667eea')
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
+    file_count = Column(Integer, default=0, nullable=False)  # maintained incrementally, never recounted
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        UniqueConstraint('user_id', 'tag_name', name='uq_tags_user_name'),
+    )
+    
+    @staticmethod
+    def adjust_counts(db_session, deltas):
+        """Apply {tag_id: delta} to file_count with one UPDATE per distinct delta"""
+        by_delta = {}
+        for tag_id, delta in deltas.items():
+            if delta:
+                by_delta.setdefault(delta, []).append(tag_id)
+        for delta, tag_ids in by_delta.items():
+            db_session.execute(
+                update(Tag).where(Tag.tag_id.in_(tag_ids))
+                .values(file_count=Tag.file_count + delta)
+                .execution_options(synchronize_session=False)
+            )
+    
+    @staticmethod
+    def untag_files(db_session, file_ids):
+        """Drop every tag link of the given files, keeping file_count in step"""
+        if not file_ids:
+            return
+        deltas = {
+            tag_id: -count for tag_id, count in db_session.query(FileTag.tag_id, func.count())
+            .filter(FileTag.file_id.in_(file_ids)).group_by(FileTag.tag_id)
+        }
+        db_session.query(FileTag).filter(FileTag.file_id.in_(file_ids)).delete(synchronize_session=False)
+        Tag.adjust_counts(db_session, deltas)
+    
     def to_dict(self):
         return {
             'tag_id': self.tag_id,
             'tag_name': self.tag_name,
             'color': self.color,
+            'file_count': self.file_count or 0,
             'created_at': self.created_at.isoformat()
         }
 
@@ -292,6 +359,13 @@ class FileTag(Base):
     file_id = Column(Integer, ForeignKey('files.file_id'), nullable=False)
     tag_id = Column(Integer, ForeignKey('tags.tag_id'), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # The unique constraint doubles as the (file_id, tag_id) lookup index;
+    # the reverse index serves files-by-tag queries
+    __table_args__ = (
+        UniqueConstraint('file_id', 'tag_id', name='uq_file_tags_file_tag'),
+        Index('ix_file_tags_tag_file', 'tag_id', 'file_id'),
+    )
 
 
 class Comment(Base):
@@ -302,8 +376,33 @@ class Comment(Base):
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
     comment_text = Column(Text, nullable=False)
     parent_comment_id = Column(Integer, ForeignKey('comments.comment_id'), nullable=True)
+    # Thread bookkeeping: root_comment_id is the top-level comment of the thread
+    # (itself for roots), path is the materialized path of zero-padded ids
+    # ("0000000012/0000000034/") so a whole thread sorts depth-first by path.
+    root_comment_id = Column(Integer, nullable=True)
+    path = Column(String(255), nullable=True)
+    depth = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        Index('ix_comments_file_parent_created', 'file_id', 'parent_comment_id', 'created_at'),
+        Index('ix_comments_root_path', 'root_comment_id', 'path'),
+    )
+    
+    PATH_SEGMENT_WIDTH = 10
+    
+    def assign_thread_position(self, parent=None):
+        """Set root/path/depth once comment_id is known (call after flush)"""
+        segment = str(self.comment_id).zfill(self.PATH_SEGMENT_WIDTH) + '/'
+        if parent is None:
+            self.root_comment_id = self.comment_id
+            self.path = segment
+            self.depth = 0
+        else:
+            self.root_comment_id = parent.root_comment_id or parent.comment_id
+            self.path = (parent.path or '') + segment
+            self.depth = (parent.depth or 0) + 1
+    
     def to_dict(self, db_session=None, include_user=True):
         data = {
             'comment_id': self.comment_id,
@@ -311,9 +410,129 @@ class Comment(Base):
             'user_id': self.user_id,
             'comment_text': self.comment_text,
             'parent_comment_id': self.parent_comment_id,
+            'root_comment_id': self.root_comment_id,
+            'depth': self.depth or 0,
             'created_at': self.created_at.isoformat()
         }
         if include_user and db_session:
             user = db_session.query(User).filter(User.user_id == self.user_id).first()
             data['user_email'] = user.email if user else None
         return data
+
+
+class Job(Base):
+    """A long-running operation processed in batches by the job runner (see jobs.py)"""
+    __tablename__ = 'jobs'
+    
+    job_id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
+    kind = Column(String(30), nullable=False)  # a registered handler: 'folder_copy', 'thumbnail', ...
+    queue = Column(String(30), default='default', nullable=False)
+    priority = Column(Integer, default=0, nullable=False)  # higher runs first within a queue
+    status = Column(String(20), default='pending', nullable=False)  # pending, running, completed, failed, cancelled
+    folder_id = Column(Integer, nullable=True)  # the folder operated on; no FK, deletes outlive it
+    target_folder_id = Column(Integer, nullable=True)
+    result_folder_id = Column(Integer, nullable=True)  # e.g. the root of a copy
+    params = Column(Text, nullable=True)  # JSON
+    state = Column(Text, nullable=True)  # JSON cursor, committed with each batch
+    total_items = Column(Integer, nullable=True)  # known once the tree is planned
+    processed_items = Column(Integer, default=0, nullable=False)
+    cancel_requested = Column(Boolean, default=False, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)  # failed batches so far
+    max_attempts = Column(Integer, default=5, nullable=False)
+    run_after = Column(DateTime, nullable=True)  # retry backoff
+    lease_owner = Column(String(100), nullable=True)  # worker running a batch right now
+    lease_expires_at = Column(DateTime, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index('ix_jobs_claim', 'queue', 'status', 'priority'),
+        Index('ix_jobs_owner_created', 'owner_id', 'created_at'),
+    )
+    
+    FINISHED = ('completed', 'failed', 'cancelled')
+    
+    def load_params(self):
+        return json.loads(self.params) if self.params else {}
+    
+    def load_state(self):
+        return json.loads(self.state) if self.state else {}
+    
+    def save_state(self, state):
+        self.state = json.dumps(state)
+    
+    def to_dict(self):
+        progress = None
+        if self.status == 'completed':
+            progress = 100.0
+        elif self.total_items:
+            progress = round(100.0 * min(self.processed_items or 0, self.total_items) / self.total_items, 1)
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'queue': self.queue,
+            'priority': self.priority,
+            'status': self.status,
+            'phase': self.load_state().get('phase'),
+            'folder_id': self.folder_id,
+            'target_folder_id': self.target_folder_id,
+            'result_folder_id': self.result_folder_id,
+            'total_items': self.total_items,
+            'processed_items': self.processed_items or 0,
+            'progress': progress,
+            'cancel_requested': bool(self.cancel_requested),
+            'attempts': self.attempts or 0,
+            'max_attempts': self.max_attempts,
+            'retry_at': self.run_after.isoformat() if self.run_after and self.status not in self.FINISHED else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class JobFolder(Base):
+    """One folder of a job's subtree, in breadth-first order (seq)"""
+    __tablename__ = 'job_folders'
+    
+    job_id = Column(Integer, ForeignKey('jobs.job_id'), primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    folder_id = Column(Integer, nullable=False)
+    new_folder_id = Column(Integer, nullable=True)  # its copy, for folder_copy
+    
+    __table_args__ = (
+        Index('ix_job_folders_job_folder', 'job_id', 'folder_id'),
+    )
+
+
+class Change(Base):
+    """
+    Change journal: the latest change of each of a user's files, folders and
+    shares, numbered by the user's change_seq; deletes stay as tombstones
+    """
+    __tablename__ = 'changes'
+    
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    seq = Column(BigInteger, primary_key=True)
+    kind = Column(String(10), nullable=False)  # 'file', 'folder', 'share'
+    object_id = Column(String(50), nullable=False)
+    action = Column(String(10), nullable=False)  # created, updated, moved, trashed, restored, deleted
+    data = Column(Text, nullable=True)  # JSON: the changed fields the feed sends along
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('ix_changes_object', 'user_id', 'kind', 'object_id'),
+    )
+    
+    def to_dict(self):
+        return {
+            'seq': self.seq,
+            'type': f'{self.kind}.{self.action}',
+            'id': int(self.object_id) if self.kind != 'share' else self.object_id,
+            'data': json.loads(self.data) if self.data else {},
+            'at': self.created_at.isoformat()
+        }
@@ -0,0 +1,166 @@
+"""
+Server-side application of document deltas for EuType / EuSheets autosave.
+
+Two formats are supported:
+- JSON Patch (RFC 6902) for JSON documents
+- text edits: a list of {"offset", "delete", "insert"} splices against the
+  base text, offsets in Unicode code points, non-overlapping
+"""
+import copy
+from typing import Any, List
+
+
+class PatchError(ValueError):
+    """The patch is malformed or does not apply to the base document"""
+
+
+def _parse_pointer(pointer: str) -> List[str]:
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise PatchError(f"Invalid JSON pointer: {pointer!r}")
+    return [part.replace('~1', '/').replace('~0', '~') for part in pointer[1:].split('/')]
+
+
+def _list_index(container: list, token: str, allow_end: bool) -> int:
+    if token == '-' and allow_end:
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise PatchError(f"Invalid array index: {token!r}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise PatchError(f"Array index out of range: {index}")
+    return index
+
+
+def _resolve_parent(doc: Any, parts: List[str]):
+    node = doc
+    for token in parts[:-1]:
+        if isinstance(node, dict):
+            if token not in node:
+                raise PatchError(f"Path not found: /{'/'.join(parts)}")
+            node = node[token]
+        elif isinstance(node, list):
+            node = node[_list_index(node, token, allow_end=False)]
+        else:
+            raise PatchError(f"Path not found: /{'/'.join(parts)}")
+    return node
+
+
+def _get(doc: Any, pointer: str) -> Any:
+    parts = _parse_pointer(pointer)
+    if not parts:
+        return doc
+    parent = _resolve_parent(doc, parts)
+    token = parts[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise PatchError(f"Path not found: {pointer}")
+        return parent[token]
+    if isinstance(parent, list):
+        return parent[_list_index(parent, token, allow_end=False)]
+    raise PatchError(f"Path not found: {pointer}")
+
+
+def _add(doc: Any, pointer: str, value: Any) -> Any:
+    parts = _parse_pointer(pointer)
+    if not parts:
+        return value
+    parent = _resolve_parent(doc, parts)
+    token = parts[-1]
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(_list_index(parent, token, allow_end=True), value)
+    else:
+        raise PatchError(f"Cannot add at {pointer}")
+    return doc
+
+
+def _remove(doc: Any, pointer: str) -> Any:
+    parts = _parse_pointer(pointer)
+    if not parts:
+        raise PatchError("Cannot remove the document root")
+    parent = _resolve_parent(doc, parts)
+    token = parts[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise PatchError(f"Path not found: {pointer}")
+        del parent[token]
+    elif isinstance(parent, list):
+        del parent[_list_index(parent, token, allow_end=False)]
+    else:
+        raise PatchError(f"Path not found: {pointer}")
+    return doc
+
+
+def apply_json_patch(document: Any, operations: List[dict]) -> Any:
+    """Apply RFC 6902 operations; the input document is left untouched"""
+    if not isinstance(operations, list):
+        raise PatchError("JSON Patch must be a list of operations")
+
+    doc = copy.deepcopy(document)
+    for operation in operations:
+        if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+            raise PatchError(f"Invalid operation: {operation!r}")
+        op, path = operation['op'], operation['path']
+
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise PatchError(f"'{op}' requires a value")
+        if op in ('move', 'copy') and 'from' not in operation:
+            raise PatchError(f"'{op}' requires from")
+
+        if op == 'add':
+            doc = _add(doc, path, copy.deepcopy(operation['value']))
+        elif op == 'remove':
+            doc = _remove(doc, path)
+        elif op == 'replace':
+            _get(doc, path)
+            if _parse_pointer(path):
+                doc = _remove(doc, path)
+            doc = _add(doc, path, copy.deepcopy(operation['value']))
+        elif op == 'move':
+            source = operation['from']
+            if path.startswith(source + '/'):
+                raise PatchError("Cannot move a value into one of its children")
+            value = _get(doc, source)
+            doc = _remove(doc, source)
+            doc = _add(doc, path, value)
+        elif op == 'copy':
+            doc = _add(doc, path, copy.deepcopy(_get(doc, operation['from'])))
+        elif op == 'test':
+            if _get(doc, path) != operation['value']:
+                raise PatchError(f"Test failed at {path}")
+        else:
+            raise PatchError(f"Unknown operation: {op!r}")
+    return doc
+
+
+def apply_text_edits(text: str, edits: List[dict]) -> str:
+    """Apply non-overlapping splices, all expressed against the base text"""
+    if not isinstance(edits, list):
+        raise PatchError("Text edits must be a list")
+
+    spans = []
+    for edit in edits:
+        try:
+            offset = int(edit['offset'])
+            delete = int(edit.get('delete', 0))
+            insert = edit.get('insert', '')
+        except (KeyError, TypeError, ValueError):
+            raise PatchError(f"Invalid edit: {edit!r}")
+        if not isinstance(insert, str) or offset < 0 or delete < 0 or offset + delete > len(text):
+            raise PatchError(f"Edit out of range: {edit!r}")
+        spans.append((offset, delete, insert))
+
+    spans.sort(key=lambda span: span[0])
+    parts = []
+    position = 0
+    for offset, delete, insert in spans:
+        if offset < position:
+            raise PatchError("Text edits overlap")
+        parts.append(text[position:offset])
+        parts.append(insert)
+        position = offset + delete
+    parts.append(text[position:])
+    return ''.join(parts)
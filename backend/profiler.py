@@ -0,0 +1,229 @@
+"""
+Live profiling of a running API process, for when a pod is slow and the
+question is where the time goes (Argon2, thumbnailing, JSON encoding,
+waiting on the database...).
+
+- sample(): a time-boxed stack sampler. A worker thread snapshots
+  every thread's Python stack (sys._current_frames) at a fixed interval;
+  identical stacks are counted. The result renders as folded stacks
+  ("thread;module:func;module:func count"), the input format of
+  flamegraph.pl, speedscope and inferno. The coroutine running on the
+  event loop shows up in the loop thread's stack. Idle threads (waiting
+  in select or on a queue) are left out unless asked for.
+- LoopMonitor: a watchdog for the event loop. The loop bumps a heartbeat
+  every few milliseconds; a watchdog thread that sees no heartbeat for
+  LOOP_BLOCK_THRESHOLD_MS logs the stack of whatever is blocking the loop,
+  while it is still blocking, and keeps the most recent stalls.
+
+Both are served under /api/admin. Sampling costs a few percent of one core
+while it runs and nothing otherwise.
+"""
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional
+
+from config import Config
+import metrics
+
+logger = logging.getLogger('profiler')
+
+# Leaf frames that mean a thread is waiting rather than working
+_IDLE_LEAVES = {
+    ('selectors', 'select'), ('threading', 'wait'), ('queue', 'get'),
+    ('thread', '_worker'), ('threading', '_wait_for_tstate_lock'),
+}
+
+_lock = threading.Lock()  # one profile at a time per process
+
+
+class ProfilerBusy(Exception):
+    """Another profile is being recorded in this process"""
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{module}:{name}".replace(';', ':').replace(' ', '_')
+
+
+def _is_idle(frame) -> bool:
+    code = frame.f_code
+    return (os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name) in _IDLE_LEAVES
+
+
+def _thread_names() -> Dict[int, str]:
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+@dataclass
+class Profile:
+    started_at: float
+    duration: float = 0.0
+    interval: float = 0.0
+    samples: int = 0
+    stacks: collections.Counter = field(default_factory=collections.Counter)
+
+    def folded(self) -> str:
+        """Collapsed stacks, heaviest first: feed to flamegraph.pl or drop into speedscope"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 30) -> List[dict]:
+        """Self and total sample counts per function (recursion counted once per stack)"""
+        own, total = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return [
+            {'function': name, 'self': own[name], 'total': hits,
+             'self_pct': round(100 * own[name] / self.samples, 1) if self.samples else 0.0}
+            for name, hits in sorted(total.items(), key=lambda item: (own[item[0]], item[1]), reverse=True)[:limit]
+        ]
+
+
+def sample(seconds: float, interval: float = 0.005, include_idle: bool = False) -> Profile:
+    """Sample every thread's stack for `seconds`; blocks the calling thread meanwhile"""
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already being recorded")
+    try:
+        me = threading.get_ident()
+        profile = Profile(started_at=time.time(), interval=interval)
+        names = _thread_names()
+        started = time.perf_counter()
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (not include_idle and _is_idle(frame)):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                if ident not in names:
+                    names = _thread_names()
+                stack.append(names.get(ident, f"thread-{ident}").replace(';', ':').replace(' ', '_'))
+                profile.stacks[';'.join(reversed(stack))] += 1
+            profile.samples += 1
+            time.sleep(interval)
+        profile.duration = time.perf_counter() - started
+        return profile
+    finally:
+        _lock.release()
+
+
+# --- Event loop blocking ------------------------------------------------
+
+LOOP_LAG = metrics.REGISTRY.register(metrics.Histogram(
+    'eucloud_event_loop_lag_seconds', 'Delay of the event loop heartbeat beyond its schedule',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)))
+LOOP_STALLS = metrics.REGISTRY.register(metrics.Counter(
+    'eucloud_event_loop_stalls_total', 'Times the event loop was blocked longer than LOOP_BLOCK_THRESHOLD_MS'))
+
+
+@dataclass
+class Stall:
+    detected_at: float
+    blocked_ms: float  # when detected; the final duration is in `duration_ms`
+    stack: List[str]
+    duration_ms: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return {'detected_at': self.detected_at, 'blocked_ms': round(self.blocked_ms, 1),
+                'duration_ms': round(self.duration_ms, 1) if self.duration_ms is not None else None,
+                'stack': self.stack}
+
+
+class LoopMonitor:
+    """Heartbeat task on the loop plus a watchdog thread that catches the loop blocked"""
+
+    def __init__(self, threshold_ms: Optional[float] = None, history: int = 50):
+        self.threshold = (threshold_ms if threshold_ms is not None else Config.LOOP_BLOCK_THRESHOLD_MS) / 1000
+        self.heartbeat_interval = min(0.05, self.threshold / 4)
+        self.stalls: Deque[Stall] = collections.deque(maxlen=history)
+        self._beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.heartbeat_interval
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            LOOP_LAG.observe(max(0.0, now - expected))
+            self._beat = now
+
+    def _watch(self):
+        stall, stalled_beat = None, None
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            if stall is not None:
+                if beat == stalled_beat:
+                    continue  # still blocked, already reported
+                stall.duration_ms = (beat - stalled_beat - self.heartbeat_interval) * 1000
+                stall = None
+            blocked = time.monotonic() - beat - self.heartbeat_interval
+            if blocked < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = traceback.format_stack(frame) if frame is not None else []
+            stall, stalled_beat = Stall(detected_at=time.time(), blocked_ms=blocked * 1000, stack=stack), beat
+            self.stalls.append(stall)
+            LOOP_STALLS.inc()
+            logger.warning(f"Event loop blocked for {blocked * 1000:.0f} ms so far; loop thread is at:\n{''.join(stack)}")
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._watchdog:
+            self._watchdog.join(timeout=1)
+
+    def recent_stalls(self, since: Optional[float] = None) -> List[dict]:
+        return [stall.to_dict() for stall in self.stalls if since is None or stall.detected_at >= since]
+
+
+_monitor: Optional[LoopMonitor] = None
+
+
+def get_loop_monitor() -> Optional[LoopMonitor]:
+    return _monitor
+
+
+def start_loop_monitor(threshold_ms: Optional[float] = None) -> LoopMonitor:
+    """Call from the running loop (app lifespan / worker startup)"""
+    global _monitor
+    _monitor = LoopMonitor(threshold_ms)
+    _monitor.start()
+    return _monitor
+
+
+async def stop_loop_monitor():
+    global _monitor
+    if _monitor is not None:
+        await _monitor.stop()
+        _monitor = None
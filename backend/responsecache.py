@@ -0,0 +1,294 @@
+"""
+Per-user response cache for the listings clients fetch on every
+navigation (the endpoints marked @cacheable: file and folder listings,
+favorites, tags, storage usage).
+
+Every user has a generation number, kept in shared_state so all worker
+processes agree on it. It is bumped after each commit that changed
+anything those listings show: the user's files, folders, tags, file tags
+or user row. Session hooks see ORM writes and the changes queued with
+changefeed.record_change(); other bulk writes call invalidate_user().
+Responses are cached serialized under (user, generation, path, query), so
+a bump makes every older entry unreachable: nothing is ever invalidated
+by hand, and no worker serves a listing older than the last commit.
+
+That only holds when every process serving the API sees the same
+generations, so the cache stays off with SHARED_STATE=local: a bump in one
+pod's (or worker's) own memory would leave the others answering from
+their entries, 304s included. 'shm' covers the workers of one host;
+several replicas need 'redis'.
+
+ResponseCacheMiddleware answers hits before the endpoint, its database
+session or serialization run; the token is checked with
+auth.decode_token, which needs no query. Cached responses carry a strong
+ETag (a hash of the body), so clients revalidating with If-None-Match get
+304 Not Modified. Entries live in a per-process LRU of at most
+Config.RESPONSE_CACHE_MAX_BYTES; hits, misses and evictions are exported
+on /metrics.
+"""
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from jose import JWTError
+from sqlalchemy import event, select
+from starlette.requests import Request
+from starlette.routing import Match
+
+from auth import decode_token, request_token
+from config import Config
+import metrics
+from models import SessionLocal, File, FileTag, Folder, Tag, User
+from shared_state import get_shared_state
+
+logger = logging.getLogger(__name__)
+
+ENTRY_OVERHEAD = 256  # bytes per entry besides the body: key, headers, bookkeeping
+SHARED_BACKENDS = ('shm', 'redis')  # shared_state backends every process sees alike
+
+_warned_local = False
+
+
+def cacheable(endpoint):
+    """Mark a GET endpoint whose response depends only on the user's own data and the URL"""
+    endpoint.response_cache = True
+    return endpoint
+
+
+# --- Generations ----------------------------------------------------------
+
+def cache_enabled() -> bool:
+    """Whether listings may be served from the cache: on, and with generations all processes share"""
+    global _warned_local
+    if not Config.RESPONSE_CACHE_ENABLED:
+        return False
+    if Config.SHARED_STATE not in SHARED_BACKENDS:
+        if not _warned_local:
+            _warned_local = True
+            logger.warning(f"Response cache disabled: SHARED_STATE={Config.SHARED_STATE} keeps listing "
+                           f"generations per process; use shm (one host) or redis (several replicas)")
+        return False
+    return True
+
+
+def generation(user_id: int) -> int:
+    return get_shared_state().counter(f'listing-gen:{user_id}')
+
+
+def invalidate_user(session, user_id: int):
+    """Bump the user's generation once the session commits (for bulk writes the hooks can't see)"""
+    session.info.setdefault('cache_users', set()).add(user_id)
+
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _collect_users(session, flush_context):
+    users = session.info.setdefault('cache_users', set())
+    tagged_files = session.info.setdefault('cache_tagged_files', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (File, Folder)):
+            users.add(obj.owner_id)
+        elif isinstance(obj, Tag):
+            users.add(obj.user_id)
+        elif isinstance(obj, User):
+            users.add(obj.user_id)
+        elif isinstance(obj, FileTag):
+            tagged_files.add(obj.file_id)
+
+
+@event.listens_for(SessionLocal, 'before_commit')
+def _resolve_users(session):
+    session.flush()
+    users = session.info.setdefault('cache_users', set())
+    users.update(user_id for user_id, _ in session.info.get('changes') or ())
+    tagged_files = session.info.pop('cache_tagged_files', None)
+    if tagged_files:
+        users.update(session.execute(select(File.owner_id).where(File.file_id.in_(tagged_files))).scalars())
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _bump_generations(session):
+    users = session.info.pop('cache_users', None)
+    if not users:
+        return
+    try:
+        state = get_shared_state()
+        for user_id in users:
+            if user_id is not None:
+                state.incr(f'listing-gen:{user_id}')
+    except Exception as e:
+        # Entries of the old generation would outlive the write: drop this process's
+        logger.warning(f"Bumping listing generations failed, clearing the response cache: {e}")
+        get_response_cache().clear()
+
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def _discard_users(session):
+    session.info.pop('cache_users', None)
+    session.info.pop('cache_tagged_files', None)
+
+
+# --- The cache ------------------------------------------------------------
+
+class Entry(NamedTuple):
+    etag: bytes
+    body: bytes
+    content_type: bytes
+
+
+class ResponseCache:
+    """LRU of serialized responses, bounded by their total size"""
+
+    def __init__(self, max_bytes: int, evictions=metrics.RESPONSE_CACHE_EVICTIONS):
+        self.max_bytes = max_bytes
+        self.evictions = evictions
+        self.size = 0
+        self._entries: "OrderedDict[tuple, Entry]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple) -> Optional[Entry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, entry: Entry):
+        cost = len(entry.body) + ENTRY_OVERHEAD
+        if cost > self.max_bytes // 8:
+            return  # one listing shouldn't push out dozens of others
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous.body) + ENTRY_OVERHEAD
+        self._entries[key] = entry
+        self.size += cost
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.body) + ENTRY_OVERHEAD
+            self.evictions.inc()
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(Config.RESPONSE_CACHE_MAX_BYTES)
+    return _cache
+
+
+def etag_matches(if_none_match: Optional[str], etag: bytes) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag.decode() in tags or f'W/{etag.decode()}' in tags
+
+
+@metrics.register_collector
+def _collect_cache_size():
+    cache = get_response_cache()
+    metrics.RESPONSE_CACHE_BYTES.set(cache.size)
+    metrics.RESPONSE_CACHE_ENTRIES.set(len(cache))
+
+
+# --- Middleware -----------------------------------------------------------
+
+def _cache_headers(etag: bytes) -> list:
+    # private: per user; no-cache: browsers revalidate every time, which costs a 304
+    return [(b'etag', etag), (b'cache-control', b'private, no-cache')]
+
+
+class ResponseCacheMiddleware:
+    """Serves @cacheable GETs from the cache, and fills it with their 200 responses"""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def cacheable_route(scope):
+        """The route the router will pick (the first full match), if it is @cacheable"""
+        for route in scope['app'].router.routes:
+            if route.matches(scope)[0] == Match.FULL:
+                return route if getattr(getattr(route, 'endpoint', None), 'response_cache', False) else None
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET' or not cache_enabled():
+            return await self.app(scope, receive, send)
+        route = self.cacheable_route(scope)
+        if route is None:
+            return await self.app(scope, receive, send)
+
+        request = Request(scope)
+        token = request_token(request)
+        try:
+            user_id = decode_token(token) if token else None
+        except JWTError:
+            user_id = None
+        if user_id is None:
+            return await self.app(scope, receive, send)  # answered with a 401 there
+
+        try:
+            current = generation(user_id)
+        except Exception as e:
+            # Without the generation a cached entry can't be trusted: serve uncached
+            logger.warning(f"Reading the listing generation failed, skipping the response cache: {e}")
+            return await self.app(scope, receive, send)
+        query = b'&'.join(sorted(scope['query_string'].split(b'&')))
+        key = (user_id, current, scope['path'], query)
+        if_none_match = request.headers.get('if-none-match')
+        cache = get_response_cache()
+        entry = cache.get(key)
+        if entry is not None:
+            metrics.RESPONSE_CACHE.inc(1, route.path_format, 'hit')
+            scope.update(route.matches(scope)[1])  # endpoint and path params, for the route label in metrics
+            if etag_matches(if_none_match, entry.etag):
+                await send({'type': 'http.response.start', 'status': 304, 'headers': _cache_headers(entry.etag)})
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', entry.content_type), (b'content-length', str(len(entry.body)).encode()),
+                *_cache_headers(entry.etag),
+            ]})
+            await send({'type': 'http.response.body', 'body': entry.body})
+            return
+        metrics.RESPONSE_CACHE.inc(1, route.path_format, 'miss')
+
+        start = None
+
+        async def caching_send(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+                return  # held back until the body is complete, to add the ETag
+            if start is None:
+                await send(message)
+                return
+            if message.get('more_body'):
+                # Streamed: not a listing, pass it along untouched
+                await send(start)
+                start = None
+                await send(message)
+                return
+            body = message.get('body', b'')
+            if start['status'] != 200:
+                await send(start)
+                await send(message)
+                return
+            etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'.encode()
+            headers = dict(start.get('headers', []))
+            cache.put(key, Entry(etag, body, headers.get(b'content-type', b'application/json')))
+            if etag_matches(if_none_match, etag):
+                await send({'type': 'http.response.start', 'status': 304, 'headers': _cache_headers(etag)})
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            await send({**start, 'headers': [*start.get('headers', []), *_cache_headers(etag)]})
+            await send(message)
+
+        await self.app(scope, receive, caching_send)
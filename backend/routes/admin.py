@@ -0,0 +1,86 @@
+﻿from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+
+from models import User
+from auth import get_admin_user
+from config import Config
+import sqlprofile
+import profiler
+
+router = APIRouter()
+
+@router.get("/sql-profile")
+async def sql_profile(
+    top: int = 10,
+    admin: User = Depends(get_admin_user)
+):
+    """
+    Per-route SQL aggregates since the last reset (this process only):
+    queries and database time per request and the heaviest statements.
+    Needs SQL_PROFILING=true.
+    """
+    if not Config.SQL_PROFILING:
+        raise HTTPException(status_code=409, detail="SQL profiling is off (set SQL_PROFILING=true)")
+    routes = await run_in_threadpool(sqlprofile.dump, max(1, min(top, 100)))
+    return {
+        "slow_query_ms": Config.SLOW_QUERY_MS,
+        "routes": routes
+    }
+
+@router.delete("/sql-profile")
+async def reset_sql_profile(
+    admin: User = Depends(get_admin_user)
+):
+    sqlprofile.reset()
+    return {"message": "SQL profile reset"}
+
+@router.get("/profile")
+async def sampling_profile(
+    seconds: float = 10,
+    interval_ms: float = 5,
+    format: str = 'folded',
+    idle: bool = False,
+    admin: User = Depends(get_admin_user)
+):
+    """
+    Sample every thread of this process for `seconds` and return the stacks.
+    format=folded (default) is collapsed-stack text for flamegraph.pl or
+    speedscope; format=json gives the hottest functions and any event loop
+    stalls seen meanwhile. idle=true keeps threads that are only waiting.
+    """
+    if not 0 < seconds <= Config.PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {Config.PROFILE_MAX_SECONDS}")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be between 1 and 1000")
+    if format not in ('folded', 'json'):
+        raise HTTPException(status_code=400, detail="format must be 'folded' or 'json'")
+    
+    try:
+        profile = await run_in_threadpool(profiler.sample, seconds, interval_ms / 1000, idle)
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    if format == 'folded':
+        return PlainTextResponse(profile.folded())
+    monitor = profiler.get_loop_monitor()
+    return {
+        "duration": round(profile.duration, 3),
+        "interval_ms": interval_ms,
+        "samples": profile.samples,
+        "functions": profile.top_functions(),
+        "loop_stalls": monitor.recent_stalls(since=profile.started_at) if monitor else None
+    }
+
+@router.get("/loop-stalls")
+async def loop_stalls(
+    admin: User = Depends(get_admin_user)
+):
+    """Most recent times the event loop was blocked, with the stack that blocked it"""
+    monitor = profiler.get_loop_monitor()
+    if monitor is None:
+        raise HTTPException(status_code=409, detail="Event loop monitor is off (LOOP_MONITOR_ENABLED)")
+    return {
+        "threshold_ms": monitor.threshold * 1000,
+        "stalls": monitor.recent_stalls()
+    }
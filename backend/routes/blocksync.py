@@ -0,0 +1,137 @@
+﻿from fastapi import APIRouter, Depends, HTTPException, Header, Request, Response
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from datetime import datetime
+import tempfile
+from typing import Optional
+
+from models import get_db, File, User, Activity
+from auth import get_current_user
+from config import Config
+from storage import get_storage
+from blocksync import DeltaRejected, apply_file_delta, file_signature, store_signature
+from routes.files import claim_next_version, parse_if_match
+
+router = APIRouter()
+
+def log_activity(db: Session, user_id: int, activity_type: str, file_id: Optional[int] = None, folder_id: Optional[int] = None, details: Optional[str] = None):
+    activity = Activity(
+        user_id=user_id,
+        file_id=file_id,
+        folder_id=folder_id,
+        activity_type=activity_type,
+        activity_details=details
+    )
+    db.add(activity)
+
+def get_owned_file(db: Session, user: User, file_id: int) -> File:
+    file = db.query(File).get(file_id)
+    
+    if not file or file.owner_id != user.user_id or file.is_deleted:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    if not get_storage().exists(file.file_path):
+        raise HTTPException(status_code=404, detail="File not found on disk")
+    
+    return file
+
+@router.get("/{file_id:int}/signature")
+async def get_signature(
+    file_id: int,
+    response: Response,
+    block_size: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Block signature of the file's current content: one [adler32, blake2b-128
+    hex] pair per full block. Scan the new content against it (rolling the
+    weak hash a byte at a time), then POST the delta to /delta with the
+    ETag in If-Match. block_size must be a power of two between 512 and
+    65536; otherwise the server picks one (~sqrt of the size).
+    """
+    file = get_owned_file(db, current_user, file_id)
+    signature = await run_in_threadpool(file_signature, file, block_size)
+    if signature.content_version != file.content_version:
+        raise HTTPException(status_code=409, detail="Content changed while computing its signature, retry")
+    
+    response.headers['ETag'] = file.content_etag()
+    return {"file_id": file.file_id, **signature.to_dict()}
+
+@router.post("/{file_id:int}/delta")
+async def upload_delta(
+    file_id: int,
+    request: Request,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    x_content_sha256: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Replace the file's content with the result of applying a delta to it.
+    
+    The body is a binary delta (application/octet-stream): b'EUD1', then
+    records b'C' + offset (u64 BE) + length (u32 BE) copying bytes of the
+    current content, and b'D' + length (u32 BE) + literal bytes. If-Match
+    names the content the delta was computed against (412 if it moved on);
+    X-Content-SHA256, if given, is checked against the result. The previous
+    content becomes the newest version.
+    """
+    file = get_owned_file(db, current_user, file_id)
+    
+    base_version = parse_if_match(if_match, file)
+    if base_version is None:
+        raise HTTPException(status_code=428, detail="If-Match is required")
+    if base_version != file.content_version:
+        raise HTTPException(status_code=412, detail="Content was modified by someone else")
+    
+    # A delta of a file is never larger than the file, plus record headers
+    received = 0
+    delta = tempfile.SpooledTemporaryFile(max_size=Config.UPLOAD_CHUNK_SIZE * 8)
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > Config.MAX_CONTENT_LENGTH + Config.UPLOAD_CHUNK_SIZE:
+                raise HTTPException(status_code=413, detail="Delta too large")
+            delta.write(chunk)
+        delta.seek(0)
+        
+        # From the version claim to the commit in one worker thread (see save_content in routes/files.py)
+        def apply():
+            claim_next_version(db, file, base_version)
+            try:
+                size_diff, signature = apply_file_delta(db, file, delta, Config.MAX_CONTENT_LENGTH, x_content_sha256)
+            except DeltaRejected as e:
+                db.rollback()
+                raise HTTPException(status_code=422, detail=f"Delta does not apply: {str(e)}")
+            
+            if current_user.storage_used + size_diff > current_user.storage_quota:
+                db.rollback()
+                raise HTTPException(status_code=413, detail="Storage quota exceeded")
+            
+            file.modified_at = datetime.utcnow()
+            current_user.storage_used += size_diff
+            log_activity(db, current_user.user_id, 'update_content', file_id=file.file_id, details=f'Synced changed blocks of {file.filename}')
+            db.commit()
+            return signature
+        
+        signature = await run_in_threadpool(apply)
+        db.refresh(file)
+        await run_in_threadpool(store_signature, file, signature)
+        
+        response.headers['ETag'] = file.content_etag()
+        return {
+            "message": "File content updated successfully",
+            "version": file.content_version,
+            "etag": file.content_etag(),
+            "bytes_received": received,
+            "file": file.to_dict()
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error applying delta: {str(e)}")
+    finally:
+        delta.close()
@@ -0,0 +1,45 @@
+﻿from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from typing import Optional
+
+from models import get_db, User
+from auth import get_current_user
+from changefeed import changes_since
+
+router = APIRouter()
+
+@router.get("")
+async def list_changes(
+    cursor: Optional[int] = None,
+    limit: int = 1000,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    What changed since `cursor`: the latest state of every changed file,
+    folder and share (deletes as tombstones), oldest first, and the cursor
+    to pass next time. Keep calling while has_more is true.
+    
+    Without a cursor, returns the current one: fetch it before a full
+    listing, then sync from it. reset means the cursor is too old (or not
+    this account's): list everything again and start over from the
+    returned cursor.
+    """
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    current = current_user.change_seq or 0
+    
+    if cursor is None:
+        return {"changes": [], "cursor": current, "has_more": False, "reset": False}
+    
+    result = changes_since(db, current_user, cursor, min(limit, 5000))
+    if result is None:
+        return {"changes": [], "cursor": current, "has_more": False, "reset": True}
+    
+    changes, has_more = result
+    return {
+        "changes": [change.to_dict() for change in changes],
+        "cursor": changes[-1].seq if changes else cursor,
+        "has_more": has_more,
+        "reset": False
+    }
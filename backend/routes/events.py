@@ -0,0 +1,48 @@
+﻿from fastapi import APIRouter, Depends, Header, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from typing import Optional
+
+from models import get_db, User
+from auth import get_current_user
+from config import Config
+from changefeed import Subscription, format_sse, get_broker
+
+router = APIRouter()
+
+async def event_stream(request: Request, subscription: Subscription):
+    """SSE messages until the client goes away, with keepalive comments while idle"""
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            item = await subscription.get(Config.CHANGE_KEEPALIVE_SECONDS)
+            if await request.is_disconnected():
+                break
+            yield format_sse(item) if item is not None else ": keepalive\n\n"
+    finally:
+        subscription.close()
+
+@router.get("/stream")
+async def stream_changes(
+    request: Request,
+    after: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Server-Sent Events stream of the user's file, folder and share changes.
+    EventSource resends Last-Event-ID when it reconnects, and gets the
+    events it missed; after a 'resync' event, catch up through
+    GET /api/changes from the last event's cursor.
+    """
+    user_id = current_user.user_id
+    # A stream lives for hours; don't hold a pooled connection for it
+    db.close()
+    
+    subscription = get_broker().subscribe(user_id, last_event_id or after)
+    return StreamingResponse(
+        event_stream(request, subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
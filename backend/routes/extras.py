@@ -1,11 +1,17 @@
-﻿from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+﻿from fastapi import APIRouter, Depends, HTTPException, status, Query
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy.exc import IntegrityError
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
+import base64
+import json
 
 from models import get_db, File, Tag, FileTag, Comment, Activity, User
 from auth import get_current_user
+from responsecache import cacheable
+from search import mark_for_reindex
 
 router = APIRouter()
 
@@ -52,42 +58,46 @@ async def toggle_favorite(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/favorites/list")
+@cacheable
 async def list_favorites(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    favorites = db.query(File).filter_by(
+    favorites = db.query(File).options(selectinload(File.tags)).filter_by(
         owner_id=current_user.user_id,
         is_favorite=True,
         is_deleted=False
     ).all()
     
     return {
-        "files": [f.to_dict() for f in favorites]
+        "files": [f.to_dict(include_tags=True) for f in favorites]
     }
 
 class TagCreate(BaseModel):
     tag_name: str
     color: Optional[str] = None
 
+class TagApply(BaseModel):
+    file_ids: List[int]
+    tag_ids: List[int]
+
+def owned_tag_ids(db: Session, user_id: int, tag_ids) -> set:
+    return {
+        tag_id for (tag_id,) in db.query(Tag.tag_id).filter(
+            Tag.user_id == user_id, Tag.tag_id.in_(set(tag_ids))
+        )
+    }
+
 @router.post("/tags/create", status_code=status.HTTP_201_CREATED)
 async def create_tag(
     tag_data: TagCreate,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    existing = db.query(Tag).filter_by(
-        tag_name=tag_data.tag_name,
-        owner_id=current_user.user_id
-    ).first()
-    
-    if existing:
-        raise HTTPException(status_code=400, detail="Tag already exists")
-    
     tag = Tag(
         tag_name=tag_data.tag_name,
-        color=tag_data.color,
-        owner_id=current_user.user_id
+        color=tag_data.color or '#667eea',
+        user_id=current_user.user_id
     )
     
     try:
@@ -99,21 +109,48 @@ async def create_tag(
             "message": "Tag created successfully",
             "tag": tag.to_dict()
         }
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Tag already exists")
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/tags/list")
+@cacheable
 async def list_tags(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    tags = db.query(Tag).filter_by(owner_id=current_user.user_id).all()
+    tags = db.query(Tag).filter_by(user_id=current_user.user_id).order_by(Tag.tag_name).all()
     
     return {
         "tags": [t.to_dict() for t in tags]
     }
 
+@router.delete("/tags/{tag_id}")
+async def delete_tag(
+    tag_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    tag = db.query(Tag).get(tag_id)
+    
+    if not tag or tag.user_id != current_user.user_id:
+        raise HTTPException(status_code=404, detail="Tag not found")
+    
+    try:
+        tagged_files = [file_id for (file_id,) in db.query(FileTag.file_id).filter_by(tag_id=tag_id)]
+        db.query(FileTag).filter_by(tag_id=tag_id).delete(synchronize_session=False)
+        db.delete(tag)
+        mark_for_reindex(db, tagged_files)
+        db.commit()
+        
+        return {"message": "Tag deleted"}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.post("/tags/add/{file_id}/{tag_id}")
 async def add_tag_to_file(
     file_id: int,
@@ -127,21 +164,63 @@ async def add_tag_to_file(
     if not file or file.owner_id != current_user.user_id:
         raise HTTPException(status_code=404, detail="File not found")
     
-    if not tag or tag.owner_id != current_user.user_id:
+    if not tag or tag.user_id != current_user.user_id:
         raise HTTPException(status_code=404, detail="Tag not found")
     
-    existing = db.query(FileTag).filter_by(file_id=file_id, tag_id=tag_id).first()
-    
-    if existing:
+    try:
+        # The (file_id, tag_id) unique constraint is the existence check
+        db.add(FileTag(file_id=file_id, tag_id=tag_id))
+        db.flush()
+        Tag.adjust_counts(db, {tag_id: 1})
+        db.commit()
+        
+        return {"message": "Tag added to file"}
+    except IntegrityError:
+        db.rollback()
         raise HTTPException(status_code=400, detail="Tag already added to file")
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/tags/apply")
+async def apply_tags(
+    data: TagApply,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Tag many files with many tags; existing links are checked in one query"""
+    file_ids = {
+        file_id for (file_id,) in db.query(File.file_id).filter(
+            File.owner_id == current_user.user_id, File.file_id.in_(set(data.file_ids))
+        )
+    }
+    tag_ids = owned_tag_ids(db, current_user.user_id, data.tag_ids)
+    
+    if len(file_ids) != len(set(data.file_ids)):
+        raise HTTPException(status_code=404, detail="File not found")
+    if len(tag_ids) != len(set(data.tag_ids)):
+        raise HTTPException(status_code=404, detail="Tag not found")
     
-    file_tag = FileTag(file_id=file_id, tag_id=tag_id)
+    existing = set(db.query(FileTag.file_id, FileTag.tag_id).filter(
+        FileTag.file_id.in_(file_ids), FileTag.tag_id.in_(tag_ids)
+    ))
+    missing = [(f, t) for f in sorted(file_ids) for t in sorted(tag_ids) if (f, t) not in existing]
     
     try:
-        db.add(file_tag)
+        db.add_all([FileTag(file_id=f, tag_id=t) for f, t in missing])
+        deltas = {}
+        for _, tag_id in missing:
+            deltas[tag_id] = deltas.get(tag_id, 0) + 1
+        Tag.adjust_counts(db, deltas)
         db.commit()
         
-        return {"message": "Tag added to file"}
+        return {
+            "message": "Tags applied",
+            "added": len(missing)
+        }
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Tags changed concurrently, retry")
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -165,6 +244,7 @@ async def remove_tag_from_file(
     
     try:
         db.delete(file_tag)
+        Tag.adjust_counts(db, {tag_id: -1})
         db.commit()
         
         return {"message": "Tag removed from file"}
@@ -172,8 +252,80 @@ async def remove_tag_from_file(
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/tags/files")
+async def list_files_by_tags(
+    tag_ids: List[int] = Query(...),
+    mode: str = Query("all", pattern="^(all|any)$"),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Files carrying all (AND) or any (OR) of the given tags.
+    Matching runs as one join over the (tag_id, file_id) index.
+    """
+    owned = owned_tag_ids(db, current_user.user_id, tag_ids)
+    # Dropping a foreign or deleted tag would turn an AND into a looser one
+    if len(owned) != len(set(tag_ids)):
+        raise HTTPException(status_code=404, detail="Tag not found")
+    tag_ids = owned
+    
+    matches = select(FileTag.file_id).where(FileTag.tag_id.in_(tag_ids)).group_by(FileTag.file_id)
+    if mode == "all":
+        matches = matches.having(func.count(FileTag.tag_id) == len(tag_ids))
+    
+    files = db.query(File).options(selectinload(File.tags)).filter(
+        File.file_id.in_(matches),
+        File.owner_id == current_user.user_id,
+        File.is_deleted == False
+    ).order_by(File.filename).all()
+    
+    return {
+        "files": [f.to_dict(include_tags=True) for f in files]
+    }
+
 class CommentCreate(BaseModel):
     comment_text: str
+    parent_comment_id: Optional[int] = None
+
+# Replies nested deeper than this are attached to their parent's parent so
+# materialized paths stay bounded
+MAX_COMMENT_DEPTH = 20
+
+def encode_cursor(values) -> str:
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str, *types) -> list:
+    """The values encode_cursor stored, one per type in `types` (datetimes travel as ISO strings)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError("wrong shape")
+        decoded = []
+        for value, kind in zip(values, types):
+            if kind is datetime:
+                value = datetime.fromisoformat(value)
+            elif not isinstance(value, kind) or isinstance(value, bool):
+                raise ValueError("wrong type")
+            decoded.append(value)
+        return decoded
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def comment_row_to_dict(row) -> dict:
+    """Serialize a comment row that already carries the author's email"""
+    return {
+        'comment_id': row.comment_id,
+        'file_id': row.file_id,
+        'user_id': row.user_id,
+        'user_email': row.user_email,
+        'comment_text': row.comment_text,
+        'parent_comment_id': row.parent_comment_id,
+        'root_comment_id': row.root_comment_id,
+        'depth': row.depth or 0,
+        'created_at': row.created_at.isoformat()
+    }
 
 @router.post("/comments/{file_id}", status_code=status.HTTP_201_CREATED)
 async def add_comment(
@@ -187,14 +339,25 @@ async def add_comment(
     if not file or file.owner_id != current_user.user_id:
         raise HTTPException(status_code=404, detail="File not found")
     
+    parent = None
+    if comment_data.parent_comment_id:
+        parent = db.query(Comment).get(comment_data.parent_comment_id)
+        if not parent or parent.file_id != file_id:
+            raise HTTPException(status_code=404, detail="Parent comment not found")
+        while parent.depth and parent.depth >= MAX_COMMENT_DEPTH:
+            parent = db.query(Comment).get(parent.parent_comment_id)
+    
     comment = Comment(
         file_id=file_id,
         user_id=current_user.user_id,
-        comment_text=comment_data.comment_text
+        comment_text=comment_data.comment_text,
+        parent_comment_id=parent.comment_id if parent else None
     )
     
     try:
         db.add(comment)
+        db.flush()
+        comment.assign_thread_position(parent)
         db.commit()
         db.refresh(comment)
         
@@ -223,6 +386,123 @@ async def get_comments(
         "comments": [c.to_dict() for c in comments]
     }
 
+@router.get("/comments/{file_id}/threads")
+async def get_comment_threads(
+    file_id: int,
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    reply_limit: int = Query(5, ge=0, le=100),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Paginated comment threads, newest thread first.
+    
+    A single statement selects the page of top-level comments, pulls every
+    thread member in depth-first order via the materialized path, and uses
+    window functions for the per-thread truncation and reply counts.
+    Threads with more replies than `reply_limit` carry a `replies_cursor`
+    for /comments/{file_id}/threads/{root_id}/replies.
+    """
+    file = db.query(File).get(file_id)
+    
+    if not file or file.owner_id != current_user.user_id:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    page_query = select(Comment.comment_id, Comment.created_at).where(
+        Comment.file_id == file_id,
+        Comment.parent_comment_id.is_(None)
+    )
+    if cursor:
+        created_at, comment_id = decode_cursor(cursor, datetime, int)
+        page_query = page_query.where(or_(
+            Comment.created_at < created_at,
+            and_(Comment.created_at == created_at, Comment.comment_id < comment_id)
+        ))
+    page = page_query.order_by(
+        Comment.created_at.desc(), Comment.comment_id.desc()
+    ).limit(limit + 1).cte('page')
+    
+    ranked = select(
+        Comment,
+        func.row_number().over(partition_by=Comment.root_comment_id, order_by=Comment.path).label('position'),
+        func.count().over(partition_by=Comment.root_comment_id).label('thread_size')
+    ).where(Comment.root_comment_id.in_(select(page.c.comment_id))).subquery()
+    
+    rows = db.execute(
+        select(ranked, User.email.label('user_email'))
+        .join(page, page.c.comment_id == ranked.c.root_comment_id)
+        .join(User, User.user_id == ranked.c.user_id)
+        .where(ranked.c.position <= reply_limit + 1)
+        .order_by(page.c.created_at.desc(), page.c.comment_id.desc(), ranked.c.path)
+    ).all()
+    
+    threads = []
+    last_paths = []  # path of each thread's last comment returned, where its replies cursor starts
+    for row in rows:
+        if row.comment_id == row.root_comment_id:
+            thread = comment_row_to_dict(row)
+            thread['reply_count'] = row.thread_size - 1
+            thread['replies'] = []
+            threads.append(thread)
+            last_paths.append(row.path)
+        else:
+            threads[-1]['replies'].append(comment_row_to_dict(row))
+            last_paths[-1] = row.path
+    for thread, last_path in zip(threads, last_paths):
+        more = thread['reply_count'] > len(thread['replies'])
+        thread['replies_cursor'] = encode_cursor([last_path]) if more else None
+    
+    next_cursor = None
+    if len(threads) > limit:
+        threads = threads[:limit]
+        last = threads[-1]
+        next_cursor = encode_cursor([last['created_at'], last['comment_id']])
+    
+    return {
+        "threads": threads,
+        "next_cursor": next_cursor
+    }
+
+@router.get("/comments/{file_id}/threads/{root_comment_id}/replies")
+async def get_thread_replies(
+    file_id: int,
+    root_comment_id: int,
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Next page of a thread's replies in depth-first order ("load more")"""
+    file = db.query(File).get(file_id)
+    
+    if not file or file.owner_id != current_user.user_id:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    query = select(Comment, User.email.label('user_email')).join(
+        User, User.user_id == Comment.user_id
+    ).where(
+        Comment.file_id == file_id,
+        Comment.root_comment_id == root_comment_id,
+        Comment.comment_id != root_comment_id
+    )
+    if cursor:
+        path, = decode_cursor(cursor, str)
+        query = query.where(Comment.path > path)
+    
+    rows = db.execute(query.order_by(Comment.path).limit(limit + 1)).all()
+    
+    replies = [
+        dict(comment.to_dict(include_user=False), user_email=email)
+        for comment, email in rows[:limit]
+    ]
+    next_cursor = encode_cursor([rows[limit - 1][0].path]) if len(rows) > limit else None
+    
+    return {
+        "replies": replies,
+        "next_cursor": next_cursor
+    }
+
 @router.delete("/comments/{comment_id}")
 async def delete_comment(
     comment_id: int,
@@ -235,6 +515,13 @@ async def delete_comment(
         raise HTTPException(status_code=404, detail="Comment not found")
     
     try:
+        # Replies go with the comment they answer
+        if comment.path:
+            db.query(Comment).filter(
+                Comment.root_comment_id == comment.root_comment_id,
+                Comment.path.like(comment.path + '%'),
+                Comment.comment_id != comment.comment_id
+            ).delete(synchronize_session=False)
         db.delete(comment)
         db.commit()
         
@@ -1,19 +1,25 @@
-﻿import os
-import uuid
-import mimetypes
+﻿import mimetypes
 import zipfile
-import io
-import shutil
+import json
+import urllib.parse
 from datetime import datetime
-from typing import Optional
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File as FastAPIFile, Form
-from fastapi.responses import FileResponse, StreamingResponse
-from sqlalchemy.orm import Session
-from PIL import Image
+from typing import Any, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File as FastAPIFile, Form, Header, Response
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, selectinload
+from pydantic import BaseModel
 
 from models import get_db, File, User, Folder, Activity
 from auth import get_current_user
+from responsecache import cacheable
 from config import Config
+from patching import PatchError, apply_json_patch, apply_text_edits
+import compression
+from storage import get_storage, get_thumbnail_storage, new_blob_key
+from versioning import record_version
+from filecopy import CopyConflict, duplicate_file, writable_key
+import jobs
 
 router = APIRouter()
 
@@ -32,14 +38,150 @@ def allowed_file(filename: str) -> bool:
     # No restrictions on file extensions
     return True
 
-def generate_thumbnail(file_path: str, thumbnail_path: str) -> Optional[str]:
+def parse_if_match(if_match: Optional[str], file: File) -> Optional[int]:
+    """Content version named by an If-Match header ('*' means current)"""
+    if not if_match:
+        return None
+    value = if_match.strip()
+    if value == '*':
+        return file.content_version
+    if value.startswith('W/'):
+        value = value[2:]
+    try:
+        file_part, version_part = value.strip('"').rsplit('-', 1)
+        if int(file_part) == file.file_id:
+            return int(version_part)
+    except ValueError:
+        pass
+    raise HTTPException(status_code=412, detail="ETag does not match this file")
+
+def claim_next_version(db: Session, file: File, base_version: int):
+    """
+    Conditionally bump content_version; whoever loses the race gets 412.
+    The blob key is part of the condition so a save never writes to a key
+    the storage layout migration has just moved the file away from.
+    """
+    claimed = db.query(File).filter(
+        File.file_id == file.file_id,
+        File.content_version == base_version,
+        File.file_path == file.file_path
+    ).update({File.content_version: base_version + 1}, synchronize_session=False)
+    if not claimed:
+        db.rollback()
+        raise HTTPException(status_code=412, detail="Content was modified by someone else")
+    file.content_version = base_version + 1
+
+def save_content(db: Session, user: User, file: File, data: bytes, base_version: int, details: str):
+    """
+    Store new content as the next version of a document and commit.
+    Called in the threadpool as a whole: from the version claim to the
+    commit the database holds a write lock, and the event loop may be
+    stuck waiting for that lock in another request, so nothing in between
+    can wait on the loop.
+    """
+    size_diff = len(data) - file.file_size
+    claim_next_version(db, file, base_version)
+    record_version(db, file)
+    blob = get_storage().write_bytes(writable_key(db, file), data, compression.choose_encoding(file.mime_type, file.app_type, file.filename))
+    
+    file.file_size = len(data)
+    file.stored_encoding = blob.encoding
+    file.physical_size = blob.stored_size
+    file.modified_at = datetime.utcnow()
+    user.storage_used += size_diff
+    
+    log_activity(db, user.user_id, 'update_content', file_id=file.file_id, details=details)
+    db.commit()
+
+def content_disposition(filename: str) -> str:
+    quoted = urllib.parse.quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """(start, length) of a single 'bytes=' range; None serves the whole blob"""
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    first, _, last = range_header[6:].strip().partition('-')
     try:
-        img = Image.open(file_path)
-        img.thumbnail((200, 200))
-        img.save(thumbnail_path)
-        return thumbnail_path
-    except:
+        if first == '':
+            length = min(int(last), size)
+            start = size - length
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            length = end - start + 1
+    except ValueError:
         return None
+    if start >= size or length <= 0:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, length
+
+def blob_response(file: File, accept_encoding: Optional[str] = None, filename: Optional[str] = None,
+                  range_header: Optional[str] = None):
+    """
+    Serve a file's blob from whichever storage driver holds it: a redirect
+    to a presigned URL when the driver offers one, sendfile for local disks,
+    a stream otherwise. Compressed blobs go out as-is with Content-Encoding
+    when the client accepts it and are decompressed as they stream if not;
+    single byte ranges are honored for uncompressed blobs.
+    """
+    storage = get_storage()
+    stat = storage.stat(file.file_path)
+    if stat is None:
+        raise HTTPException(status_code=404, detail="File not found on disk")
+    
+    media_type = file.mime_type or 'application/octet-stream'
+    encoding = file.stored_encoding or compression.IDENTITY
+    passthrough = encoding != compression.IDENTITY and compression.accepts_encoding(accept_encoding, encoding)
+    
+    if Config.PRESIGNED_DOWNLOADS and (encoding == compression.IDENTITY or passthrough):
+        url = storage.presign(file.file_path, Config.PRESIGN_EXPIRES_SECONDS, filename=filename,
+                              content_type=media_type, content_encoding=encoding if passthrough else None)
+        if url:
+            return RedirectResponse(url, status_code=307)
+    
+    headers = {}
+    if filename:
+        headers["Content-Disposition"] = content_disposition(filename)
+    
+    if encoding == compression.IDENTITY:
+        headers["Accept-Ranges"] = "bytes"
+        byte_range = parse_range(range_header, stat.size)
+        if byte_range:
+            start, length = byte_range
+            headers["Content-Range"] = f"bytes {start}-{start + length - 1}/{stat.size}"
+            headers["Content-Length"] = str(length)
+            return StreamingResponse(storage.read_range(file.file_path, start, length), status_code=206, media_type=media_type, headers=headers)
+        path = storage.local_path(file.file_path)
+        if path:
+            return FileResponse(path=path, media_type=media_type, headers=headers)
+        headers["Content-Length"] = str(stat.size)
+        return StreamingResponse(storage.iter_raw(file.file_path), media_type=media_type, headers=headers)
+    
+    headers["Vary"] = "Accept-Encoding"
+    if passthrough:
+        headers["Content-Encoding"] = encoding
+        path = storage.local_path(file.file_path)
+        if path:
+            return FileResponse(path=path, media_type=media_type, headers=headers)
+        headers["Content-Length"] = str(stat.size)
+        return StreamingResponse(storage.iter_raw(file.file_path), media_type=media_type, headers=headers)
+    
+    headers["Content-Length"] = str(file.file_size)
+    return StreamingResponse(storage.iter_content(file.file_path, encoding), media_type=media_type, headers=headers)
+
+def read_text(file: File) -> str:
+    """Logical content of a text blob (UnicodeDecodeError if it is binary)"""
+    return get_storage().read_content(file.file_path, file.stored_encoding).decode('utf-8')
+
+def remove_blob(key: str):
+    """Best-effort removal of a blob whose database row never committed"""
+    try:
+        get_storage().delete(key)
+    except Exception:
+        pass
 
 @router.post("/upload", status_code=status.HTTP_201_CREATED)
 async def upload_file(
@@ -49,6 +191,7 @@ async def upload_file(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    stored_key = None
     try:
         if not file.filename:
             raise HTTPException(status_code=400, detail="No selected file")
@@ -56,51 +199,48 @@ async def upload_file(
         if not allowed_file(file.filename):
             raise HTTPException(status_code=400, detail="File type not allowed")
         
-        contents = await file.read()
-        file_size = len(contents)
-        
-        if current_user.storage_used + file_size > current_user.storage_quota:
-            raise HTTPException(status_code=413, detail="Storage quota exceeded")
-        
         if folder_id:
             folder = db.query(Folder).get(folder_id)
             if not folder or folder.owner_id != current_user.user_id:
                 raise HTTPException(status_code=403, detail="Invalid folder")
         
-        # NEW: User-based directory structure
-        user_upload_dir = os.path.join(Config.UPLOAD_FOLDER, str(current_user.user_id))
-        os.makedirs(user_upload_dir, exist_ok=True)
-        
         filename = file.filename
-        file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-        unique_file_id = str(uuid.uuid4())
-        unique_filename = f"{unique_file_id}.{file_ext}" if file_ext else unique_file_id
         
-        # NEW: Store as uploads/{owner_id}/{file_id}.ext
-        file_path = os.path.join(user_upload_dir, unique_filename)
-        relative_path = f"{current_user.user_id}/{unique_filename}"
-        
-        with open(file_path, "wb") as f:
-            f.write(contents)
+        # Stored as {owner_id}/{ab}/{cd}/{uuid}.ext (see storage/layout.py)
+        relative_path = new_blob_key(current_user.user_id, filename)
         
         mime_type = mimetypes.guess_type(filename)[0]
         
-        thumbnail_path = None
-        if mime_type and mime_type.startswith('image/'):
-            thumbnail_filename = f"thumb_{unique_filename}"
-            thumbnail_full_path = os.path.join(Config.THUMBNAIL_FOLDER, thumbnail_filename)
-            if generate_thumbnail(file_path, thumbnail_full_path):
-                thumbnail_path = thumbnail_filename
+        # Stream to a temp blob, enforcing limits as bytes arrive; the blob
+        # only appears under its key once it is complete and durable
+        blob = get_storage().open_write(relative_path, compression.choose_encoding(mime_type, app_type, filename))
+        try:
+            while True:
+                chunk = await file.read(Config.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                # zstd and the disk write stay off the event loop
+                await run_in_threadpool(blob.write, chunk)
+                if blob.size > Config.MAX_CONTENT_LENGTH:
+                    raise HTTPException(status_code=413, detail="File too large")
+                if current_user.storage_used + blob.size > current_user.storage_quota:
+                    raise HTTPException(status_code=413, detail="Storage quota exceeded")
+            file_size = await run_in_threadpool(blob.commit)
+        except BaseException:
+            blob.abort()
+            raise
+        stored_key = relative_path
         
         new_file = File(
             filename=filename,
             file_path=relative_path,  # NEW: Store relative path
             file_size=file_size,
+            stored_encoding=blob.encoding,
+            physical_size=blob.stored_size,
             mime_type=mime_type,
             folder_id=folder_id,
             owner_id=current_user.user_id,
-            app_type=app_type,  # NEW: Store app type
-            thumbnail_path=thumbnail_path
+            app_type=app_type  # NEW: Store app type
         )
         
         db.add(new_file)
@@ -108,8 +248,14 @@ async def upload_file(
         
         log_activity(db, current_user.user_id, 'upload', file_id=new_file.file_id, details=f'Uploaded {filename}')
         
+        # Thumbnails are made in the background; previews serve the image itself until then
+        if mime_type and mime_type.startswith('image/'):
+            db.flush()
+            jobs.enqueue(db, current_user.user_id, 'thumbnail', params={'file_id': new_file.file_id, 'file_key': relative_path})
+        
         db.commit()
         db.refresh(new_file)
+        jobs.notify()
         
         return {
             "message": "File uploaded successfully",
@@ -119,15 +265,19 @@ async def upload_file(
         raise
     except Exception as e:
         db.rollback()
+        if stored_key:
+            remove_blob(stored_key)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/list")
+@cacheable
 async def list_files(
     folder_id: Optional[int] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    query = db.query(File).filter_by(owner_id=current_user.user_id, is_deleted=False)
+    # Tags for the whole listing come from one batched IN query
+    query = db.query(File).options(selectinload(File.tags)).filter_by(owner_id=current_user.user_id, is_deleted=False)
     
     if folder_id:
         query = query.filter_by(folder_id=folder_id)
@@ -145,7 +295,7 @@ async def list_files(
     folders = folder_query.all()
     
     return {
-        "files": [f.to_dict() for f in files],
+        "files": [f.to_dict(include_tags=True) for f in files],
         "folders": [f.to_dict() for f in folders]
     }
 
@@ -165,6 +315,8 @@ async def get_file(
 @router.get("/{file_id:int}/download")
 async def download_file(
     file_id: int,
+    accept_encoding: Optional[str] = Header(None),
+    range: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -173,19 +325,12 @@ async def download_file(
     if not file or file.owner_id != current_user.user_id:
         raise HTTPException(status_code=404, detail="File not found")
     
-    file_path = os.path.join(Config.UPLOAD_FOLDER, file.file_path)
-    
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="File not found on disk")
+    response = blob_response(file, accept_encoding, filename=file.filename, range_header=range)
     
     log_activity(db, current_user.user_id, 'download', file_id=file.file_id, details=f'Downloaded {file.filename}')
     db.commit()
     
-    return FileResponse(
-        path=file_path,
-        filename=file.filename,
-        media_type=file.mime_type or 'application/octet-stream'
-    )
+    return response
 
 @router.put("/{file_id:int}/rename")
 async def rename_file(
@@ -282,39 +427,39 @@ async def copy_file(
     if current_user.storage_used + original_file.file_size > current_user.storage_quota:
         raise HTTPException(status_code=413, detail="Storage quota exceeded")
     
-    original_path = os.path.join(Config.UPLOAD_FOLDER, original_file.file_path)
-    if not os.path.exists(original_path):
+    storage = get_storage()
+    if not storage.exists(original_file.file_path):
         raise HTTPException(status_code=404, detail="Original file not found on disk")
     
-    unique_filename = f"{uuid.uuid4()}_{original_file.filename}"
-    new_path = os.path.join(Config.UPLOAD_FOLDER, unique_filename)
-    shutil.copy2(original_path, new_path)
-    
-    new_file = File(
-        filename=f"Copy of {original_file.filename}",
-        file_path=unique_filename,
-        file_size=original_file.file_size,
-        mime_type=original_file.mime_type,
-        folder_id=target_folder_id,
-        owner_id=current_user.user_id
-    )
-    
-    db.add(new_file)
-    current_user.storage_used += original_file.file_size
-    
-    log_activity(db, current_user.user_id, 'copy', file_id=new_file.file_id, details=f'Copied {original_file.filename}')
+    # Reflink, hard link or a copy-on-write reference before any byte copy (see filecopy.py);
+    # up to the commit in one worker thread, as in save_content
+    def copy():
+        new_file, strategy = duplicate_file(db, original_file, f"Copy of {original_file.filename}", target_folder_id)
+        current_user.storage_used += original_file.file_size
+        log_activity(db, current_user.user_id, 'copy', file_id=new_file.file_id, details=f'Copied {original_file.filename}')
+        db.commit()
+        return new_file, strategy
     
-    db.commit()
+    try:
+        new_file, strategy = await run_in_threadpool(copy)
+    except CopyConflict as e:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception:
+        db.rollback()
+        raise
     db.refresh(new_file)
     
     return {
         "message": "File copied successfully",
+        "strategy": strategy,
         "file": new_file.to_dict()
     }
 
 @router.get("/{file_id:int}/preview")
 async def preview_file(
     file_id: int,
+    accept_encoding: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -324,26 +469,23 @@ async def preview_file(
         raise HTTPException(status_code=404, detail="File not found")
     
     if file.thumbnail_path:
-        thumbnail_full_path = os.path.join(Config.THUMBNAIL_FOLDER, file.thumbnail_path)
-        if os.path.exists(thumbnail_full_path):
-            return FileResponse(
-                path=thumbnail_full_path,
-                media_type='image/jpeg'
-            )
-    
-    file_path = os.path.join(Config.UPLOAD_FOLDER, file.file_path)
-    if os.path.exists(file_path):
-        return FileResponse(
-            path=file_path,
-            media_type=file.mime_type or 'application/octet-stream'
-        )
-    
-    raise HTTPException(status_code=404, detail="File not found on disk")
+        thumbnails = get_thumbnail_storage()
+        if thumbnails.exists(file.thumbnail_path):
+            thumbnail_full_path = thumbnails.local_path(file.thumbnail_path)
+            if thumbnail_full_path:
+                return FileResponse(
+                    path=thumbnail_full_path,
+                    media_type='image/jpeg'
+                )
+            return StreamingResponse(thumbnails.iter_raw(file.thumbnail_path), media_type='image/jpeg')
+    
+    return blob_response(file, accept_encoding)
 
 # NEW: Content endpoints for EuType integration
 @router.get("/{file_id:int}/content")
 async def get_file_content(
     file_id: int,
+    response: Response,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -356,23 +498,22 @@ async def get_file_content(
     if not file or file.owner_id != current_user.user_id:
         raise HTTPException(status_code=404, detail="File not found")
     
-    file_path = os.path.join(Config.UPLOAD_FOLDER, file.file_path)
-    
-    if not os.path.exists(file_path):
+    if not get_storage().exists(file.file_path):
         raise HTTPException(status_code=404, detail="File not found on disk")
     
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        content = read_text(file)
         
         log_activity(db, current_user.user_id, 'read_content', file_id=file.file_id, details=f'Read content of {file.filename}')
         db.commit()
         
+        response.headers['ETag'] = file.content_etag()
         return {
             "file_id": file.file_id,
             "filename": file.filename,
             "content": content,
             "app_type": file.app_type,
+            "version": file.content_version,
             "modified_at": file.modified_at.isoformat() if file.modified_at else None
         }
     except UnicodeDecodeError:
@@ -383,50 +524,48 @@ async def get_file_content(
 @router.put("/{file_id:int}/content")
 async def update_file_content(
     file_id: int,
+    response: Response,
     content: str = Form(...),
+    if_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """
     Update the raw content of a file.
     Used by EuType for saving document changes.
+    Honors If-Match for optimistic concurrency; prefer PATCH for autosave.
     """
     file = db.query(File).get(file_id)
     
     if not file or file.owner_id != current_user.user_id:
         raise HTTPException(status_code=404, detail="File not found")
     
-    file_path = os.path.join(Config.UPLOAD_FOLDER, file.file_path)
-    
-    if not os.path.exists(file_path):
+    if not get_storage().exists(file.file_path):
         raise HTTPException(status_code=404, detail="File not found on disk")
     
+    base_version = parse_if_match(if_match, file)
+    if base_version is not None and base_version != file.content_version:
+        raise HTTPException(status_code=412, detail="Content was modified by someone else")
+    
     try:
-        # Calculate size difference for quota management
-        old_size = file.file_size
-        new_size = len(content.encode('utf-8'))
-        size_diff = new_size - old_size
+        # Encode once: the bytes are both measured and written
+        data = content.encode('utf-8')
+        size_diff = len(data) - file.file_size
         
         # Check quota
         if current_user.storage_used + size_diff > current_user.storage_quota:
             raise HTTPException(status_code=413, detail="Storage quota exceeded")
         
-        # Write new content
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-        
-        # Update file metadata
-        file.file_size = new_size
-        file.modified_at = datetime.utcnow()
-        current_user.storage_used += size_diff
-        
-        log_activity(db, current_user.user_id, 'update_content', file_id=file.file_id, details=f'Updated content of {file.filename}')
-        
-        db.commit()
+        await run_in_threadpool(
+            save_content, db, current_user, file, data,
+            file.content_version if base_version is None else base_version, f'Updated content of {file.filename}'
+        )
         db.refresh(file)
         
+        response.headers['ETag'] = file.content_etag()
         return {
             "message": "File content updated successfully",
+            "version": file.content_version,
             "file": file.to_dict()
         }
     except HTTPException:
@@ -434,3 +573,83 @@ async def update_file_content(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error updating file: {str(e)}")
+
+class ContentPatch(BaseModel):
+    format: str = 'json-patch'  # 'json-patch' (RFC 6902) or 'text' (offset splices)
+    patch: Any
+    base_version: Optional[int] = None
+
+@router.patch("/{file_id:int}/content")
+async def patch_file_content(
+    file_id: int,
+    patch_data: ContentPatch,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Apply a delta to a document instead of re-sending all of it.
+    
+    The base version comes from If-Match (the ETag returned by GET/PUT/PATCH
+    content) or from base_version in the body. If the document moved on in
+    the meantime the request fails with 412 and the client refetches.
+    The response carries the new version and ETag for the next delta.
+    """
+    file = db.query(File).get(file_id)
+    
+    if not file or file.owner_id != current_user.user_id:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    base_version = parse_if_match(if_match, file)
+    if base_version is None:
+        base_version = patch_data.base_version
+    if base_version is None:
+        raise HTTPException(status_code=428, detail="If-Match or base_version is required")
+    if base_version != file.content_version:
+        raise HTTPException(status_code=412, detail="Content was modified by someone else")
+    
+    if not get_storage().exists(file.file_path):
+        raise HTTPException(status_code=404, detail="File not found on disk")
+    
+    try:
+        current = read_text(file)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="File is not text-based")
+    
+    try:
+        if patch_data.format == 'json-patch':
+            try:
+                document = json.loads(current) if current.strip() else None
+            except ValueError:
+                raise HTTPException(status_code=400, detail="File is not a JSON document")
+            updated = json.dumps(apply_json_patch(document, patch_data.patch), ensure_ascii=False)
+        elif patch_data.format == 'text':
+            updated = apply_text_edits(current, patch_data.patch)
+        else:
+            raise HTTPException(status_code=400, detail="Unknown patch format")
+    except PatchError as e:
+        raise HTTPException(status_code=422, detail=f"Patch does not apply: {str(e)}")
+    
+    data = updated.encode('utf-8')
+    size_diff = len(data) - file.file_size
+    
+    if current_user.storage_used + size_diff > current_user.storage_quota:
+        raise HTTPException(status_code=413, detail="Storage quota exceeded")
+    
+    try:
+        await run_in_threadpool(save_content, db, current_user, file, data, base_version, f'Patched content of {file.filename}')
+        db.refresh(file)
+        
+        response.headers['ETag'] = file.content_etag()
+        return {
+            "message": "File content patched successfully",
+            "version": file.content_version,
+            "etag": file.content_etag(),
+            "file": file.to_dict()
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error patching file: {str(e)}")
@@ -1,10 +1,13 @@
-﻿from fastapi import APIRouter, Depends, HTTPException, status
+﻿from fastapi import APIRouter, Depends, HTTPException, Response, status
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from typing import Optional
 
 from models import get_db, Folder, File, User
 from auth import get_current_user
+from responsecache import cacheable
+import jobs
+from folder_jobs import is_within
 
 router = APIRouter()
 
@@ -15,6 +18,39 @@ class FolderCreate(BaseModel):
 class FolderRename(BaseModel):
     folder_name: str
 
+class FolderCopy(BaseModel):
+    target_parent_id: Optional[int] = None
+    folder_name: Optional[str] = None
+
+class FolderMove(BaseModel):
+    target_parent_id: Optional[int] = None
+
+def get_owned_folder(db: Session, current_user: User, folder_id: int) -> Folder:
+    folder = db.query(Folder).get(folder_id)
+    if not folder or folder.owner_id != current_user.user_id:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    return folder
+
+def check_target_parent(db: Session, current_user: User, folder: Folder, target_parent_id: Optional[int]):
+    if target_parent_id:
+        parent = db.query(Folder).get(target_parent_id)
+        if not parent or parent.owner_id != current_user.user_id:
+            raise HTTPException(status_code=403, detail="Invalid target folder")
+        if is_within(db, parent.folder_id, folder.folder_id):
+            raise HTTPException(status_code=400, detail="Cannot copy or move a folder into itself")
+
+def start_folder_job(db: Session, current_user: User, kind: str, folder: Folder, target_parent_id: Optional[int] = None, params: Optional[dict] = None):
+    """Queue a recursive folder job; poll /api/jobs/{job_id} for progress"""
+    try:
+        job = jobs.enqueue(db, current_user.user_id, kind, folder.folder_id, target_parent_id, params)
+        db.commit()
+        db.refresh(job)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    jobs.notify()
+    return job
+
 @router.post("/create", status_code=status.HTTP_201_CREATED)
 async def create_folder(
     folder_data: FolderCreate,
@@ -46,6 +82,7 @@ async def create_folder(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/list")
+@cacheable
 async def list_folders(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -57,6 +94,7 @@ async def list_folders(
     }
 
 @router.get("/{folder_id}")
+@cacheable
 async def get_folder(
     folder_id: int,
     current_user: User = Depends(get_current_user),
@@ -99,13 +137,18 @@ async def rename_folder(
 @router.delete("/{folder_id}")
 async def delete_folder(
     folder_id: int,
+    response: Response,
+    recursive: bool = False,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    folder = db.query(Folder).get(folder_id)
+    """Delete an empty folder, or with recursive=true a whole tree as a background job (files go to the trash)"""
+    folder = get_owned_folder(db, current_user, folder_id)
     
-    if not folder or folder.owner_id != current_user.user_id:
-        raise HTTPException(status_code=404, detail="Folder not found")
+    if recursive:
+        job = start_folder_job(db, current_user, 'folder_delete', folder)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": "Folder deletion started", "job": job.to_dict()}
     
     has_files = db.query(File).filter_by(folder_id=folder_id, is_deleted=False).first()
     has_subfolders = db.query(Folder).filter_by(parent_folder_id=folder_id).first()
@@ -121,3 +164,32 @@ async def delete_folder(
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/{folder_id}/copy", status_code=status.HTTP_202_ACCEPTED)
+async def copy_folder(
+    folder_id: int,
+    copy_data: FolderCopy,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Copy a folder with all its subfolders and files as a background job"""
+    folder = get_owned_folder(db, current_user, folder_id)
+    check_target_parent(db, current_user, folder, copy_data.target_parent_id)
+    
+    params = {'folder_name': copy_data.folder_name} if copy_data.folder_name else None
+    job = start_folder_job(db, current_user, 'folder_copy', folder, copy_data.target_parent_id, params)
+    return {"message": "Folder copy started", "job": job.to_dict()}
+
+@router.post("/{folder_id}/move", status_code=status.HTTP_202_ACCEPTED)
+async def move_folder(
+    folder_id: int,
+    move_data: FolderMove,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Move a folder (and everything in it) under another folder, or to the root"""
+    folder = get_owned_folder(db, current_user, folder_id)
+    check_target_parent(db, current_user, folder, move_data.target_parent_id)
+    
+    job = start_folder_job(db, current_user, 'folder_move', folder, move_data.target_parent_id)
+    return {"message": "Folder move started", "job": job.to_dict()}
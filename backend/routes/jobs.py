@@ -0,0 +1,76 @@
+﻿from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+
+from models import get_db, Job, User
+from auth import get_current_user
+import jobs
+
+router = APIRouter()
+
+def get_owned_job(db: Session, current_user: User, job_id: int) -> Job:
+    job = db.query(Job).get(job_id)
+    if not job or job.owner_id != current_user.user_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/list")
+async def list_jobs(
+    limit: int = 50,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """The user's most recent background jobs"""
+    recent = db.query(Job).filter_by(owner_id=current_user.user_id).order_by(Job.job_id.desc()).limit(min(limit, 200)).all()
+    
+    return {
+        "jobs": [job.to_dict() for job in recent]
+    }
+
+@router.get("/metrics")
+async def job_metrics(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Queue depths, leases and backoffs across all workers, plus this process's runner"""
+    runner = jobs.get_runner()
+    return {
+        "queues": jobs.queue_metrics(db),
+        "runner": runner.status() if runner else None
+    }
+
+@router.get("/{job_id}")
+async def get_job(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Status and progress of a job; poll until status is completed, failed or cancelled"""
+    return {
+        "job": get_owned_job(db, current_user, job_id).to_dict()
+    }
+
+@router.post("/{job_id}/cancel")
+async def cancel_job(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Stop a job after its current batch; work already done is kept"""
+    job = get_owned_job(db, current_user, job_id)
+    
+    if job.status in Job.FINISHED:
+        raise HTTPException(status_code=400, detail=f"Job is already {job.status}")
+    
+    job.cancel_requested = True
+    
+    try:
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    jobs.notify()
+    
+    return {
+        "message": "Cancellation requested",
+        "job": job.to_dict()
+    }
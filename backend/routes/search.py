@@ -0,0 +1,55 @@
+﻿from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+from typing import Optional
+from datetime import datetime
+
+from models import get_db, File, User
+from auth import get_current_user
+from search import SearchFilters, search_files
+
+router = APIRouter()
+
+@router.get("")
+async def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    mime_type: Optional[str] = None,
+    folder_id: Optional[int] = None,
+    modified_after: Optional[datetime] = None,
+    modified_before: Optional[datetime] = None,
+    min_size: Optional[int] = Query(None, ge=0),
+    max_size: Optional[int] = Query(None, ge=0),
+    favorite: Optional[bool] = None,
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Ranked search over filenames, tags, comments and EuType/EuSheets content.
+    Every word is prefix-matched and all words must match.
+    """
+    filters = SearchFilters(
+        mime_type=mime_type,
+        folder_id=folder_id,
+        modified_after=modified_after,
+        modified_before=modified_before,
+        min_size=min_size,
+        max_size=max_size,
+        favorite=favorite
+    )
+    hits = search_files(db, current_user.user_id, q, filters, limit=limit + 1, offset=offset)
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+    
+    files = {f.file_id: f for f in db.query(File).filter(File.file_id.in_([file_id for file_id, _ in hits]))}
+    results = []
+    for file_id, score in hits:
+        if file_id in files:
+            data = files[file_id].to_dict()
+            data['score'] = score
+            results.append(data)
+    
+    return {
+        "files": results,
+        "has_more": has_more
+    }
@@ -4,10 +4,12 @@ from sqlalchemy import func
 
 from models import get_db, User, File
 from auth import get_current_user
+from responsecache import cacheable
 
 router = APIRouter()
 
 @router.get("/usage")
+@cacheable
 async def get_storage_usage(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -27,23 +29,28 @@ async def get_storage_stats(
     stats = db.query(
         File.mime_type,
         func.count(File.file_id).label('count'),
-        func.sum(File.file_size).label('total_size')
+        func.sum(File.file_size).label('total_size'),
+        func.sum(func.coalesce(File.physical_size, File.file_size)).label('physical_size')
     ).filter_by(
         owner_id=current_user.user_id,
         is_deleted=False
     ).group_by(File.mime_type).all()
     
     file_types = []
-    for mime_type, count, total_size in stats:
+    for mime_type, count, total_size, physical_size in stats:
         file_types.append({
             "mime_type": mime_type or "unknown",
             "count": count,
-            "total_size": total_size or 0
+            "total_size": total_size or 0,
+            "physical_size": physical_size or 0
         })
     
     total_files = db.query(File).filter_by(owner_id=current_user.user_id, is_deleted=False).count()
     
+    # Quotas are charged on logical size; physical size is what the disks hold
     return {
         "total_files": total_files,
-        "file_types": file_types
+        "file_types": file_types,
+        "logical_size": sum(t["total_size"] for t in file_types),
+        "physical_size": sum(t["physical_size"] for t in file_types)
     }
@@ -1,10 +1,16 @@
-﻿from fastapi import APIRouter, Depends, HTTPException, status
+﻿from fastapi import APIRouter, Depends, HTTPException, Response, status
 from sqlalchemy.orm import Session
 from typing import Optional
 from datetime import datetime
 
-from models import get_db, File, User, Activity
+from models import get_db, File, User, Activity, Tag
+from config import Config
 from auth import get_current_user
+from versioning import delete_all_versions
+from storage import delete_after_commit, get_thumbnail_storage
+from filecopy import release_blob
+from blocksync import forget_signature
+import jobs
 
 router = APIRouter()
 
@@ -18,6 +24,17 @@ def log_activity(db: Session, user_id: int, activity_type: str, file_id: Optiona
     )
     db.add(activity)
 
+def delete_file_permanently(db: Session, file: File):
+    """Delete the file's row; its blob, thumbnail, versions and block signature go once the delete commits"""
+    if file.thumbnail_path:
+        delete_after_commit(db, [file.thumbnail_path], driver=get_thumbnail_storage())
+    delete_all_versions(db, file)
+    forget_signature(db, file)
+    db.delete(file)
+    # Flushed first so a concurrent copy-by-reference either sees the delete or is seen
+    db.flush()
+    release_blob(db, file)
+
 @router.get("/list")
 async def list_trash(
     current_user: User = Depends(get_current_user),
@@ -70,9 +87,6 @@ async def delete_permanently(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    import os
-    from config import Config
-    
     file = db.query(File).get(file_id)
     
     if not file or file.owner_id != current_user.user_id:
@@ -81,17 +95,9 @@ async def delete_permanently(
     if not file.is_deleted:
         raise HTTPException(status_code=400, detail="File must be in trash first")
     
-    file_path = os.path.join(Config.UPLOAD_FOLDER, file.file_path)
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    
-    if file.thumbnail_path:
-        thumb_path = os.path.join(Config.THUMBNAIL_FOLDER, file.thumbnail_path)
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
-    
     try:
-        db.delete(file)
+        Tag.untag_files(db, [file.file_id])
+        delete_file_permanently(db, file)
         db.commit()
         
         return {"message": "File permanently deleted"}
@@ -101,30 +107,39 @@ async def delete_permanently(
 
 @router.post("/empty")
 async def empty_trash(
+    response: Response,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    import os
-    from config import Config
+    count = db.query(File).filter_by(owner_id=current_user.user_id, is_deleted=True).count()
+    
+    # More than a batch goes to a background job (see tasks.EmptyTrash)
+    if count > Config.JOB_BATCH_SIZE:
+        try:
+            job = jobs.enqueue(db, current_user.user_id, 'trash_empty')
+            db.commit()
+            db.refresh(job)
+        except Exception as e:
+            db.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+        jobs.notify()
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {
+            "message": f"Deleting {count} files permanently",
+            "count": count,
+            "job": job.to_dict()
+        }
     
     deleted_files = db.query(File).filter_by(
         owner_id=current_user.user_id,
         is_deleted=True
     ).all()
     
-    for file in deleted_files:
-        file_path = os.path.join(Config.UPLOAD_FOLDER, file.file_path)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        
-        if file.thumbnail_path:
-            thumb_path = os.path.join(Config.THUMBNAIL_FOLDER, file.thumbnail_path)
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
-        
-        db.delete(file)
+    Tag.untag_files(db, [file.file_id for file in deleted_files])
     
     try:
+        for file in deleted_files:
+            delete_file_permanently(db, file)
         db.commit()
         
         return {
@@ -0,0 +1,138 @@
+﻿from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from datetime import datetime
+from typing import Optional
+
+from models import get_db, File, FileVersion, User, Activity
+from auth import get_current_user
+import compression
+from storage import get_storage
+from versioning import iter_version_content, record_version
+from filecopy import writable_key
+from routes.files import claim_next_version, parse_if_match
+
+router = APIRouter()
+
+def log_activity(db: Session, user_id: int, activity_type: str, file_id: Optional[int] = None, folder_id: Optional[int] = None, details: Optional[str] = None):
+    activity = Activity(
+        user_id=user_id,
+        file_id=file_id,
+        folder_id=folder_id,
+        activity_type=activity_type,
+        activity_details=details
+    )
+    db.add(activity)
+
+def get_owned_version(db: Session, user: User, file_id: int, version_number: int):
+    file = db.query(File).get(file_id)
+    
+    if not file or file.owner_id != user.user_id:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    version = db.query(FileVersion).filter_by(file_id=file_id, version_number=version_number).first()
+    
+    if not version:
+        raise HTTPException(status_code=404, detail="Version not found")
+    
+    return file, version
+
+@router.get("/{file_id:int}/versions")
+async def list_versions(
+    file_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    file = db.query(File).get(file_id)
+    
+    if not file or file.owner_id != current_user.user_id:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    versions = db.query(FileVersion).filter_by(file_id=file_id).order_by(FileVersion.version_number.desc()).all()
+    
+    return {
+        "current_version": file.content_version,
+        "versions": [v.to_dict() for v in versions],
+        "stored_bytes": sum(v.stored_size or v.file_size for v in versions),
+        "logical_bytes": sum(v.file_size for v in versions)
+    }
+
+@router.get("/{file_id:int}/versions/{version_number:int}/download")
+async def download_version(
+    file_id: int,
+    version_number: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    file, version = get_owned_version(db, current_user, file_id, version_number)
+    
+    try:
+        content = iter_version_content(db, version)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Version not found on disk")
+    
+    return StreamingResponse(
+        content,
+        media_type=file.mime_type or 'application/octet-stream',
+        headers={
+            "Content-Disposition": f'attachment; filename="v{version_number}_{file.filename}"',
+            "Content-Length": str(version.file_size)
+        }
+    )
+
+@router.post("/{file_id:int}/versions/{version_number:int}/restore")
+async def restore_version(
+    file_id: int,
+    version_number: int,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Make an old version current again; the content it replaces becomes a new version"""
+    file, version = get_owned_version(db, current_user, file_id, version_number)
+    
+    # Without If-Match, the content as loaded here is the one being replaced
+    base_version = parse_if_match(if_match, file)
+    if base_version is None:
+        base_version = file.content_version
+    elif base_version != file.content_version:
+        raise HTTPException(status_code=412, detail="Content was modified by someone else")
+    
+    size_diff = version.file_size - file.file_size
+    if current_user.storage_used + size_diff > current_user.storage_quota:
+        raise HTTPException(status_code=413, detail="Storage quota exceeded")
+    
+    try:
+        # From the first write to the commit in one worker thread (see save_content in routes/files.py)
+        def restore():
+            content = iter_version_content(db, version)
+            # Claimed before writing: a racing save or delta gets 412, and a concurrent copy either sees it or finishes first
+            claim_next_version(db, file, base_version)
+            record_version(db, file, force=True)
+            encoding = compression.choose_encoding(file.mime_type, file.app_type, file.filename)
+            blob = get_storage().write_chunks(writable_key(db, file), content, encoding)
+            
+            file.file_size = version.file_size
+            file.stored_encoding = blob.encoding
+            file.physical_size = blob.stored_size
+            file.modified_at = datetime.utcnow()
+            current_user.storage_used += size_diff
+            
+            log_activity(db, current_user.user_id, 'restore_version', file_id=file.file_id, details=f'Restored {file.filename} to version {version_number}')
+            db.commit()
+        
+        await run_in_threadpool(restore)
+        db.refresh(file)
+        
+        response.headers['ETag'] = file.content_etag()
+        return {
+            "message": "Version restored successfully",
+            "file": file.to_dict()
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error restoring version: {str(e)}")
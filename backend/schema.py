@@ -0,0 +1,38 @@
+"""
+Explicit schema step
+
+    python schema.py
+
+Applies pending schema migrations (see migrations/; a new database gets
+every table at once) and creates the local storage folders. By default
+every API process and worker.py does this on startup
+(SCHEMA_AUTO_CREATE=true), which is fine for one process but means each
+new replica waits for the migration lock and checks the schema before it
+can serve. Deployments that scale out set SCHEMA_AUTO_CREATE=false and
+run this (or `python -m migrations`) once per release instead, from an
+init container or a pre-deploy job, before the new replicas start.
+"""
+import logging
+import sys
+
+from config import Config
+import migrations
+
+logger = logging.getLogger(__name__)
+
+
+def create_schema():
+    """Bring the database and folders up to date; safe to repeat"""
+    Config.init_app(None)
+    return migrations.upgrade()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+    applied = create_schema()
+    logger.info(f"Applied {len(applied)} migration(s)" if applied else "Schema is up to date")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+"""
+Full-text search index over filenames, tag names, comments and EuType /
+EuSheets document content.
+
+The index lives next to the regular tables and is picked by database
+backend: an FTS5 virtual table on SQLite, a weighted tsvector column with a
+GIN index on PostgreSQL. It is kept up to date incrementally: session hooks
+collect the file ids touched by each flush and reindex them right after the
+transaction commits.
+
+Rebuild from scratch with:  python search.py rebuild
+"""
+import json
+import logging
+import re
+import sys
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, text
+
+from storage import get_storage
+from models import Base, SessionLocal, engine, File, FileTag, Comment, Tag
+
+logger = logging.getLogger(__name__)
+
+# Only document apps get their content indexed; everything else is binary
+# or too large to be worth it
+INDEXED_APP_TYPES = ('eutype', 'eusheets')
+MAX_CONTENT_BYTES = 1024 * 1024
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+@dataclass
+class SearchFilters:
+    mime_type: Optional[str] = None       # exact type, or a prefix ending in '/' like 'image/'
+    folder_id: Optional[int] = None       # restrict to this folder and all of its subfolders
+    modified_after: Optional[datetime] = None
+    modified_before: Optional[datetime] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    favorite: Optional[bool] = None
+
+
+def query_terms(query: str) -> List[str]:
+    """Split user input into plain word tokens (operators are not exposed)"""
+    return [t.lower() for t in _TERM_RE.findall(query or '')][:16]
+
+
+def extract_document_text(key: str, encoding: Optional[str] = None) -> str:
+    """Plain text of an EuType/EuSheets document: every string value in its JSON"""
+    try:
+        raw = get_storage().read_content(key, encoding, limit=MAX_CONTENT_BYTES)
+        content = raw.decode('utf-8', errors='ignore')
+    except Exception:  # unreadable blobs are indexed by metadata only
+        return ''
+
+    try:
+        document = json.loads(content)
+    except ValueError:
+        return content
+
+    parts = []
+    stack = [document]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            parts.append(node)
+        elif isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, (int, float)) and not isinstance(node, bool):
+            parts.append(str(node))
+    return ' '.join(reversed(parts))
+
+
+class SearchIndex(ABC):
+    """Backend-specific storage and querying of search documents"""
+
+    @abstractmethod
+    def create_schema(self, conn):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_documents(self, conn, file_ids: List[int]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_documents(self, conn, documents: List[dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def match(self, conn, owner_id: int, terms: List[str], filters: SearchFilters,
+              limit: int, offset: int) -> List[Tuple[int, float]]:
+        raise NotImplementedError
+
+    def reindex(self, conn, file_ids: Iterable[int]):
+        """Recompute the documents of the given files (missing files are dropped)"""
+        file_ids = sorted(set(file_ids))
+        if not file_ids:
+            return
+        documents = load_documents(conn, file_ids)
+        self.delete_documents(conn, file_ids)
+        self.write_documents(conn, documents)
+
+    @staticmethod
+    def filter_clauses(filters: SearchFilters, params: dict) -> List[str]:
+        clauses = []
+        if filters.mime_type:
+            if filters.mime_type.endswith('/'):
+                clauses.append("f.mime_type LIKE :mime_prefix")
+                params['mime_prefix'] = filters.mime_type + '%'
+            else:
+                clauses.append("f.mime_type = :mime_type")
+                params['mime_type'] = filters.mime_type
+        if filters.folder_id is not None:
+            clauses.append("f.folder_id IN (SELECT folder_id FROM subtree)")
+            params['root_folder_id'] = filters.folder_id
+        if filters.modified_after:
+            clauses.append("f.modified_at >= :modified_after")
+            params['modified_after'] = filters.modified_after
+        if filters.modified_before:
+            clauses.append("f.modified_at < :modified_before")
+            params['modified_before'] = filters.modified_before
+        if filters.min_size is not None:
+            clauses.append("f.file_size >= :min_size")
+            params['min_size'] = filters.min_size
+        if filters.max_size is not None:
+            clauses.append("f.file_size <= :max_size")
+            params['max_size'] = filters.max_size
+        if filters.favorite is not None:
+            clauses.append("f.is_favorite = :favorite")
+            params['favorite'] = filters.favorite
+        return clauses
+
+    @staticmethod
+    def subtree_cte(filters: SearchFilters) -> str:
+        if filters.folder_id is None:
+            return ''
+        return (
+            "WITH RECURSIVE subtree(folder_id) AS ("
+            " SELECT folder_id FROM folders WHERE folder_id = :root_folder_id AND owner_id = :owner_id"
+            " UNION ALL"
+            " SELECT c.folder_id FROM folders c JOIN subtree s ON c.parent_folder_id = s.folder_id"
+            ") "
+        )
+
+
+class SqliteSearchIndex(SearchIndex):
+    """FTS5 table keyed by rowid = file_id; the owner is an indexed token so
+    MATCH itself narrows to one user's documents before any join"""
+
+    def create_schema(self, conn):
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+            "owner, filename, tags, comments, content, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        ))
+
+    def delete_documents(self, conn, file_ids):
+        for start in range(0, len(file_ids), 500):
+            chunk = file_ids[start:start + 500]
+            params = {f'id{i}': file_id for i, file_id in enumerate(chunk)}
+            placeholders = ', '.join(f':{name}' for name in params)
+            conn.execute(text(f"DELETE FROM search_index WHERE rowid IN ({placeholders})"), params)
+
+    def write_documents(self, conn, documents):
+        if documents:
+            conn.execute(text(
+                "INSERT INTO search_index (rowid, owner, filename, tags, comments, content) "
+                "VALUES (:file_id, :owner, :filename, :tags, :comments, :content)"
+            ), [dict(d, owner=f"o{d['owner_id']}") for d in documents])
+
+    def match(self, conn, owner_id, terms, filters, limit, offset):
+        params = {'owner_id': owner_id, 'limit': limit, 'offset': offset}
+        params['match'] = f'owner : o{owner_id} AND ' + ' AND '.join(
+            '"{}" *'.format(term.replace('"', '')) for term in terms
+        )
+        clauses = ["search_index MATCH :match", "f.owner_id = :owner_id", "f.is_deleted = 0"]
+        clauses += self.filter_clauses(filters, params)
+        # bm25 weights per column: owner, filename, tags, comments, content
+        sql = (
+            self.subtree_cte(filters) +
+            "SELECT f.file_id, bm25(search_index, 0.0, 10.0, 5.0, 2.0, 1.0) AS rank "
+            "FROM search_index JOIN files f ON f.file_id = search_index.rowid "
+            "WHERE " + ' AND '.join(clauses) + " "
+            "ORDER BY rank LIMIT :limit OFFSET :offset"
+        )
+        return [(row[0], -row[1]) for row in conn.execute(text(sql), params)]
+
+
+class PostgresSearchIndex(SearchIndex):
+    """One weighted tsvector per file with a GIN index"""
+
+    def create_schema(self, conn):
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS search_documents ("
+            " file_id INTEGER PRIMARY KEY REFERENCES files(file_id) ON DELETE CASCADE,"
+            " owner_id INTEGER NOT NULL,"
+            " document TSVECTOR NOT NULL)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_search_documents_document "
+            "ON search_documents USING GIN (document)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_search_documents_owner ON search_documents (owner_id)"
+        ))
+
+    def delete_documents(self, conn, file_ids):
+        conn.execute(text("DELETE FROM search_documents WHERE file_id = ANY(:ids)"), {'ids': list(file_ids)})
+
+    def write_documents(self, conn, documents):
+        if documents:
+            conn.execute(text(
+                "INSERT INTO search_documents (file_id, owner_id, document) VALUES (:file_id, :owner_id, "
+                " setweight(to_tsvector('simple', :filename), 'A') ||"
+                " setweight(to_tsvector('simple', :tags), 'B') ||"
+                " setweight(to_tsvector('simple', :comments), 'C') ||"
+                " setweight(to_tsvector('simple', :content), 'D'))"
+            ), documents)
+
+    def match(self, conn, owner_id, terms, filters, limit, offset):
+        params = {'owner_id': owner_id, 'limit': limit, 'offset': offset}
+        params['tsquery'] = ' & '.join(f"{term}:*" for term in terms)
+        clauses = ["s.owner_id = :owner_id", "s.document @@ to_tsquery('simple', :tsquery)", "f.is_deleted = false"]
+        clauses += self.filter_clauses(filters, params)
+        sql = (
+            self.subtree_cte(filters) +
+            "SELECT f.file_id, ts_rank_cd(s.document, to_tsquery('simple', :tsquery)) AS rank "
+            "FROM search_documents s JOIN files f ON f.file_id = s.file_id "
+            "WHERE " + ' AND '.join(clauses) + " "
+            "ORDER BY rank DESC LIMIT :limit OFFSET :offset"
+        )
+        return [(row[0], float(row[1])) for row in conn.execute(text(sql), params)]
+
+
+def get_search_index(bind=None) -> SearchIndex:
+    dialect = (bind or engine).dialect.name
+    if dialect == 'postgresql':
+        return PostgresSearchIndex()
+    return SqliteSearchIndex()
+
+
+def load_documents(conn, file_ids: List[int]) -> List[dict]:
+    """Build search documents for files with three batched queries"""
+    files = conn.execute(
+        File.__table__.select().where(File.file_id.in_(file_ids))
+    ).mappings().all()
+
+    tags = {}
+    for file_id, tag_name in conn.execute(
+        FileTag.__table__.join(Tag.__table__, FileTag.tag_id == Tag.tag_id)
+        .select().with_only_columns(FileTag.file_id, Tag.tag_name)
+        .where(FileTag.file_id.in_(file_ids))
+    ):
+        tags.setdefault(file_id, []).append(tag_name)
+
+    comments = {}
+    for file_id, comment_text in conn.execute(
+        Comment.__table__.select().with_only_columns(Comment.file_id, Comment.comment_text)
+        .where(Comment.file_id.in_(file_ids))
+    ):
+        comments.setdefault(file_id, []).append(comment_text)
+
+    documents = []
+    for row in files:
+        content = ''
+        if row['app_type'] in INDEXED_APP_TYPES:
+            content = extract_document_text(row['file_path'], row['stored_encoding'])
+        documents.append({
+            'file_id': row['file_id'],
+            'owner_id': row['owner_id'],
+            'filename': row['filename'],
+            'tags': ' '.join(tags.get(row['file_id'], [])),
+            'comments': '\n'.join(comments.get(row['file_id'], [])),
+            'content': content,
+        })
+    return documents
+
+
+def search_files(db, owner_id: int, query: str, filters: Optional[SearchFilters] = None,
+                 limit: int = 50, offset: int = 0) -> List[Tuple[int, float]]:
+    """Ranked (file_id, score) pairs for the owner's non-deleted files"""
+    terms = query_terms(query)
+    if not terms:
+        return []
+    index = get_search_index(db.get_bind())
+    return index.match(db.connection(), owner_id, terms, filters or SearchFilters(), limit, offset)
+
+
+def rebuild_index(batch_size: int = 1000):
+    """Reindex every file in id order, one transaction per batch"""
+    index = get_search_index()
+    last_id = 0
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(
+                text("SELECT file_id FROM files WHERE file_id > :last ORDER BY file_id LIMIT :n"),
+                {'last': last_id, 'n': batch_size}
+            )]
+            if not ids:
+                break
+            index.reindex(conn, ids)
+        last_id = ids[-1]
+        total += len(ids)
+    return total
+
+
+# --- Incremental maintenance ----------------------------------------------
+
+def mark_for_reindex(session, file_ids):
+    """Queue files for reindexing on commit (for bulk writes the hooks can't see)"""
+    session.info.setdefault('search_reindex', set()).update(file_ids)
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def _create_search_schema(target, connection, **kw):
+    get_search_index(connection).create_schema(connection)
+
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _collect_changed_files(session, flush_context):
+    pending = session.info.setdefault('search_reindex', set())
+    tag_ids = session.info.setdefault('search_retag', set())
+
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, File):
+            pending.add(obj.file_id)
+        elif isinstance(obj, (Comment, FileTag)):
+            pending.add(obj.file_id)
+        elif isinstance(obj, Tag) and obj not in session.new:
+            tag_ids.add(obj.tag_id)
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _apply_pending(session):
+    pending = session.info.pop('search_reindex', set())
+    tag_ids = session.info.pop('search_retag', set())
+    pending.discard(None)
+    if not pending and not tag_ids:
+        return
+    try:
+        with engine.begin() as conn:
+            if tag_ids:
+                pending.update(row[0] for row in conn.execute(
+                    FileTag.__table__.select().with_only_columns(FileTag.file_id)
+                    .where(FileTag.tag_id.in_(tag_ids))
+                ))
+            get_search_index(conn).reindex(conn, pending)
+    except Exception as e:
+        # The index is derived data; never fail the write that triggered it
+        logger.warning(f"Search reindex failed for files {sorted(pending)[:10]}: {e}")
+
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('search_reindex', None)
+    session.info.pop('search_retag', None)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebuild':
+        with engine.begin() as conn:
+            get_search_index(conn).create_schema(conn)
+        print(f"✅ Reindexed {rebuild_index()} files")
+    else:
+        print("Usage: python search.py rebuild")
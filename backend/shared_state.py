@@ -0,0 +1,230 @@
+"""
+State every worker process of one API instance sees alike: caches and
+counters (rate limits, generation numbers).
+
+Under gunicorn (gunicorn.conf.py) each worker is its own process, so a
+module-level dict is per worker: a cache one worker filled is cold in the
+others and a limit of N requests becomes N per worker. Code that needs
+one view across workers goes through get_shared_state():
+
+- LocalState: in-process dicts; enough for a single process (the default)
+- SQLiteState: a small SQLite database on tmpfs (/dev/shm), so shared
+  memory in effect, with SQLite doing the locking; every worker on the
+  host, no extra service. gunicorn.conf.py picks it when it starts
+  several workers.
+- RedisState: a Redis server, shared by processes and pods alike (needs
+  the optional redis package)
+
+Values are bytes (callers encode); keys with a ttl expire after that many
+seconds. Change events have their own cross-process fan-out
+(changefeed.SharedBroker), stored in the same SQLite file.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+from config import Config
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def default_path() -> str:
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'eucloud-state.db')
+
+
+class SharedState(ABC):
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Add to a counter and return the new value; ttl applies from the
+        counter's creation (a fixed window), not from every increment"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def counter(self, key: str) -> int:
+        """A counter's current value (0 if unset or expired), without writing"""
+        raise NotImplementedError
+
+
+class LocalState(SharedState):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[str, Tuple[object, Optional[float]]] = {}
+
+    def _live(self, key: str, now: float):
+        entry = self._values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._live(key, time.time())
+            return entry[0] if entry is not None and isinstance(entry[0], bytes) else None
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None or not isinstance(entry[0], int):
+                entry = (0, now + ttl if ttl else None)
+            value = entry[0] + amount
+            self._values[key] = (value, entry[1])
+            return value
+
+    def counter(self, key: str) -> int:
+        with self._lock:
+            entry = self._live(key, time.time())
+            return entry[0] if entry is not None and isinstance(entry[0], int) else 0
+
+
+class SQLiteState(SharedState):
+    """A SQLite database meant for tmpfs; one connection per thread and process"""
+
+    SWEEP_EVERY = 1000  # writes between removals of expired rows
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or default_path()
+        self._local = threading.local()
+        self._writes = 0
+        conn = self.connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires REAL)")
+
+    def connect(self) -> sqlite3.Connection:
+        """This thread's connection; a forked worker opens its own instead of sharing the parent's"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # tmpfs: nothing to make durable
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _wrote(self, conn: sqlite3.Connection, now: float):
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            conn.execute("DELETE FROM kv WHERE expires <= ?", (now,))
+            conn.execute("DELETE FROM counters WHERE expires <= ?", (now,))
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self.connect().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        now = time.time()
+        conn = self.connect()
+        conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                     (key, value, now + ttl if ttl else None))
+        self._wrote(conn, now)
+
+    def delete(self, key: str):
+        self.connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.time()
+        conn = self.connect()
+        # An expired counter restarts at amount with a new window
+        value, = conn.execute(
+            """
+            INSERT INTO counters (key, value, expires) VALUES (:key, :amount, :expires)
+            ON CONFLICT (key) DO UPDATE SET
+                value = CASE WHEN counters.expires <= :now THEN :amount ELSE counters.value + :amount END,
+                expires = CASE WHEN counters.expires <= :now THEN :expires ELSE counters.expires END
+            RETURNING value
+            """,
+            {'key': key, 'amount': amount, 'expires': now + ttl if ttl else None, 'now': now},
+        ).fetchone()
+        self._wrote(conn, now)
+        return value
+
+    def counter(self, key: str) -> int:
+        row = self.connect().execute(
+            "SELECT value FROM counters WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+
+class RedisState(SharedState):
+    def __init__(self, url: str, prefix: str = 'eucloud:state:'):
+        if redis is None:
+            raise RuntimeError("redis is required for SHARED_STATE=redis")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        self.client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        name = self.prefix + key
+        pipe = self.client.pipeline()
+        if ttl:
+            pipe.set(name, 0, px=int(ttl * 1000), nx=True)  # starts the window only once
+        pipe.incrby(name, amount)
+        return pipe.execute()[-1]
+
+    def counter(self, key: str) -> int:
+        return int(self.client.get(self.prefix + key) or 0)
+
+
+_state: Optional[SharedState] = None
+_state_lock = threading.Lock()
+
+
+def create_shared_state() -> SharedState:
+    if Config.SHARED_STATE == 'shm':
+        return SQLiteState(Config.SHARED_STATE_PATH)
+    if Config.SHARED_STATE == 'redis':
+        return RedisState(Config.REDIS_URL)
+    return LocalState()
+
+
+def get_shared_state() -> SharedState:
+    global _state
+    with _state_lock:
+        if _state is None:
+            _state = create_shared_state()
+        return _state
+
+
+def set_shared_state(state: Optional[SharedState]):
+    """Swap the process-wide state (config changes, tests)"""
+    global _state
+    with _state_lock:
+        _state = state
@@ -0,0 +1,245 @@
+"""
+Opt-in SQL profiling (SQL_PROFILING=true): which routes issue which queries.
+
+- Every query a request runs is timed and attributed to the request's
+  route template; per-route aggregates (requests, queries per request,
+  database time, and the heaviest statements) are kept in memory and dumped
+  by GET /api/admin/sql-profile.
+- Queries slower than SLOW_QUERY_MS are logged to the 'sql.slow' logger
+  with the shape of their bound parameters (types and lengths, never
+  values) and, for reads, the database's query plan.
+- With DEBUG on, responses carry X-Query-Count and Server-Timing headers
+  (visible in the browser's network panel).
+
+Statements are grouped by fingerprint: the parameterized SQL with
+whitespace collapsed and expanded IN lists folded, so `IN (?, ?, ?)` and
+`IN (?, ?)` count as one statement. Aggregates are per process.
+"""
+import logging
+import re
+import threading
+import time
+import contextvars
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+from config import Config
+from metrics import route_template
+from models import engine
+
+logger = logging.getLogger('sql.slow')
+
+MAX_STATEMENTS_PER_ROUTE = 200  # the rarest are dropped beyond this
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)'
+_IN_LIST_RE = re.compile(r'\(\s*' + _PLACEHOLDER + r'(?:\s*,\s*' + _PLACEHOLDER + r')+\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+_EXPLAIN_PREFIX = {'sqlite': 'EXPLAIN QUERY PLAN ', 'postgresql': 'EXPLAIN ', 'mysql': 'EXPLAIN '}
+
+
+def fingerprint(statement: str) -> str:
+    return _IN_LIST_RE.sub('(?, ...)', _SPACE_RE.sub(' ', statement).strip())
+
+
+def _value_shape(value) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (str, bytes)):
+        return f'{type(value).__name__}[{len(value)}]'
+    return type(value).__name__
+
+
+def parameter_shape(parameters, executemany: bool = False) -> str:
+    """Types (and lengths) of bound parameters, never their values"""
+    if executemany:
+        rows = list(parameters or [])
+        return f"{len(rows)} x {parameter_shape(rows[0]) if rows else '()'}"
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{name}: {_value_shape(value)}' for name, value in parameters.items()) + '}'
+    return '(' + ', '.join(_value_shape(value) for value in parameters or ()) + ')'
+
+
+def explain(conn, statement: str, parameters) -> Optional[str]:
+    """The query plan of a read, from a separate raw cursor so it is not profiled itself"""
+    prefix = _EXPLAIN_PREFIX.get(conn.dialect.name)
+    if prefix is None or not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    if conn.dialect.name == 'sqlite':  # (id, parent, notused, detail)
+        return '\n'.join(row[-1] for row in rows)
+    return '\n'.join(' | '.join(str(column) for column in row) for row in rows)
+
+
+# --- Per-route aggregates -----------------------------------------------
+
+class RequestProfile:
+    __slots__ = ('request', 'queries', 'seconds', 'statements')
+
+    def __init__(self, request: str = ''):
+        self.request = request
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements: List[tuple] = []
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.max_queries = 0
+        self.statements: Dict[str, list] = {}  # fingerprint -> [count, seconds, max seconds]
+
+    def add(self, profile: RequestProfile):
+        self.requests += 1
+        self.queries += profile.queries
+        self.seconds += profile.seconds
+        self.max_queries = max(self.max_queries, profile.queries)
+        for statement, elapsed in profile.statements:
+            key = fingerprint(statement)
+            entry = self.statements.get(key)
+            if entry is None:
+                if len(self.statements) >= MAX_STATEMENTS_PER_ROUTE:
+                    rarest = min(self.statements, key=lambda k: self.statements[k][0])
+                    del self.statements[rarest]
+                entry = self.statements[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+
+    def to_dict(self, top: int) -> dict:
+        heaviest = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return {
+            'requests': self.requests,
+            'queries': self.queries,
+            'queries_per_request': round(self.queries / self.requests, 2),
+            'max_queries': self.max_queries,
+            'db_ms': round(self.seconds * 1000, 2),
+            'db_ms_per_request': round(self.seconds * 1000 / self.requests, 3),
+            'statements': [
+                {
+                    'sql': sql,
+                    'count': count,
+                    'per_request': round(count / self.requests, 2),  # >1 on every request smells of N+1
+                    'total_ms': round(seconds * 1000, 2),
+                    'max_ms': round(slowest * 1000, 2),
+                }
+                for sql, (count, seconds, slowest) in heaviest
+            ]
+        }
+
+
+_lock = threading.Lock()
+_routes: Dict[tuple, RouteStats] = {}
+_current: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar('sql_profile', default=None)
+
+
+def record(method: str, route: str, profile: RequestProfile):
+    with _lock:
+        stats = _routes.get((method, route))
+        if stats is None:
+            stats = _routes[(method, route)] = RouteStats()
+        stats.add(profile)
+
+
+def dump(top: int = 10) -> List[dict]:
+    """Per-route aggregates, routes with the most database time first"""
+    with _lock:
+        routes = [{'method': method, 'route': route, **stats.to_dict(top)}
+                  for (method, route), stats in _routes.items()]
+    return sorted(routes, key=lambda r: r['db_ms'], reverse=True)
+
+
+def reset():
+    with _lock:
+        _routes.clear()
+
+
+# --- Query hooks --------------------------------------------------------
+
+_installed = False
+
+
+def install():
+    """Hook the engine's cursor events (idempotent); queries are only profiled while SQL_PROFILING is on"""
+    global _installed
+    if _installed:
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    _installed = True
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and Config.SQL_PROFILING:
+        context._profile_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_profile_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    profile = _current.get()
+    if profile is not None:
+        profile.queries += 1
+        profile.seconds += elapsed
+        profile.statements.append((statement, elapsed))
+    if elapsed * 1000 >= Config.SLOW_QUERY_MS:
+        log_slow_query(conn, statement, parameters, executemany, elapsed)
+
+
+def log_slow_query(conn, statement: str, parameters, executemany: bool, elapsed: float):
+    plan = None
+    if not executemany:
+        try:
+            plan = explain(conn, statement, parameters)
+        except Exception as e:
+            plan = f'(no plan: {e})'
+    profile = _current.get()
+    logger.warning(
+        f"Slow query ({elapsed * 1000:.1f} ms)"
+        + (f" during {profile.request}" if profile is not None else '')
+        + f": {fingerprint(statement)}\n  parameters: {parameter_shape(parameters, executemany)}"
+        + ("\n  plan:\n    " + plan.replace('\n', '\n    ') if plan else '')
+    )
+
+
+# --- Requests -----------------------------------------------------------
+
+class SQLProfileMiddleware:
+    """Attributes each request's queries to its route; passes requests through untouched when profiling is off"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not Config.SQL_PROFILING:
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(f"{scope['method']} {scope['path']}")
+        token = _current.set(profile)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start' and Config.DEBUG:
+                total_ms = (time.perf_counter() - started) * 1000
+                db_ms = profile.seconds * 1000
+                headers = list(message.get('headers', []))
+                headers.append((b'x-query-count', str(profile.queries).encode()))
+                headers.append((b'server-timing', (
+                    f'db;dur={db_ms:.2f};desc="{profile.queries} queries", app;dur={total_ms - db_ms:.2f}'
+                ).encode()))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            record(scope['method'], route_template(scope), profile)
@@ -0,0 +1,138 @@
+"""
+Pluggable blob storage.
+
+Config.STORAGE_BACKEND picks the driver for uploads (and the versions kept
+next to them):
+- local:   one directory, Config.UPLOAD_FOLDER (the default)
+- sharded: several local volumes, Config.STORAGE_VOLUMES, users spread
+           across them by rendezvous hashing
+- s3:      an S3-compatible bucket, Config.S3_* (needs boto3)
+
+Thumbnails get their own driver: the thumbnail folder for the local
+backends, a "thumbnails/" prefix in the bucket for s3. New keys follow the
+directory-sharded layout in storage/layout.py.
+
+Blob lifetimes follow database transactions: delete_after_commit() and
+discard_on_rollback() register keys on the session, and the blobs are
+removed only once the transaction's outcome is known.
+"""
+import logging
+import threading
+from typing import Iterable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from config import Config
+from storage.base import BlobStat, StorageDriver
+from storage.layout import is_sharded_key, new_blob_key, thumbnail_key
+from storage.local import LocalDriver
+from storage.sharded import ShardedDriver
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('local', 'sharded', 's3')
+
+_drivers = {}
+_lock = threading.Lock()
+
+
+def create_driver(area: str) -> StorageDriver:
+    """Build the configured driver for 'uploads' or 'thumbnails'"""
+    backend = Config.STORAGE_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {backend!r}, expected one of {BACKENDS}")
+
+    if backend == 's3':
+        from storage.s3 import S3Driver
+        return S3Driver(
+            Config.S3_BUCKET,
+            prefix=f"{Config.S3_PREFIX}{area}/",
+            endpoint_url=Config.S3_ENDPOINT_URL,
+            region_name=Config.S3_REGION,
+            aws_access_key_id=Config.S3_ACCESS_KEY_ID,
+            aws_secret_access_key=Config.S3_SECRET_ACCESS_KEY,
+        )
+    if area == 'thumbnails':
+        return LocalDriver(Config.THUMBNAIL_FOLDER)
+    if backend == 'sharded':
+        volumes = [v.strip() for v in Config.STORAGE_VOLUMES.split(',') if v.strip()]
+        return ShardedDriver([LocalDriver(v) for v in volumes or [Config.UPLOAD_FOLDER]])
+    return LocalDriver(Config.UPLOAD_FOLDER)
+
+
+def _driver(area: str) -> StorageDriver:
+    with _lock:
+        if area not in _drivers:
+            _drivers[area] = create_driver(area)
+        return _drivers[area]
+
+
+def get_storage() -> StorageDriver:
+    """Driver holding uploaded files and their versions"""
+    return _driver('uploads')
+
+
+def get_thumbnail_storage() -> StorageDriver:
+    return _driver('thumbnails')
+
+
+def reset_storage(uploads: Optional[StorageDriver] = None, thumbnails: Optional[StorageDriver] = None):
+    """Swap the process-wide drivers (config changes, tests)"""
+    with _lock:
+        _drivers.clear()
+        if uploads:
+            _drivers['uploads'] = uploads
+        if thumbnails:
+            _drivers['thumbnails'] = thumbnails
+
+
+# --- Tying blob lifetimes to database transactions ------------------------
+
+def delete_after_commit(session, keys: Iterable[str], driver: Optional[StorageDriver] = None):
+    """Remove blobs once the transaction that stopped referencing them commits"""
+    driver = driver or get_storage()
+    session.info.setdefault('blobs_to_delete', []).extend((driver, key) for key in keys)
+
+
+def discard_on_rollback(session, keys: Iterable[str], driver: Optional[StorageDriver] = None):
+    """Remove freshly written blobs if the transaction referencing them rolls back"""
+    driver = driver or get_storage()
+    session.info.setdefault('blobs_written', []).extend((driver, key) for key in keys)
+
+
+def _delete_all(entries):
+    for driver, key in entries:
+        try:
+            driver.delete(key)
+        except Exception:
+            logger.exception(f"Could not delete blob {key}")
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    session.info.pop('blobs_written', None)
+    _delete_all(session.info.pop('blobs_to_delete', []))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('blobs_to_delete', None)
+    _delete_all(session.info.pop('blobs_written', []))
+
+
+def __getattr__(name):
+    # boto3 takes longer to import than the rest of the app's own modules:
+    # only deployments on s3 (or code asking for S3Driver) load it
+    if name == 'S3Driver':
+        from storage.s3 import S3Driver
+        return S3Driver
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = [
+    'BlobStat', 'StorageDriver', 'LocalDriver', 'ShardedDriver', 'S3Driver',
+    'create_driver', 'get_storage', 'get_thumbnail_storage', 'reset_storage',
+    'delete_after_commit', 'discard_on_rollback',
+    'new_blob_key', 'thumbnail_key', 'is_sharded_key',
+]
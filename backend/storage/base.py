@@ -0,0 +1,145 @@
+"""
+The storage driver interface.
+
+Blobs are addressed by keys: the relative paths stored in File.file_path,
+FileVersion.file_path and File.thumbnail_path (e.g. "12/3f/2c/3f2c....ty"). A
+driver maps keys to physical storage; nothing outside storage/ should build
+filesystem paths for blobs.
+"""
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from typing import BinaryIO, Iterable, Iterator, NamedTuple, Optional
+
+import compression
+from blobstore import BlobUpload
+
+READ_CHUNK = 1024 * 1024
+
+
+class BlobStat(NamedTuple):
+    size: int        # stored bytes
+    modified: float  # unix timestamp
+
+
+class StorageDriver(ABC):
+    """Base class of all drivers; subclasses implement the raw operations"""
+
+    name = 'abstract'
+
+    # --- Raw operations -------------------------------------------------
+
+    @abstractmethod
+    def open_read(self, key: str) -> BinaryIO:
+        """Stream of the stored bytes; FileNotFoundError if missing"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_range(self, key: str, start: int, length: int, chunk_size: int = READ_CHUNK) -> Iterator[bytes]:
+        """Stream `length` stored bytes starting at `start`"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def open_write(self, key: str, encoding: str = compression.IDENTITY) -> BlobUpload:
+        """Streaming writer; the blob becomes visible under key on commit()"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Remove a blob; missing blobs are ignored"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stat(self, key: str) -> Optional[BlobStat]:
+        """Size and mtime of a blob, None if it does not exist"""
+        raise NotImplementedError
+
+    def presign(self, key: str, expires: int = 300, filename: Optional[str] = None,
+                content_type: Optional[str] = None, content_encoding: Optional[str] = None) -> Optional[str]:
+        """Time-limited URL clients can fetch the blob from directly, if supported"""
+        return None
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Filesystem path of the blob for zero-copy serving, if it has one"""
+        return None
+
+    def link(self, source_key: str, target_key: str) -> bool:
+        """Make target_key name the same stored bytes without copying them;
+        False if the driver cannot (callers then copy)"""
+        return False
+
+    def clone(self, source_key: str, target_key: str) -> bool:
+        """Make target_key an independent copy that shares storage with the
+        source until either is rewritten (a reflink); False if unsupported"""
+        return False
+
+    def sweep(self) -> int:
+        """Clean up leftovers of interrupted writes; returns how many"""
+        return 0
+
+    # --- Derived operations ---------------------------------------------
+
+    def exists(self, key: str) -> bool:
+        return self.stat(key) is not None
+
+    def copy(self, source_key: str, target_key: str) -> int:
+        """Physically copy stored bytes as they are (encoding included); returns the size"""
+        with self.open_read(source_key) as source:
+            return self.write_chunks(target_key, iter(lambda: source.read(READ_CHUNK), b'')).stored_size
+
+    def write_bytes(self, key: str, data: bytes, encoding: str = compression.IDENTITY) -> BlobUpload:
+        """Write a whole blob; returns it committed (size, stored_size, encoding)"""
+        with self.open_write(key, encoding) as blob:
+            blob.write(data)
+        return blob
+
+    def write_chunks(self, key: str, chunks: Iterable[bytes], encoding: str = compression.IDENTITY) -> BlobUpload:
+        with self.open_write(key, encoding) as blob:
+            for chunk in chunks:
+                blob.write(chunk)
+        return blob
+
+    def iter_raw(self, key: str, chunk_size: int = READ_CHUNK) -> Iterator[bytes]:
+        """Stream the stored bytes without decoding"""
+        with self.open_read(key) as stream:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def open_content(self, key: str, encoding: Optional[str] = compression.IDENTITY) -> BinaryIO:
+        """Stream of a blob's logical content, decompressing on the fly"""
+        return compression.decoded(self.open_read(key), encoding)
+
+    def iter_content(self, key: str, encoding: Optional[str] = compression.IDENTITY,
+                     chunk_size: int = READ_CHUNK) -> Iterator[bytes]:
+        with self.open_content(key, encoding) as stream:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def read_content(self, key: str, encoding: Optional[str] = compression.IDENTITY,
+                     limit: Optional[int] = None) -> bytes:
+        """Logical content of a blob (the first `limit` bytes if given)"""
+        with self.open_content(key, encoding) as stream:
+            if limit is None:
+                return b''.join(iter(lambda: stream.read(READ_CHUNK), b''))
+            parts, remaining = [], limit
+            while remaining > 0:
+                chunk = stream.read(min(READ_CHUNK, remaining))
+                if not chunk:
+                    break
+                parts.append(chunk)
+                remaining -= len(chunk)
+            return b''.join(parts)
+
+    def open_seekable(self, key: str) -> BinaryIO:
+        """Seekable stream of the stored bytes (spooled to a temp file if needed)"""
+        spooled = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+        with self.open_read(key) as source:
+            shutil.copyfileobj(source, spooled, READ_CHUNK)
+        spooled.seek(0)
+        return spooled
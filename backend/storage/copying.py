@@ -0,0 +1,93 @@
+"""
+Duplicating a local blob between two open files, cheapest mechanism first.
+
+- reflink: the FICLONE ioctl shares the source's extents (btrfs, XFS with
+  reflink=1, bcachefs, OCFS2). The clone is an independent file that takes
+  no extra space until one side is rewritten.
+- copy_file_range: an in-kernel copy with no round trip through user space;
+  NFS 4.2 and some filesystems turn it into a server-side copy or a reflink.
+- sendfile: in-kernel copy for kernels without copy_file_range.
+- read_write: plain buffered copy, works everywhere.
+
+The functions block, so call them from a worker thread.
+"""
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+CHUNK = 64 * 1024 * 1024
+
+# errnos meaning "this mechanism is not available here", as opposed to I/O errors
+UNSUPPORTED = {
+    errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+    errno.ENOSYS, errno.EBADF, errno.EPERM,
+}
+
+
+def reflink(source_fd: int, target_fd: int) -> bool:
+    """Clone source into the (empty) target; False if the filesystem can't"""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+    except OSError as e:
+        if e.errno in UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def copy_file_range(source_fd: int, target_fd: int, size: int):
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(source_fd, target_fd, min(CHUNK, size - offset), offset, offset)
+        if copied == 0:
+            break
+        offset += copied
+
+
+def sendfile(source_fd: int, target_fd: int, size: int):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(target_fd, source_fd, offset, min(CHUNK, size - offset))
+        if sent == 0:
+            break
+        offset += sent
+
+
+def read_write(source_fd: int, target_fd: int, size: int):
+    with open(source_fd, 'rb', closefd=False) as source, open(target_fd, 'wb', closefd=False) as target:
+        source.seek(0)
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+
+PHYSICAL_METHODS = {
+    'copy_file_range': copy_file_range,
+    'sendfile': sendfile,
+    'read_write': read_write,
+}
+
+
+def physical_copy(source_fd: int, target_fd: int) -> str:
+    """Copy every byte into the (empty) target; returns the mechanism used"""
+    size = os.fstat(source_fd).st_size
+    for name in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, name):
+            continue
+        try:
+            PHYSICAL_METHODS[name](source_fd, target_fd, size)
+            return name
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            # Start over with the next mechanism
+            os.ftruncate(target_fd, 0)
+            os.lseek(target_fd, 0, os.SEEK_SET)
+    read_write(source_fd, target_fd, size)
+    return 'read_write'
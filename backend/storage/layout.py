@@ -0,0 +1,33 @@
+"""
+Key layout for uploaded blobs.
+
+    {owner_id}/{ab}/{cd}/{uuid}.{ext}        uploads
+    {owner_id}/{ab}/{cd}/thumb_{uuid}.{ext}  thumbnails (thumbnail storage)
+    {owner_id}/.versions/{file_id}/...       version history (see versioning.py)
+
+ab and cd are the first four hex digits of the random uuid, so even a user
+with millions of files gets directories of a few dozen entries instead of
+one huge flat directory. The owner stays the first segment, which keeps a
+user's blobs together for the sharded driver.
+"""
+import re
+import uuid
+from typing import Optional
+
+SHARDED_KEY = re.compile(r'^\d+/[0-9a-f]{2}/[0-9a-f]{2}/[^/]+$')
+
+
+def new_blob_key(owner_id: int, filename: str) -> str:
+    """Fresh key for a new upload or copy owned by owner_id"""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    name = uuid.uuid4().hex
+    return f"{owner_id}/{name[:2]}/{name[2:4]}/{name}.{ext}" if ext else f"{owner_id}/{name[:2]}/{name[2:4]}/{name}"
+
+
+def thumbnail_key(blob_key: str) -> str:
+    directory, _, name = blob_key.rpartition('/')
+    return f"{directory}/thumb_{name}" if directory else f"thumb_{name}"
+
+
+def is_sharded_key(key: Optional[str]) -> bool:
+    return bool(key) and SHARDED_KEY.match(key) is not None
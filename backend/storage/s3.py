@@ -0,0 +1,133 @@
+"""
+S3-compatible driver (AWS S3, MinIO, Ceph RGW, ...), built on the optional
+boto3 package.
+
+Writes are spooled to a temp file (in memory while small) and uploaded on
+commit with boto3's managed transfer, which switches to multipart uploads
+for large blobs; an object only appears once its upload completed, so
+readers never see partial blobs. Downloads can be handed off to the object
+store with presigned URLs.
+"""
+import tempfile
+from typing import BinaryIO, Iterator, Optional
+
+import compression
+from blobstore import BlobUpload
+from storage.base import READ_CHUNK, BlobStat, StorageDriver
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+    ClientError = None
+
+SPOOL_IN_MEMORY = 8 * 1024 * 1024
+
+
+def _is_missing(error) -> bool:
+    code = error.response.get('Error', {}).get('Code')
+    return code in ('404', 'NoSuchKey', 'NotFound')
+
+
+class S3Upload(BlobUpload):
+    """Spools a blob locally, then uploads it in one (multipart) transfer"""
+
+    def __init__(self, driver: 'S3Driver', key: str, encoding: str):
+        super().__init__(encoding)
+        self.driver = driver
+        self.key = key
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_IN_MEMORY)
+
+    def _store(self, data: bytes):
+        self.spool.write(data)
+
+    def _publish(self):
+        self.spool.seek(0)
+        try:
+            self.driver.client.upload_fileobj(self.spool, self.driver.bucket, self.driver.object_key(self.key))
+        finally:
+            self.spool.close()
+
+    def _discard(self):
+        self.spool.close()
+
+
+class S3Driver(StorageDriver):
+    name = 's3'
+
+    def __init__(self, bucket: str, prefix: str = '', client=None, **client_options):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("boto3 is required for the S3 storage backend")
+            client = boto3.client('s3', **{k: v for k, v in client_options.items() if v})
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self, key: str) -> str:
+        key = key.replace('\\', '/')
+        if key.startswith('/') or '..' in key.split('/'):
+            raise ValueError(f"Invalid storage key: {key!r}")
+        return self.prefix + key
+
+    def open_read(self, key: str) -> BinaryIO:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))['Body']
+        except ClientError as e:
+            if _is_missing(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def read_range(self, key: str, start: int, length: int, chunk_size: int = READ_CHUNK) -> Iterator[bytes]:
+        if length <= 0:
+            return
+        try:
+            body = self.client.get_object(
+                Bucket=self.bucket, Key=self.object_key(key), Range=f'bytes={start}-{start + length - 1}'
+            )['Body']
+        except ClientError as e:
+            if _is_missing(e):
+                raise FileNotFoundError(key)
+            raise
+        with body:
+            while True:
+                chunk = body.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def open_write(self, key: str, encoding: str = compression.IDENTITY) -> BlobUpload:
+        self.object_key(key)
+        return S3Upload(self, key, encoding)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def stat(self, key: str) -> Optional[BlobStat]:
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if _is_missing(e):
+                return None
+            raise
+        return BlobStat(head['ContentLength'], head['LastModified'].timestamp())
+
+    def copy(self, source_key: str, target_key: str) -> int:
+        """Server-side copy; nothing flows through this process"""
+        self.client.copy(
+            {'Bucket': self.bucket, 'Key': self.object_key(source_key)},
+            self.bucket, self.object_key(target_key)
+        )
+        return self.stat(target_key).size
+
+    def presign(self, key: str, expires: int = 300, filename: Optional[str] = None,
+                content_type: Optional[str] = None, content_encoding: Optional[str] = None) -> Optional[str]:
+        params = {'Bucket': self.bucket, 'Key': self.object_key(key)}
+        if filename:
+            params['ResponseContentDisposition'] = f'attachment; filename="{filename}"'
+        if content_type:
+            params['ResponseContentType'] = content_type
+        if content_encoding:
+            params['ResponseContentEncoding'] = content_encoding
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires)
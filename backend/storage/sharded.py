@@ -0,0 +1,106 @@
+"""
+Multi-volume driver: spreads users across several local volumes (disks or
+PVCs) so capacity and I/O bandwidth grow with the number of volumes.
+
+The shard key is the first segment of a blob key, i.e. the owner id for
+uploads and versions, so all of a user's blobs live on one volume. Volumes
+are picked by rendezvous (highest-random-weight) hashing: adding a volume
+only moves the users that now hash to it, and until they are rebalanced
+their existing blobs are still found by probing the other volumes.
+Overwrites stay on the volume that already holds the blob.
+"""
+import hashlib
+from typing import BinaryIO, Iterator, List, Optional
+
+import compression
+from blobstore import BlobUpload
+from storage.base import READ_CHUNK, BlobStat, StorageDriver
+from storage.local import LocalDriver
+
+
+class ShardedDriver(StorageDriver):
+    name = 'sharded'
+
+    def __init__(self, volumes: List[LocalDriver]):
+        if not volumes:
+            raise ValueError("ShardedDriver needs at least one volume")
+        self.volumes = volumes
+
+    @staticmethod
+    def shard_key(key: str) -> str:
+        return key.replace('\\', '/').split('/', 1)[0]
+
+    def preferred_volume(self, key: str) -> LocalDriver:
+        """The volume new blobs of this key's shard are written to"""
+        shard = self.shard_key(key)
+
+        def weight(volume):
+            digest = hashlib.blake2b(f'{volume.root}\0{shard}'.encode(), digest_size=8).digest()
+            return int.from_bytes(digest, 'big')
+
+        return max(self.volumes, key=weight)
+
+    def locate(self, key: str) -> Optional[LocalDriver]:
+        """The volume holding an existing blob (preferred volume first)"""
+        preferred = self.preferred_volume(key)
+        if preferred.stat(key) is not None:
+            return preferred
+        for volume in self.volumes:
+            if volume is not preferred and volume.stat(key) is not None:
+                return volume
+        return None
+
+    def _reader(self, key: str) -> LocalDriver:
+        volume = self.locate(key)
+        if volume is None:
+            raise FileNotFoundError(key)
+        return volume
+
+    def open_read(self, key: str) -> BinaryIO:
+        return self._reader(key).open_read(key)
+
+    def read_range(self, key: str, start: int, length: int, chunk_size: int = READ_CHUNK) -> Iterator[bytes]:
+        return self._reader(key).read_range(key, start, length, chunk_size)
+
+    def open_write(self, key: str, encoding: str = compression.IDENTITY) -> BlobUpload:
+        volume = self.locate(key) or self.preferred_volume(key)
+        return volume.open_write(key, encoding)
+
+    def delete(self, key: str):
+        for volume in self.volumes:
+            volume.delete(key)
+
+    def stat(self, key: str) -> Optional[BlobStat]:
+        volume = self.locate(key)
+        return volume.stat(key) if volume else None
+
+    def _same_volume(self, source_key: str, target_key: str) -> Optional[LocalDriver]:
+        """The volume holding source_key, if target_key would be written there too"""
+        volume = self.locate(source_key)
+        if volume is None or volume is not (self.locate(target_key) or self.preferred_volume(target_key)):
+            return None
+        return volume
+
+    def link(self, source_key: str, target_key: str) -> bool:
+        volume = self._same_volume(source_key, target_key)
+        return volume.link(source_key, target_key) if volume else False
+
+    def clone(self, source_key: str, target_key: str) -> bool:
+        volume = self._same_volume(source_key, target_key)
+        return volume.clone(source_key, target_key) if volume else False
+
+    def copy(self, source_key: str, target_key: str) -> int:
+        volume = self._same_volume(source_key, target_key)
+        if volume:
+            return volume.copy(source_key, target_key)
+        return super().copy(source_key, target_key)
+
+    def local_path(self, key: str) -> Optional[str]:
+        volume = self.locate(key)
+        return volume.path(key) if volume else None
+
+    def open_seekable(self, key: str) -> BinaryIO:
+        return self.open_read(key)
+
+    def sweep(self) -> int:
+        return sum(volume.sweep() for volume in self.volumes)
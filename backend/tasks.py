@@ -0,0 +1,80 @@
+"""
+Background jobs for work that used to run inline in request handlers
+(see jobs.py): image thumbnails and emptying large trashes.
+"""
+import io
+from typing import Optional
+
+from sqlalchemy import or_
+
+from changefeed import record_change
+from jobs import JobHandler, register, task
+from models import Activity, File, Tag
+from routes.trash import delete_file_permanently
+from storage import delete_after_commit, discard_on_rollback, get_storage, get_thumbnail_storage, thumbnail_key
+
+
+def generate_thumbnail(file_key: str, thumb_key: str) -> Optional[str]:
+    """Write a 200px thumbnail; None if the blob is not an image PIL can read"""
+    from PIL import Image  # imported by the first thumbnail, not by every API process at startup
+
+    try:
+        with get_storage().open_seekable(file_key) as source:
+            img = Image.open(source)
+            image_format = img.format or 'PNG'
+            img.thumbnail((200, 200))
+            buffer = io.BytesIO()
+            img.save(buffer, format=image_format)
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError, ValueError, SyntaxError):
+        return None
+    get_thumbnail_storage().write_bytes(thumb_key, buffer.getvalue())
+    return thumb_key
+
+
+@task('thumbnail', queue='media')
+def make_thumbnail(db, job, file_id: int, file_key: str):
+    """Thumbnail an uploaded image, unless the file was deleted or rewritten meanwhile"""
+    file = db.query(File).get(file_id)
+    if file is None or file.file_path != file_key or file.thumbnail_path:
+        return
+    thumb_key = generate_thumbnail(file_key, thumbnail_key(file_key))
+    if thumb_key is None:
+        return
+    thumbnails = get_thumbnail_storage()
+    discard_on_rollback(db, [thumb_key], driver=thumbnails)
+    updated = db.query(File).filter(File.file_id == file_id, File.file_path == file_key).update(
+        {File.thumbnail_path: thumb_key}, synchronize_session=False
+    )
+    if updated:
+        record_change(db, file.owner_id, 'file', 'updated', file_id, {'thumbnail_path': thumb_key})
+    else:
+        delete_after_commit(db, [thumb_key], driver=thumbnails)
+
+
+@register
+class EmptyTrash(JobHandler):
+    """Permanently delete everything that was in the trash when the job was enqueued"""
+    kind = 'trash_empty'
+
+    def trashed(self, db, job):
+        return db.query(File).filter(
+            File.owner_id == job.owner_id,
+            File.is_deleted == True,
+            or_(File.deleted_at == None, File.deleted_at <= job.created_at)
+        )
+
+    def start(self, db, job):
+        job.total_items = self.trashed(db, job).count()
+
+    def step(self, db, job, state, batch_size):
+        files = self.trashed(db, job).order_by(File.file_id).limit(batch_size).all()
+        Tag.untag_files(db, [file.file_id for file in files])
+        for file in files:
+            delete_file_permanently(db, file)
+        job.processed_items += len(files)
+        return len(files) < batch_size
+
+    def finish(self, db, job, state, status):
+        if status == 'completed':
+            db.add(Activity(user_id=job.owner_id, activity_type='delete',
+                            activity_details=f"Emptied trash ({job.processed_items} files deleted permanently)"))
@@ -0,0 +1,127 @@
+"""
+Crash-injection tests for blob writes.
+
+Each crash test runs a real write in a child process and kills it with
+os._exit at one step of the write path, then checks that the target holds
+exactly the old or exactly the new bytes, never a mix, and that the leftover
+temp file is swept by remove_stale_temp_files.
+"""
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+
+import pytest
+
+import blobstore
+from blobstore import BlobWriter, remove_stale_temp_files
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+OLD = b'old contents\n' * 1000
+NEW = b'NEW CONTENTS\n' * 50000
+
+CHILD = textwrap.dedent('''
+    import os, sys
+    sys.path.insert(0, {backend!r})
+    import blobstore
+
+    def crash(*args, **kwargs):
+        os._exit(17)
+
+    point = {point!r}
+    if point == 'mid-write':
+        real_write = blobstore.PendingBlob.write
+        def half_write(self, chunk):
+            real_write(self, chunk[:len(chunk) // 2])
+            self.file.flush()
+            crash()
+        blobstore.PendingBlob.write = half_write
+    elif point == 'before-fsync':
+        os.fsync = os.fdatasync = crash
+    elif point == 'before-rename':
+        os.replace = crash
+    elif point == 'after-rename':
+        real_replace = os.replace
+        def replace_then_crash(src, dst):
+            real_replace(src, dst)
+            crash()
+        os.replace = replace_then_crash
+
+    writer = blobstore.BlobWriter(policy={policy!r}, batch_window_ms=5)
+    with open({source!r}, 'rb') as f:
+        data = f.read()
+    writer.write_bytes({target!r}, data)
+    os._exit(0)
+''')
+
+CRASH_POINTS = [
+    ('mid-write', 'old'),
+    ('before-fsync', 'old'),
+    ('before-rename', 'old'),
+    ('after-rename', 'new'),
+]
+
+
+@pytest.mark.parametrize('policy', ['always', 'batch'])
+@pytest.mark.parametrize('point,expected', CRASH_POINTS)
+def test_crash_leaves_old_or_new_blob(tmp_path, policy, point, expected):
+    target = tmp_path / 'user' / 'doc.ty'
+    target.parent.mkdir()
+    target.write_bytes(OLD)
+    source = tmp_path / 'new-version'
+    source.write_bytes(NEW)
+    expected = OLD if expected == 'old' else NEW
+
+    script = CHILD.format(backend=BACKEND_DIR, point=point, policy=policy, target=str(target), source=str(source))
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, timeout=60)
+
+    assert result.returncode == 17, result.stderr.decode()
+    assert target.read_bytes() == expected
+
+    # Recovery: the orphaned temp file (if any) is swept, the blob is untouched
+    remove_stale_temp_files(str(tmp_path), older_than_seconds=0)
+    assert os.listdir(target.parent) == ['doc.ty']
+    assert target.read_bytes() == expected
+
+
+def test_failed_write_does_not_commit_metadata(client, db, monkeypatch):
+    response = client.post("/api/files/upload", files={"file": ("notes.txt", "version one")})
+    file_id = response.json()["file"]["file_id"]
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(blobstore.os, 'replace', failing_replace)
+    response = client.put(f"/api/files/{file_id}/content", data={"content": "version two, much longer"})
+    monkeypatch.undo()
+
+    assert response.status_code == 500
+    content = client.get(f"/api/files/{file_id}/content").json()
+    assert content["content"] == "version one"
+    assert content["version"] == 1
+    assert client.get(f"/api/files/{file_id}").json()["file"]["file_size"] == len("version one")
+
+
+def test_group_commit_batches_directory_syncs(tmp_path, monkeypatch):
+    synced = []
+    real_fsync_directory = blobstore.fsync_directory
+    monkeypatch.setattr(blobstore, 'fsync_directory', lambda path: (synced.append(path), real_fsync_directory(path)))
+
+    writer = BlobWriter(policy='batch', batch_window_ms=50)
+    barrier = threading.Barrier(8)
+
+    def autosave(i):
+        barrier.wait()
+        writer.write_bytes(str(tmp_path / f'doc{i}.ty'), f'document {i}'.encode())
+
+    threads = [threading.Thread(target=autosave, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    writer.close()
+
+    for i in range(8):
+        assert (tmp_path / f'doc{i}.ty').read_bytes() == f'document {i}'.encode()
+    assert 1 <= len(synced) < 8
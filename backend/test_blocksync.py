@@ -0,0 +1,109 @@
+"""
+Tests for client-driven block-level sync: signatures, delta uploads and
+how the replaced content is kept as a version.
+"""
+import hashlib
+import random
+
+from blocksync import index_from_signature, signature_key
+from deltas import MAGIC, compute_delta
+from models import File, FileVersion, User
+from storage import get_storage
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def push_delta(client, file_id, new_content, headers=None):
+    signature = client.get(f"/api/files/{file_id}/signature")
+    assert signature.status_code == 200
+    index, block_size = index_from_signature(signature.json())
+    delta = compute_delta(index, block_size, new_content)
+    headers = {"If-Match": signature.headers["ETag"], **(headers or {})}
+    return delta, client.post(f"/api/files/{file_id}/delta", content=delta, headers=headers)
+
+
+def test_small_edit_to_large_file_costs_kilobytes(client, db, user, every_save_versions, upload):
+    original = random_bytes(4 * 1024 * 1024)
+    file = upload("disk.img", original)
+    db.expire_all()
+    original_key = db.query(File).get(file["file_id"]).file_path
+    used_before = db.query(User).get(user.user_id).storage_used
+
+    edited = original[:1_000_000] + b'patched sector' + original[1_000_100:3_000_000] + b'appended' + original[3_000_000:]
+    delta, response = push_delta(client, file["file_id"], edited,
+                                 headers={"X-Content-SHA256": hashlib.sha256(edited).hexdigest()})
+    assert response.status_code == 200, response.text
+    assert len(delta) < 16 * 1024
+    assert response.json()["version"] == 2 and response.headers["ETag"] == response.json()["etag"]
+
+    downloaded = client.get(f"/api/files/{file['file_id']}/download").content
+    assert downloaded == edited
+
+    # The old blob became the version as it was, without a copy
+    db.expire_all()
+    row = db.query(File).get(file["file_id"])
+    version = db.query(FileVersion).filter_by(file_id=row.file_id).one()
+    assert version.file_path == original_key and version.file_path != row.file_path
+    assert client.get(f"/api/files/{row.file_id}/versions/1/download").content == original
+    assert db.query(User).get(user.user_id).storage_used == used_before + len(edited) - len(original)
+
+    # The new content's signature was cached as part of the upload
+    cached = get_storage().read_content(signature_key(row))
+    assert cached.startswith(b'EUS1')
+    assert client.get(f"/api/files/{row.file_id}/signature").json()["version"] == 2
+
+
+def test_compressed_files_are_versioned_by_copy(client, db, every_save_versions, upload):
+    text = ''.join(random.Random(3).choice('abc def\n') for _ in range(200_000)).encode()
+    file = upload("notes.txt", text)
+    edited = text[:5000] + b'new paragraph\n' + text[5000:]
+    _, response = push_delta(client, file["file_id"], edited)
+    assert response.status_code == 200, response.text
+
+    assert client.get(f"/api/files/{file['file_id']}/download").content == edited
+    assert client.get(f"/api/files/{file['file_id']}/versions/1/download").content == text
+
+
+def test_stale_or_missing_if_match(client, upload):
+    content = random_bytes(64 * 1024, seed=1)
+    file_id = upload("data.bin", content)["file_id"]
+    signature = client.get(f"/api/files/{file_id}/signature")
+    index, block_size = index_from_signature(signature.json())
+    delta = compute_delta(index, block_size, content + b'more')
+
+    assert client.post(f"/api/files/{file_id}/delta", content=delta).status_code == 428
+    assert client.post(f"/api/files/{file_id}/delta", content=delta,
+                       headers={"If-Match": signature.headers["ETag"]}).status_code == 200
+    assert client.post(f"/api/files/{file_id}/delta", content=delta,
+                       headers={"If-Match": signature.headers["ETag"]}).status_code == 412
+
+
+def test_bad_deltas_are_rejected_and_leave_content_alone(client, db, upload):
+    content = random_bytes(64 * 1024, seed=2)
+    file = upload("data.bin", content)
+    original_key = db.query(File).get(file["file_id"]).file_path
+    etag = client.get(f"/api/files/{file['file_id']}/signature").headers["ETag"]
+
+    beyond_end = MAGIC + b'C' + (60 * 1024).to_bytes(8, 'big') + (8 * 1024).to_bytes(4, 'big')
+    truncated = MAGIC + b'D' + (100).to_bytes(4, 'big') + b'short'
+    for delta in (b'garbage', beyond_end, truncated):
+        response = client.post(f"/api/files/{file['file_id']}/delta", content=delta, headers={"If-Match": etag})
+        assert response.status_code == 422
+
+    response = client.post(f"/api/files/{file['file_id']}/delta", content=MAGIC + b'D' + (3).to_bytes(4, 'big') + b'new',
+                           headers={"If-Match": etag, "X-Content-SHA256": "0" * 64})
+    assert response.status_code == 422
+
+    db.expire_all()
+    row = db.query(File).get(file["file_id"])
+    assert row.content_version == 1 and row.file_path == original_key
+    assert client.get(f"/api/files/{row.file_id}/download").content == content
+
+
+def test_signature_block_size(client, upload):
+    file_id = upload("data.bin", random_bytes(100_000, seed=4))["file_id"]
+    signature = client.get(f"/api/files/{file_id}/signature?block_size=1024").json()
+    assert signature["block_size"] == 1024 and len(signature["blocks"]) == 100_000 // 1024
+    assert client.get(f"/api/files/{file_id}/signature?block_size=1000").json()["block_size"] != 1000
@@ -0,0 +1,190 @@
+"""
+Tests for the change feed and journal: events published on commit, replay
+after reconnects, the SSE encoding and delta sync from a cursor.
+"""
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from changefeed import RESYNC, LocalBroker, coalesce, compact_journal, format_sse, set_broker
+from models import Change, Folder
+from routes.events import event_stream
+
+
+@pytest.fixture
+def broker():
+    broker = LocalBroker(replay_size=5)
+    set_broker(broker)
+    yield broker
+    set_broker(None)
+
+
+async def drain(subscription, timeout=0.05):
+    events = []
+    while True:
+        item = await subscription.get(timeout)
+        if item is None:
+            return events
+        events.append(item)
+
+
+def test_committed_changes_are_pushed(client, db, user, broker):
+    async def scenario():
+        subscription = broker.subscribe(user.user_id)
+        file_id = client.post("/api/files/upload", files={"file": ("notes.txt", "v1")}).json()["file"]["file_id"]
+        client.put(f"/api/files/{file_id}/content", data={"content": "v2"})
+        folder_id = client.post("/api/folders/create", json={"folder_name": "Inbox"}).json()["folder"]["folder_id"]
+        client.delete(f"/api/files/{file_id}")
+
+        # Rolled back work is never published
+        db.add(Folder(folder_name="ghost", owner_id=user.user_id))
+        db.flush()
+        db.rollback()
+
+        events = await drain(subscription)
+        subscription.close()
+        return file_id, folder_id, events
+
+    file_id, folder_id, events = asyncio.run(scenario())
+    seen = [(e["type"], e["id"]) for e in events]
+    assert seen == [
+        ("file.created", file_id), ("file.updated", file_id),
+        ("folder.created", folder_id), ("file.trashed", file_id),
+    ]
+    assert events[0]["data"]["filename"] == "notes.txt"
+    assert events[1]["data"]["content_version"] == 2
+    assert len({e["seq"] for e in events}) == 4
+
+
+def test_reconnect_replays_missed_events_or_asks_for_resync(broker):
+    async def scenario():
+        broker.publish(1, [{"type": "file.created", "id": n} for n in range(3)])
+        last_seen = broker._recent[1][0]["seq"]
+        resumed = await drain(broker.subscribe(1, after=last_seen))
+        up_to_date = await drain(broker.subscribe(1, after=broker._recent[1][-1]["seq"]))
+
+        broker.publish(1, [{"type": "file.updated", "id": n} for n in range(10)])  # beyond the replay buffer
+        too_old = await drain(broker.subscribe(1, after=last_seen))
+        other_process = await drain(broker.subscribe(1, after="deadbeef-1"))
+        return resumed, up_to_date, too_old, other_process
+
+    resumed, up_to_date, too_old, other_process = asyncio.run(scenario())
+    assert [e["id"] for e in resumed] == [1, 2]
+    assert up_to_date == []
+    assert too_old == [RESYNC] and other_process == [RESYNC]
+
+
+def test_slow_subscriber_gets_resync_instead_of_a_backlog(broker, monkeypatch):
+    monkeypatch.setattr("config.Config.CHANGE_REPLAY_EVENTS", 3)
+
+    async def scenario():
+        subscription = broker.subscribe(7)
+        broker.publish(7, [{"type": "file.created", "id": n} for n in range(2)])
+        broker.publish(7, [{"type": "file.created", "id": n} for n in range(2, 4)])
+        await asyncio.sleep(0)
+        first = await drain(subscription)
+        broker.publish(7, [{"type": "file.deleted", "id": 9}])
+        return first, await drain(subscription)
+
+    first, after = asyncio.run(scenario())
+    assert first == [RESYNC]
+    assert [e["id"] for e in after] == [9]
+
+
+def test_sse_stream(broker, monkeypatch):
+    monkeypatch.setattr("config.Config.CHANGE_KEEPALIVE_SECONDS", 0.01)
+
+    class Request:
+        polls = 0
+
+        async def is_disconnected(self):
+            self.polls += 1
+            return self.polls > 2
+
+    async def scenario():
+        subscription = broker.subscribe(3)
+        broker.publish(3, [{"type": "folder.created", "id": 5}])
+        return [chunk async for chunk in event_stream(Request(), subscription)]
+
+    chunks = asyncio.run(scenario())
+    assert chunks[0].startswith("retry:")
+    message = dict(line.split(": ", 1) for line in chunks[1].strip().split("\n"))
+    assert message["event"] == "change" and json.loads(message["data"])["id"] == 5
+    assert message["id"] == broker._recent[3][0]["seq"]
+    assert chunks[2] == ": keepalive\n\n"
+    assert format_sse(RESYNC).startswith("event: resync")
+
+
+def test_changes_in_one_transaction_are_coalesced():
+    events = [
+        (1, {"type": "file.created", "id": 1, "data": {"filename": "a"}}),
+        (1, {"type": "file.updated", "id": 1, "data": {"file_size": 3}}),
+        (1, {"type": "file.updated", "id": 2, "data": {}}),
+        (1, {"type": "file.trashed", "id": 2, "data": {"is_deleted": True}}),
+        (1, {"type": "folder.created", "id": 1, "data": {}}),
+        (1, {"type": "folder.deleted", "id": 1, "data": {}}),
+        (2, {"type": "file.moved", "id": 3, "data": {}}),
+        (2, {"type": "file.updated", "id": 3, "data": {}}),
+    ]
+    assert coalesce(events) == {
+        1: [{"type": "file.created", "id": 1, "data": {"filename": "a", "file_size": 3}},
+            {"type": "file.trashed", "id": 2, "data": {"is_deleted": True}}],
+        2: [{"type": "file.moved", "id": 3, "data": {}}],
+    }
+
+
+def sync(client, cursor, limit=1000):
+    return client.get("/api/changes", params={"cursor": cursor, "limit": limit}).json()
+
+
+def test_change_journal_returns_latest_state_since_cursor(client):
+    start = client.get("/api/changes").json()["cursor"]
+    assert sync(client, start) == {"changes": [], "cursor": start, "has_more": False, "reset": False}
+
+    a = client.post("/api/files/upload", files={"file": ("a.txt", "a")}).json()["file"]["file_id"]
+    b = client.post("/api/files/upload", files={"file": ("b.txt", "b")}).json()["file"]["file_id"]
+    folder = client.post("/api/folders/create", json={"folder_name": "Docs"}).json()["folder"]["folder_id"]
+    client.put(f"/api/files/{a}/rename", data={"new_name": "a2.txt"})
+    client.post(f"/api/files/{a}/move", data={"target_folder_id": str(folder)})
+    client.delete(f"/api/files/{b}")
+    client.delete(f"/api/trash/permanent/{b}")
+
+    delta = sync(client, start)
+    latest = {(c["type"].split(".")[0], c["id"]): c for c in delta["changes"]}
+    assert len(latest) == len(delta["changes"]) == 3  # one entry per object
+    assert latest[("file", a)]["type"] == "file.moved"
+    assert latest[("file", a)]["data"]["folder_id"] == folder
+    assert latest[("file", b)]["type"] == "file.deleted"  # tombstone
+    assert latest[("folder", folder)]["type"] == "folder.created"
+    assert [c["seq"] for c in delta["changes"]] == sorted(c["seq"] for c in delta["changes"])
+
+    # Nothing new: one tiny answer; paging walks the same entries
+    assert sync(client, delta["cursor"])["changes"] == []
+    cursor, paged = start, []
+    while True:
+        page = sync(client, cursor, limit=2)
+        paged += page["changes"]
+        cursor = page["cursor"]
+        if not page["has_more"]:
+            break
+    assert paged == delta["changes"] and cursor == delta["cursor"]
+
+
+def test_expired_tombstones_reset_old_cursors(client, db, user):
+    start = client.get("/api/changes").json()["cursor"]
+    file_id = client.post("/api/files/upload", files={"file": ("gone.txt", "x")}).json()["file"]["file_id"]
+    client.delete(f"/api/files/{file_id}")
+    client.delete(f"/api/trash/permanent/{file_id}")
+    kept = client.post("/api/folders/create", json={"folder_name": "kept"}).json()["folder"]["folder_id"]
+    current = sync(client, start)["cursor"]
+
+    db.query(Change).filter_by(user_id=user.user_id, action="deleted").update({Change.created_at: datetime.utcnow() - timedelta(days=2)})
+    db.commit()
+    assert compact_journal(tombstone_days=1) >= 1
+
+    assert sync(client, start)["reset"] is True
+    assert sync(client, 10 ** 9)["reset"] is True
+    assert sync(client, current) == {"changes": [], "cursor": current, "has_more": False, "reset": False}
+    assert [c["id"] for c in sync(client, current - 1)["changes"]] == [kept]
@@ -0,0 +1,116 @@
+"""
+Tests for threaded comments: single-query thread assembly, cursor paging
+of top-level threads and "load more" cursors for long reply chains.
+"""
+import base64
+import json
+
+from sqlalchemy import event
+
+from models import File, engine
+
+
+def make_file(db, user):
+    file = File(filename='notes.ty', file_path=f'{user.user_id}/notes.ty', file_size=0, owner_id=user.user_id)
+    db.add(file)
+    db.commit()
+    return file.file_id
+
+
+def post_comment(client, file_id, text, parent_id=None):
+    response = client.post(f"/api/extras/comments/{file_id}", json={"comment_text": text, "parent_comment_id": parent_id})
+    assert response.status_code == 201, response.text
+    return response.json()["comment"]["comment_id"]
+
+
+def test_threads_are_assembled_and_truncated(client, db, user):
+    file_id = make_file(db, user)
+    root = post_comment(client, file_id, "root")
+    first = post_comment(client, file_id, "reply 1", root)
+    post_comment(client, file_id, "nested under reply 1", first)
+    post_comment(client, file_id, "reply 2", root)
+    post_comment(client, file_id, "reply 3", root)
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        response = client.get(f"/api/extras/comments/{file_id}/threads", params={"reply_limit": 2})
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+
+    thread = response.json()["threads"][0]
+    assert thread["comment_id"] == root
+    assert thread["reply_count"] == 4
+    # Depth-first order: the nested reply follows the reply it answers
+    assert [r["comment_text"] for r in thread["replies"]] == ["reply 1", "nested under reply 1"]
+    assert thread["replies"][1]["depth"] == 2
+    assert thread["user_email"] == user.email
+    comment_queries = [s for s in statements if "comments" in s]
+    assert len(comment_queries) == 1
+
+    more = client.get(
+        f"/api/extras/comments/{file_id}/threads/{root}/replies",
+        params={"cursor": thread["replies_cursor"]}
+    ).json()
+    assert [r["comment_text"] for r in more["replies"]] == ["reply 2", "reply 3"]
+    assert more["next_cursor"] is None
+
+
+def test_top_level_threads_page_by_cursor(client, db, user):
+    file_id = make_file(db, user)
+    roots = [post_comment(client, file_id, f"thread {i}") for i in range(5)]
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get(f"/api/extras/comments/{file_id}/threads", params=params).json()
+        seen += [t["comment_id"] for t in page["threads"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    assert seen == list(reversed(roots))
+
+
+def test_deleting_a_comment_removes_its_replies(client, db, user):
+    file_id = make_file(db, user)
+    root = post_comment(client, file_id, "root")
+    reply = post_comment(client, file_id, "reply", root)
+    post_comment(client, file_id, "reply to reply", reply)
+
+    assert client.delete(f"/api/extras/comments/{reply}").status_code == 200
+
+    thread = client.get(f"/api/extras/comments/{file_id}/threads").json()["threads"][0]
+    assert thread["reply_count"] == 0
+
+
+def test_threads_without_returned_replies_still_carry_a_cursor(client, db, user):
+    file_id = make_file(db, user)
+    root = post_comment(client, file_id, "root")
+    post_comment(client, file_id, "only reply", root)
+
+    thread = client.get(f"/api/extras/comments/{file_id}/threads", params={"reply_limit": 0}).json()["threads"][0]
+    assert thread["replies"] == [] and thread["reply_count"] == 1
+    more = client.get(f"/api/extras/comments/{file_id}/threads/{root}/replies",
+                      params={"cursor": thread["replies_cursor"]}).json()
+    assert [r["comment_text"] for r in more["replies"]] == ["only reply"]
+
+
+def test_malformed_cursors_are_rejected(client, db, user):
+    file_id = make_file(db, user)
+    root = post_comment(client, file_id, "root")
+
+    def cursor(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+    for bad in ("not base64!", cursor({"a": 1}), cursor(["2024-01-01T00:00:00"]), cursor(["yesterday", 5]),
+                cursor(["2024-01-01T00:00:00", "5"]), cursor([None, 5])):
+        response = client.get(f"/api/extras/comments/{file_id}/threads", params={"cursor": bad})
+        assert response.status_code == 400, bad
+    for bad in (cursor({"a": 1}), cursor([]), cursor([7]), cursor(["a", "b"])):
+        response = client.get(f"/api/extras/comments/{file_id}/threads/{root}/replies", params={"cursor": bad})
+        assert response.status_code == 400, bad
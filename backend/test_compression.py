@@ -0,0 +1,88 @@
+"""
+Tests for transparent at-rest compression: policy, streaming decompression
+on download, pass-through of compressed bytes and logical vs physical size.
+"""
+import os
+
+import pytest
+
+zstandard = pytest.importorskip('zstandard')
+
+import compression
+from config import Config
+from models import File
+
+LOG = b''.join(b'2024-05-01T12:00:%02d INFO [worker-1] sync: uploaded chunk %d ok\n' % (i % 60, i) for i in range(2000))
+
+
+def stored_path(db, file_id):
+    return os.path.join(Config.UPLOAD_FOLDER, db.query(File).get(file_id).file_path)
+
+
+def test_policy_picks_compressible_types():
+    assert compression.choose_encoding('text/csv') == compression.ZSTD
+    assert compression.choose_encoding('application/json') == compression.ZSTD
+    assert compression.choose_encoding(None, 'eutype', 'doc.ty') == compression.ZSTD
+    assert compression.choose_encoding(None, 'generic', 'server.log') == compression.ZSTD
+    assert compression.choose_encoding('image/jpeg') == compression.IDENTITY
+    assert compression.choose_encoding('application/zip') == compression.IDENTITY
+
+
+def test_compressible_upload_is_stored_compressed_and_downloads_logically(client, db, upload):
+    info = upload("server.log", LOG)
+    assert info["file_size"] == len(LOG)
+    assert info["physical_size"] < len(LOG) // 4
+
+    with open(stored_path(db, info["file_id"]), 'rb') as f:
+        assert f.read(4) == b'\x28\xb5\x2f\xfd'  # zstd frame magic
+
+    response = client.get(f"/api/files/{info['file_id']}/download", headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert response.headers["content-length"] == str(len(LOG))
+    assert response.content == LOG
+
+
+def test_compressed_bytes_are_served_as_is_when_accepted(client, upload):
+    info = upload("server.log", LOG)
+
+    with client.stream("GET", f"/api/files/{info['file_id']}/download", headers={"Accept-Encoding": "gzip, zstd"}) as response:
+        assert response.headers["content-encoding"] == "zstd"
+        raw = b''.join(response.iter_raw())
+    assert len(raw) == info["physical_size"]
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(raw) == LOG
+
+
+def test_small_and_binary_files_stay_raw(client, upload):
+    small = upload("note.txt", b"tiny note")
+    image = upload("photo.jpg", os.urandom(64 * 1024))
+    assert small["physical_size"] == small["file_size"]
+    assert image["physical_size"] == image["file_size"]
+
+
+def test_content_round_trip_and_storage_stats(client, user, db, upload):
+    document = '{"blocks": [' + ','.join(f'"paragraph {i} of the quarterly report"' for i in range(500)) + ']}'
+    info = upload("report.ty", document.encode(), app_type="eutype")
+    assert info["physical_size"] < info["file_size"]
+
+    updated = document.replace("quarterly", "annual")
+    assert client.put(f"/api/files/{info['file_id']}/content", data={"content": updated}).status_code == 200
+    assert client.get(f"/api/files/{info['file_id']}/content").json()["content"] == updated
+
+    db.refresh(user)
+    assert user.storage_used == sum(f.file_size for f in db.query(File).filter_by(owner_id=user.user_id))
+    stats = client.get("/api/storage/stats").json()
+    assert stats["physical_size"] < stats["logical_size"]
+
+
+def test_writer_compresses_only_past_threshold(tmp_path):
+    from blobstore import BlobWriter
+    writer = BlobWriter(policy='none')
+    small = writer.write_bytes(str(tmp_path / 'small'), b'x' * 100, compression.ZSTD)
+    large = writer.write_chunks(str(tmp_path / 'large'), [b'y' * 3000] * 10, compression.ZSTD)
+
+    assert small.encoding == compression.IDENTITY and small.stored_size == 100
+    assert large.encoding == compression.ZSTD and large.size == 30000
+    assert large.stored_size == os.path.getsize(tmp_path / 'large') < 1000
+    with compression.decoded(open(tmp_path / 'large', 'rb'), large.encoding) as stream:
+        assert stream.read() == b'y' * 30000
@@ -0,0 +1,107 @@
+"""
+Tests for delta-based content saves: JSON Patch / text edits, ETag
+concurrency control and the patch primitives themselves.
+"""
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from patching import PatchError, apply_json_patch, apply_text_edits
+from storage import get_storage
+
+
+@pytest.fixture
+def upload_document(upload):
+    return lambda document: upload("doc.ty", json.dumps(document), app_type="eutype")["file_id"]
+
+
+def test_json_patch_round_trip(client, upload_document):
+    file_id = upload_document({"title": "Draft", "blocks": ["a", "b"]})
+    etag = client.get(f"/api/files/{file_id}/content").headers["ETag"]
+
+    response = client.patch(
+        f"/api/files/{file_id}/content",
+        json={"patch": [{"op": "replace", "path": "/title", "value": "Final"},
+                        {"op": "add", "path": "/blocks/-", "value": "c"}]},
+        headers={"If-Match": etag}
+    )
+    assert response.status_code == 200, response.text
+    assert response.json()["version"] == 2
+    assert response.headers["ETag"] != etag
+
+    content = client.get(f"/api/files/{file_id}/content").json()
+    assert json.loads(content["content"]) == {"title": "Final", "blocks": ["a", "b", "c"]}
+    assert content["version"] == 2
+
+
+def test_stale_base_version_is_rejected(client, upload_document):
+    file_id = upload_document({"n": 1})
+    first = client.patch(f"/api/files/{file_id}/content",
+                         json={"patch": [{"op": "replace", "path": "/n", "value": 2}], "base_version": 1})
+    assert first.status_code == 200
+
+    stale = client.patch(f"/api/files/{file_id}/content",
+                         json={"patch": [{"op": "replace", "path": "/n", "value": 3}], "base_version": 1})
+    assert stale.status_code == 412
+
+    missing = client.patch(f"/api/files/{file_id}/content", json={"patch": []})
+    assert missing.status_code == 428
+
+
+def test_text_edits_and_quota_accounting(client, db, user):
+    response = client.post("/api/files/upload", files={"file": ("notes.txt", "hello world")})
+    file_id = response.json()["file"]["file_id"]
+
+    response = client.patch(
+        f"/api/files/{file_id}/content",
+        json={"format": "text", "base_version": 1,
+              "patch": [{"offset": 0, "delete": 5, "insert": "goodbye"}, {"offset": 11, "insert": "!"}]}
+    )
+    assert response.status_code == 200, response.text
+    assert client.get(f"/api/files/{file_id}/content").json()["content"] == "goodbye world!"
+    assert response.json()["file"]["file_size"] == len("goodbye world!")
+
+    db.refresh(user)
+    assert user.storage_used == len("goodbye world!")
+
+
+def test_save_does_not_hold_the_database_across_the_event_loop(client, monkeypatch, upload_document):
+    """A save waiting on its blob write must not block writers on the event loop (SQLite would time out)"""
+    file_id = upload_document({"n": 1})
+    storage = get_storage()
+    write_bytes = storage.write_bytes
+
+    def slow_write_bytes(*args, **kwargs):
+        time.sleep(0.3)
+        return write_bytes(*args, **kwargs)
+
+    monkeypatch.setattr(storage, 'write_bytes', slow_write_bytes)
+
+    async def concurrently():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=client.app), base_url="http://test") as http:
+            save = asyncio.ensure_future(http.patch(
+                f"/api/files/{file_id}/content",
+                json={"patch": [{"op": "replace", "path": "/n", "value": 2}], "base_version": 1}))
+            await asyncio.sleep(0.1)
+            upload = await http.post("/api/files/upload", files={"file": ("other.txt", b"data")})
+            return await save, upload
+
+    started = time.perf_counter()
+    save, upload = asyncio.run(concurrently())
+    assert save.status_code == 200 and upload.status_code == 201
+    assert time.perf_counter() - started < 3
+
+
+def test_patch_primitives():
+    doc = {"a": {"b": [1, 2]}}
+    assert apply_json_patch(doc, [{"op": "move", "from": "/a/b/0", "path": "/first"}]) == {"a": {"b": [2]}, "first": 1}
+    assert doc == {"a": {"b": [1, 2]}}
+    with pytest.raises(PatchError):
+        apply_json_patch(doc, [{"op": "test", "path": "/a/b/0", "value": 9}])
+    with pytest.raises(PatchError):
+        apply_json_patch(doc, [{"op": "remove", "path": "/missing"}])
+    with pytest.raises(PatchError):
+        apply_text_edits("abc", [{"offset": 0, "delete": 2}, {"offset": 1, "delete": 1}])
@@ -0,0 +1,108 @@
+"""
+Tests for server-side copies: the copy mechanisms and the strategy chain
+(reflink, hardlink, copy-on-write references, physical copy).
+"""
+import os
+
+import pytest
+
+from config import Config
+from filecopy import CopyConflict, copy_blob
+from models import File
+from storage import LocalDriver, get_storage
+from storage import copying
+
+
+@pytest.fixture
+def strategies(monkeypatch):
+    def use(value):
+        monkeypatch.setattr(Config, 'COPY_STRATEGIES', value)
+    return use
+
+
+def test_physical_copy_mechanisms(tmp_path):
+    source = tmp_path / 'source.bin'
+    source.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+    for name, method in copying.PHYSICAL_METHODS.items():
+        if name != 'read_write' and not hasattr(os, name):
+            continue
+        target = tmp_path / f'{name}.bin'
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            method(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size)
+        assert target.read_bytes() == source.read_bytes(), name
+
+    with open(source, 'rb') as src, open(tmp_path / 'auto.bin', 'wb') as dst:
+        assert copying.physical_copy(src.fileno(), dst.fileno()) in copying.PHYSICAL_METHODS
+    assert (tmp_path / 'auto.bin').read_bytes() == source.read_bytes()
+
+
+def test_local_driver_clone_and_copy(tmp_path):
+    driver = LocalDriver(str(tmp_path))
+    driver.write_bytes('1/a.bin', b'x' * 100000)
+    assert driver.copy('1/a.bin', '1/copy.bin') == 100000
+    assert driver.read_content('1/copy.bin') == b'x' * 100000
+    assert os.stat(driver.path('1/copy.bin')).st_ino != os.stat(driver.path('1/a.bin')).st_ino
+
+    # Reflinks depend on the filesystem; either it works or nothing is left behind
+    if driver.clone('1/a.bin', '1/clone.bin'):
+        assert driver.read_content('1/clone.bin') == b'x' * 100000
+    else:
+        assert not driver.exists('1/clone.bin')
+        assert not [n for n in os.listdir(tmp_path / '1') if n.startswith('.tmp')]
+
+
+def test_hardlink_copies_stay_independent(client, db, strategies, upload):
+    strategies('hardlink,copy')
+    original = upload('doc.txt', 'first')
+    copy = client.post(f"/api/files/{original['file_id']}/copy").json()
+    assert copy["strategy"] == "hardlink"
+
+    storage = get_storage()
+    keys = [db.query(File).get(i).file_path for i in (original['file_id'], copy['file']['file_id'])]
+    assert keys[0] != keys[1]
+    assert os.stat(storage.local_path(keys[0])).st_ino == os.stat(storage.local_path(keys[1])).st_ino
+
+    client.put(f"/api/files/{original['file_id']}/content", data={"content": "second"})
+    assert client.get(f"/api/files/{copy['file']['file_id']}/content").json()["content"] == "first"
+    assert client.get(f"/api/files/{original['file_id']}/content").json()["content"] == "second"
+
+
+def test_reference_copies_are_copy_on_write(client, db, strategies, upload):
+    strategies('reference')
+    original = upload('shared.txt', 'v1')
+    copy = client.post(f"/api/files/{original['file_id']}/copy").json()
+    assert copy["strategy"] == "reference"
+    copy_id = copy["file"]["file_id"]
+    shared_key = db.query(File).get(original['file_id']).file_path
+    assert db.query(File).get(copy_id).file_path == shared_key
+
+    # Writing the copy moves it to its own blob; the original keeps the shared one
+    client.put(f"/api/files/{copy_id}/content", data={"content": "v2"})
+    db.expire_all()
+    assert db.query(File).get(copy_id).file_path != shared_key
+    assert db.query(File).get(original['file_id']).file_path == shared_key
+    assert client.get(f"/api/files/{original['file_id']}/content").json()["content"] == "v1"
+    assert client.get(f"/api/files/{copy_id}/content").json()["content"] == "v2"
+
+    # The shared blob outlives the first delete and goes with the last reference
+    second = client.post(f"/api/files/{original['file_id']}/copy").json()["file"]["file_id"]
+    for file_id in (original['file_id'], second):
+        client.delete(f"/api/files/{file_id}")
+    client.delete(f"/api/trash/permanent/{original['file_id']}")
+    assert get_storage().exists(shared_key)
+    assert client.get(f"/api/files/{second}/content").json()["content"] == "v1"
+    client.delete(f"/api/trash/permanent/{second}")
+    assert not get_storage().exists(shared_key)
+
+
+def test_reference_copy_conflicts_with_concurrent_write(db, user, strategies):
+    strategies('reference')
+    get_storage().write_bytes(f'{user.user_id}/race.txt', b'data')
+    file = File(filename='race.txt', file_path=f'{user.user_id}/race.txt', file_size=4, owner_id=user.user_id)
+    db.add(file)
+    db.commit()
+
+    file.content_version = 5  # what this session read; the row says 1
+    with pytest.raises(CopyConflict):
+        copy_blob(db, file, user.user_id)
+    db.rollback()
@@ -0,0 +1,136 @@
+"""
+Tests for recursive folder copy, move and delete background jobs: batching,
+resuming from the committed cursor, quota and cancellation.
+"""
+from jobs import run_batch, run_to_completion
+from models import File, Folder, Job, JobFolder, User
+
+
+def make_folder(client, name, parent_id=None):
+    return client.post("/api/folders/create", json={"folder_name": name, "parent_folder_id": parent_id}).json()["folder"]["folder_id"]
+
+
+def make_tree(client, upload):
+    """root/{a.txt, b.txt, sub/{c.txt, deep/{d.txt}}, empty/}"""
+    root = make_folder(client, "Project")
+    sub = make_folder(client, "sub", root)
+    deep = make_folder(client, "deep", sub)
+    make_folder(client, "empty", root)
+    for name, folder in (("a.txt", root), ("b.txt", root), ("c.txt", sub), ("d.txt", deep)):
+        upload(name, f"content of {name}", folder_id=folder)
+    return root, sub, deep
+
+
+def tree_paths(db, folder_id, prefix=''):
+    """{path: file or None for folders} below folder_id"""
+    paths = {}
+    for file in db.query(File).filter_by(folder_id=folder_id, is_deleted=False):
+        paths[prefix + file.filename] = file
+    for child in db.query(Folder).filter_by(parent_folder_id=folder_id):
+        paths[prefix + child.folder_name + '/'] = None
+        paths.update(tree_paths(db, child.folder_id, prefix + child.folder_name + '/'))
+    return paths
+
+
+def test_copy_job_runs_in_batches_and_resumes(client, db, user, upload):
+    root, _, _ = make_tree(client, upload)
+    target = make_folder(client, "Archive")
+    db.expire_all()
+    used_before = db.query(User).get(user.user_id).storage_used
+
+    response = client.post(f"/api/folders/{root}/copy", json={"target_parent_id": target})
+    assert response.status_code == 202
+    job_id = response.json()["job"]["job_id"]
+    assert response.json()["job"]["status"] == "pending"
+
+    # Planning four folders one per batch, then "restart": the rest runs from the committed cursor
+    assert run_to_completion(job_id, batch_size=1, max_batches=5) == 5
+    job = client.get(f"/api/jobs/{job_id}").json()["job"]
+    assert job["status"] == "running" and job["total_items"] == 8 and job["phase"] == "folders"
+    assert run_to_completion(job_id, batch_size=1) > 4
+
+    job = client.get(f"/api/jobs/{job_id}").json()["job"]
+    assert job["status"] == "completed" and job["progress"] == 100.0
+    assert job["processed_items"] == 8
+
+    db.expire_all()
+    copy_root = db.query(Folder).get(job["result_folder_id"])
+    assert copy_root.folder_name == "Copy of Project" and copy_root.parent_folder_id == target
+    assert set(tree_paths(db, copy_root.folder_id)) == set(tree_paths(db, root))
+    copied = tree_paths(db, copy_root.folder_id)["sub/deep/d.txt"]
+    assert client.get(f"/api/files/{copied.file_id}/content").json()["content"] == "content of d.txt"
+
+    total = sum(len(f"content of {n}.txt") for n in "abcd")
+    assert db.query(User).get(user.user_id).storage_used == used_before + total
+    assert db.query(JobFolder).filter_by(job_id=job_id).count() == 0
+
+
+def test_copy_into_itself_and_quota(client, db, user, upload):
+    root, sub, _ = make_tree(client, upload)
+    assert client.post(f"/api/folders/{root}/copy", json={"target_parent_id": sub}).status_code == 400
+
+    db_user = db.query(User).get(user.user_id)
+    db_user.storage_quota = db_user.storage_used + 10
+    db.commit()
+    job_id = client.post(f"/api/folders/{root}/copy", json={}).json()["job"]["job_id"]
+    run_to_completion(job_id)
+    job = client.get(f"/api/jobs/{job_id}").json()["job"]
+    assert job["status"] == "failed" and job["error"] == "Storage quota exceeded"
+    assert job["result_folder_id"] is None
+
+
+def test_cancelled_copy_is_charged_for_what_was_copied(client, db, user, upload):
+    root, _, _ = make_tree(client, upload)
+    db.expire_all()
+    used_before = db.query(User).get(user.user_id).storage_used
+    job_id = client.post(f"/api/folders/{root}/copy", json={"folder_name": "Half"}).json()["job"]["job_id"]
+
+    # Plan (4 folders + end), create the 4 folders, then copy one file
+    while db.query(Job).get(job_id).load_state().get('phase') != 'files':
+        run_batch(job_id, batch_size=1)
+        db.expire_all()
+    run_batch(job_id, batch_size=1)
+    assert client.post(f"/api/jobs/{job_id}/cancel").status_code == 200
+    assert not run_batch(job_id)
+
+    db.expire_all()
+    job = db.query(Job).get(job_id)
+    assert job.status == "cancelled"
+    copied = [f for f in tree_paths(db, job.result_folder_id).values() if f is not None]
+    assert len(copied) == 1
+    assert db.query(User).get(user.user_id).storage_used == used_before + copied[0].file_size
+    assert client.post(f"/api/jobs/{job_id}/cancel").status_code == 400
+
+
+def test_recursive_delete_moves_files_to_trash(client, db, upload):
+    root, sub, deep = make_tree(client, upload)
+    assert client.delete(f"/api/folders/{sub}").status_code == 400  # not empty
+
+    response = client.delete(f"/api/folders/{root}?recursive=true")
+    assert response.status_code == 202
+    job_id = response.json()["job"]["job_id"]
+    run_to_completion(job_id, batch_size=2)
+
+    job = client.get(f"/api/jobs/{job_id}").json()["job"]
+    assert job["status"] == "completed"
+    db.expire_all()
+    assert db.query(Folder).filter(Folder.folder_id.in_([root, sub, deep])).count() == 0
+    trash = {f["filename"] for f in client.get("/api/trash/list").json()["files"]}
+    assert {"a.txt", "b.txt", "c.txt", "d.txt"} <= trash
+    restored = client.get("/api/trash/list").json()["files"][0]
+    assert restored["folder_id"] is None
+
+
+def test_move_job(client, db, upload):
+    root, sub, deep = make_tree(client, upload)
+    target = make_folder(client, "Elsewhere")
+    assert client.post(f"/api/folders/{root}/move", json={"target_parent_id": deep}).status_code == 400
+
+    job_id = client.post(f"/api/folders/{sub}/move", json={"target_parent_id": target}).json()["job"]["job_id"]
+    assert run_to_completion(job_id) == 1
+    db.expire_all()
+    assert db.query(Folder).get(sub).parent_folder_id == target
+    assert db.query(Folder).get(deep).parent_folder_id == sub
+
+    listed = client.get("/api/jobs/list").json()["jobs"]
+    assert listed[0]["job_id"] == job_id and listed[0]["kind"] == "folder_move"
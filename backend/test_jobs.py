@@ -0,0 +1,152 @@
+"""
+Tests for the job queue: retries with backoff, leases, priorities, queue
+limits, and the thumbnail and empty-trash jobs.
+"""
+import io
+from datetime import datetime, timedelta
+
+import pytest
+from PIL import Image
+
+import jobs
+from config import Config
+from jobs import JobHandler, JobRetry, claim, enqueue, register, run_batch, run_to_completion
+from models import File, Job
+
+
+@register
+class Flaky(JobHandler):
+    """Fails the first `failures` batches, then completes"""
+    kind = 'test_flaky'
+    queue = 'test'
+
+    def step(self, db, job, state, batch_size):
+        state['calls'] = state.get('calls', 0) + 1
+        job.save_state(state)
+        if job.attempts < job.load_params().get('failures', 0):
+            raise RuntimeError("boom")
+        return True
+
+
+@register
+class Conflicted(JobHandler):
+    """Runs into the same transient conflict every batch"""
+    kind = 'test_conflicted'
+    queue = 'test'
+
+    def step(self, db, job, state, batch_size):
+        raise JobRetry("target changed")
+
+
+def new_job(db, user, priority=None, **params):
+    job = enqueue(db, user.user_id, 'test_flaky', params=params or None, priority=priority)
+    db.commit()
+    return job.job_id
+
+
+@pytest.fixture(autouse=True)
+def empty_test_queue(db):
+    """Leftover test jobs would count against the queue's limit"""
+    yield
+    db.query(Job).filter(Job.queue == 'test', Job.status.notin_(Job.FINISHED)).update(
+        {Job.status: 'cancelled', Job.lease_owner: None, Job.lease_expires_at: None}, synchronize_session=False
+    )
+    db.commit()
+
+
+def test_failed_batches_back_off_then_give_up(db, user):
+    job_id = new_job(db, user, failures=2)
+    assert run_batch(job_id)
+    db.expire_all()
+    job = db.query(Job).get(job_id)
+    assert job.status == 'pending' and job.attempts == 1 and job.error == "boom"
+    wait = (job.run_after - datetime.utcnow()).total_seconds()
+    assert Config.JOB_RETRY_BASE_SECONDS * 0.4 < wait <= Config.JOB_RETRY_BASE_SECONDS
+    assert jobs.retry_delay(30) <= Config.JOB_RETRY_MAX_SECONDS
+
+    # Not claimable while backing off
+    assert claim('w1', 'test', 5) is None
+    run_to_completion(job_id)
+    db.expire_all()
+    assert db.query(Job).get(job_id).status == 'completed'
+
+    hopeless = new_job(db, user, failures=99)
+    assert run_to_completion(hopeless) == Config.JOB_MAX_ATTEMPTS
+    db.expire_all()
+    job = db.query(Job).get(hopeless)
+    assert job.status == 'failed' and job.attempts == Config.JOB_MAX_ATTEMPTS and job.error == "boom"
+
+
+def test_transient_conflicts_count_as_attempts(db, user):
+    job_id = enqueue(db, user.user_id, 'test_conflicted').job_id
+    db.commit()
+    assert run_batch(job_id)
+    db.expire_all()
+    job = db.query(Job).get(job_id)
+    assert job.attempts == 1 and job.lease_owner is None
+    assert (job.run_after - datetime.utcnow()).total_seconds() > Config.JOB_RETRY_BASE_SECONDS * 0.4
+
+    assert run_to_completion(job_id) == Config.JOB_MAX_ATTEMPTS - 1
+    db.expire_all()
+    job = db.query(Job).get(job_id)
+    assert job.status == 'failed' and job.error == "target changed"
+
+
+def test_leases_priorities_and_queue_limits(db, user):
+    low = new_job(db, user)
+    high = new_job(db, user, priority=5)
+    assert claim('w1', 'test', 1) == high
+    assert claim('w2', 'test', 1) is None  # the queue is at its limit
+    assert claim('w2', 'test', 2) == low
+
+    # Only the lease holder runs the batch, and the lease is released with it
+    assert not run_batch(high, worker_id='w2')
+    db.expire_all()
+    assert db.query(Job).get(high).status == 'pending'
+    run_batch(high, worker_id='w1')
+    db.expire_all()
+    job = db.query(Job).get(high)
+    assert job.status == 'completed' and job.lease_owner is None
+
+    # A worker that died leaves a lease that expires; another worker takes over
+    db.query(Job).filter_by(job_id=low).update({Job.lease_expires_at: datetime.utcnow() - timedelta(seconds=1)})
+    db.commit()
+    assert claim('w3', 'test', 1) == low
+    assert not run_batch(low, worker_id='w2')
+    run_batch(low, worker_id='w3')
+    db.expire_all()
+    assert db.query(Job).get(low).status == 'completed'
+
+
+def test_thumbnail_job(client, db):
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480), 'red').save(buffer, format='PNG')
+    uploaded = client.post("/api/files/upload", files={"file": ("red.png", buffer.getvalue())}).json()["file"]
+    assert uploaded["thumbnail_path"] is None
+
+    job = db.query(Job).filter_by(kind='thumbnail').order_by(Job.job_id.desc()).first()
+    assert job.queue == 'media' and job.load_params()['file_id'] == uploaded["file_id"]
+    run_to_completion(job.job_id)
+    db.expire_all()
+    assert db.query(Job).get(job.job_id).status == 'completed'
+    assert db.query(File).get(uploaded["file_id"]).thumbnail_path is not None
+    preview = client.get(f"/api/files/{uploaded['file_id']}/preview")
+    assert Image.open(io.BytesIO(preview.content)).size == (200, 150)
+
+
+def test_large_trash_is_emptied_by_a_job(client, db, monkeypatch):
+    monkeypatch.setattr(Config, 'JOB_BATCH_SIZE', 2)
+    for i in range(5):
+        file_id = client.post("/api/files/upload", files={"file": (f"old{i}.txt", f"old {i}")}).json()["file"]["file_id"]
+        client.delete(f"/api/files/{file_id}")
+
+    response = client.post("/api/trash/empty")
+    assert response.status_code == 202 and response.json()["count"] == 5
+    job_id = response.json()["job"]["job_id"]
+    assert run_to_completion(job_id) == 3
+    assert client.get(f"/api/jobs/{job_id}").json()["job"]["processed_items"] == 5
+    assert client.get("/api/trash/list").json()["files"] == []
+
+    metrics = client.get("/api/jobs/metrics").json()
+    assert metrics["queues"]["default"]["completed"] >= 1
+    assert metrics["queues"]["media"]["limit"] == 2
@@ -0,0 +1,86 @@
+"""
+Tests for the Prometheus metrics: per-route request metrics, database
+queries per request, scrape-time gauges, the auth token cache and the
+/metrics endpoint itself.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from jose import JWTError, jwt
+
+import auth
+import metrics
+from config import Config
+
+
+def test_requests_are_labelled_by_route_template(client):
+    file_id = client.post("/api/files/upload", files={"file": ("a.txt", b"x" * 1000)}).json()["file"]["file_id"]
+    labels = ('GET', '/api/files/{file_id}')
+    before = metrics.REQUEST_LATENCY.count(*labels, '200')
+    sent_before = metrics.SENT_BYTES.value(*labels)
+
+    for _ in range(3):
+        assert client.get(f"/api/files/{file_id}").status_code == 200
+    assert client.get("/api/files/999999").status_code == 404
+
+    assert metrics.REQUEST_LATENCY.count(*labels, '200') == before + 3
+    assert metrics.REQUEST_LATENCY.count(*labels, '404') >= 1
+    assert metrics.SENT_BYTES.value(*labels) > sent_before
+    assert metrics.RECEIVED_BYTES.value('POST', '/api/files/upload') >= 1000
+    assert metrics.REQUESTS_IN_PROGRESS.value('GET') == 0
+
+
+def test_database_queries_are_counted_per_request(client):
+    labels = ('GET', '/api/files/list')
+    count_before = metrics.REQUEST_QUERIES.count(*labels)
+    queries_before = metrics.REQUEST_QUERIES.sum(*labels)
+
+    assert client.get("/api/files/list").status_code == 200
+    assert metrics.REQUEST_QUERIES.count(*labels) == count_before + 1
+    assert metrics.REQUEST_QUERIES.sum(*labels) - queries_before >= 2  # user, then files
+    assert metrics.current_query_stats() is None
+
+
+def test_scrape_output_and_queue_gauges(client):
+    client.post("/api/files/upload", files={"file": ("photo.png", b"not really a png")})
+    body = client.get("/metrics")
+    assert body.status_code == 200
+    assert body.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    text = body.text
+    assert '# TYPE eucloud_http_request_duration_seconds histogram' in text
+    assert 'eucloud_http_request_duration_seconds_bucket{method="POST",route="/api/files/upload",status="201",le="+Inf"}' in text
+    assert 'eucloud_job_queue_jobs{queue="media",state="pending"}' in text
+    assert metrics.THUMBNAIL_QUEUE.value() >= 1
+
+
+def test_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(Config, 'METRICS_TOKEN', 's3cret')
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+
+def test_histogram_rendering():
+    histogram = metrics.Histogram('test_seconds', 'Test', ('path',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(value, 'a"b')
+    lines = histogram.render()
+    assert 'test_seconds_bucket{path="a\\"b",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{path="a\\"b",le="1"} 3' in lines
+    assert 'test_seconds_bucket{path="a\\"b",le="+Inf"} 4' in lines
+    assert 'test_seconds_count{path="a\\"b"} 4' in lines
+
+
+def test_auth_cache_hits_and_expiry():
+    token = auth.create_access_token(42)
+    hits, misses = metrics.AUTH_CACHE.value('hit'), metrics.AUTH_CACHE.value('miss')
+    assert auth.decode_token(token) == 42
+    assert auth.decode_token(token) == 42
+    assert metrics.AUTH_CACHE.value('hit') == hits + 1
+    assert metrics.AUTH_CACHE.value('miss') == misses + 1
+
+    expired = jwt.encode({"user_id": 42, "exp": datetime.utcnow() - timedelta(seconds=5)},
+                         auth.SECRET_KEY, algorithm=auth.ALGORITHM)
+    auth._token_cache[expired] = (42, 0)  # a stale entry is never served
+    with pytest.raises(JWTError):
+        auth.decode_token(expired)
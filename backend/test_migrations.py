@@ -0,0 +1,124 @@
+"""
+Tests for the versioned schema migrations: new databases, databases from
+before the migrations existed, and the online-safe operations.
+"""
+import threading
+
+from sqlalchemy import create_engine, inspect, text
+
+import migrations
+from migrations.operations import Operations, index_ddl
+from models import Base
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE users (user_id INTEGER PRIMARY KEY, email VARCHAR(255) NOT NULL, password_hash VARCHAR(255), "
+    "storage_quota BIGINT, storage_used BIGINT, created_at DATETIME)",
+    "CREATE TABLE files (file_id INTEGER PRIMARY KEY, filename VARCHAR(255) NOT NULL, file_path TEXT NOT NULL, "
+    "file_size BIGINT NOT NULL, mime_type VARCHAR(100), folder_id INTEGER, owner_id INTEGER NOT NULL, "
+    "thumbnail_path TEXT, created_at DATETIME, modified_at DATETIME)",
+    "CREATE TABLE comments (comment_id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+    "comment_text TEXT NOT NULL, parent_comment_id INTEGER, created_at DATETIME)",
+    "CREATE TABLE tags (tag_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, tag_name VARCHAR(50) NOT NULL, "
+    "color VARCHAR(7), created_at DATETIME)",
+    "CREATE TABLE file_tags (file_tag_id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, tag_id INTEGER NOT NULL, "
+    "created_at DATETIME)",
+    "CREATE TABLE jobs (job_id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL, kind VARCHAR(30) NOT NULL, "
+    "status VARCHAR(20) NOT NULL, folder_id INTEGER, target_folder_id INTEGER, result_folder_id INTEGER, "
+    "params TEXT, state TEXT, total_items INTEGER, processed_items INTEGER NOT NULL DEFAULT 0, "
+    "cancel_requested BOOLEAN NOT NULL DEFAULT 0, error TEXT, created_at DATETIME, started_at DATETIME, "
+    "updated_at DATETIME, finished_at DATETIME)",
+    "CREATE INDEX ix_jobs_status ON jobs (status)",
+]
+
+
+def objects(engine):
+    with engine.connect() as conn:
+        return set(conn.execute(text(
+            "SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' AND name != 'schema_migrations'"
+        )))
+
+
+def test_new_database_gets_the_models_schema(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'new.db'}")
+    reference = create_engine(f"sqlite:///{tmp_path / 'reference.db'}")
+    Base.metadata.create_all(bind=reference)
+
+    assert migrations.upgrade(engine) == ['0001']
+    assert objects(engine) == objects(reference)
+    assert migrations.upgrade(engine) == []
+    assert [row['applied_at'] is not None for row in migrations.status(engine)] == [True]
+
+
+def test_legacy_database_is_brought_up_to_date(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        for ddl in LEGACY_SCHEMA:
+            conn.execute(text(ddl))
+        conn.execute(text("INSERT INTO users (user_id, email) VALUES (1, 'a@test.local')"))
+        conn.execute(text("INSERT INTO files (file_id, filename, file_path, file_size, owner_id) "
+                          "VALUES (1, 'a.txt', '1/a.txt', 10, 1)"))
+        conn.execute(text("INSERT INTO comments (comment_id, file_id, user_id, comment_text, parent_comment_id) "
+                          "VALUES (1, 1, 1, 'root', NULL), (2, 1, 1, 'reply', 1), (3, 1, 1, 'nested', 2), "
+                          "(4, 1, 1, 'orphan', 99)"))
+        conn.execute(text("INSERT INTO tags (tag_id, user_id, tag_name) VALUES (1, 1, 'work')"))
+        conn.execute(text("INSERT INTO file_tags (file_id, tag_id) VALUES (1, 1), (1, 1)"))
+        conn.execute(text("INSERT INTO jobs (job_id, owner_id, kind, status) "
+                          "VALUES (1, 1, 'folder_copy', 'pending'), (2, 1, 'thumbnail', 'pending')"))
+
+    migrations.upgrade(engine)
+
+    columns = {table: {c['name'] for c in inspect(engine).get_columns(table)} for table in Base.metadata.tables}
+    for table in Base.metadata.sorted_tables:
+        assert {column.name for column in table.columns} <= columns[table.name], table.name
+    indexes = {index['name'] for index in inspect(engine).get_indexes('jobs')}
+    assert {'ix_jobs_claim', 'ix_jobs_owner_created'} <= indexes and 'ix_jobs_status' not in indexes
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT comment_id, root_comment_id, parent_comment_id, path, depth "
+                                 "FROM comments ORDER BY 1")).fetchall() == [
+            (1, 1, None, '0000000001/', 0), (2, 1, 1, '0000000001/0000000002/', 1),
+            (3, 1, 2, '0000000001/0000000002/0000000003/', 2),
+            (4, 4, None, '0000000004/', 0),  # its parent is gone: a thread of its own
+        ]
+        assert conn.execute(text("SELECT COUNT(*) FROM file_tags")).scalar() == 1
+        assert conn.execute(text("SELECT file_count FROM tags")).scalar() == 1
+        assert conn.execute(text("SELECT physical_size FROM files")).scalar() == 10
+        assert conn.execute(text("SELECT kind, queue FROM jobs ORDER BY 1")).fetchall() == [
+            ('folder_copy', 'folders'), ('thumbnail', 'default'),
+        ]
+
+
+def test_backfill_runs_in_resumable_batches(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'backfill.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE items (item_id INTEGER PRIMARY KEY, size INTEGER, stored INTEGER)"))
+        conn.execute(text("INSERT INTO items (item_id, size) VALUES " + ', '.join(f'({n}, {n * 10})' for n in range(1, 11))))
+        conn.execute(text("UPDATE items SET stored = -1 WHERE item_id = 4"))  # done by an interrupted run
+    op = Operations(engine)
+
+    assert [len(keys) for keys in op.batches('items', 'item_id', 'stored IS NULL', batch_size=4)] == [4, 4, 1]
+    assert op.backfill('items', 'item_id', 'stored = size', 'stored IS NULL', batch_size=4) == 9
+    assert op.backfill('items', 'item_id', 'stored = size', 'stored IS NULL', batch_size=4) == 0
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT stored FROM items WHERE item_id IN (4, 5) ORDER BY item_id")).fetchall() == [(-1,), (50,)]
+
+
+def test_concurrent_runners_apply_each_migration_once(tmp_path):
+    path = tmp_path / 'shared.db'
+    results = []
+
+    def run():
+        results.append(migrations.upgrade(create_engine(f"sqlite:///{path}")))
+
+    runners = [threading.Thread(target=run) for _ in range(3)]
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join()
+    assert sorted(results) == [[], [], ['0001']]
+
+
+def test_index_builds_are_online_on_postgres():
+    assert index_ddl('postgresql', 'ix_a', 'files', ['owner_id', 'file_id']) == \
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_a ON files (owner_id, file_id)"
+    assert index_ddl('sqlite', 'uq_b', 'tags', ['user_id'], unique=True, where='user_id > 0') == \
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_b ON tags (user_id) WHERE user_id > 0"
@@ -0,0 +1,93 @@
+"""
+Tests for live profiling: the stack sampler, its admin endpoint and the
+event loop stall monitor.
+"""
+import asyncio
+import hashlib
+import threading
+import time
+
+import pytest
+
+import profiler
+
+
+def busy_hashing(stop):
+    while not stop.is_set():
+        hashlib.sha256(b'x' * 65536).digest()
+
+
+@pytest.fixture
+def busy_thread():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_hashing, args=(stop,), name='busy worker')
+    thread.start()
+    yield thread
+    stop.set()
+    thread.join()
+
+
+def test_sampler_finds_the_busy_thread_and_skips_idle_ones(busy_thread):
+    idle = threading.Event()
+    sleeper = threading.Thread(target=idle.wait, name='sleeper')
+    sleeper.start()
+    try:
+        profile = profiler.sample(0.3, interval=0.002)
+    finally:
+        idle.set()
+        sleeper.join()
+
+    assert profile.samples > 20
+    folded = profile.folded().splitlines()
+    busy = [line for line in folded if line.startswith('busy_worker;')]
+    assert busy and all('test_profiler:busy_hashing' in line for line in busy)
+    assert not any(line.startswith('sleeper;') for line in folded)
+    stack, count = folded[0].rsplit(' ', 1)
+    assert int(count) > 0 and ';' in stack
+
+    top = profile.top_functions()
+    assert any(f['function'] == 'test_profiler:busy_hashing' and f['total'] > 0 for f in top)
+
+
+def test_profile_endpoint(client, admin, busy_thread):
+    folded = client.get("/api/admin/profile?seconds=0.2&interval_ms=2")
+    assert folded.status_code == 200 and folded.headers["content-type"].startswith("text/plain")
+    assert "test_profiler:busy_hashing" in folded.text
+
+    summary = client.get("/api/admin/profile?seconds=0.2&format=json").json()
+    assert summary["samples"] > 0 and summary["functions"]
+
+    assert client.get("/api/admin/profile?seconds=0").status_code == 400
+    assert client.get("/api/admin/profile?seconds=0.1&format=svg").status_code == 400
+    with profiler._lock:
+        assert client.get("/api/admin/profile?seconds=0.1").status_code == 409
+
+
+def test_profile_endpoint_is_admin_only(client):
+    assert client.get("/api/admin/profile?seconds=0.1").status_code == 403
+    assert client.get("/api/admin/loop-stalls").status_code == 403
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+def test_loop_monitor_logs_the_blocking_stack(caplog):
+    async def scenario():
+        monitor = profiler.LoopMonitor(threshold_ms=50)
+        monitor.start()
+        await asyncio.sleep(0.1)
+        blocking_call()
+        await asyncio.sleep(0.15)
+        await monitor.stop()
+        return monitor
+
+    stalls_before = profiler.LOOP_STALLS.value()
+    monitor = asyncio.run(scenario())
+
+    assert len(monitor.stalls) == 1
+    stall = monitor.recent_stalls()[0]
+    assert any('blocking_call' in line for line in stall["stack"])
+    assert stall["duration_ms"] >= 200
+    assert profiler.LOOP_STALLS.value() == stalls_before + 1
+    assert any('Event loop blocked' in r.getMessage() and 'blocking_call' in r.getMessage() for r in caplog.records)
@@ -0,0 +1,145 @@
+"""
+Tests for the per-user listing cache: hits skip the database, ETags give
+304s, and any committed change to the user's data is visible at once.
+"""
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+import metrics
+from auth import create_access_token
+from config import Config
+from main import app
+from models import File, User, engine
+from responsecache import Entry, ResponseCache, cache_enabled, get_response_cache, invalidate_user
+from shared_state import LocalState, SQLiteState, set_shared_state
+
+
+@pytest.fixture
+def api(user, tmp_path, monkeypatch):
+    """A client sending a real token, so the cache sees who is asking"""
+    get_response_cache().clear()
+    monkeypatch.setattr(Config, 'SHARED_STATE', 'shm')
+    set_shared_state(SQLiteState(str(tmp_path / 'state.db')))
+    yield TestClient(app, headers={'Authorization': f'Bearer {create_access_token(user.user_id)}'})
+    set_shared_state(None)
+
+
+@pytest.fixture
+def queries():
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', count)
+
+
+def test_repeat_listing_skips_the_database(api, queries):
+    hits = metrics.RESPONSE_CACHE.value('/api/files/list', 'hit')
+    first = api.get('/api/files/list')
+    assert first.status_code == 200 and first.headers['etag']
+    assert queries
+
+    queries.clear()
+    again = api.get('/api/files/list')
+    assert again.content == first.content and again.headers['etag'] == first.headers['etag']
+    assert queries == []
+    assert metrics.RESPONSE_CACHE.value('/api/files/list', 'hit') == hits + 1
+
+    not_modified = api.get('/api/files/list', headers={'If-None-Match': first.headers['etag']})
+    assert not_modified.status_code == 304 and not_modified.content == b''
+    assert queries == []
+
+
+def test_commits_invalidate_the_users_listings(api, db, user):
+    before = api.get('/api/files/list').json()
+    tags = api.get('/api/extras/tags/list').json()
+
+    api.post('/api/folders/create', json={'folder_name': 'Reports'})
+    assert [f['folder_name'] for f in api.get('/api/files/list').json()['folders']] == ['Reports']
+    assert before['folders'] == []
+
+    tag = api.post('/api/extras/tags/create', json={'tag_name': 'urgent'}).json()['tag']
+    assert [t['tag_name'] for t in api.get('/api/extras/tags/list').json()['tags']] == ['urgent']
+    assert tags['tags'] == []
+
+    file = File(filename='a.txt', file_path='x/a.txt', file_size=3, owner_id=user.user_id)
+    db.add(file)
+    db.commit()
+    assert api.get('/api/files/list').json()['files'][0]['tags'] == []
+    api.post('/api/extras/tags/apply', json={'file_ids': [file.file_id], 'tag_ids': [tag['tag_id']]})
+    listed = api.get('/api/files/list').json()['files']
+    assert [t['tag_name'] for t in listed[0]['tags']] == ['urgent']
+
+    # Bulk writes the session hooks can't see
+    usage = api.get('/api/storage/usage').json()
+    db.query(User).filter(User.user_id == user.user_id).update({User.storage_used: 1234}, synchronize_session=False)
+    invalidate_user(db, user.user_id)
+    db.commit()
+    assert api.get('/api/storage/usage').json()['storage_used'] == 1234 != usage['storage_used']
+
+
+def test_other_workers_see_the_new_generation(api, user, tmp_path):
+    path = str(tmp_path / 'workers.db')
+    set_shared_state(SQLiteState(path))
+    first = api.get('/api/folders/list')
+    assert api.get('/api/folders/list').headers['etag'] == first.headers['etag']
+
+    misses = metrics.RESPONSE_CACHE.value('/api/folders/list', 'miss')
+    SQLiteState(path).incr(f'listing-gen:{user.user_id}')  # a commit in another worker process
+    api.get('/api/folders/list')
+    assert metrics.RESPONSE_CACHE.value('/api/folders/list', 'miss') == misses + 1
+
+
+def test_per_process_generations_keep_the_cache_off(api, user, monkeypatch, queries):
+    # Two pods with SHARED_STATE=local: a commit through A bumps A's generation only
+    pod_a, pod_b = LocalState(), LocalState()
+    pod_a.incr(f'listing-gen:{user.user_id}')
+    assert pod_b.counter(f'listing-gen:{user.user_id}') == 0  # B would keep serving its old entries
+
+    monkeypatch.setattr(Config, 'SHARED_STATE', 'local')
+    assert not cache_enabled()
+    first = api.get('/api/files/list')
+    queries.clear()
+    again = api.get('/api/files/list')
+    assert 'etag' not in first.headers and 'etag' not in again.headers
+    assert queries
+
+
+def test_unreachable_shared_state_skips_the_cache(api, queries):
+    class Down(LocalState):
+        def counter(self, key):
+            raise ConnectionError("shared state is down")
+
+    set_shared_state(Down())
+    response = api.get('/api/files/list')
+    assert response.status_code == 200 and 'etag' not in response.headers
+    assert queries
+
+
+def test_responses_are_not_shared_between_users(api, db):
+    other = User(email='other-cache@test.local', password_hash='x')
+    db.add(other)
+    db.commit()
+    api.post('/api/folders/create', json={'folder_name': 'Mine'})
+    api.get('/api/folders/list')
+
+    theirs = api.get('/api/folders/list', headers={'Authorization': f'Bearer {create_access_token(other.user_id)}'})
+    assert theirs.json() == {'folders': []}
+    assert api.get('/api/folders/list', headers={'Authorization': 'Bearer not-a-token'}).status_code == 401
+
+
+def test_lru_stays_within_its_memory_budget():
+    cache = ResponseCache(max_bytes=8 * 1024)
+    body = b'x' * 500
+    for n in range(20):
+        cache.put(('u', n), Entry(b'"e"', body, b'application/json'))
+        cache.get(('u', 0))  # kept warm
+    assert cache.size <= 8 * 1024
+    assert cache.get(('u', 0)) is not None and cache.get(('u', 1)) is None and cache.get(('u', 19)) is not None
+
+    cache.put(('u', 'huge'), Entry(b'"h"', b'x' * 4096, b'application/json'))
+    assert cache.get(('u', 'huge')) is None
@@ -0,0 +1,83 @@
+"""
+Tests for on-the-wire response compression: negotiation, the size and type
+policy, streamed downloads and the cache of compressed variants.
+"""
+import gzip
+
+import pytest
+
+import httpcompression
+import metrics
+from config import Config
+from models import Folder
+
+GZIP_ONLY = {'Accept-Encoding': 'gzip'}
+TEXT = b''.join(b'%05d,amsterdam,invoice,approved,1250.00\n' % i for i in range(5000))
+
+
+@pytest.fixture
+def folders(db, user):
+    db.add_all(Folder(folder_name=f'Project {n}', owner_id=user.user_id) for n in range(60))
+    db.commit()
+
+
+def test_listings_are_compressed_with_the_negotiated_encoding(client, folders):
+    plain = client.get('/api/files/list', headers={'Accept-Encoding': 'identity'})
+    assert 'content-encoding' not in plain.headers
+
+    compressed = client.get('/api/files/list', headers=GZIP_ONLY)
+    assert compressed.headers['content-encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['vary']
+    assert int(compressed.headers['content-length']) < len(plain.content) // 3
+    assert compressed.content == plain.content
+
+    if httpcompression.compression.zstandard is not None:
+        preferred = client.get('/api/files/list', headers={'Accept-Encoding': 'gzip, zstd'})
+        assert preferred.headers['content-encoding'] == 'zstd'
+        assert preferred.content == plain.content
+    assert client.get('/api/files/list', headers={'Accept-Encoding': 'gzip;q=0'}).headers.get('content-encoding') is None
+
+
+def test_small_bodies_and_media_are_left_alone(client, upload):
+    assert 'content-encoding' not in client.get('/api/folders/list', headers=GZIP_ONLY).headers
+
+    photo = upload('photo.jpg', b'\xff\xd8' + bytes(20000))
+    response = client.get(f"/api/files/{photo['file_id']}/download", headers=GZIP_ONLY)
+    assert 'content-encoding' not in response.headers
+    assert int(response.headers['content-length']) == 20002
+
+
+def test_downloads_stream_compressed_but_ranges_are_not(client, monkeypatch, upload):
+    monkeypatch.setattr(Config, 'COMPRESSION_ENABLED', False)  # stored as-is, so sent via sendfile
+    info = upload('export.csv', TEXT)
+    url = f"/api/files/{info['file_id']}/download"
+
+    response = client.get(url, headers=GZIP_ONLY)
+    assert response.headers['content-encoding'] == 'gzip'
+    assert 'content-length' not in response.headers and 'accept-ranges' not in response.headers
+    assert response.content == TEXT
+
+    partial = client.get(url, headers={**GZIP_ONLY, 'Range': 'bytes=100-199'})
+    assert partial.status_code == 206 and 'content-encoding' not in partial.headers
+    assert partial.content == TEXT[100:200]
+
+
+def test_repeated_bodies_reuse_their_compressed_variant(client, folders):
+    httpcompression.get_variant_cache().clear()
+    hits = metrics.COMPRESSION_VARIANT_CACHE.value('hit')
+    bodies = [client.get('/api/files/list', headers=GZIP_ONLY) for _ in range(3)]
+    assert metrics.COMPRESSION_VARIANT_CACHE.value('hit') == hits + 1
+    assert len({r.content for r in bodies}) == 1
+
+
+def test_policy():
+    def headers(**values):
+        return httpcompression.MutableHeaders(raw=[(k.replace('_', '-').encode(), v.encode()) for k, v in values.items()])
+
+    assert httpcompression.should_compress(200, headers(content_type='application/json'))
+    assert httpcompression.should_compress(200, headers(content_type='text/csv; charset=utf-8'))
+    assert not httpcompression.should_compress(200, headers(content_type='text/event-stream'))
+    assert not httpcompression.should_compress(200, headers(content_type='application/zip'))
+    assert not httpcompression.should_compress(200, headers(content_type='text/plain', content_encoding='zstd'))
+    assert not httpcompression.should_compress(304, headers(content_type='application/json'))
+    assert gzip.decompress(httpcompression.compress(TEXT, 'gzip')) == TEXT
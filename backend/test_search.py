@@ -0,0 +1,71 @@
+"""
+Tests for the search index: incremental updates on write, prefix
+matching, ranking and metadata filters.
+"""
+import json
+import uuid
+
+from models import File, Folder, Tag, FileTag, User
+
+
+def search(client, q, **params):
+    response = client.get("/api/search", params=dict(params, q=q))
+    assert response.status_code == 200, response.text
+    return [f["file_id"] for f in response.json()["files"]]
+
+
+def test_index_follows_writes(client, db, user, upload):
+    doc = upload("Quarterly report.ty", json.dumps({"body": "Revenue grew in Rotterdam"}), app_type="eutype")["file_id"]
+    photo = upload("holiday.jpg", b"not really a jpeg")["file_id"]
+
+    assert search(client, "quart") == [doc]          # prefix match on filename
+    assert search(client, "rotterd") == [doc]        # document content
+    assert search(client, "holiday") == [photo]
+
+    client.put(f"/api/files/{photo}/rename", data={"new_name": "rotterdam skyline.jpg"})
+    # Filename hits outrank content hits
+    assert search(client, "rotterdam") == [photo, doc]
+
+    client.post(f"/api/extras/comments/{doc}", json={"comment_text": "needs sign-off from finance"})
+    assert search(client, "finance") == [doc]
+
+    tag = Tag(tag_name="urgent", user_id=user.user_id)
+    db.add(tag)
+    db.flush()
+    db.add(FileTag(file_id=photo, tag_id=tag.tag_id))
+    db.commit()
+    assert search(client, "urgent") == [photo]
+
+    client.delete(f"/api/files/{photo}")
+    assert search(client, "rotterdam") == [doc]
+
+
+def test_filters(client, db, user, upload):
+    parent = Folder(folder_name="projects", owner_id=user.user_id)
+    db.add(parent)
+    db.flush()
+    child = Folder(folder_name="alpha", owner_id=user.user_id, parent_folder_id=parent.folder_id)
+    db.add(child)
+    db.commit()
+
+    nested = upload("plan alpha.txt", b"x" * 10, folder_id=child.folder_id)["file_id"]
+    top = upload("plan beta.png", b"x" * 1000)["file_id"]
+
+    assert search(client, "plan", folder_id=parent.folder_id) == [nested]
+    assert search(client, "plan", mime_type="image/") == [top]
+    assert search(client, "plan", min_size=100) == [top]
+
+    client.post(f"/api/extras/favorites/toggle/{nested}")
+    assert search(client, "plan", favorite=True) == [nested]
+
+
+def test_results_are_scoped_to_owner(client, db, user, upload):
+    mine = upload("secret plans.txt", b"x")["file_id"]
+    other = User(email=f"{uuid.uuid4().hex[:12]}@test.local", password_hash='x')
+    db.add(other)
+    db.flush()
+    db.add(File(filename="secret plans.txt", file_path=f"{other.user_id}/secret.txt", file_size=1, owner_id=other.user_id))
+    db.commit()
+
+    assert search(client, "secret") == [mine]
+    assert search(client, "***") == []
@@ -0,0 +1,99 @@
+"""
+Tests for state shared by worker processes: the cache/counter backends and
+the change broker that fans out across processes.
+"""
+import asyncio
+import multiprocessing
+import time
+
+import pytest
+
+from changefeed import RESYNC, SharedBroker
+from shared_state import LocalState, SQLiteState
+
+
+@pytest.fixture(params=['local', 'shm'])
+def state(request, tmp_path):
+    return LocalState() if request.param == 'local' else SQLiteState(str(tmp_path / 'state.db'))
+
+
+def test_values_counters_and_expiry(state):
+    assert state.get('missing') is None
+    state.set('greeting', b'hello')
+    state.set('short', b'lived', ttl=0.05)
+    assert state.get('greeting') == b'hello' and state.get('short') == b'lived'
+
+    assert state.counter('hits') == 0
+    assert [state.incr('hits', ttl=0.05) for _ in range(3)] == [1, 2, 3]
+    assert state.counter('hits') == 3 and state.counter('hits') == 3
+    assert state.incr('total', 5) == 5
+    time.sleep(0.1)
+    assert state.get('short') is None
+    assert state.counter('hits') == 0
+    assert state.incr('hits', ttl=0.05) == 1  # a new window
+    assert state.incr('total', 5) == 10
+
+    state.delete('greeting')
+    assert state.get('greeting') is None
+
+
+def count_hits(path, n):
+    state = SQLiteState(path)
+    for _ in range(n):
+        state.incr('hits')
+
+
+# Spawned, not forked: threads other tests leave running could hold locks at fork time
+spawn = multiprocessing.get_context('spawn')
+
+
+def test_sqlite_state_is_shared_by_worker_processes(tmp_path):
+    state = SQLiteState(str(tmp_path / 'state.db'))
+    state.incr('hits')
+    workers = [spawn.Process(target=count_hits, args=(state.path, 100)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert state.incr('hits', 0) == 401
+
+
+def publish_from_another_worker(path):
+    SharedBroker(SQLiteState(path)).publish(3, [{"type": "file.created", "id": n} for n in range(3)])
+
+
+async def drain(subscription, timeout=0.3):
+    events = []
+    while True:
+        item = await subscription.get(timeout)
+        if item is None:
+            return events
+        events.append(item)
+
+
+def test_shared_broker_delivers_and_replays_across_workers(tmp_path):
+    path = str(tmp_path / 'state.db')
+
+    async def scenario():
+        broker = SharedBroker(SQLiteState(path))
+        subscription = broker.subscribe(3)
+        other = broker.subscribe(4)
+        worker = spawn.Process(target=publish_from_another_worker, args=(path,))
+        worker.start()
+        worker.join()
+        delivered = await drain(subscription)
+        assert await drain(other, 0.1) == []
+        subscription.close()
+        other.close()
+
+        # A client reconnecting to yet another worker resumes from its last event id
+        elsewhere = SharedBroker(SQLiteState(path))
+        resumed = await drain(elsewhere.subscribe(3, after=delivered[0]["seq"]))
+        foreign = await drain(elsewhere.subscribe(3, after="deadbeef-1"), 0.1)
+        return delivered, resumed, foreign
+
+    delivered, resumed, foreign = asyncio.run(scenario())
+    assert [e["id"] for e in delivered] == [0, 1, 2]
+    assert len({e["seq"] for e in delivered}) == 3
+    assert [e["id"] for e in resumed] == [1, 2]
+    assert foreign == [RESYNC]
@@ -0,0 +1,78 @@
+"""
+Tests for the opt-in SQL profiler: per-route aggregates, debug headers,
+the slow query log and the admin dump.
+"""
+import logging
+
+import pytest
+
+import sqlprofile
+from config import Config
+
+
+@pytest.fixture
+def profiling(monkeypatch):
+    monkeypatch.setattr(Config, 'SQL_PROFILING', True)
+    monkeypatch.setattr(Config, 'DEBUG', True)
+    sqlprofile.install()
+    sqlprofile.reset()
+    yield
+    sqlprofile.reset()
+
+
+def test_queries_are_attributed_to_routes(client, profiling, admin):
+    for name in ("a.txt", "b.txt"):
+        client.post("/api/files/upload", files={"file": (name, b"data")})
+    for _ in range(2):
+        response = client.get("/api/files/list")
+        assert int(response.headers["X-Query-Count"]) >= 2
+        assert response.headers["Server-Timing"].startswith("db;dur=")
+
+    routes = client.get("/api/admin/sql-profile").json()["routes"]
+    listing = next(r for r in routes if r["route"] == "/api/files/list")
+    assert listing["method"] == "GET" and listing["requests"] == 2
+    assert listing["queries"] == 2 * listing["queries_per_request"]
+    assert any("FROM files" in s["sql"] and s["per_request"] >= 1 for s in listing["statements"])
+    assert any(r["route"] == "/api/files/upload" for r in routes)
+
+    assert client.delete("/api/admin/sql-profile").status_code == 200
+    routes = client.get("/api/admin/sql-profile").json()["routes"]
+    assert [r["route"] for r in routes] == ["/api/admin/sql-profile"]  # just the reset itself
+
+
+def test_slow_queries_are_logged_with_shapes_and_plans(client, profiling, monkeypatch, caplog):
+    file_id = client.post("/api/files/upload", files={"file": ("secret-name.txt", b"data")}).json()["file"]["file_id"]
+    monkeypatch.setattr(Config, 'SLOW_QUERY_MS', 0)
+    with caplog.at_level(logging.WARNING, logger='sql.slow'):
+        client.get(f"/api/files/{file_id}")
+
+    messages = [r.getMessage() for r in caplog.records if r.name == 'sql.slow']
+    lookup = next(m for m in messages if "FROM files" in m)
+    assert f"during GET /api/files/{file_id}" in lookup
+    assert "parameters: (int" in lookup
+    assert "plan:" in lookup and ("SEARCH" in lookup or "SCAN" in lookup)
+
+
+def test_profiling_off_adds_nothing(client, monkeypatch, admin):
+    monkeypatch.setattr(Config, 'SQL_PROFILING', False)
+    monkeypatch.setattr(Config, 'DEBUG', True)
+    response = client.get("/api/files/list")
+    assert "X-Query-Count" not in response.headers
+    assert client.get("/api/admin/sql-profile").status_code == 409
+
+
+def test_admin_only(client, profiling):
+    assert client.get("/api/admin/sql-profile").status_code == 403
+    assert client.delete("/api/admin/sql-profile").status_code == 403
+
+
+def test_fingerprints_and_parameter_shapes():
+    assert sqlprofile.fingerprint("SELECT *\n  FROM files WHERE file_id IN (?, ?, ?)") == \
+        sqlprofile.fingerprint("SELECT * FROM files WHERE file_id IN (?,?)") == \
+        "SELECT * FROM files WHERE file_id IN (?, ...)"
+    assert sqlprofile.fingerprint("SELECT * FROM t WHERE a IN (%(a_1)s, %(a_2)s)") == "SELECT * FROM t WHERE a IN (?, ...)"
+
+    shape = sqlprofile.parameter_shape((7, "hunter2", None, b"\x00\x01"))
+    assert shape == "(int, str[7], NULL, bytes[2])"
+    assert sqlprofile.parameter_shape({"email": "a@b.c"}) == "{email: str[5]}"
+    assert sqlprofile.parameter_shape([(1, "x"), (2, "y")], executemany=True) == "2 x (int, str[1])"
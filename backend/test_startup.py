@@ -0,0 +1,85 @@
+"""
+Cold start budget: how long a new API process takes from interpreter start
+until it can serve, and what it imports on the way. Each measurement runs
+in a fresh interpreter under `python -X importtime`, so modules this test
+session already imported don't hide their cost; over budget, the failure
+lists the slowest imports.
+
+STARTUP_BUDGET_SECONDS overrides the budget on slow machines.
+"""
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_BUDGET_SECONDS = float(os.environ.get('STARTUP_BUDGET_SECONDS', '1.5'))
+ATTEMPTS = 3  # a busy machine gets a second chance, a slow import doesn't
+
+# Only the code paths that need them import these
+LAZY_MODULES = ('PIL', 'boto3', 'botocore')
+
+BOOT = """
+import time
+started = time.perf_counter()
+import asyncio, json, sys
+import main
+imported = time.perf_counter()
+
+async def boot():
+    async with main.lifespan(main.app):
+        return time.perf_counter()
+
+ready = asyncio.run(boot())
+with open(sys.argv[1], 'w') as f:
+    json.dump({'import': imported - started, 'ready': ready - started,
+               'loaded': [m for m in sys.argv[2:] if m in sys.modules]}, f)
+"""
+
+
+def import_report(stderr: str, top: int = 15) -> str:
+    """The slowest imports by cumulative time, from -X importtime output"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.strip()))
+    rows.sort(reverse=True)
+    return '\n'.join(f"{us / 1000:9.1f} ms  {name}" for us, name in rows[:top])
+
+
+def test_api_starts_within_budget(tmp_path):
+    env = {
+        **os.environ, 'DATABASE_URL': f"sqlite:///{tmp_path / 'startup.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'), 'THUMBNAIL_FOLDER': str(tmp_path / 'thumbnails'),
+        'SCHEMA_AUTO_CREATE': 'false', 'JOB_RUNNER_IN_PROCESS': 'false',
+    }
+    # The explicit schema step, as a deploy runs it before starting replicas
+    subprocess.run([sys.executable, 'schema.py'], cwd=BACKEND_DIR, env=env, check=True, capture_output=True)
+
+    result_path = tmp_path / 'startup.json'
+    for _ in range(ATTEMPTS):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', BOOT, str(result_path), *LAZY_MODULES],
+                                 cwd=BACKEND_DIR, env=env, capture_output=True, text=True, timeout=60)
+        assert process.returncode == 0, process.stderr[-2000:]
+        timings = json.loads(result_path.read_text())
+        if timings['ready'] <= STARTUP_BUDGET_SECONDS:
+            break
+
+    assert timings['loaded'] == [], f"imported at startup: {timings['loaded']}"
+    assert timings['ready'] <= STARTUP_BUDGET_SECONDS, (
+        f"ready after {timings['ready']:.2f}s (imports {timings['import']:.2f}s), "
+        f"budget {STARTUP_BUDGET_SECONDS:.2f}s; slowest imports:\n{import_report(process.stderr)}"
+    )
+
+
+def test_schema_is_left_alone_when_not_auto_created(tmp_path):
+    env = {
+        **os.environ, 'DATABASE_URL': f"sqlite:///{tmp_path / 'empty.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'), 'THUMBNAIL_FOLDER': str(tmp_path / 'thumbnails'),
+        'SCHEMA_AUTO_CREATE': 'false', 'JOB_RUNNER_IN_PROCESS': 'false',
+    }
+    script = "import asyncio, main\nasync def boot():\n    async with main.lifespan(main.app): pass\nasyncio.run(boot())"
+    subprocess.run([sys.executable, '-c', script], cwd=BACKEND_DIR, env=env, check=True, capture_output=True)
+    assert not (tmp_path / 'empty.db').exists() or (tmp_path / 'empty.db').stat().st_size == 0
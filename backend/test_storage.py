@@ -0,0 +1,138 @@
+"""
+Contract tests run against every storage driver (local, sharded and S3 via
+moto), plus sharding placement and ranged downloads through the API.
+"""
+import os
+
+import pytest
+
+import compression
+from storage import LocalDriver, ShardedDriver, S3Driver, reset_storage
+
+DATA = bytes(range(256)) * 400
+
+
+@pytest.fixture
+def s3_driver():
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='test-bucket')
+        yield S3Driver('test-bucket', prefix='uploads/', client=client)
+
+
+@pytest.fixture(params=['local', 'sharded', 's3'])
+def driver(request, tmp_path):
+    if request.param == 'local':
+        return LocalDriver(str(tmp_path / 'uploads'))
+    if request.param == 'sharded':
+        return ShardedDriver([LocalDriver(str(tmp_path / f'vol{i}')) for i in range(3)])
+    return request.getfixturevalue('s3_driver')
+
+
+def test_stream_write_read_stat_delete(driver):
+    with driver.open_write('7/blob.bin') as blob:
+        for start in range(0, len(DATA), 10000):
+            blob.write(DATA[start:start + 10000])
+    assert blob.size == blob.stored_size == len(DATA)
+
+    assert driver.stat('7/blob.bin').size == len(DATA)
+    assert b''.join(driver.iter_raw('7/blob.bin')) == DATA
+    assert driver.read_content('7/blob.bin', limit=300) == DATA[:300]
+
+    driver.delete('7/blob.bin')
+    assert driver.stat('7/blob.bin') is None
+    with pytest.raises(FileNotFoundError):
+        driver.open_read('7/blob.bin')
+    driver.delete('7/blob.bin')  # deleting twice is fine
+
+
+def test_ranged_read(driver):
+    driver.write_bytes('7/blob.bin', DATA)
+    assert b''.join(driver.read_range('7/blob.bin', 1000, 5000, chunk_size=777)) == DATA[1000:6000]
+    assert b''.join(driver.read_range('7/blob.bin', len(DATA) - 10, 10)) == DATA[-10:]
+
+
+def test_aborted_write_leaves_nothing(driver):
+    driver.write_bytes('7/blob.bin', b'old')
+    with pytest.raises(RuntimeError):
+        with driver.open_write('7/blob.bin') as blob:
+            blob.write(b'half of the new')
+            raise RuntimeError("client went away")
+    assert driver.read_content('7/blob.bin') == b'old'
+
+
+def test_compressed_round_trip_and_copy(driver):
+    pytest.importorskip('zstandard')
+    text = b'the same line of a log file\n' * 5000
+    blob = driver.write_bytes('7/app.log', text, compression.ZSTD)
+    assert blob.encoding == compression.ZSTD and blob.stored_size < len(text) // 10
+
+    driver.copy('7/app.log', '7/copy.log')
+    assert driver.stat('7/copy.log').size == blob.stored_size
+    assert driver.read_content('7/copy.log', blob.encoding) == text
+    with driver.open_seekable('7/app.log') as stream:
+        stream.seek(4)
+        assert stream.read(4) == b''.join(driver.iter_raw('7/app.log'))[4:8]
+
+
+def test_keys_cannot_escape_the_store(driver):
+    with pytest.raises(ValueError):
+        driver.write_bytes('../outside', b'x')
+
+
+def test_presign(driver):
+    if isinstance(driver, S3Driver):
+        driver.write_bytes('7/blob.bin', DATA)
+        url = driver.presign('7/blob.bin', expires=60, filename='report.pdf')
+        assert 'uploads/7/blob.bin' in url and 'Signature' in url
+    else:
+        assert driver.presign('7/blob.bin') is None
+
+
+def test_sharding_spreads_users_and_survives_new_volumes(tmp_path):
+    volumes = [LocalDriver(str(tmp_path / f'vol{i}')) for i in range(3)]
+    driver = ShardedDriver(volumes)
+    for user_id in range(60):
+        driver.write_bytes(f'{user_id}/doc.ty', b'doc')
+        driver.write_bytes(f'{user_id}/.versions/1/v1.full', b'old doc')
+
+    per_volume = [sum(len(files) for _, _, files in os.walk(v.root)) for v in volumes]
+    assert all(count >= 20 for count in per_volume), per_volume  # ~40 each, one user's blobs stay together
+    assert all(count % 2 == 0 for count in per_volume)
+
+    grown = ShardedDriver(volumes + [LocalDriver(str(tmp_path / 'vol3'))])
+    moved = [u for u in range(60) if grown.preferred_volume(f'{u}/x') is not driver.preferred_volume(f'{u}/x')]
+    assert 0 < len(moved) < 30
+    assert all(grown.preferred_volume(f'{u}/x').root.endswith('vol3') for u in moved)
+    for user_id in range(60):
+        assert grown.read_content(f'{user_id}/doc.ty') == b'doc'
+        grown.write_bytes(f'{user_id}/doc.ty', b'doc v2')  # overwrites stay where the blob lives
+    assert not os.path.exists(tmp_path / 'vol3' / str(moved[0]) / 'doc.ty')
+
+
+def test_download_honors_range(client):
+    file_id = client.post("/api/files/upload", files={"file": ("video.mp4", DATA)}).json()["file"]["file_id"]
+
+    response = client.get(f"/api/files/{file_id}/download", headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-199/{len(DATA)}"
+    assert response.content == DATA[100:200]
+
+    assert client.get(f"/api/files/{file_id}/download", headers={"Range": "bytes=-50"}).content == DATA[-50:]
+    assert client.get(f"/api/files/{file_id}/download", headers={"Range": f"bytes={len(DATA)}-"}).status_code == 416
+    assert client.get(f"/api/files/{file_id}/download").content == DATA
+
+
+def test_s3_backed_api_redirects_downloads(client, s3_driver):
+    reset_storage(uploads=s3_driver)
+    try:
+        file_id = client.post("/api/files/upload", files={"file": ("notes.txt", "stored in a bucket")}).json()["file"]["file_id"]
+        assert client.get(f"/api/files/{file_id}/content").json()["content"] == "stored in a bucket"
+
+        response = client.get(f"/api/files/{file_id}/download", follow_redirects=False)
+        assert response.status_code == 307
+        assert 'Signature' in response.headers["location"]
+    finally:
+        reset_storage()
@@ -0,0 +1,87 @@
+"""
+Tests for the directory-sharded key layout and the online migration that
+moves legacy blobs into it.
+"""
+import os
+
+from models import File
+from storage import get_storage, get_thumbnail_storage, is_sharded_key
+import migrate_storage_layout
+from migrate_storage_layout import migrate_storage_layout as run_migration, save_state
+
+
+def legacy_file(db, user, key, content, thumbnail=None):
+    get_storage().write_bytes(key, content)
+    if thumbnail:
+        get_thumbnail_storage().write_bytes(thumbnail, b'thumb')
+    file = File(filename=os.path.basename(key).split('_')[-1], file_path=key, file_size=len(content),
+                owner_id=user.user_id, thumbnail_path=thumbnail)
+    db.add(file)
+    db.commit()
+    return file.file_id
+
+
+def test_uploads_and_copies_use_the_sharded_layout(client, db):
+    info = client.post("/api/files/upload", files={"file": ("notes.txt", "hello")}).json()["file"]
+    copy = client.post(f"/api/files/{info['file_id']}/copy").json()["file"]
+
+    for file_id in (info["file_id"], copy["file_id"]):
+        key = db.query(File).get(file_id).file_path
+        assert is_sharded_key(key), key
+        assert key.startswith(f"{info['owner_id']}/")
+    assert client.get(f"/api/files/{copy['file_id']}/content").json()["content"] == "hello"
+
+
+def test_migration_moves_legacy_blobs_and_resumes(db, user, tmp_path):
+    ids = [
+        legacy_file(db, user, f"{user.user_id}/aaaa-{i}.txt", f"flat {i}".encode(), thumbnail=f"thumb_aaaa-{i}.txt" if i == 0 else None)
+        for i in range(5)
+    ] + [legacy_file(db, user, f"bbbb-{i}_old copy.txt", f"root copy {i}".encode()) for i in range(2)]
+    state = str(tmp_path / 'state.json')
+    save_state(state, {'last_file_id': ids[0] - 1})  # other tests' files share the database
+
+    first = run_migration(batch_size=2, grace_seconds=0, state_path=state, max_batches=1)
+    assert first['migrated'] >= 1
+    second = run_migration(batch_size=2, grace_seconds=0, state_path=state)
+    assert first['migrated'] + second['migrated'] >= len(ids)
+
+    db.expire_all()
+    for i, file_id in enumerate(ids):
+        file = db.query(File).get(file_id)
+        assert is_sharded_key(file.file_path)
+        expected = f"flat {i}" if i < 5 else f"root copy {i - 5}"
+        assert get_storage().read_content(file.file_path) == expected.encode()
+    assert not get_storage().exists(f"{user.user_id}/aaaa-0.txt")
+    thumb = db.query(File).get(ids[0]).thumbnail_path
+    assert thumb.endswith('.txt') and '/thumb_' in thumb
+    assert get_thumbnail_storage().read_content(thumb) == b'thumb'
+
+    # Running again is a no-op
+    save_state(state, {'last_file_id': ids[0] - 1})
+    again = run_migration(batch_size=10, grace_seconds=0, state_path=state)
+    assert again['migrated'] == 0 and again['conflict'] == 0
+
+
+def test_concurrent_save_wins_over_the_move(db, user, monkeypatch, tmp_path):
+    file_id = legacy_file(db, user, f"{user.user_id}/cccc.txt", b"before")
+    real_place = migrate_storage_layout.place
+    saves = []
+
+    def place_then_save(driver, old_key, new_key):
+        real_place(driver, old_key, new_key)
+        if old_key == f"{user.user_id}/cccc.txt" and not saves:  # a save lands between the copy and the UPDATE
+            saves.append(1)
+            get_storage().write_bytes(old_key, b"after")
+            db.query(File).filter_by(file_id=file_id).update({File.content_version: File.content_version + 1})
+            db.commit()
+
+    monkeypatch.setattr(migrate_storage_layout, 'place', place_then_save)
+    state = str(tmp_path / 'state.json')
+    save_state(state, {'last_file_id': file_id - 1})
+    summary = run_migration(batch_size=10, grace_seconds=0, state_path=state)
+    assert summary['conflict'] == 0 and saves
+
+    db.expire_all()
+    file = db.query(File).get(file_id)
+    assert is_sharded_key(file.file_path)
+    assert get_storage().read_content(file.file_path) == b"after"
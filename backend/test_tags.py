@@ -0,0 +1,84 @@
+"""
+Tests for tagging: uniqueness, incremental per-tag counts, AND/OR
+files-by-tag queries and batched tag loading in listings.
+"""
+from sqlalchemy import event
+
+from models import File, engine
+
+
+def make_files(db, user, *names):
+    files = [File(filename=n, file_path=f'{user.user_id}/{n}', file_size=1, owner_id=user.user_id) for n in names]
+    db.add_all(files)
+    db.commit()
+    return [f.file_id for f in files]
+
+
+def create_tag(client, name):
+    response = client.post("/api/extras/tags/create", json={"tag_name": name})
+    assert response.status_code == 201, response.text
+    return response.json()["tag"]["tag_id"]
+
+
+def tag_counts(client):
+    return {t["tag_name"]: t["file_count"] for t in client.get("/api/extras/tags/list").json()["tags"]}
+
+
+def test_tag_lifecycle_and_counts(client, db, user):
+    a, b = make_files(db, user, "a.txt", "b.txt")
+    work = create_tag(client, "work")
+    assert client.post("/api/extras/tags/create", json={"tag_name": "work"}).status_code == 400
+
+    assert client.post(f"/api/extras/tags/add/{a}/{work}").status_code == 200
+    assert client.post(f"/api/extras/tags/add/{a}/{work}").status_code == 400
+    assert client.post("/api/extras/tags/apply", json={"file_ids": [a, b], "tag_ids": [work]}).json()["added"] == 1
+    assert tag_counts(client) == {"work": 2}
+
+    client.delete(f"/api/extras/tags/remove/{a}/{work}")
+    assert tag_counts(client) == {"work": 1}
+
+    client.delete(f"/api/files/{b}")
+    client.delete(f"/api/trash/permanent/{b}")
+    assert tag_counts(client) == {"work": 0}
+
+
+def test_files_by_tags_and_or(client, db, user):
+    a, b, c = make_files(db, user, "a.txt", "b.txt", "c.txt")
+    red, blue = create_tag(client, "red"), create_tag(client, "blue")
+    client.post("/api/extras/tags/apply", json={"file_ids": [a, b], "tag_ids": [red]})
+    client.post("/api/extras/tags/apply", json={"file_ids": [b, c], "tag_ids": [blue]})
+
+    def files(mode):
+        response = client.get("/api/extras/tags/files", params={"tag_ids": [red, blue], "mode": mode})
+        return [f["file_id"] for f in response.json()["files"]]
+
+    assert files("all") == [b]
+    assert files("any") == [a, b, c]
+
+
+def test_files_by_tags_rejects_unknown_tags(client, db, user):
+    a, = make_files(db, user, "a.txt")
+    mine = create_tag(client, "mine")
+    client.post("/api/extras/tags/apply", json={"file_ids": [a], "tag_ids": [mine]})
+
+    for mode in ("all", "any"):
+        response = client.get("/api/extras/tags/files", params={"tag_ids": [mine, 999999], "mode": mode})
+        assert response.status_code == 404
+    assert client.get("/api/extras/tags/files", params={"tag_ids": [mine, mine]}).json()["files"][0]["file_id"] == a
+
+
+def test_listing_loads_tags_in_one_query(client, db, user):
+    ids = make_files(db, user, *[f"f{i}.txt" for i in range(10)])
+    tag = create_tag(client, "batch")
+    client.post("/api/extras/tags/apply", json={"file_ids": ids, "tag_ids": [tag]})
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        listing = client.get("/api/files/list").json()
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+
+    assert all(f["tags"][0]["tag_name"] == "batch" for f in listing["files"])
+    assert len([s for s in statements if "file_tags" in s]) == 1
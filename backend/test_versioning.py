@@ -0,0 +1,142 @@
+"""
+Tests for file version history: delta encoding, snapshot chains, retention
+and the version endpoints.
+"""
+import io
+import random
+from datetime import datetime, timedelta
+
+from config import Config
+from deltas import apply_delta, block_signatures, compute_delta, signature_index
+from models import File, FileVersion
+from storage import get_storage
+from versioning import apply_retention
+
+
+def make_delta(base, target, block_size=512):
+    index = signature_index(block_signatures(io.BytesIO(base), block_size), block_size)
+    return compute_delta(index, block_size, target)
+
+
+def document(seed, size=64 * 1024):
+    rng = random.Random(seed)
+    return ''.join(rng.choice('abcdefghij \n') for _ in range(size))
+
+
+def test_delta_round_trip_with_insertions_and_deletions():
+    rng = random.Random(1)
+    base = bytes(rng.getrandbits(8) for _ in range(20000))
+    target = base[:3000] + b'inserted text' + base[3000:9000] + base[12000:] + b'tail'
+
+    delta = make_delta(base, target)
+    assert len(delta) < len(target) // 4
+    assert b''.join(apply_delta(io.BytesIO(base), delta)) == target
+
+
+def test_delta_gives_up_when_mostly_literal():
+    base = b'a' * 4096
+    target = bytes(range(256)) * 16
+    index = signature_index(block_signatures(io.BytesIO(base), 512), 512)
+    assert compute_delta(index, 512, target, max_literal_bytes=len(target) // 2) is None
+
+
+def test_saves_build_delta_history_and_download_any_version(client, db, every_save_versions):
+    contents = [document(0)]
+    for i in range(1, 6):
+        previous = contents[-1]
+        cut = 5000 * i
+        contents.append(previous[:cut] + f'edit {i}' + previous[cut + 10:])
+
+    file_id = client.post("/api/files/upload", files={"file": ("doc.ty", contents[0])}).json()["file"]["file_id"]
+    for text in contents[1:]:
+        assert client.put(f"/api/files/{file_id}/content", data={"content": text}).status_code == 200
+
+    history = client.get(f"/api/files/{file_id}/versions").json()
+    assert [v["version_number"] for v in history["versions"]] == [5, 4, 3, 2, 1]
+    assert [v["storage_kind"] for v in history["versions"]][-1] == 'full'
+    assert all(v["storage_kind"] == 'delta' for v in history["versions"][:-1])
+    assert history["stored_bytes"] < history["logical_bytes"] // 3
+
+    # Every delta points straight at a snapshot: one application at most
+    for version in db.query(FileVersion).filter_by(file_id=file_id, storage_kind='delta'):
+        assert db.query(FileVersion).get(version.base_version_id).storage_kind == 'full'
+
+    for number, expected in enumerate(contents[:-1], start=1):
+        response = client.get(f"/api/files/{file_id}/versions/{number}/download")
+        assert response.status_code == 200
+        assert response.content.decode() == expected
+
+
+def test_download_of_a_version_with_a_missing_blob_is_404(client, db, every_save_versions):
+    file_id = client.post("/api/files/upload", files={"file": ("doc.ty", document(1))}).json()["file"]["file_id"]
+    for i in range(2):
+        client.put(f"/api/files/{file_id}/content", data={"content": document(1)[:1000] + f'edit {i}' + document(1)[1010:]})
+    snapshot = db.query(FileVersion).filter_by(file_id=file_id, storage_kind='full').one()
+    get_storage().delete(snapshot.file_path)
+
+    # Both the snapshot and the delta built on it are unreadable: 404 before any body is sent
+    for number in (1, 2):
+        assert client.get(f"/api/files/{file_id}/versions/{number}/download").status_code == 404
+
+
+def test_autosaves_within_interval_are_coalesced(client):
+    file_id = client.post("/api/files/upload", files={"file": ("doc.ty", "one")}).json()["file"]["file_id"]
+    for text in ("two", "three", "four"):
+        client.put(f"/api/files/{file_id}/content", data={"content": text})
+
+    versions = client.get(f"/api/files/{file_id}/versions").json()["versions"]
+    assert len(versions) == 1
+
+
+def test_restore_makes_old_content_current(client, every_save_versions):
+    file_id = client.post("/api/files/upload", files={"file": ("doc.ty", "first draft")}).json()["file"]["file_id"]
+    client.put(f"/api/files/{file_id}/content", data={"content": "second draft"})
+
+    response = client.post(f"/api/files/{file_id}/versions/1/restore")
+    assert response.status_code == 200, response.text
+    assert response.json()["file"]["version"] == 3
+
+    assert client.get(f"/api/files/{file_id}/content").json()["content"] == "first draft"
+    numbers = [v["version_number"] for v in client.get(f"/api/files/{file_id}/versions").json()["versions"]]
+    assert numbers == [2, 1]
+    assert client.get(f"/api/files/{file_id}/versions/2/download").content == b"second draft"
+
+
+def test_restore_with_a_stale_etag_is_rejected(client, every_save_versions):
+    file_id = client.post("/api/files/upload", files={"file": ("doc.ty", "first draft")}).json()["file"]["file_id"]
+    stale = client.get(f"/api/files/{file_id}/content").headers["ETag"]
+    client.put(f"/api/files/{file_id}/content", data={"content": "second draft"})
+
+    response = client.post(f"/api/files/{file_id}/versions/1/restore", headers={"If-Match": stale})
+    assert response.status_code == 412
+    assert client.get(f"/api/files/{file_id}/content").json()["content"] == "second draft"
+
+    current = client.get(f"/api/files/{file_id}/content").headers["ETag"]
+    assert client.post(f"/api/files/{file_id}/versions/1/restore", headers={"If-Match": current}).status_code == 200
+
+
+def test_retention_thins_old_versions_but_keeps_needed_snapshots(db, user, monkeypatch):
+    monkeypatch.setattr(Config, 'VERSION_KEEP_LAST', 2)
+    monkeypatch.setattr(Config, 'VERSION_MAX_AGE_DAYS', 30)
+    file = File(owner_id=user.user_id, filename='r.ty', file_path='x', file_size=1)
+    db.add(file)
+    db.flush()
+
+    now = datetime.utcnow()
+    snapshot = FileVersion(file_id=file.file_id, version_number=1, file_path='v1', file_size=1,
+                           storage_kind='full', created_at=now - timedelta(days=40))
+    db.add(snapshot)
+    db.flush()
+    ages = {2: 40, 3: 5, 4: 5, 5: 0, 6: 0}
+    for number, days in ages.items():
+        db.add(FileVersion(file_id=file.file_id, version_number=number, file_path=f'v{number}', file_size=1,
+                           storage_kind='delta', base_version_id=snapshot.version_id,
+                           created_at=now - timedelta(days=days, minutes=number)))
+    db.flush()
+
+    pruned = apply_retention(db, file.file_id, now)
+    db.flush()
+    assert sorted(pruned) == [2, 3]
+    remaining = sorted(v.version_number for v in db.query(FileVersion).filter_by(file_id=file.file_id))
+    assert remaining == [1, 4, 5, 6]
+    db.rollback()
@@ -0,0 +1,222 @@
+"""
+File version history with delta storage.
+
+Before a file's content is overwritten, its current bytes become the newest
+FileVersion. Versions are stored either as a full snapshot or as a
+zlib-compressed rsync-style delta against the file's latest snapshot; a new
+snapshot is taken every Config.VERSION_SNAPSHOT_INTERVAL versions or when a
+delta would not pay off. Every version is therefore at most one delta
+application away from a snapshot, and reconstruction streams.
+
+Blobs live in the uploads storage next to the owner's files:
+    {owner_id}/.versions/{file_id}/v{number}.full|.delta
+except for snapshots adopted by keep_as_version(), which keep the key the
+file's content had.
+"""
+import hashlib
+import zlib
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
+
+from sqlalchemy.orm import Session
+
+from config import Config
+from models import File, FileVersion
+from storage import get_storage, delete_after_commit, discard_on_rollback
+from deltas import apply_delta, block_signatures, choose_block_size, compute_delta, signature_index
+from filecopy import is_shared, release_blob
+
+def versions_directory(file: File) -> str:
+    """Relative directory holding a file's version blobs"""
+    return f"{file.owner_id}/.versions/{file.file_id}"
+
+
+def latest_version(db: Session, file_id: int) -> Optional[FileVersion]:
+    return db.query(FileVersion).filter_by(file_id=file_id).order_by(FileVersion.version_number.desc()).first()
+
+
+def _delta_against_snapshot(db: Session, file: File, content: bytes) -> Optional[tuple]:
+    """(snapshot, compressed delta) if a delta is worthwhile, else None"""
+    snapshot = db.query(FileVersion).filter_by(
+        file_id=file.file_id, storage_kind='full'
+    ).order_by(FileVersion.version_number.desc()).first()
+    if snapshot is None:
+        return None
+
+    dependents = db.query(FileVersion).filter_by(base_version_id=snapshot.version_id).count()
+    if dependents + 1 >= Config.VERSION_SNAPSHOT_INTERVAL:
+        return None
+
+    block_size = choose_block_size(snapshot.file_size)
+    with get_storage().open_read(snapshot.file_path) as base:
+        index = signature_index(block_signatures(base, block_size), block_size)
+    delta = compute_delta(index, block_size, content, max_literal_bytes=len(content) // 2)
+    if delta is None:
+        return None
+    return snapshot, zlib.compress(delta, 6)
+
+
+def record_version(db: Session, file: File, force: bool = False) -> Optional[FileVersion]:
+    """
+    Preserve the file's current on-disk content as its newest version.
+    Call before overwriting the content; the caller commits. Unless forced,
+    saves within VERSION_MIN_INTERVAL_SECONDS of the previous version are
+    coalesced (the previous version already covers that burst of autosaves).
+    """
+    storage = get_storage()
+    if not storage.exists(file.file_path):
+        return None
+
+    latest = latest_version(db, file.file_id)
+    now = datetime.utcnow()
+    if latest and not force and now - latest.created_at < timedelta(seconds=Config.VERSION_MIN_INTERVAL_SECONDS):
+        return None
+
+    number = (latest.version_number if latest else 0) + 1
+    encoding = file.stored_encoding
+    directory = versions_directory(file)
+
+    # Versions hold logical bytes (uncompressed) so deltas can seek into them
+    delta = None
+    if file.file_size <= Config.VERSION_MAX_DELTA_SIZE:
+        content = storage.read_content(file.file_path, encoding)
+        size = len(content)
+        content_hash = hashlib.sha256(content).hexdigest()
+        delta = _delta_against_snapshot(db, file, content)
+    else:
+        content = None
+        size = 0
+        digest = hashlib.sha256()
+        for chunk in storage.iter_content(file.file_path, encoding):
+            digest.update(chunk)
+            size += len(chunk)
+        content_hash = digest.hexdigest()
+
+    if delta:
+        snapshot, payload = delta
+        relative_path = f"{directory}/v{number}.delta"
+        stored_size = storage.write_bytes(relative_path, payload).stored_size
+        base_version_id = snapshot.version_id
+        kind = 'delta'
+    else:
+        relative_path = f"{directory}/v{number}.full"
+        chunks = [content] if content is not None else storage.iter_content(file.file_path, encoding)
+        stored_size = storage.write_chunks(relative_path, chunks).stored_size
+        base_version_id = None
+        kind = 'full'
+    discard_on_rollback(db, [relative_path])
+
+    version = FileVersion(
+        file_id=file.file_id,
+        version_number=number,
+        file_path=relative_path,
+        file_size=size,
+        storage_kind=kind,
+        base_version_id=base_version_id,
+        stored_size=stored_size,
+        content_hash=content_hash,
+        created_at=now
+    )
+    db.add(version)
+    db.flush()
+    apply_retention(db, file.file_id, now)
+    return version
+
+
+def keep_as_version(db: Session, file: File, content_hash: Optional[str] = None) -> Optional[FileVersion]:
+    """
+    Preserve the file's current content for a write that puts the new
+    content under a fresh key: the old blob itself becomes the newest
+    version, without copying it (a large file then gains a version at no
+    I/O cost). Falls back to record_version() when the blob can't be
+    adopted (compressed, or shared with copies); the old blob is released
+    either way unless a version holds it. The caller then points the file
+    at its new key and commits.
+    """
+    storage = get_storage()
+    if not storage.exists(file.file_path):
+        return None
+    if file.stored_encoding != 'identity' or is_shared(db, file.file_path, file.file_id):
+        version = record_version(db, file)
+        release_blob(db, file)
+        return version
+
+    latest = latest_version(db, file.file_id)
+    now = datetime.utcnow()
+    if latest and now - latest.created_at < timedelta(seconds=Config.VERSION_MIN_INTERVAL_SECONDS):
+        release_blob(db, file)
+        return None
+
+    version = FileVersion(
+        file_id=file.file_id,
+        version_number=(latest.version_number if latest else 0) + 1,
+        file_path=file.file_path,
+        file_size=file.file_size,
+        storage_kind='full',
+        stored_size=file.physical_size if file.physical_size is not None else file.file_size,
+        content_hash=content_hash,
+        created_at=now
+    )
+    db.add(version)
+    db.flush()
+    apply_retention(db, file.file_id, now)
+    return version
+
+
+def apply_retention(db: Session, file_id: int, now: Optional[datetime] = None) -> List[int]:
+    """
+    Keep the newest VERSION_KEEP_LAST versions; thin older ones to one per
+    day and drop them past VERSION_MAX_AGE_DAYS. Snapshots that surviving
+    deltas depend on are kept. Returns the pruned version numbers.
+    """
+    now = now or datetime.utcnow()
+    versions = db.query(FileVersion).filter_by(file_id=file_id).order_by(FileVersion.version_number.desc()).all()
+    max_age = timedelta(days=Config.VERSION_MAX_AGE_DAYS)
+
+    keep, drop = [], []
+    seen_days = set()
+    for position, version in enumerate(versions):
+        if position < Config.VERSION_KEEP_LAST:
+            keep.append(version)
+        elif now - version.created_at > max_age or version.created_at.date() in seen_days:
+            drop.append(version)
+        else:
+            keep.append(version)
+        seen_days.add(version.created_at.date())
+
+    needed = {v.base_version_id for v in keep if v.base_version_id}
+    pruned = [v for v in drop if v.version_id not in needed]
+    for version in pruned:
+        db.delete(version)
+    delete_after_commit(db, [v.file_path for v in pruned])
+    return [v.version_number for v in pruned]
+
+
+def iter_version_content(db: Session, version: FileVersion) -> Iterator[bytes]:
+    """Stream a version's logical content (at most one delta application).
+    Keys are resolved and checked eagerly so the iterator can outlive the
+    session, and a missing blob raises FileNotFoundError here rather than
+    midway through a response."""
+    storage = get_storage()
+    if version.storage_kind != 'delta':
+        if not storage.exists(version.file_path):
+            raise FileNotFoundError(version.file_path)
+        return storage.iter_raw(version.file_path)
+
+    base = db.query(FileVersion).get(version.base_version_id)
+    if base is None or not storage.exists(base.file_path):
+        raise FileNotFoundError(f"base of {version.file_path}")
+    base_key = base.file_path
+    with storage.open_read(version.file_path) as f:
+        delta = zlib.decompress(f.read())
+
+    def reconstruct():
+        with storage.open_seekable(base_key) as base_file:
+            yield from apply_delta(base_file, delta)
+
+    return reconstruct()
+
+
+def delete_all_versions(db: Session, file: File):
+    """Schedule removal of every version blob of a file (rows cascade with it)"""
+    delete_after_commit(db, [v.file_path for v in file.versions])
@@ -0,0 +1,59 @@
+"""
+Out-of-process job worker: runs background jobs (see jobs.py) next to, or
+instead of, the runner inside the API processes.
+
+    python worker.py                        # every queue in JOB_QUEUES
+    python worker.py --queues media:4       # only thumbnails, 4 at a time
+
+Any number of workers can share the database; leases keep them from
+running the same batch and the queue limits apply across all of them. Set
+JOB_RUNNER_IN_PROCESS=false to keep jobs out of the API processes.
+SIGTERM/SIGINT stop claiming and let running batches commit.
+"""
+import argparse
+import asyncio
+import logging
+import signal
+import sys
+
+from config import Config
+from schema import create_schema
+import folder_jobs  # noqa: F401  (registers job handlers)
+import tasks  # noqa: F401
+import sqlprofile
+import profiler
+from jobs import queue_limits, start_runner, stop_runner
+
+logger = logging.getLogger('worker')
+
+
+async def serve(queues):
+    runner = await start_runner(queues)
+    if Config.LOOP_MONITOR_ENABLED:
+        profiler.start_loop_monitor()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+    logger.info(f"Stopping; waiting for {sum(runner.running.values())} running batches")
+    await profiler.stop_loop_monitor()
+    await stop_runner()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--queues', default=Config.JOB_QUEUES, help='queue:limit,... (default: JOB_QUEUES)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+    if Config.SQL_PROFILING:
+        sqlprofile.install()  # slow query log for job batches
+    if Config.SCHEMA_AUTO_CREATE:
+        create_schema()
+    asyncio.run(serve(queue_limits(args.queues)))
+
+
+if __name__ == '__main__':
+    main()
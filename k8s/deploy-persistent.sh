@@ -44,6 +44,7 @@ echo "⚙️  Applying Kubernetes manifests..."
 kubectl apply -f k8s/namespace.yaml
 kubectl apply -f k8s/secrets.yaml
 kubectl apply -f k8s/pvc.yaml
+kubectl apply -f k8s/redis.yaml
 
 echo "Waiting for PVs to bind..."
 sleep 5
@@ -29,6 +29,7 @@ echo "⚙️  Step 3/4: Applying Kubernetes manifests..."
 kubectl apply -f namespace.yaml
 kubectl apply -f secrets.yaml
 kubectl apply -f pvc.yaml
+kubectl apply -f redis.yaml
 sleep 5  # Wait for PVs to bind
 
 kubectl apply -f backend-deployment.yaml